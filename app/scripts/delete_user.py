@@ -3,12 +3,16 @@ import sys
 sys.path.insert(0, '/app')
 from vpn_api.database import SessionLocal
 from vpn_api.models import User
+from vpn_api import user_cache
 
 db = SessionLocal()
 user = db.query(User).filter(User.email == 'testuser@mail.com').first()
 if user:
+    email = user.email
     db.delete(user)
     db.commit()
+    # running API workers cache authenticated users; make them drop it
+    user_cache.invalidate(email, everywhere=True)
     print('User deleted')
 else:
     print('User not found')
@@ -0,0 +1,47 @@
+"""composite and partial indexes for the hot user_tariffs / vpn_peers queries
+
+Revision ID: 20261017_add_hot_query_indexes
+Revises: 20261017_add_user_active_subscription
+Create Date: 2026-10-17
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "20261017_add_hot_query_indexes"
+down_revision = "20261017_add_user_active_subscription"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_user_tariffs_user_status_ended",
+        "user_tariffs",
+        ["user_id", "status", "ended_at"],
+    )
+    op.create_index(
+        "ix_user_tariffs_active_ended",
+        "user_tariffs",
+        ["ended_at"],
+        sqlite_where=sa.text("status = 'active'"),
+        postgresql_where=sa.text("status = 'active'"),
+    )
+    # covered by the leading column of ix_user_tariffs_user_status_ended
+    op.drop_index("ix_user_tariffs_user_id", table_name="user_tariffs")
+    op.create_index(
+        "ix_vpn_peers_user_active_created",
+        "vpn_peers",
+        ["user_id", sa.text("created_at DESC")],
+        sqlite_where=sa.text("active = 1"),
+        postgresql_where=sa.text("active"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_vpn_peers_user_active_created", table_name="vpn_peers")
+    op.create_index("ix_user_tariffs_user_id", "user_tariffs", ["user_id"])
+    op.drop_index("ix_user_tariffs_active_ended", table_name="user_tariffs")
+    op.drop_index("ix_user_tariffs_user_status_ended", table_name="user_tariffs")
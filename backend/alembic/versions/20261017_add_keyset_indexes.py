@@ -0,0 +1,28 @@
+"""(created_at, id) indexes for keyset pagination of peers and payments
+
+Revision ID: 20261017_add_keyset_indexes
+Revises: 20261017_add_products
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "20261017_add_keyset_indexes"
+down_revision = "20261017_add_products"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_vpn_peers_created_id", "vpn_peers", ["created_at", "id"])
+    op.create_index("ix_vpn_peers_user_created_id", "vpn_peers", ["user_id", "created_at", "id"])
+    op.create_index("ix_payments_created_id", "payments", ["created_at", "id"])
+    op.create_index("ix_payments_user_created_id", "payments", ["user_id", "created_at", "id"])
+
+
+def downgrade():
+    op.drop_index("ix_payments_user_created_id", table_name="payments")
+    op.drop_index("ix_payments_created_id", table_name="payments")
+    op.drop_index("ix_vpn_peers_user_created_id", table_name="vpn_peers")
+    op.drop_index("ix_vpn_peers_created_id", table_name="vpn_peers")
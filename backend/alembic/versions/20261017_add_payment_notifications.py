@@ -0,0 +1,55 @@
+"""payment_notifications inbox for asynchronous webhook ingestion
+
+Revision ID: 20261017_add_payment_notifications
+Revises: 20261017_unique_provider_payment_id
+Create Date: 2026-10-17
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "20261017_add_payment_notifications"
+down_revision = "20261017_unique_provider_payment_id"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "payment_notifications",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("provider", sa.String(), nullable=False),
+        sa.Column("payload", sa.Text(), nullable=False),
+        sa.Column("status", sa.String(length=16), nullable=False, server_default="pending"),
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column(
+            "next_attempt_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.func.now(),
+            nullable=False,
+        ),
+        sa.Column("locked_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.Column("result", sa.Text(), nullable=True),
+        sa.Column(
+            "received_at", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False
+        ),
+        sa.Column("processed_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    op.create_index(
+        "ix_payment_notifications_status_id", "payment_notifications", ["status", "id"]
+    )
+    op.create_index(
+        "ix_payment_notifications_user_status",
+        "payment_notifications",
+        ["user_id", "status", "id"],
+    )
+
+
+def downgrade():
+    op.drop_index("ix_payment_notifications_user_status", table_name="payment_notifications")
+    op.drop_index("ix_payment_notifications_status_id", table_name="payment_notifications")
+    op.drop_table("payment_notifications")
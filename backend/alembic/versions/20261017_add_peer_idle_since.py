@@ -0,0 +1,26 @@
+"""add idle_since to vpn_peers
+
+Revision ID: 20261017_add_peer_idle_since
+Revises: 20261017_add_peer_usage
+Create Date: 2026-10-17
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "20261017_add_peer_idle_since"
+down_revision = "20261017_add_peer_usage"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("vpn_peers") as batch_op:
+        batch_op.add_column(sa.Column("idle_since", sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("vpn_peers") as batch_op:
+        batch_op.drop_column("idle_since")
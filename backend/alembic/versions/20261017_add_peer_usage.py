@@ -0,0 +1,50 @@
+"""add peer_usage time-series table
+
+Revision ID: 20261017_add_peer_usage
+Revises: 20261017_add_outbox_events
+Create Date: 2026-10-17
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "20261017_add_peer_usage"
+down_revision = "20261017_add_outbox_events"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "peer_usage",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column(
+            "peer_id",
+            sa.Integer(),
+            sa.ForeignKey("vpn_peers.id", ondelete="CASCADE"),
+            nullable=False,
+        ),
+        sa.Column(
+            "user_id", sa.Integer(), sa.ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+        ),
+        sa.Column("resolution", sa.Integer(), nullable=False),
+        sa.Column("bucket_start", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("rx_bytes", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("tx_bytes", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("last_handshake", sa.DateTime(timezone=True), nullable=True),
+        sa.UniqueConstraint(
+            "peer_id", "resolution", "bucket_start", name="uix_peer_usage_bucket"
+        ),
+    )
+    op.create_index("ix_peer_usage_user_bucket", "peer_usage", ["user_id", "bucket_start"])
+    op.create_index(
+        "ix_peer_usage_resolution_bucket", "peer_usage", ["resolution", "bucket_start"]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_peer_usage_resolution_bucket", table_name="peer_usage")
+    op.drop_index("ix_peer_usage_user_bucket", table_name="peer_usage")
+    op.drop_table("peer_usage")
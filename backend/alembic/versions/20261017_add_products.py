@@ -0,0 +1,53 @@
+"""products: store product id -> tariff, replacing ProductIdToTariffMapper
+
+Revision ID: 20261017_add_products
+Revises: 20261017_add_payment_notifications
+Create Date: 2026-10-17
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "20261017_add_products"
+down_revision = "20261017_add_payment_notifications"
+branch_labels = None
+depends_on = None
+
+# the mapping previously hard-coded in ProductIdToTariffMapper.MAPPING
+_LEGACY = {
+    "com.example.vpn.monthly": 1,
+    "com.example.vpn.annual": 2,
+    "com.example.vpn.lifetime": 3,
+}
+
+
+def upgrade():
+    op.create_table(
+        "products",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("product_id", sa.String(), nullable=False, unique=True),
+        sa.Column(
+            "tariff_id",
+            sa.Integer(),
+            sa.ForeignKey("tariffs.id", ondelete="CASCADE"),
+            nullable=False,
+        ),
+        sa.Column(
+            "created_at", sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False
+        ),
+    )
+    op.create_index("ix_products_tariff_id", "products", ["tariff_id"])
+    for product_id, tariff_id in _LEGACY.items():
+        op.execute(
+            sa.text(
+                "INSERT INTO products (product_id, tariff_id) "
+                "SELECT :product_id, id FROM tariffs WHERE id = :tariff_id"
+            ).bindparams(product_id=product_id, tariff_id=tariff_id)
+        )
+
+
+def downgrade():
+    op.drop_index("ix_products_tariff_id", table_name="products")
+    op.drop_table("products")
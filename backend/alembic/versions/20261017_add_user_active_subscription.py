@@ -0,0 +1,77 @@
+"""add materialized active_tariff_id / active_until to users
+
+Revision ID: 20261017_add_user_active_subscription
+Revises: 20261017_add_peer_idle_since
+Create Date: 2026-10-17
+"""
+
+from datetime import UTC, datetime
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "20261017_add_user_active_subscription"
+down_revision = "20261017_add_peer_idle_since"
+branch_labels = None
+depends_on = None
+
+
+def _aware(value):
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=UTC)
+    return value
+
+
+def upgrade():
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.add_column(sa.Column("active_tariff_id", sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column("active_until", sa.DateTime(timezone=True), nullable=True))
+        batch_op.create_foreign_key(
+            "fk_users_active_tariff_id",
+            "tariffs",
+            ["active_tariff_id"],
+            ["id"],
+            ondelete="SET NULL",
+        )
+        batch_op.create_index("ix_users_active_until", ["active_until"])
+
+    # backfill with the same rule as vpn_api.subscriptions.compute
+    conn = op.get_bind()
+    now = datetime.now(UTC)
+    best = {}
+    rows = conn.execute(
+        sa.text("SELECT user_id, tariff_id, ended_at FROM user_tariffs WHERE status = 'active'")
+    )
+    for user_id, tariff_id, ended_at in rows:
+        if isinstance(ended_at, str):
+            ended_at = datetime.fromisoformat(ended_at)
+        ended_at = _aware(ended_at)
+        if ended_at is not None and ended_at <= now:
+            continue
+        current = best.get(user_id)
+        if current and current[1] is None:
+            continue
+        if current is None or ended_at is None or ended_at > current[1]:
+            best[user_id] = (tariff_id, ended_at)
+    users = sa.table(
+        "users",
+        sa.column("id", sa.Integer),
+        sa.column("active_tariff_id", sa.Integer),
+        sa.column("active_until", sa.DateTime(timezone=True)),
+    )
+    for user_id, (tariff_id, until) in best.items():
+        conn.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .values(active_tariff_id=tariff_id, active_until=until)
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.drop_index("ix_users_active_until")
+        batch_op.drop_constraint("fk_users_active_tariff_id", type_="foreignkey")
+        batch_op.drop_column("active_until")
+        batch_op.drop_column("active_tariff_id")
@@ -0,0 +1,40 @@
+"""unique (provider, provider_payment_id) on payments
+
+Revision ID: 20261017_unique_provider_payment_id
+Revises: 20261017_add_hot_query_indexes
+Create Date: 2026-10-17
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "20261017_unique_provider_payment_id"
+down_revision = "20261017_add_hot_query_indexes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # earlier webhook races may have recorded a store transaction twice; keep
+    # the first row and tag the others so the unique index can be built
+    op.execute(
+        sa.text(
+            "UPDATE payments SET provider_payment_id = "
+            "provider_payment_id || ':dup:' || CAST(id AS VARCHAR) "
+            "WHERE provider_payment_id IS NOT NULL AND id NOT IN ("
+            "SELECT MIN(id) FROM payments WHERE provider_payment_id IS NOT NULL "
+            "GROUP BY provider, provider_payment_id)"
+        )
+    )
+    op.create_index(
+        "uq_payments_provider_payment_id",
+        "payments",
+        ["provider", "provider_payment_id"],
+        unique=True,
+    )
+
+
+def downgrade():
+    op.drop_index("uq_payments_provider_payment_id", table_name="payments")
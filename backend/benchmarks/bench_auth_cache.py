@@ -0,0 +1,62 @@
+"""Compare authenticated request throughput with and without the user cache.
+
+Uses a throwaway SQLite database and FastAPI's TestClient against
+``GET /auth/me`` (authentication plus serialising the user, no other
+queries), first with AUTH_CACHE_SIZE=0 and then with the cache enabled.
+
+Usage: python benchmarks/bench_auth_cache.py [requests]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+_db = Path(tempfile.mkdtemp()) / "bench_auth_cache.db"
+os.environ["DATABASE_URL"] = f"sqlite:///{_db.as_posix()}"
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+os.environ.setdefault("WG_OUTBOX_WORKERS", "0")
+
+
+def _run(client, headers: dict, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        r = client.get("/auth/me", headers=headers)
+        assert r.status_code == 200, r.text
+    return count / (time.perf_counter() - start)
+
+
+def main(count: int = 2000) -> None:
+    from fastapi.testclient import TestClient
+
+    from vpn_api import metrics, user_cache
+    from vpn_api.database import Base, engine
+    from vpn_api.main import app
+
+    Base.metadata.create_all(bind=engine)
+    client = TestClient(app)
+    client.post("/auth/register", json={"email": "bench@example.com", "password": "benchpass1"})
+    token = client.post(
+        "/auth/login", json={"email": "bench@example.com", "password": "benchpass1"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    _run(client, headers, 100)  # warm up
+    user_cache.AUTH_CACHE_SIZE = 0
+    uncached = _run(client, headers, count)
+    user_cache.AUTH_CACHE_SIZE = 10000
+    metrics.reset()
+    cached = _run(client, headers, count)
+    stats = user_cache.get_user_cache().stats()
+    print(f"requests={count}")
+    print(f"  no cache: {uncached:8.0f} req/s")
+    print(
+        f"  cache:    {cached:8.0f} req/s  ({cached / uncached:.2f}x, hit_rate={stats['hit_rate']})"
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
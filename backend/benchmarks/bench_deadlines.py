@@ -0,0 +1,85 @@
+"""Pending subscription deadlines: timing wheel vs binary heap.
+
+Inserts ``n`` deadlines spread over 30 days, then renews 10% of them (the
+renewal path of :func:`vpn_api.deadlines.reschedule`), and finally ticks
+through the whole 30 days one second at a time, as the scheduler thread does.
+With :mod:`heapq` each insert is O(log n), and a renewal leaves a stale item
+that has to be popped later. The wheel is O(1) per insert and per tick, but
+it is pure Python while heapq is C, so compare the totals, not just the
+complexity.
+
+Usage: python benchmarks/bench_deadlines.py [n]
+"""
+
+import heapq
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from vpn_api.deadlines import TimingWheel
+
+SPAN = 30 * 86400
+
+
+def _deadlines(n: int, start: float) -> tuple[list[float], list[float]]:
+    rng = random.Random(1)
+    first = [start + rng.uniform(1, SPAN) for _ in range(n)]
+    renewed = [start + rng.uniform(1, SPAN) for _ in range(n // 10)]
+    return first, renewed
+
+
+def bench_wheel(first, renewed, start):
+    wheel = TimingWheel(tick=1, start=start)
+    t0 = time.perf_counter()
+    for key, when in enumerate(first):
+        wheel.add(key, when)
+    for key, when in enumerate(renewed):
+        wheel.add(key, when)
+    inserted = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fired = 0
+    for tick in range(1, SPAN + 2):
+        fired += len(wheel.advance(start + tick))
+    return inserted, time.perf_counter() - t0, fired
+
+
+def bench_heap(first, renewed, start):
+    heap: list = []
+    current: dict[int, float] = {}
+    t0 = time.perf_counter()
+    for key, when in enumerate(first):
+        current[key] = when
+        heapq.heappush(heap, (when, key))
+    for key, when in enumerate(renewed):
+        current[key] = when
+        heapq.heappush(heap, (when, key))
+    inserted = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fired = 0
+    for tick in range(1, SPAN + 2):
+        now = start + tick
+        while heap and heap[0][0] <= now:
+            when, key = heapq.heappop(heap)
+            if current.get(key) == when:
+                del current[key]
+                fired += 1
+    return inserted, time.perf_counter() - t0, fired
+
+
+def main(n: int = 1_000_000) -> None:
+    start = time.time()
+    first, renewed = _deadlines(n, start)
+    print(f"deadlines={n} renewals={len(renewed)} ticks={SPAN}")
+    for name, bench in (("timing wheel", bench_wheel), ("heapq", bench_heap)):
+        inserted, ticked, fired = bench(first, renewed, start)
+        print(
+            f"  {name:12s} insert {inserted / (n + len(renewed)) * 1e9:6.0f} ns/op  "
+            f"30 days of ticks {ticked:6.2f}s  fired={fired}"
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:2]])
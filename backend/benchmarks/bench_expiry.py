@@ -0,0 +1,119 @@
+"""Expiry sweep over millions of ``user_tariffs`` rows: ORM loop vs chunked UPDATE.
+
+Seeds ``rows`` subscriptions (ten per user; 7.5% of them still active but
+past their end, half of the users left without access) and one active peer
+per user into a throwaway SQLite database. It then times the old ``mark_expired_subscriptions`` loop
+(load every due row and flip it) against :func:`vpn_api.expiry.sweep` on
+identical copies. Host removal is stubbed, since only the database work is
+measured.
+
+Usage: python benchmarks/bench_expiry.py [rows] [batch]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import UTC, datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+_dir = Path(tempfile.mkdtemp())
+_db = _dir / "bench_expiry.db"
+os.environ["DATABASE_URL"] = f"sqlite:///{_db.as_posix()}"
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+
+
+def _seed(conn, rows: int, now: str) -> None:
+    # ten subscriptions per user, the last two current: even users' latest one
+    # ended an hour ago (they lapse), users 1, 5, 9, ... also have an older
+    # one just ended but a current renewal. Everything else ended long ago.
+    users = max(1, rows // 10)
+    numbers = "WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1) "
+    conn.exec_driver_sql(
+        "INSERT INTO tariffs (id, name, duration_days, price, created_at) "
+        "VALUES (1, 't', 30, 1, ?)",
+        (now,),
+    )
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO user_tariffs (user_id, tariff_id, started_at, ended_at, status) "
+        "SELECT u, 1, datetime(?, '-' || i || ' seconds'), "
+        "CASE WHEN due THEN datetime(?, '-1 hour') WHEN k = 9 THEN datetime(?, '+30 days') "
+        "ELSE datetime(?, '-60 days') END, "
+        "CASE WHEN due OR k = 9 THEN 'active' ELSE 'expired' END "
+        "FROM (SELECT i, i / 10 + 1 AS u, i % 10 AS k, "
+        "(i % 10 = 9 AND (i / 10 + 1) % 2 = 0) OR (i % 10 = 8 AND (i / 10 + 1) % 4 = 1) AS due "
+        "FROM n)",
+        (users * 10, now, now, now, now),
+    )
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO users (id, email, status, is_admin, is_verified, created_at, "
+        "active_tariff_id, active_until) "
+        "SELECT i + 1, 'u' || i || '@example.com', 'active', 0, 1, ?, 1, "
+        "CASE WHEN (i + 1) % 2 = 0 THEN datetime(?, '-1 hour') "
+        "ELSE datetime(?, '+30 days') END FROM n",
+        (users, now, now, now),
+    )
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO vpn_peers (user_id, wg_private_key, wg_public_key, wg_ip, "
+        "active, created_at) SELECT i + 1, 'k', 'pub' || i, 'ip' || i, 1, ? FROM n",
+        (users, now),
+    )
+    conn.exec_driver_sql("ANALYZE")
+
+
+def main(rows: int = 2_000_000, batch: int = 5000) -> None:
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from vpn_api import expiry, models
+    from vpn_api.database import Base, engine
+
+    now = datetime.now(UTC)
+    Base.metadata.create_all(bind=engine)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        _seed(conn, rows, now.isoformat(" "))
+    engine.dispose()
+    print(f"rows={rows} batch={batch} seeded in {time.perf_counter() - start:.1f}s")
+
+    copy = _dir / "copy.db"
+    shutil.copy(_db, copy)
+
+    # old: mark_expired_subscriptions
+    old_engine = create_engine(f"sqlite:///{copy.as_posix()}")
+    db = sessionmaker(bind=old_engine)()
+    start = time.perf_counter()
+    expired = (
+        db.query(models.UserTariff)
+        .filter(models.UserTariff.status == "active", models.UserTariff.ended_at <= now)
+        .all()
+    )
+    for record in expired:
+        record.status = "expired"
+    db.commit()
+    old = time.perf_counter() - start
+    print(f"  orm loop:      {old:7.2f}s  expired={len(expired)} (peers untouched)")
+    db.close()
+    old_engine.dispose()
+
+    db = sessionmaker(bind=engine)()
+    start = time.perf_counter()
+    totals = expiry.sweep(db, now=now, batch=batch)
+    new = time.perf_counter() - start
+    print(
+        f"  chunked sweep: {new:7.2f}s  expired={totals['expired']} "
+        f"lapsed_users={totals['lapsed_users']} peers={totals['peers']}"
+    )
+    start = time.perf_counter()
+    expiry.sweep(db, now=now, batch=batch)
+    print(f"  idle sweep:    {(time.perf_counter() - start) * 1000:7.2f} ms (nothing due)")
+    db.close()
+    shutil.rmtree(_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,40 @@
+"""Benchmark IPAM allocate/release on a /16 pool.
+
+Usage: python benchmarks/bench_ipam.py [count]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from vpn_api.ipam import IpPool, parse_ranges
+
+
+def main(count: int = 60000) -> None:
+    pool = IpPool("10.8.0.0/16", parse_ranges("10.8.0.1-10.8.0.19"))
+
+    start = time.perf_counter()
+    addrs = [pool.allocate() for _ in range(count)]
+    alloc = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for a in addrs[::2]:
+        pool.release(a)
+    release = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(len(addrs[::2])):
+        pool.allocate()
+    realloc = time.perf_counter() - start
+
+    assert len(set(addrs)) == count
+    print(f"allocate   {count:>6}: {alloc:.3f}s ({alloc / count * 1e6:.2f} us/op)")
+    print(f"release    {count // 2:>6}: {release:.3f}s")
+    print(f"reallocate {count // 2:>6}: {realloc:.3f}s (holes refilled lowest-first)")
+    print(f"pool {pool.network}: used={pool.used} free={pool.free}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 60000)
@@ -0,0 +1,39 @@
+"""Benchmark keypair pool latency against inline X25519 generation.
+
+Usage: python benchmarks/bench_keypool.py [count]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from vpn_api.keypool import KeyPool, generate_keypair
+
+
+def main(count: int = 5000) -> None:
+    start = time.perf_counter()
+    for _ in range(count):
+        generate_keypair()
+    inline = time.perf_counter() - start
+
+    pool = KeyPool(low=0, high=count)
+    pool.fill()
+    start = time.perf_counter()
+    for _ in range(count):
+        pool.get()
+    pooled = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pool.take(count)
+    bulk = time.perf_counter() - start
+
+    print(f"inline generate {count}: {inline / count * 1e6:.1f} us/pair")
+    print(f"pool get        {count}: {pooled / count * 1e6:.2f} us/pair")
+    print(f"bulk take       {count}: {bulk:.3f}s (empty pool, generated in one call)")
+    print(pool.stats())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,110 @@
+"""Deep pages of ``GET /payments/``: offset/limit vs keyset cursor.
+
+Seeds ``rows`` payments into a throwaway SQLite database, five per second of
+``created_at``, so pages often split rows that share a timestamp. It then
+pages through all of them with :func:`vpn_api.payments.list_payments` in
+cursor mode and checks every row is seen once. Pages at a few depths are
+timed in both modes; offset mode is only sampled, since walking a million
+rows with it is quadratic.
+
+Usage: python benchmarks/bench_keyset_pagination.py [rows] [page_size]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import UTC, datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+_dir = Path(tempfile.mkdtemp())
+_db = _dir / "bench_keyset.db"
+os.environ["DATABASE_URL"] = f"sqlite:///{_db.as_posix()}"
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+
+DEPTHS = (0.0, 0.1, 0.5, 0.9, 0.999)
+
+
+def _seed(conn, rows: int, now: str) -> None:
+    users = max(1, rows // 10)
+    numbers = "WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < ? - 1) "
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO users (id, email, status, is_admin, is_verified, created_at) "
+        "SELECT i + 1, 'u' || i || '@example.com', 'active', 0, 1, ? FROM n",
+        (users, now),
+    )
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO payments (user_id, amount, currency, status, provider, "
+        "provider_payment_id, created_at) "
+        "SELECT i % ? + 1, 3, 'USD', 'completed', 'apple', 'tx' || i, "
+        "datetime(?, '-' || ((? - i) / 5) || ' seconds') FROM n",
+        (rows, users, now, rows),
+    )
+    conn.exec_driver_sql("ANALYZE")
+
+
+def _ms(fn) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main(rows: int = 1_000_000, page_size: int = 100) -> None:
+    from sqlalchemy.orm import sessionmaker
+
+    from vpn_api import payments
+    from vpn_api.database import Base, engine
+
+    Base.metadata.create_all(bind=engine)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        _seed(conn, rows, datetime.now(UTC).isoformat(" "))
+    print(f"rows={rows} page_size={page_size} seeded in {time.perf_counter() - start:.1f}s")
+
+    db = sessionmaker(bind=engine)()
+    admin = SimpleNamespace(id=0, is_admin=True)
+    pages = -(-rows // page_size)
+    sampled = {min(pages - 1, int(pages * d)) for d in DEPTHS}
+
+    keyset_ms = {}
+    seen = 0
+    last_id = None
+    cursor = ""
+    start = time.perf_counter()
+    for page_no in range(pages):
+        ms, page = _ms(
+            lambda c=cursor: payments.list_payments(
+                limit=page_size, cursor=c, db=db, current_user=admin
+            )
+        )
+        if page_no in sampled:
+            keyset_ms[page_no] = ms
+        seen += len(page["items"])
+        last_id = page["items"][-1].id
+        cursor = page["next_cursor"]
+        db.expunge_all()
+    walk = time.perf_counter() - start
+    assert cursor is None and seen == rows, (seen, rows)
+    print(f"  keyset walk: {pages} pages in {walk:.1f}s (last id {last_id}), every row once")
+
+    print("  page     depth   offset ms   keyset ms")
+    for page_no in sorted(sampled):
+        ms, _ = _ms(
+            lambda p=page_no: payments.list_payments(
+                skip=p * page_size, limit=page_size, db=db, current_user=admin
+            )
+        )
+        db.expunge_all()
+        print(f"  {page_no:6d}  {page_no / pages:7.1%}  {ms:10.2f}  {keyset_ms[page_no]:10.2f}")
+    db.close()
+    engine.dispose()
+    shutil.rmtree(_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,77 @@
+"""Login throughput with password hashing on 0 (inline), 1, 2 and 4 worker processes.
+
+Runs ``auth.login`` from a thread pool of request "threads" against a
+throwaway SQLite database, as the sync endpoint would run under uvicorn, and
+reports logins per second, p95 latency and shed (503) logins per setting.
+
+Usage: python benchmarks/bench_login.py [logins] [threads]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+_db = Path(tempfile.mkdtemp()) / "bench_login.db"
+os.environ["DATABASE_URL"] = f"sqlite:///{_db.as_posix()}"
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+
+
+def main(logins: int = 200, threads: int = 16) -> None:
+    from fastapi import HTTPException
+
+    from vpn_api import auth, hashing, models, schemas
+    from vpn_api.database import Base, SessionLocal, engine
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    db.add(
+        models.User(
+            email="bench@example.com",
+            hashed_password=hashing.pwd_context.hash("benchpass1"),
+            status="active",
+        )
+    )
+    db.commit()
+    db.close()
+    creds = schemas.UserLogin(email="bench@example.com", password="benchpass1")
+
+    def one(_):
+        session = SessionLocal()
+        start = time.perf_counter()
+        try:
+            auth.login(creds, session)
+            return time.perf_counter() - start, False
+        except HTTPException as e:
+            if e.status_code != 503:
+                raise
+            return time.perf_counter() - start, True
+        finally:
+            session.close()
+
+    print(f"logins={logins} request_threads={threads} cpus={os.cpu_count()}")
+    for workers in (0, 1, 2, 4):
+        hashing.shutdown()
+        hashing._pool = hashing.HashPool(workers=workers, queue=max(1, workers) * 8, timeout=60)
+        one(None)  # start the worker processes outside the measurement
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            results = list(ex.map(one, range(logins)))
+        elapsed = time.perf_counter() - start
+        ok = sorted(t for t, shed in results if not shed)
+        shed = sum(1 for _t, s in results if s)
+        p95 = ok[int(len(ok) * 0.95) - 1] * 1000 if ok else float("nan")
+        print(
+            f"  workers={workers}: {len(ok) / elapsed:7.1f} logins/s"
+            f"  p95={p95:7.1f} ms  shed={shed}"
+        )
+    hashing.shutdown()
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,78 @@
+"""Benchmark POST /vpn_peers/bulk for 10k peers against stub host/controller.
+
+Runs the app in-process on a throwaway SQLite database. Host apply (done by
+the outbox workers after the response) and wg-easy creation are replaced by
+stubs that sleep for ``STUB_LATENCY`` seconds, mimicking a remote round trip.
+
+Usage: python benchmarks/bench_peer_bulk.py [count]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+_db = Path(tempfile.mkdtemp()) / "bench_bulk.db"
+os.environ["DATABASE_URL"] = f"sqlite:///{_db.as_posix()}"
+os.environ["DEV_INIT_DB"] = "1"
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+os.environ.setdefault("PROMOTE_SECRET", "bench-promote")
+os.environ.setdefault("WG_IP_POOL", "10.8.0.0/16")
+os.environ.setdefault("CONFIG_ENCRYPTION_KEY", Fernet.generate_key().decode())
+STUB_LATENCY = 0.002
+
+
+def _stub_apply(peer):
+    time.sleep(STUB_LATENCY)
+    return True
+
+
+def _stub_wg_easy(user_id, name):
+    time.sleep(STUB_LATENCY)
+    n = name.rsplit("-", 1)[1]
+    idx = int(n)
+    return f"pk-{n}", f"priv-{n}", f"cid-{n}", {"address": f"10.9.{idx // 250}.{idx % 250 + 1}/32"}
+
+
+def _admin(client, email: str) -> tuple[int, dict]:
+    user = client.post("/auth/register", json={"email": email, "password": "benchpass"}).json()
+    client.post("/auth/admin/promote", params={"user_id": user["id"], "secret": "bench-promote"})
+    token = client.post("/auth/login", json={"email": email, "password": "benchpass"}).json()
+    return user["id"], {"Authorization": f"Bearer {token['access_token']}"}
+
+
+def _run(client, headers: dict, user_id: int, count: int, policy: str) -> None:
+    os.environ["WG_KEY_POLICY"] = policy
+    specs = [{"user_id": user_id, "device_name": f"{policy}-{i}"} for i in range(count)]
+    start = time.perf_counter()
+    resp = client.post("/vpn_peers/bulk", json={"peers": specs}, headers=headers)
+    summary = json.loads(resp.text.strip().splitlines()[-1])["summary"]
+    elapsed = time.perf_counter() - start
+    print(f"{policy:>8}: {count} peers in {elapsed:.1f}s {summary}")
+
+
+def main(count: int = 10000) -> None:
+    # imported here: the app reads its settings from the environment at import
+    from fastapi.testclient import TestClient
+
+    from vpn_api import peers
+    from vpn_api.main import app
+
+    peers.apply_peer = _stub_apply
+    peers._handle_wg_easy_creation = _stub_wg_easy
+    os.environ["WG_EASY_URL"] = "http://stub"
+    os.environ["WG_EASY_PASSWORD"] = "stub"
+    client = TestClient(app)
+    user_id, headers = _admin(client, "bench-bulk@example.com")
+    _run(client, headers, user_id, count, "db")
+    _run(client, headers, user_id, count, "wg-easy")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,74 @@
+"""Benchmark one reconcile cycle over 50k peers (DB + wg-easy list + wg dump).
+
+Uses a throwaway SQLite database and synthetic wg-easy / ``wg show dump``
+snapshots with ~1% drift. Reports the first (cold) cycle, a cycle after a
+change, and an unchanged cycle that is short-circuited by the digest.
+
+Usage: python benchmarks/bench_reconciler.py [peers]
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+_db = Path(tempfile.mkdtemp()) / "bench_reconcile.db"
+os.environ["DATABASE_URL"] = f"sqlite:///{_db.as_posix()}"
+
+
+def _setup(count: int) -> tuple[str, list[dict]]:
+    from vpn_api import models
+    from vpn_api.database import Base, engine
+
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(models.User.__table__.insert(), [{"email": "bench@example.com"}])
+        conn.execute(
+            models.VpnPeer.__table__.insert(),
+            [
+                {
+                    "user_id": 1,
+                    "wg_private_key": "x",
+                    "wg_public_key": f"pk{i:06d}",
+                    "wg_client_id": f"c{i}",
+                    "wg_ip": f"10.{8 + i // 65536}.{i // 256 % 256}.{i % 256}/32",
+                    "active": True,
+                }
+                for i in range(count)
+            ],
+        )
+    lines = ["PRIV\tPUB\t51820\toff"]
+    for i in range(count):
+        if i % 100 == 0:
+            continue  # missing on the interface
+        ip = f"10.{8 + i // 65536}.{i // 256 % 256}.{i % 256}/32"
+        lines.append(f"pk{i:06d}\t(none)\t1.2.3.4:51820\t{ip}\t1700000000\t{i}\t{i}\toff")
+    lines += [f"stale{i}\t(none)\t(none)\t10.99.0.{i}/32\t0\t0\t0\toff" for i in range(50)]
+    clients = [{"id": f"c{i}", "name": f"n{i}", "publicKey": f"pk{i:06d}"} for i in range(count)]
+    clients += [{"id": f"orphan{i}", "name": "o", "publicKey": f"opk{i}"} for i in range(50)]
+    return "\n".join(lines), clients
+
+
+def main(count: int = 50000) -> None:
+    from vpn_api import reconciler, wg_host
+    from vpn_api.database import SessionLocal
+
+    dump, clients = _setup(count)
+    reconciler.snapshot_iface = lambda iface: reconciler.snapshot_state(wg_host.parse_dump(dump))
+    reconciler.snapshot_wg_easy = lambda: reconciler.snapshot_clients(clients)
+
+    rec = reconciler.Reconciler()
+    db = SessionLocal()
+    for label in ("cold", "unchanged"):
+        report = rec.cycle(db, dry_run=True)
+        print(f"{label:>10}: {report.seconds * 1000:7.1f} ms {report.summary()}")
+    clients.append({"id": "late", "name": "late", "publicKey": "late"})
+    report = rec.cycle(db, dry_run=True)
+    print(f"{'changed':>10}: {report.seconds * 1000:7.1f} ms {report.summary()}")
+    db.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,69 @@
+"""Benchmark parsing a synthetic ``wg show all dump`` and computing per-peer deltas.
+
+The dump has ``lines`` peer lines spread over four interfaces. Reports the
+parse time, the time to turn the parsed state into a sample and the delta
+computation against the previous sample (every peer moved some traffic).
+
+Usage: python benchmarks/bench_telemetry_parse.py [lines]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def _dump(count: int, tick: int) -> str:
+    lines = []
+    per_iface = count // 4 + 1
+    for i in range(count):
+        iface = f"wg{i // per_iface}"
+        if i % per_iface == 0:
+            lines.append(f"{iface}\tPRIV\tPUB\t{51820 + i // per_iface}\toff")
+        ip = f"10.{8 + i // 65536}.{i // 256 % 256}.{i % 256}/32"
+        rx, tx = i * 1000 + tick * 1500, i * 300 + tick * 700
+        lines.append(
+            f"{iface}\tpk{i:06d}\t(none)\t1.2.3.4:51820\t{ip}\t{1700000000 + tick}\t{rx}\t{tx}\t25"
+        )
+    return "\n".join(lines)
+
+
+def main(count: int = 50000, rounds: int = 5) -> None:
+    from vpn_api import telemetry, wg_host
+
+    collector = telemetry.Collector()
+    dumps = [_dump(count, tick) for tick in range(rounds + 1)]
+
+    def sample(text: str) -> dict:
+        out = {}
+        for state in wg_host.parse_all_dump(text).values():
+            for pub, peer in state.peers.items():
+                out[pub] = (peer.rx_bytes, peer.tx_bytes, peer.latest_handshake)
+        return out
+
+    collector.deltas(sample(dumps[0]))
+    parse = build = delta = 0.0
+    for text in dumps[1:]:
+        start = time.perf_counter()
+        states = wg_host.parse_all_dump(text)
+        parse += time.perf_counter() - start
+        start = time.perf_counter()
+        current = {
+            pub: (p.rx_bytes, p.tx_bytes, p.latest_handshake)
+            for state in states.values()
+            for pub, p in state.peers.items()
+        }
+        build += time.perf_counter() - start
+        start = time.perf_counter()
+        changed = collector.deltas(current)
+        delta += time.perf_counter() - start
+        assert len(changed) == count
+    print(f"lines={count} rounds={rounds}")
+    print(f"  parse_all_dump: {parse / rounds * 1000:7.1f} ms")
+    print(f"  sample build:   {build / rounds * 1000:7.1f} ms")
+    print(f"  deltas:         {delta / rounds * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
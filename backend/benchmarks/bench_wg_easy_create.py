@@ -0,0 +1,84 @@
+"""Benchmark wg-easy client creation latency against controller size.
+
+Starts a stub wg-easy controller (aiohttp.web) preloaded with N clients and
+measures WgEasyAdapter.create_client through the HTTP path, with and without
+the controller returning the created client in the POST body.
+
+Usage: python benchmarks/bench_wg_easy_create.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import aiohttp
+from aiohttp import web
+
+from vpn_api import wg_easy_adapter
+from vpn_api.wg_easy_adapter import WgEasyAdapter
+
+SIZES = (100, 1000, 5000, 20000)
+CREATES = 50
+
+
+class _NoWrapper:
+    """Wrapper stand-in that always fails so the adapter uses its HTTP path."""
+
+    def __init__(self, url, password, session=None):
+        pass
+
+    async def create_client(self, name):
+        raise RuntimeError("use HTTP path")
+
+
+def _controller(preload: int, return_body: bool) -> web.Application:
+    clients = [
+        {"id": f"old-{i}", "name": f"old-{i}", "publicKey": f"pk{i}"} for i in range(preload)
+    ]
+
+    async def create(request):
+        body = await request.json()
+        client = {"id": f"cid-{len(clients)}", "name": body["name"], "publicKey": "pk"}
+        clients.append(client)
+        return web.json_response(client if return_body else {"success": True})
+
+    async def list_clients(request):
+        return web.json_response(clients)
+
+    app = web.Application()
+    app.router.add_post("/api/wireguard/client", create)
+    app.router.add_get("/api/wireguard/client", list_clients)
+    return app
+
+
+async def _measure(preload: int, return_body: bool) -> float:
+    runner = web.AppRunner(_controller(preload, return_body))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with WgEasyAdapter(f"http://127.0.0.1:{port}", "pw", session=session) as adapter:
+                start = time.perf_counter()
+                for i in range(CREATES):
+                    await adapter.create_client(f"bench-{i}")
+                return (time.perf_counter() - start) / CREATES
+    finally:
+        await runner.cleanup()
+
+
+async def main() -> None:
+    wg_easy_adapter.WgEasy = _NoWrapper
+    print(f"{'clients':>8} {'body returned':>15} {'list on create':>15}  (ms per create)")
+    for n in SIZES:
+        with_body = await _measure(n, True)
+        without_body = await _measure(n, False)
+        print(f"{n:>8} {with_body * 1e3:>15.2f} {without_body * 1e3:>15.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,32 +4,49 @@ Contains registration, login, user lookup and admin utilities. This module
 is exercised by unit and integration tests.
 """
 
+import logging
 import os
+from dataclasses import dataclass
 from datetime import UTC, datetime, timedelta
 from typing import Optional
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from vpn_api import models, schemas
+from vpn_api import (
+    catalog,
+    hashing,
+    models,
+    ratelimit,
+    revocation,
+    schemas,
+    subscriptions,
+    user_cache,
+)
 from vpn_api.database import get_db
 
+logger = logging.getLogger(__name__)
+
 # email verification flow removed: no external email sending
 
 router = APIRouter()
-# Prefer pbkdf2_sha256 to avoid bcrypt's 72-byte input limit and any CI
-# platform-dependent bcrypt backend issues. Keep bcrypt_sha256 and bcrypt
-# as fallbacks so existing hashes remain verifiable.
-pwd_context = CryptContext(schemes=["pbkdf2_sha256", "bcrypt_sha256", "bcrypt"], deprecated="auto")
+# hashing runs on a process pool, see vpn_api.hashing
+pwd_context = hashing.pwd_context
 
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+# "db": every request loads the user by email (default).
+# "stateless": short-lived access tokens carry uid/status/is_admin and are
+# trusted without a DB lookup; see vpn_api.revocation for how changes propagate.
+AUTH_MODE = os.getenv("AUTH_MODE", "db")
+STATELESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("STATELESS_TOKEN_EXPIRE_MINUTES", "5"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+revocation.configure(STATELESS_TOKEN_EXPIRE_MINUTES * 60)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 # optional oauth2 scheme that does not raise on missing token
@@ -44,13 +61,25 @@ def validate_password(password: str):
     return True
 
 
+def _busy() -> HTTPException:
+    return HTTPException(
+        status_code=503, detail="Server busy, retry later", headers={"Retry-After": "1"}
+    )
+
+
 def get_password_hash(password: str):
     validate_password(password)
-    return pwd_context.hash(password)
+    try:
+        return hashing.hash_password(password)
+    except hashing.HashPoolSaturated as e:
+        raise _busy() from e
 
 
 def verify_password(plain, hashed):
-    return pwd_context.verify(plain[:72], hashed)
+    try:
+        return hashing.verify_password(plain[:72], hashed)
+    except hashing.HashPoolSaturated as e:
+        raise _busy() from e
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -65,6 +94,58 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def _status_value(status) -> str:
+    # models.User.status is an Enum; compare to its value
+    try:
+        return status.value if hasattr(status, "value") else str(status)
+    except Exception:
+        return str(status)
+
+
+@dataclass
+class TokenUser:
+    """User snapshot rebuilt from stateless token claims (no DB row behind it)."""
+
+    id: int
+    email: str
+    status: str
+    is_admin: bool = False
+
+
+def _claims(user) -> dict:
+    return {
+        "sub": user.email,
+        "uid": user.id,
+        "status": _status_value(user.status),
+        "is_admin": bool(user.is_admin),
+        "ver": revocation.current(),
+    }
+
+
+def issue_tokens(user) -> dict:
+    """Build the login response for ``user``.
+
+    In stateless mode the access token is short-lived and comes with a refresh
+    token for ``POST /auth/refresh``.
+    """
+    claims = _claims(user)
+    if AUTH_MODE != "stateless":
+        return {"access_token": create_access_token(claims), "token_type": "bearer"}
+    access = create_access_token(
+        {**claims, "typ": "access"}, timedelta(minutes=STATELESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh = create_access_token(
+        {"sub": user.email, "uid": user.id, "typ": "refresh"},
+        timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    )
+    return {"access_token": access, "token_type": "bearer", "refresh_token": refresh}
+
+
+def revoke_user_tokens(user_id: int) -> None:
+    """Reject the user's current stateless tokens (status or admin flag changed)."""
+    revocation.bump(user_id)
+
+
 @router.post(
     "/register",
     response_model=schemas.UserOut,
@@ -87,7 +168,7 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
         400: {"description": "Validation error or already exists"},
     },
 )
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
+def register(user: schemas.UserCreate, db: Session = Depends(get_db), request: Request = None):
     """Register a user.
 
     Provide `email` and `password` (password is required). Newly created users
@@ -95,6 +176,7 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
     email-only flow use `/auth/register/email` which is intentionally a
     separate endpoint.
     """
+    ratelimit.check_register(request)
     # legacy registration (username+password) remains supported via existing route
     db_user = db.query(models.User).filter(models.User.email == user.email).first()
     if db_user:
@@ -125,12 +207,16 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
     responses={200: {"description": "Returns access token for convenience"}},
 )
 def email_register(
-    payload: schemas.RegisterIn, background_tasks: BackgroundTasks, db: Session = Depends(get_db)
+    payload: schemas.RegisterIn,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    request: Request = None,
 ):
     """Start email verification flow: create user record (if missing), generate code and email it.
 
     Returns a generic success message to avoid leaking account existence.
     """
+    ratelimit.check_register(request)
     # Simplified flow: create user if missing and mark as verified immediately
     db_user = db.query(models.User).filter(models.User.email == payload.email).first()
     if not db_user:
@@ -140,9 +226,9 @@ def email_register(
     db_user.status = "active"
     db.commit()
     db.refresh(db_user)
+    user_cache.invalidate(db_user.email)
     # return access token for convenience
-    token = create_access_token({"sub": db_user.email})
-    return {"access_token": token, "token_type": "bearer"}
+    return issue_tokens(db_user)
 
 
 @router.post(
@@ -157,7 +243,9 @@ def email_register(
         }
     },
 )
-def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
+def login(user: schemas.UserLogin, db: Session = Depends(get_db), request: Request = None):
+    # throttle before the user lookup and the password hash
+    ratelimit.check_login(request, user.email)
     db_user = db.query(models.User).filter(models.User.email == user.email).first()
     if not db_user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -170,8 +258,31 @@ def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
     else:
         if not verify_password(user.password, db_user.hashed_password):
             raise HTTPException(status_code=401, detail="Invalid credentials")
-    token = create_access_token({"sub": db_user.email})
-    return {"access_token": token, "token_type": "bearer"}
+    return issue_tokens(db_user)
+
+
+@router.post("/refresh", response_model=schemas.TokenOut)
+def refresh(payload: schemas.RefreshIn, db: Session = Depends(get_db)):
+    """Exchange a refresh token for a new access/refresh pair (stateless mode).
+
+    The user is re-read from the DB here, so the new access token reflects
+    status and admin changes; refresh tokens are therefore not subject to
+    vpn_api.revocation (a blocked user simply cannot refresh).
+    """
+    credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
+    try:
+        claims = jwt.decode(payload.refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError as err:
+        raise credentials_exception from err
+    user_id = claims.get("uid")
+    if claims.get("typ") != "refresh" or user_id is None:
+        raise credentials_exception
+    user = db.query(models.User).filter(models.User.id == user_id).first()
+    if user is None:
+        raise credentials_exception
+    if _status_value(user.status) != "active":
+        raise HTTPException(status_code=403, detail="User not active")
+    return issue_tokens(user)
 
 
 # /verify endpoint removed (email verification not used)
@@ -181,6 +292,32 @@ def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
 
+def _authenticated_user(db: Session, email: str):
+    """Return the user for a token subject, through the user cache when enabled."""
+    if not user_cache.enabled():
+        return get_user_by_email(db, email)
+    cache = user_cache.get_user_cache()
+    user = cache.get(email)
+    if user is None:
+        row = get_user_by_email(db, email)
+        if row is None:
+            return None
+        user = cache.put(row)
+    return user
+
+
+def _token_user(payload: dict) -> Optional[TokenUser]:
+    """Return the user described by a stateless access token, None if it is not one."""
+    if AUTH_MODE != "stateless" or payload.get("typ") != "access" or "uid" not in payload:
+        return None
+    return TokenUser(
+        id=payload["uid"],
+        email=payload.get("sub"),
+        status=payload.get("status"),
+        is_admin=bool(payload.get("is_admin")),
+    )
+
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     if not SECRET_KEY:
         raise RuntimeError("SECRET_KEY must be set in environment variables to validate tokens")
@@ -188,19 +325,20 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
-        if email is None:
+        if email is None or payload.get("typ") == "refresh":
             raise credentials_exception
     except JWTError as err:
         raise credentials_exception from err
-    user = get_user_by_email(db, email)
-    if user is None:
-        raise credentials_exception
-    # models.User.status is an Enum; compare to its value
-    try:
-        status_val = user.status.value if hasattr(user.status, "value") else str(user.status)
-    except Exception:
-        status_val = str(user.status)
-    if status_val != "active":
+    user = _token_user(payload)
+    if user is not None:
+        # stateless: trust the claims unless the user's tokens were revoked
+        if revocation.is_revoked(user.id, payload.get("ver")):
+            raise credentials_exception
+    else:
+        user = _authenticated_user(db, email)
+        if user is None:
+            raise credentials_exception
+    if _status_value(user.status) != "active":
         raise HTTPException(status_code=403, detail="User not active")
     return user
 
@@ -214,16 +352,21 @@ def get_current_user_optional(
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
-        if email is None:
+        if email is None or payload.get("typ") == "refresh":
             return None
     except Exception:
         return None
-    user = get_user_by_email(db, email)
-    return user
+    user = _token_user(payload)
+    if user is not None:
+        return None if revocation.is_revoked(user.id, payload.get("ver")) else user
+    return _authenticated_user(db, email)
 
 
 @router.get("/me", response_model=schemas.UserOut)
-def me(current_user: models.User = Depends(get_current_user)):
+def me(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if isinstance(current_user, TokenUser):
+        # the profile has fields the token does not carry
+        return db.query(models.User).filter(models.User.id == current_user.id).first()
     return current_user
 
 
@@ -239,18 +382,27 @@ def get_user_subscription(
     - null if no active subscription
 
     """
-    # Query for active UserTariff
     now = datetime.now(UTC)
+    tariff_id, until = subscriptions.active_state(db, current_user.id)
+    if not subscriptions.is_active(tariff_id, until, now):
+        return None
+
+    # the materialized state names the subscription; load it for the details
     active_subscription = (
         db.query(models.UserTariff, models.Tariff)
         .join(models.Tariff)
         .filter(
             models.UserTariff.user_id == current_user.id,
+            models.UserTariff.tariff_id == tariff_id,
             models.UserTariff.status == "active",
+            (
+                models.UserTariff.ended_at.is_(None)
+                if until is None
+                else models.UserTariff.ended_at == until
+            ),
         )
         .first()
     )
-
     if not active_subscription:
         return None
 
@@ -258,8 +410,8 @@ def get_user_subscription(
 
     # Calculate days remaining
     days_remaining = None
-    if user_tariff.ended_at:
-        delta = (user_tariff.ended_at - now).days
+    if until:
+        delta = (until - now).days
         days_remaining = max(0, delta)
     else:
         # Lifetime subscription
@@ -277,10 +429,23 @@ def get_user_subscription(
         "started_at": user_tariff.started_at,
         "ended_at": user_tariff.ended_at,
         "days_remaining": days_remaining,
-        "is_lifetime": user_tariff.ended_at is None,
+        "is_lifetime": until is None,
     }
 
 
+def _wake_idle_peers(db: Session, user_id: int) -> None:
+    """Put the user's parked peers back on the interface after a renewal."""
+    from vpn_api import idle_peers
+
+    try:
+        idle_peers.wake_user(db, user_id)
+    except Exception:
+        # the subscription is already committed; the config endpoint wakes
+        # the peer again on the next fetch
+        logger.exception("failed to wake idle peers of user %s", user_id)
+        db.rollback()
+
+
 def assign_tariff(
     user_id: int,
     assign: schemas.AssignTariff,
@@ -294,8 +459,7 @@ def assign_tariff(
     db_user = db.query(models.User).filter(models.User.id == user_id).first()
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
-    db_tariff = db.query(models.Tariff).filter(models.Tariff.id == assign.tariff_id).first()
-    if not db_tariff:
+    if catalog.tariff(assign.tariff_id) is None:
         raise HTTPException(status_code=404, detail="Tariff not found")
     # Проверка: не назначен ли уже этот тариф
     existing = (
@@ -307,8 +471,13 @@ def assign_tariff(
     db.add(user_tariff)
     # при присвоении тарифа активируем пользователя
     db_user.status = "active"
+    state = subscriptions.refresh(db, user_id)
     db.commit()
+    subscriptions.committed(user_id, state)
     db.refresh(user_tariff)
+    revoke_user_tokens(user_id)
+    user_cache.invalidate(db_user.email)
+    _wake_idle_peers(db, user_id)
     return {"msg": "tariff assigned", "user_id": user_id, "tariff_id": assign.tariff_id}
 
 
@@ -323,22 +492,13 @@ def user_subscribe(
     In production, this would be called after successful payment verification.
     """
     # Check tariff exists
-    db_tariff = db.query(models.Tariff).filter(models.Tariff.id == assign.tariff_id).first()
-    if not db_tariff:
+    tariff = catalog.tariff(assign.tariff_id)
+    if tariff is None:
         raise HTTPException(status_code=404, detail="Tariff not found")
 
     # Check if user already has an active subscription
     now = datetime.now(UTC)
-    existing_active = (
-        db.query(models.UserTariff)
-        .filter(
-            models.UserTariff.user_id == current_user.id,
-            models.UserTariff.status == "active",
-            (models.UserTariff.ended_at.is_(None)) | (models.UserTariff.ended_at > now),
-        )
-        .first()
-    )
-    if existing_active:
+    if subscriptions.has_active(db, current_user.id, now):
         raise HTTPException(status_code=400, detail="already_has_active_subscription")
 
     # Create new UserTariff record
@@ -346,17 +506,22 @@ def user_subscribe(
         user_id=current_user.id,
         tariff_id=assign.tariff_id,
         started_at=now,
-        ended_at=now + timedelta(days=db_tariff.duration_days) if db_tariff.duration_days else None,
+        ended_at=tariff.ends_at(now),
         status="active",
     )
     db.add(user_tariff)
 
     # Activate user if pending
     if current_user.status != "active":
-        current_user.status = "active"
+        # current_user may be a cached snapshot, so update the row itself
+        db.query(models.User).filter(models.User.id == current_user.id).update({"status": "active"})
 
+    state = subscriptions.refresh(db, current_user.id, now)
     db.commit()
+    subscriptions.committed(current_user.id, state)
     db.refresh(user_tariff)
+    user_cache.invalidate(current_user.email)
+    _wake_idle_peers(db, current_user.id)
 
     return {
         "msg": "subscription activated",
@@ -395,4 +560,6 @@ def promote_user(
     # make admin active so they can use protected admin endpoints immediately
     db_user.status = "active"
     db.commit()
+    revoke_user_tokens(user_id)
+    user_cache.invalidate(db_user.email, everywhere=True)
     return {"msg": "user promoted", "user_id": user_id}
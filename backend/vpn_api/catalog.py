@@ -0,0 +1,144 @@
+"""In-process snapshot of the tariff and store product catalog.
+
+The payment webhook used to query ``tariffs`` by id on every call, and it
+mapped store product ids with hard-coded dicts. Those dicts disagreed with
+``tariffs.duration_days``. Both now live in the database: ``tariffs``, and
+``products`` (store product id -> tariff). Each process keeps an
+immutable :class:`Catalog` snapshot of the two tables, which serves the
+webhook, ``GET /tariffs`` and ``/auth/subscribe`` without touching the
+database.
+
+A new snapshot is built aside and published with a single assignment, so
+readers never see a half-built catalog:
+
+- write paths in this process call :func:`reload` after committing;
+- other workers pick changes up within ``TARIFF_CATALOG_TTL`` seconds;
+- a lookup of a tariff or product missing from the snapshot reloads it,
+  so rows created by another process are usable within
+  ``TARIFF_CATALOG_MISS_RELOAD`` seconds; unknown ids sent in a burst do
+  not turn into one full reload each.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+from vpn_api import metrics
+
+TARIFF_CATALOG_TTL = float(os.getenv("TARIFF_CATALOG_TTL", "60"))
+# a lookup miss reloads only a snapshot older than this, seconds
+TARIFF_CATALOG_MISS_RELOAD = float(os.getenv("TARIFF_CATALOG_MISS_RELOAD", "5"))
+# tariffs this long (or 0 days) never end
+LIFETIME_DAYS = 36500
+
+
+@dataclass(frozen=True, slots=True)
+class TariffInfo:
+    id: int
+    name: str
+    description: Optional[str]
+    duration_days: int
+    price: Decimal
+    created_at: Optional[datetime]
+
+    def ends_at(self, start: datetime) -> Optional[datetime]:
+        """End of a subscription started at ``start`` (None: lifetime)."""
+        if not self.duration_days or self.duration_days >= LIFETIME_DAYS:
+            return None
+        return start + timedelta(days=self.duration_days)
+
+
+@dataclass(frozen=True, slots=True)
+class Catalog:
+    tariffs: Mapping[int, TariffInfo]
+    # ordered by (created_at, id), for listings (see vpn_api.pagination)
+    tariff_list: tuple[TariffInfo, ...]
+    # store product id -> tariff id
+    products: Mapping[str, int]
+    loaded_at: float
+
+
+_snapshot: Optional[Catalog] = None
+_load_lock = threading.Lock()
+
+
+def _load() -> Catalog:
+    from vpn_api import models
+    from vpn_api.database import SessionLocal
+
+    T = models.Tariff
+    # own session: callers may be inside a write transaction
+    db = SessionLocal()
+    try:
+        rows = db.query(
+            T.id, T.name, T.description, T.duration_days, T.price, T.created_at
+        ).order_by(T.created_at, T.id)
+        tariffs = {row.id: TariffInfo(*row) for row in rows}
+        products = dict(db.query(models.Product.product_id, models.Product.tariff_id))
+    finally:
+        db.close()
+    metrics.inc("tariff_catalog_loads")
+    return Catalog(
+        MappingProxyType(tariffs),
+        tuple(tariffs.values()),
+        MappingProxyType(products),
+        time.monotonic(),
+    )
+
+
+def reload() -> Catalog:
+    """Rebuild the snapshot now (call after committing a catalog change)."""
+    global _snapshot
+    with _load_lock:
+        _snapshot = _load()
+        return _snapshot
+
+
+def get_catalog() -> Catalog:
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is None or time.monotonic() - snapshot.loaded_at > TARIFF_CATALOG_TTL:
+        with _load_lock:
+            snapshot = _snapshot
+            if snapshot is None or time.monotonic() - snapshot.loaded_at > TARIFF_CATALOG_TTL:
+                snapshot = _snapshot = _load()
+    return snapshot
+
+
+def _reload_on_miss(snapshot: Catalog) -> Catalog:
+    """Reload after a lookup miss, unless ``snapshot`` is too recent for that."""
+    global _snapshot
+    if time.monotonic() - snapshot.loaded_at <= TARIFF_CATALOG_MISS_RELOAD:
+        metrics.inc("tariff_catalog_misses")
+        return snapshot
+    with _load_lock:
+        # another thread may have reloaded while we waited
+        if _snapshot is snapshot:
+            _snapshot = _load()
+        return _snapshot
+
+
+def tariff(tariff_id: int) -> Optional[TariffInfo]:
+    """Catalog entry for ``tariff_id`` (None: no such tariff)."""
+    snapshot = get_catalog()
+    info = snapshot.tariffs.get(tariff_id)
+    if info is None:
+        info = _reload_on_miss(snapshot).tariffs.get(tariff_id)
+    return info
+
+
+def product_tariff(product_id: str) -> Optional[TariffInfo]:
+    """Tariff granted by store product ``product_id`` (None: unknown product)."""
+    snapshot = get_catalog()
+    tariff_id = snapshot.products.get(product_id)
+    if tariff_id is None:
+        snapshot = _reload_on_miss(snapshot)
+        tariff_id = snapshot.products.get(product_id)
+    return snapshot.tariffs.get(tariff_id) if tariff_id is not None else None
@@ -24,6 +24,14 @@ os.environ.setdefault("DATABASE_URL", db_url)
 # Ensure local test runs create the schema via models.Base.metadata.create_all()
 # so pytest tests using the app will have tables available without relying on Alembic.
 os.environ.setdefault("DEV_INIT_DB", "1")
+# No background outbox workers in tests: tests drain the outbox explicitly
+# (vpn_api.outbox.drain) so host side effects happen deterministically.
+os.environ.setdefault("WG_OUTBOX_WORKERS", "0")
+# Same for the payment inbox (vpn_api.payment_inbox.drain).
+os.environ.setdefault("PAYMENT_INBOX_WORKERS", "0")
+# Tests register and log in many users from one client address; the rate
+# limiter tests enable it explicitly.
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
 # remove any stale DB file to start clean
 try:
     if tmp_db.exists():
@@ -0,0 +1,315 @@
+"""Exact-time subscription cutoff with an in-process hierarchical timing wheel.
+
+The expiry sweeper (:mod:`vpn_api.expiry`) runs every ``WG_EXPIRY_INTERVAL``
+seconds, so a lapsed user keeps a working tunnel until the next pass. When
+``WG_EXPIRY_SCHEDULER=1`` the API process also keeps every upcoming
+``users.active_until`` in a :class:`TimingWheel` and, within one tick of the
+deadline, calls :func:`vpn_api.expiry.expire_users`. That call marks the
+subscriptions expired and suspends the user's peers through the outbox;
+a later renewal resumes them (see :mod:`vpn_api.expiry`).
+
+- Deadlines are loaded at startup for the next ``WG_EXPIRY_HORIZON`` seconds
+  (one indexed range scan), and the window is extended as time passes, so
+  memory holds one window rather than every subscription.
+- every committed change of ``active_until`` is reported through
+  :func:`vpn_api.subscriptions.committed` (:func:`reschedule`), so a
+  transaction that rolls back leaves the wheel alone. A renewal just
+  re-adds the user; the old wheel entry
+  is recognised as stale when its slot comes up. Inserting, rescheduling and
+  cancelling are O(1), and a tick costs O(1) plus the entries that are due.
+- Firing is idempotent: ``expire_users`` re-checks the database, so stale
+  entries, transactions that rolled back, and several API workers each
+  running a wheel only cost a no-op query.
+
+Deadlines already past at startup are left to the sweeper, which stays the
+backstop.
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import os
+import threading
+import time
+from datetime import UTC, datetime
+from typing import Callable, Hashable, Optional
+
+from vpn_api import metrics
+
+logger = logging.getLogger(__name__)
+
+WG_EXPIRY_SCHEDULER = os.getenv("WG_EXPIRY_SCHEDULER", "0") == "1"
+# wheel resolution, seconds
+WG_EXPIRY_TICK = float(os.getenv("WG_EXPIRY_TICK", "1"))
+# how far ahead deadlines are kept in memory, seconds
+WG_EXPIRY_HORIZON = float(os.getenv("WG_EXPIRY_HORIZON", "86400"))
+# users expired per transaction when many deadlines share a tick
+WG_EXPIRY_FIRE_BATCH = int(os.getenv("WG_EXPIRY_FIRE_BATCH", "500"))
+
+
+class TimingWheel:
+    """Hierarchical timing wheel of keys with one deadline each.
+
+    Level 0 has one slot per tick; each higher level has one slot per full
+    turn of the level below. Its entries are moved down (cascaded) when the
+    lower level wraps. With the default 256/64/64/64 slots and 1 s ticks the
+    wheel spans about 2 years; later deadlines wait in an overflow list
+    until the top level wraps.
+    """
+
+    def __init__(
+        self, tick: float = 1.0, slots: tuple[int, ...] = (256, 64, 64, 64), start: float = 0.0
+    ):
+        if any(n & (n - 1) for n in slots):
+            raise ValueError("slot counts must be powers of two")
+        self.tick = tick
+        self._bits = [n.bit_length() - 1 for n in slots]
+        self._shift = [sum(self._bits[:i]) for i in range(len(slots))]
+        self._span = [1 << (shift + bits) for shift, bits in zip(self._shift, self._bits)]
+        self._levels: list[list[list]] = [[[] for _ in range(n)] for n in slots]
+        self._layout = [
+            (span, shift, n - 1, level)
+            for span, shift, n, level in zip(self._span, self._shift, slots, self._levels)
+        ]
+        self._overflow: list = []
+        self._ready: list = []
+        self._now = int(start // tick)
+        # key -> deadline tick; entries in slots that disagree are stale
+        self._deadline: dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._deadline)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadline
+
+    def _place(self, entry: tuple) -> None:
+        at = entry[1]
+        delta = at - self._now
+        if delta <= 0:
+            self._ready.append(entry)
+            return
+        for span, shift, mask, slots in self._layout:
+            if delta < span:
+                slots[(at >> shift) & mask].append(entry)
+                return
+        self._overflow.append(entry)
+
+    def add(self, key: Hashable, when: float) -> None:
+        """Fire ``key`` at the first tick at or after ``when`` (replaces its deadline)."""
+        at = math.ceil(when / self.tick)
+        self._deadline[key] = at
+        self._place((key, at))
+
+    def cancel(self, key: Hashable) -> None:
+        self._deadline.pop(key, None)
+
+    def _cascade(self, level: int) -> None:
+        mask = (1 << self._bits[level]) - 1
+        index = (self._now >> self._shift[level]) & mask
+        slot, self._levels[level][index] = self._levels[level][index], []
+        for entry in slot:
+            if self._deadline.get(entry[0]) == entry[1]:
+                self._place(entry)
+
+    def _collect(self, entries: list, out: list) -> None:
+        for key, at in entries:
+            if self._deadline.get(key) == at:
+                del self._deadline[key]
+                out.append(key)
+
+    def _wrap(self) -> None:
+        if self._now & (self._span[-1] - 1) == 0 and self._overflow:
+            overflow, self._overflow = self._overflow, []
+            for entry in overflow:
+                if self._deadline.get(entry[0]) == entry[1]:
+                    self._place(entry)
+        # highest wrapped level first, so its entries can land below
+        for level in range(len(self._span) - 1, 0, -1):
+            if self._now & (self._span[level - 1] - 1) == 0:
+                self._cascade(level)
+
+    def advance(self, now: float) -> list:
+        """Move the wheel to ``now``; returns the keys whose deadline has come."""
+        due: list = []
+        if self._ready:
+            ready, self._ready = self._ready, []
+            self._collect(ready, due)
+        target = int(now // self.tick)
+        mask = self._span[0] - 1
+        while self._now < target:
+            self._now += 1
+            if self._now & mask == 0:
+                self._wrap()
+            slot = self._levels[0][self._now & mask]
+            if slot:
+                self._levels[0][self._now & mask] = []
+                self._collect(slot, due)
+            if self._ready:
+                ready, self._ready = self._ready, []
+                self._collect(ready, due)
+        return due
+
+
+def _ts(value: Optional[datetime]) -> Optional[float]:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        # SQLite hands back naive datetimes; they are stored as UTC
+        value = value.replace(tzinfo=UTC)
+    return value.timestamp()
+
+
+class ExpiryScheduler:
+    """Background thread firing :func:`vpn_api.expiry.expire_users` at user deadlines."""
+
+    def __init__(
+        self,
+        tick: float = WG_EXPIRY_TICK,
+        horizon: float = WG_EXPIRY_HORIZON,
+        fire: Optional[Callable[[list[int], float], None]] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.horizon = horizon
+        self._clock = clock
+        self._fire = fire or self._expire
+        self._wheel = TimingWheel(tick, start=clock())
+        self._lock = threading.Lock()
+        self._loaded_until = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._wheel)
+
+    def reschedule(self, user_id: int, until: Optional[datetime]) -> None:
+        """Record the user's new deadline (None: lifetime or no subscription)."""
+        ts = _ts(until)
+        with self._lock:
+            if ts is None or ts > self._loaded_until:
+                # beyond the window: the next load picks it up
+                self._wheel.cancel(user_id)
+            else:
+                self._wheel.add(user_id, ts)
+        metrics.inc("expiry_scheduler_updates")
+
+    def load(self, db, now: Optional[float] = None) -> int:
+        """Add the deadlines of the next window; returns how many were added."""
+        from vpn_api import models
+
+        now = self._clock() if now is None else now
+        start = max(self._loaded_until, now)
+        until = now + self.horizon
+        if until <= start:
+            return 0
+        users = models.User
+        rows = (
+            db.query(users.id, users.active_until)
+            .filter(
+                users.active_until > datetime.fromtimestamp(start, UTC),
+                users.active_until <= datetime.fromtimestamp(until, UTC),
+                users.active_tariff_id.isnot(None),
+            )
+            .yield_per(10000)
+        )
+        added = 0
+        with self._lock:
+            for user_id, active_until in rows:
+                self._wheel.add(user_id, _ts(active_until))
+                added += 1
+            self._loaded_until = until
+        return added
+
+    def run_once(self, db=None, now: Optional[float] = None) -> list[int]:
+        """Advance the wheel to ``now``, fire what is due and extend the window."""
+        now = self._clock() if now is None else now
+        with self._lock:
+            due = self._wheel.advance(now)
+        for i in range(0, len(due), WG_EXPIRY_FIRE_BATCH):
+            try:
+                self._fire(due[i : i + WG_EXPIRY_FIRE_BATCH], now)
+            except Exception:
+                # the sweeper expires them on its next pass
+                logger.exception("[WG_EXPIRY] firing %d deadlines failed", len(due))
+        if due:
+            metrics.inc("expiry_scheduler_fired", len(due))
+        if db is not None and self._loaded_until - now < self.horizon / 2:
+            self.load(db, now)
+        return due
+
+    @staticmethod
+    def _expire(user_ids: list[int], now: float) -> None:
+        from vpn_api import expiry
+        from vpn_api.database import SessionLocal
+
+        db = SessionLocal()
+        try:
+            expiry.expire_users(db, user_ids, datetime.fromtimestamp(now, UTC))
+        finally:
+            db.close()
+
+    def _run(self) -> None:
+        from vpn_api.database import SessionLocal
+
+        while not self._stop.is_set():
+            db = SessionLocal()
+            try:
+                self.run_once(db)
+            except Exception:
+                logger.exception("expiry scheduler iteration failed")
+                db.rollback()
+            finally:
+                db.close()
+            self._stop.wait(self._wheel.tick)
+
+    def start(self) -> None:
+        from vpn_api.database import SessionLocal
+
+        db = SessionLocal()
+        try:
+            loaded = self.load(db)
+        finally:
+            db.close()
+        logger.info("[WG_EXPIRY] scheduler loaded %d deadlines", loaded)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="expiry-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+_scheduler: Optional[ExpiryScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def start() -> ExpiryScheduler:
+    """Start the process-wide scheduler (application startup)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            scheduler = ExpiryScheduler()
+            scheduler.start()
+            metrics.register_gauge("expiry_scheduler_pending", scheduler.__len__)
+            _scheduler = scheduler
+    return _scheduler
+
+
+def reschedule(user_id: int, until: Optional[datetime]) -> None:
+    """Report a changed deadline; a no-op unless the scheduler runs in this process."""
+    scheduler = _scheduler
+    if scheduler is not None:
+        scheduler.reschedule(user_id, until)
+
+
+def shutdown() -> None:
+    """Stop the process-wide scheduler (application shutdown)."""
+    global _scheduler
+    with _scheduler_lock:
+        scheduler, _scheduler = _scheduler, None
+    if scheduler is not None:
+        scheduler.stop()
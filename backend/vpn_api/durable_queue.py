@@ -0,0 +1,278 @@
+"""Shared machinery of the table-backed work queues.
+
+:mod:`vpn_api.outbox` (host/controller side effects) and
+:mod:`vpn_api.payment_inbox` (store notifications) keep their work in a table
+whose rows have ``status``, ``attempts``, ``next_attempt_at`` and
+``locked_at`` columns. What they have in common lives here, parameterised by
+the model, the column that orders rows (``dedupe_key``, ``user_id``) and the
+module's ``process_one``:
+
+- :func:`claim` moves the oldest due row to ``processing`` with a conditional
+  ``UPDATE`` (safe across threads and uvicorn workers). A row is not claimed
+  while an earlier row of its group is pending or processing, so each group
+  runs in order;
+- :func:`backoff`, :func:`recover_stale`, :func:`requeue` and :func:`counts`;
+- :class:`Worker`, the background threads, and :class:`ProcessWorker`, the
+  process-wide instance behind each module's ``get_worker``, ``notify`` and
+  ``shutdown``;
+- :func:`main`, the ``stats`` / requeue / ``drain`` command line.
+
+Each module keeps its settings, its handler and how a finished row is
+recorded (retry, dead letter, metrics).
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+from typing import Any, Callable, Optional
+
+from sqlalchemy import and_, exists, func, select, update
+from sqlalchemy.orm import aliased
+
+logger = logging.getLogger(__name__)
+
+UNFINISHED = ("pending", "processing")
+
+
+def _now() -> datetime:
+    return datetime.now(UTC)
+
+
+def backoff(attempts: int, base: float, cap: float) -> float:
+    """Delay before retry number ``attempts`` (1-based), with +-20% jitter."""
+    delay = min(base * 2 ** (attempts - 1), cap)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _no_earlier_unfinished(model, group: str):
+    earlier = aliased(model)
+    return ~exists().where(
+        and_(
+            getattr(earlier, group) == getattr(model, group),
+            earlier.id < model.id,
+            earlier.status.in_(UNFINISHED),
+        )
+    )
+
+
+def claim(db, model, group: str):
+    """Atomically move the oldest due row of ``model`` to ``processing`` and return it.
+
+    Rows whose ``group`` column matches an earlier unfinished row are skipped.
+    """
+    now = _now()
+    candidates = db.scalars(
+        select(model.id)
+        .where(
+            model.status == "pending",
+            model.next_attempt_at <= now,
+            _no_earlier_unfinished(model, group),
+        )
+        .order_by(model.id)
+        .limit(8)
+    ).all()
+    for row_id in candidates:
+        claimed = db.execute(
+            update(model)
+            .where(
+                model.id == row_id, model.status == "pending", _no_earlier_unfinished(model, group)
+            )
+            .values(status="processing", locked_at=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        if claimed:
+            return db.get(model, row_id)
+    return None
+
+
+def recover_stale(db, model, lease: float) -> int:
+    """Re-queue rows stuck in ``processing`` longer than ``lease`` seconds."""
+    count = db.execute(
+        update(model)
+        .where(model.status == "processing", model.locked_at < _now() - timedelta(seconds=lease))
+        .values(status="pending", locked_at=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return count
+
+
+def requeue(db, model, status: str, ids: Optional[list[int]] = None, **values) -> int:
+    """Move rows in ``status`` (all, or ``ids``) back to pending with a fresh attempt budget."""
+    stmt = update(model).where(model.status == status)
+    if ids:
+        stmt = stmt.where(model.id.in_(ids))
+    count = db.execute(
+        stmt.values(
+            status="pending", attempts=0, next_attempt_at=_now(), **values
+        ).execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return count
+
+
+def counts(db, model) -> dict[str, int]:
+    """Return the number of rows per status."""
+    return dict(db.execute(select(model.status, func.count(model.id)).group_by(model.status)).all())
+
+
+def drain(db, process_one: Callable[[Any], bool], max_items: Optional[int] = None) -> int:
+    """Run ``process_one`` in the calling thread until it finds nothing; returns the count."""
+    handled = 0
+    while max_items is None or handled < max_items:
+        if not process_one(db):
+            break
+        handled += 1
+    return handled
+
+
+class Worker:
+    """Background threads calling ``process_one`` until the queue is empty, then sleeping.
+
+    ``maintenance`` (e.g. re-queueing stale rows) runs about once a minute per thread.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        process_one: Callable[[Any], bool],
+        maintenance: Callable[[Any], None],
+        workers: int,
+        poll: float,
+    ):
+        self.name = name
+        self.process_one = process_one
+        self.maintenance = maintenance
+        self.workers = workers
+        self.poll = poll
+        self._wake = threading.Condition()
+        self._pending_wake = False
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._start_lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._start_lock:
+            if any(t.is_alive() for t in self._threads):
+                return
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for t in self._threads:
+                t.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self.notify()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def notify(self) -> None:
+        """Wake the workers (call after committing new rows)."""
+        with self._wake:
+            self._pending_wake = True
+            self._wake.notify_all()
+
+    def _sleep(self) -> None:
+        with self._wake:
+            if not self._pending_wake and not self._stop.is_set():
+                self._wake.wait(self.poll)
+            self._pending_wake = False
+
+    def _run(self) -> None:
+        from vpn_api.database import SessionLocal
+
+        last_maintenance = 0.0
+        while not self._stop.is_set():
+            db = SessionLocal()
+            try:
+                if time.monotonic() - last_maintenance > 60:
+                    last_maintenance = time.monotonic()
+                    self.maintenance(db)
+                while not self._stop.is_set() and self.process_one(db):
+                    pass
+            except Exception:
+                logger.exception("%s worker iteration failed", self.name)
+                db.rollback()
+            finally:
+                db.close()
+            self._sleep()
+
+
+class ProcessWorker:
+    """The process-wide :class:`Worker` of one queue, built by ``factory`` on first use."""
+
+    def __init__(self, factory: Callable[[], Worker]):
+        self._factory = factory
+        self._worker: Optional[Worker] = None
+        self._lock = threading.Lock()
+
+    @property
+    def current(self) -> Optional[Worker]:
+        return self._worker
+
+    def get(self) -> Worker:
+        """Return the worker, starting it on first use (unless it has no threads)."""
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    worker = self._factory()
+                    if worker.workers > 0:
+                        worker.start()
+                    self._worker = worker
+        return self._worker
+
+    def notify(self) -> None:
+        self.get().notify()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is not None:
+            worker.stop()
+
+
+def main(
+    argv: Optional[list[str]],
+    prog: str,
+    stats: Callable[[Any], dict],
+    requeue: Callable[[Any, Optional[list[int]]], int],
+    drain: Callable[[Any], int],
+    *,
+    stats_help: str,
+    requeue_command: str,
+    requeue_help: str,
+    ids_help: str,
+    drain_help: str,
+) -> int:
+    parser = argparse.ArgumentParser(prog=prog)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help=stats_help)
+    requeue_cmd = sub.add_parser(requeue_command, help=requeue_help)
+    requeue_cmd.add_argument("ids", nargs="*", type=int, help=ids_help)
+    sub.add_parser("drain", help=drain_help)
+    args = parser.parse_args(argv)
+
+    from vpn_api.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        if args.command == "stats":
+            print(json.dumps(stats(db), sort_keys=True))
+        elif args.command == requeue_command:
+            print(f"requeued {requeue(db, args.ids)}")
+        else:
+            print(f"processed {drain(db)}")
+    finally:
+        db.close()
+    return 0
@@ -0,0 +1,276 @@
+"""Scheduled expiry of subscriptions and deprovisioning of lapsed users' peers.
+
+Replaces ``mark_expired_subscriptions``, which loaded every expired
+``UserTariff`` into the ORM after each webhook. :func:`sweep` runs on a
+schedule and works in chunks of ``WG_EXPIRY_BATCH`` rows. Each chunk is one
+transaction:
+
+1. ``UPDATE user_tariffs SET status = 'expired' WHERE id IN (SELECT ... LIMIT n)
+   RETURNING user_id``, served by the partial index on active rows;
+2. the returned users that no longer have access according to
+   ``users.active_tariff_id`` / ``active_until`` (see
+   :mod:`vpn_api.subscriptions`) are cleared, and their active peers are
+   suspended: set inactive, with an outbox event that removes them from the
+   host (retried, and a no-op unless ``WG_APPLY_ENABLED=1``) and disables
+   their wg-easy client.
+
+Suspended peers keep their key, address and stored config. When the user
+renews, :func:`vpn_api.subscriptions.refresh` calls :func:`resume_peers`,
+which reactivates them and queues the re-apply / wg-easy enable, so the
+config the client already has keeps working. Peers still suspended
+``WG_EXPIRY_PURGE_AFTER`` seconds after the user's last subscription ended
+are deleted (:func:`purge_lapsed`), which frees their addresses.
+
+Access itself never waits for the sweep: the materialized deadline is
+compared with the current time on every check.
+
+Run ``python -m vpn_api.expiry`` (loop) or ``--once`` / ``--dry-run``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import UTC, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import and_, delete, func, or_, select, text, update
+
+from vpn_api import ipam, metrics, models, outbox
+
+logger = logging.getLogger(__name__)
+
+WG_EXPIRY_INTERVAL = float(os.getenv("WG_EXPIRY_INTERVAL", "60"))
+# user_tariffs rows expired per transaction
+WG_EXPIRY_BATCH = int(os.getenv("WG_EXPIRY_BATCH", "1000"))
+# "0": only mark subscriptions expired, leave peers alone
+WG_EXPIRY_DEPROVISION = os.getenv("WG_EXPIRY_DEPROVISION", "1") == "1"
+# delete peers this long after the user's last subscription ended, seconds (0: never)
+WG_EXPIRY_PURGE_AFTER = float(os.getenv("WG_EXPIRY_PURGE_AFTER", str(90 * 24 * 3600)))
+
+UT = models.UserTariff
+# literal, so the partial index ix_user_tariffs_active_ended matches it
+_ACTIVE = text("user_tariffs.status = 'active'")
+
+
+def _due(now: datetime, batch: int):
+    return select(UT.id).where(_ACTIVE, UT.ended_at <= now).limit(batch)
+
+
+def count_due(db, now: Optional[datetime] = None) -> int:
+    now = now or datetime.now(UTC)
+    return db.scalar(select(func.count()).select_from(UT).where(_ACTIVE, UT.ended_at <= now))
+
+
+def _lapsed(db, user_ids: list[int], now: datetime) -> list[int]:
+    """Users among ``user_ids`` without access at ``now``; their state is cleared."""
+    users = models.User
+    has_access = and_(
+        users.active_tariff_id.isnot(None),
+        or_(users.active_until.is_(None), users.active_until > now),
+    )
+    lapsed = list(db.scalars(select(users.id).where(users.id.in_(user_ids), ~has_access)))
+    if lapsed:
+        db.execute(
+            update(users)
+            .where(users.id.in_(lapsed), users.active_tariff_id.isnot(None))
+            .values(active_tariff_id=None, active_until=None)
+        )
+    return lapsed
+
+
+def _deactivate_peers(db, user_ids: list[int]) -> int:
+    """Suspend the users' active peers through the outbox; returns how many."""
+    P = models.VpnPeer
+    # rows, not entities: outbox.enqueue_suspend only reads these attributes
+    peers = db.execute(
+        select(P.id, P.wg_public_key, P.allowed_ips, P.wg_client_id).where(
+            P.user_id.in_(user_ids), P.active
+        )
+    ).all()
+    if peers:
+        db.execute(update(P).where(P.id.in_([p.id for p in peers])).values(active=False))
+        for peer in peers:
+            outbox.enqueue_suspend(db, peer)
+    return len(peers)
+
+
+def resume_peers(db, user_id: int) -> int:
+    """Reactivate the peers suspended for ``user_id``; the caller commits.
+
+    Called by :func:`vpn_api.subscriptions.refresh` once the user has access.
+    Parked peers come back too: they are re-applied like the others.
+    """
+    P = models.VpnPeer
+    peers = db.query(P).filter(P.user_id == user_id, P.active.is_(False)).all()
+    for peer in peers:
+        peer.active = True
+        peer.idle_since = None
+        outbox.enqueue_resume(db, peer)
+    if peers:
+        metrics.inc("expiry_peers_resumed", len(peers))
+    return len(peers)
+
+
+def purge_lapsed(
+    db,
+    now: Optional[datetime] = None,
+    purge_after: float = WG_EXPIRY_PURGE_AFTER,
+    batch: int = WG_EXPIRY_BATCH,
+) -> int:
+    """Delete peers suspended ``purge_after`` seconds past the user's last subscription.
+
+    Their addresses go back to the pool and their wg-easy clients are deleted
+    through the outbox. Returns how many peers were deleted.
+    """
+    if purge_after <= 0:
+        return 0
+    now = now or datetime.now(UTC)
+    cutoff = now - timedelta(seconds=purge_after)
+    P, users = models.VpnPeer, models.User
+    last_end = select(func.max(UT.ended_at)).where(UT.user_id == P.user_id).scalar_subquery()
+    total = 0
+    while True:
+        candidates = db.scalars(
+            select(P.id)
+            .join(users, users.id == P.user_id)
+            .where(P.active.is_(False), users.active_tariff_id.is_(None), last_end < cutoff)
+            .limit(batch)
+        ).all()
+        if not candidates:
+            db.rollback()
+            break
+        # re-checked in the DELETE: a renewal may have resumed some meanwhile
+        peers = db.execute(
+            delete(P)
+            .where(P.id.in_(candidates), P.active.is_(False))
+            .returning(P.id, P.wg_public_key, P.allowed_ips, P.wg_client_id, P.wg_ip)
+        ).all()
+        for peer in peers:
+            if peer.wg_client_id:
+                outbox.enqueue_remove(db, peer)
+        db.commit()
+        pool = ipam.get_pool(db)
+        for peer in peers:
+            pool.release(peer.wg_ip)
+        if any(p.wg_client_id for p in peers):
+            outbox.notify()
+        total += len(peers)
+        metrics.inc("expiry_peers_purged", len(peers))
+        if len(candidates) < batch:
+            break
+    return total
+
+
+def sweep(
+    db,
+    now: Optional[datetime] = None,
+    batch: int = WG_EXPIRY_BATCH,
+    deprovision: bool = WG_EXPIRY_DEPROVISION,
+    max_batches: Optional[int] = None,
+) -> dict[str, int]:
+    """Expire every subscription ended by ``now``; returns counts."""
+    now = now or datetime.now(UTC)
+    totals = {"expired": 0, "lapsed_users": 0, "peers": 0}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        user_ids = list(
+            db.scalars(
+                update(UT)
+                .where(UT.id.in_(_due(now, batch).scalar_subquery()))
+                .values(status="expired")
+                .returning(UT.user_id)
+                .execution_options(synchronize_session=False)
+            )
+        )
+        if not user_ids:
+            db.rollback()
+            break
+        lapsed = _lapsed(db, sorted(set(user_ids)), now)
+        peers = _deactivate_peers(db, lapsed) if deprovision and lapsed else 0
+        db.commit()
+        if peers:
+            outbox.notify()
+        batches += 1
+        totals["expired"] += len(user_ids)
+        totals["lapsed_users"] += len(lapsed)
+        totals["peers"] += peers
+        metrics.inc("expiry_subscriptions", len(user_ids))
+        metrics.inc("expiry_peers_deactivated", peers)
+        if len(user_ids) < batch:
+            break
+    if totals["expired"]:
+        logger.info(
+            "[WG_EXPIRY] expired=%d lapsed_users=%d peers=%d",
+            totals["expired"],
+            totals["lapsed_users"],
+            totals["peers"],
+        )
+    return totals
+
+
+def expire_users(db, user_ids: list[int], now: Optional[datetime] = None) -> dict[str, int]:
+    """Expire the ended subscriptions of ``user_ids`` and deprovision the lapsed ones.
+
+    Used by :mod:`vpn_api.deadlines` at each user's exact deadline. Every
+    step re-checks the database, so users who renewed in the meantime (or
+    were already handled) are left alone.
+    """
+    now = now or datetime.now(UTC)
+    user_ids = sorted(set(user_ids))
+    expired = db.execute(
+        update(UT)
+        .where(UT.user_id.in_(user_ids), _ACTIVE, UT.ended_at <= now)
+        .values(status="expired")
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    lapsed = _lapsed(db, user_ids, now)
+    deprovision = lapsed and WG_EXPIRY_DEPROVISION
+    peers = _deactivate_peers(db, lapsed) if deprovision else 0
+    db.commit()
+    if peers:
+        outbox.notify()
+    metrics.inc("expiry_subscriptions", expired)
+    metrics.inc("expiry_peers_deactivated", peers)
+    return {"expired": expired, "lapsed_users": len(lapsed), "peers": peers}
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m vpn_api.expiry",
+        description="Expire ended subscriptions and deprovision the peers of lapsed users.",
+    )
+    parser.add_argument("--once", action="store_true", help="run a single pass and exit")
+    parser.add_argument("--dry-run", action="store_true", help="count due subscriptions only")
+    parser.add_argument("--batch", type=int, default=WG_EXPIRY_BATCH)
+    parser.add_argument("--interval", type=float, default=WG_EXPIRY_INTERVAL)
+    args = parser.parse_args(argv)
+
+    from vpn_api.database import SessionLocal
+
+    while True:
+        db = SessionLocal()
+        try:
+            if args.dry_run:
+                print(f"due: {count_due(db)}")
+            else:
+                totals = sweep(db, batch=args.batch)
+                totals["purged"] = purge_lapsed(db, batch=args.batch)
+                print(" ".join(f"{k}={v}" for k, v in totals.items()))
+        except Exception:
+            logger.exception("expiry sweep failed")
+            db.rollback()
+            if args.once:
+                return 1
+        finally:
+            db.close()
+        if args.once or args.dry_run:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""Password hashing on a dedicated process pool.
+
+pbkdf2 hashing and verification are CPU-bound and used to run on the shared
+request threadpool, so a burst of logins starved every other endpoint. Here
+they run in ``PASSWORD_HASH_WORKERS`` separate processes. The request thread
+only waits on a future, and concurrent hashes are capped by the pool size
+rather than by the request threadpool.
+
+At most ``PASSWORD_HASH_QUEUE`` calls may be running or queued per process.
+Beyond that :class:`HashPoolSaturated` is raised straight away, which the auth
+endpoints turn into a 503, instead of letting the queue (and latency) grow.
+``PASSWORD_HASH_WORKERS=0`` hashes inline, as before.
+
+Workers are started with ``spawn``, so no state of the (threaded) server
+process is inherited. A crashed pool is replaced on the next call.
+"""
+
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from passlib.context import CryptContext
+
+from vpn_api import metrics
+
+logger = logging.getLogger(__name__)
+
+# Prefer pbkdf2_sha256 to avoid bcrypt's 72-byte input limit and any CI
+# platform-dependent bcrypt backend issues. Keep bcrypt_sha256 and bcrypt
+# as fallbacks so existing hashes remain verifiable.
+pwd_context = CryptContext(schemes=["pbkdf2_sha256", "bcrypt_sha256", "bcrypt"], deprecated="auto")
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Calls running or waiting per process before new ones are shed.
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", str(max(1, PASSWORD_HASH_WORKERS) * 8)))
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "10"))
+
+
+class HashPoolSaturated(Exception):
+    """The hashing queue is full (or a call timed out); the caller should shed load."""
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(plain: str, hashed: str) -> bool:
+    return pwd_context.verify(plain, hashed)
+
+
+class HashPool:
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        queue: int = PASSWORD_HASH_QUEUE,
+        timeout: float = PASSWORD_HASH_TIMEOUT,
+    ):
+        self.workers = workers
+        self.queue = queue
+        self.timeout = timeout
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _reset(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, _future=None) -> None:
+        with self._lock:
+            self._depth -= 1
+
+    def run(self, fn, *args):
+        """Run ``fn(*args)`` on the pool; raises HashPoolSaturated when over the limit."""
+        if self.workers <= 0:
+            return fn(*args)
+        with self._lock:
+            if self._depth >= self.queue:
+                metrics.inc("hash_shed")
+                raise HashPoolSaturated(f"{self._depth} hashing calls in flight")
+            self._depth += 1
+        start = time.perf_counter()
+        future = None
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args)
+                return future.result(timeout=self.timeout)
+            except BrokenProcessPool:
+                logger.warning("password hashing pool broke; restarting it")
+                metrics.inc("hash_pool_restarts")
+                self._reset(executor)
+                future = self._get_executor().submit(fn, *args)
+                return future.result(timeout=self.timeout)
+            except FutureTimeout as e:
+                future.cancel()
+                metrics.inc("hash_timeouts")
+                raise HashPoolSaturated("hashing call timed out") from e
+        finally:
+            if future is None:
+                self._release()
+            else:
+                # a call that timed out keeps its slot until a worker is done with it
+                future.add_done_callback(self._release)
+            metrics.inc("hash_calls")
+            metrics.inc("hash_seconds", time.perf_counter() - start)
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+_pool: Optional[HashPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_hash_pool() -> HashPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = HashPool()
+                metrics.register_gauge("hash_queue_depth", lambda: pool.depth)
+                _pool = pool
+    return _pool
+
+
+def hash_password(password: str) -> str:
+    return get_hash_pool().run(_hash, password)
+
+
+def verify_password(plain: str, hashed: str) -> bool:
+    return get_hash_pool().run(_verify, plain, hashed)
+
+
+def shutdown() -> None:
+    """Stop the worker processes (called on application shutdown)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
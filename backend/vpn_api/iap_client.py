@@ -0,0 +1,219 @@
+"""Pooled HTTP client for the app store receipt APIs.
+
+``IapValidator`` used to call ``requests.post`` for every webhook. Each call
+opened a new TCP + TLS connection to Apple and held the request thread for
+up to 10 s. Like :mod:`vpn_api.wg_easy_pool`, this module runs one event loop
+on a daemon thread with a shared keep-alive ``aiohttp.ClientSession``. Its
+connector caps concurrent connections per store host (``IAP_HTTP_POOL_SIZE``),
+and a short connect timeout makes an unreachable store fail fast.
+
+Apple answers 21007 when a sandbox receipt is sent to production (and 21008
+for the opposite case). The call is then repeated once against the other
+environment, which is what Apple recommends for apps that ship TestFlight
+builds.
+
+Every round trip is recorded in the ``iap_<store>_seconds`` histogram (see
+:func:`vpn_api.metrics.observe`).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Optional
+
+from vpn_api import metrics
+
+APPLE_PRODUCTION_URL = os.getenv(
+    "APPLE_PRODUCTION_URL", "https://buy.itunes.apple.com/verifyReceipt"
+)
+APPLE_SANDBOX_URL = os.getenv("APPLE_SANDBOX_URL", "https://sandbox.itunes.apple.com/verifyReceipt")
+GOOGLE_PLAY_API_URL = os.getenv(
+    "GOOGLE_PLAY_API_URL", "https://androidpublisher.googleapis.com/androidpublisher/v3"
+)
+# Max keep-alive connections per store host.
+IAP_HTTP_POOL_SIZE = int(os.getenv("IAP_HTTP_POOL_SIZE", "16"))
+# Read timeout for one receipt call, seconds.
+IAP_HTTP_TIMEOUT = float(os.getenv("IAP_HTTP_TIMEOUT", "10"))
+IAP_HTTP_CONNECT_TIMEOUT = float(os.getenv("IAP_HTTP_CONNECT_TIMEOUT", "3"))
+
+# verifyReceipt status codes
+APPLE_SANDBOX_RECEIPT = 21007
+APPLE_PRODUCTION_RECEIPT = 21008
+
+
+class IapHttpError(Exception):
+    """Transport failure or non-2xx answer from a store API.
+
+    ``status`` is the HTTP status, None when no answer was received.
+    """
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def transient(self) -> bool:
+        """True when the store or our access to it failed, rather than the receipt."""
+        return self.status is None or self.status in (401, 403, 408, 429) or self.status >= 500
+
+
+class IapHttpClient:
+    """Receipt API calls on a shared loop thread with keep-alive connections."""
+
+    def __init__(
+        self,
+        pool_size: int = IAP_HTTP_POOL_SIZE,
+        timeout: float = IAP_HTTP_TIMEOUT,
+        connect_timeout: float = IAP_HTTP_CONNECT_TIMEOUT,
+    ):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Any = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def _run():
+                    asyncio.set_event_loop(loop)
+                    ready.set()
+                    loop.run_forever()
+
+                self._thread = threading.Thread(target=_run, name="iap-http-loop", daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._loop = loop
+            return self._loop
+
+    def _get_session(self):
+        # only touched on the loop thread
+        if self._session is None:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(
+                limit=0, limit_per_host=self.pool_size, keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=self.timeout, sock_connect=self.connect_timeout
+                ),
+            )
+        return self._session
+
+    async def _request(self, store: str, method: str, url: str, **kwargs: Any) -> Any:
+        import aiohttp
+
+        start = time.perf_counter()
+        try:
+            async with self._get_session().request(method, url, **kwargs) as resp:
+                if resp.status >= 400:
+                    raise IapHttpError(f"{store} answered HTTP {resp.status}", resp.status)
+                data = await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+            metrics.inc(f"iap_{store}_errors")
+            raise IapHttpError(f"{store} request failed: {exc!r}") from exc
+        except IapHttpError:
+            metrics.inc(f"iap_{store}_errors")
+            raise
+        finally:
+            metrics.observe(f"iap_{store}_seconds", time.perf_counter() - start)
+        metrics.inc(f"iap_{store}_calls")
+        return data
+
+    async def _verify_apple(self, payload: dict, url: str) -> dict:
+        data = await self._request("apple", "POST", url, json=payload)
+        status = data.get("status")
+        other = None
+        if status == APPLE_SANDBOX_RECEIPT and url != APPLE_SANDBOX_URL:
+            other = APPLE_SANDBOX_URL
+        elif status == APPLE_PRODUCTION_RECEIPT and url != APPLE_PRODUCTION_URL:
+            other = APPLE_PRODUCTION_URL
+        if other is not None:
+            metrics.inc("iap_apple_redirects")
+            data = await self._request("apple", "POST", other, json=payload)
+        return data
+
+    def run(self, coro) -> Any:
+        """Run ``coro`` on the client loop and block until it completes."""
+        loop = self._ensure_loop()
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("IapHttpClient.run() must not be called from the loop thread")
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            # the session timeout fires first; this only guards the redirect pair
+            return future.result(2 * self.timeout + 1)
+        except TimeoutError as exc:
+            future.cancel()
+            raise IapHttpError("store request timed out") from exc
+
+    def verify_apple(self, payload: dict, url: Optional[str] = None) -> dict:
+        """POST ``payload`` to verifyReceipt and return the decoded answer.
+
+        A 21007 from production (21008 from sandbox) is retried once against
+        the other environment.
+        """
+        return self.run(self._verify_apple(payload, url or APPLE_PRODUCTION_URL))
+
+    def get_google_purchase(
+        self, package_name: str, product_id: str, token: str, access_token: str
+    ) -> dict:
+        """purchases.products.get for one purchase token."""
+        url = (
+            f"{GOOGLE_PLAY_API_URL}/applications/{package_name}"
+            f"/purchases/products/{product_id}/tokens/{token}"
+        )
+        headers = {"Authorization": f"Bearer {access_token}"}
+        return self.run(self._request("google", "GET", url, headers=headers))
+
+    async def _close_session(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def close(self) -> None:
+        """Close the session and stop the loop thread."""
+        with self._start_lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_session(), loop).result(self.timeout)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            if thread is not None:
+                thread.join(self.timeout)
+            loop.close()
+
+
+_client: Optional[IapHttpClient] = None
+_client_lock = threading.Lock()
+
+
+def get_iap_client() -> IapHttpClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = IapHttpClient()
+    return _client
+
+
+def shutdown() -> None:
+    """Close the process-wide pools (called on application shutdown)."""
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
@@ -5,19 +5,39 @@ from Apple and Google, mapping product IDs to tariff IDs, and extracting
 purchase information.
 """
 
+import logging
 import os
 from datetime import datetime
-from typing import ClassVar, Dict, Optional
+from typing import Dict, Optional
 
-import requests
+from vpn_api import catalog, iap_client
+
+logger = logging.getLogger(__name__)
+
+# verifyReceipt: "temporarily unable to provide the receipt" / internal data access errors
+APPLE_SERVER_UNAVAILABLE = 21005
+APPLE_INTERNAL_ERRORS = range(21100, 21200)
+
+
+class StoreUnavailable(Exception):
+    """The store could not be asked (outage, timeout, rejected credentials).
+
+    Raised instead of returning None so callers can retry later rather than
+    treat the receipt as invalid.
+    """
+
+
+def _unavailable(store: str, exc: iap_client.IapHttpError) -> StoreUnavailable:
+    logger.warning("%s receipt validation unavailable: %s", store, exc)
+    return StoreUnavailable(f"{store} receipt validation unavailable: {exc}")
 
 
 class IapValidator:
     """Validates receipts from Apple IAP and Google Play."""
 
     # Apple constants
-    APPLE_SANDBOX_URL = "https://sandbox.itunes.apple.com/verifyReceipt"
-    APPLE_PRODUCTION_URL = "https://buy.itunes.apple.com/verifyReceipt"
+    APPLE_SANDBOX_URL = iap_client.APPLE_SANDBOX_URL
+    APPLE_PRODUCTION_URL = iap_client.APPLE_PRODUCTION_URL
 
     @staticmethod
     def validate_apple_receipt(receipt: str, bundle_id: str) -> Optional[Dict]:
@@ -31,8 +51,12 @@ class IapValidator:
             Dict with keys: transaction_id, product_id, purchase_date, expiry_date, is_valid
             None if validation fails
 
+        Raises:
+            StoreUnavailable: Apple could not be reached or answered with a server error
+
         """
-        url = os.getenv("APPLE_RECEIPT_URL", IapValidator.APPLE_SANDBOX_URL)
+        # production first: sandbox receipts come back as 21007 and are retried there
+        url = os.getenv("APPLE_RECEIPT_URL", IapValidator.APPLE_PRODUCTION_URL)
 
         payload = {
             "receipt-data": receipt,
@@ -41,11 +65,18 @@ class IapValidator:
         }
 
         try:
-            resp = requests.post(url, json=payload, timeout=10)
-            resp.raise_for_status()
-            data = resp.json()
+            data = iap_client.get_iap_client().verify_apple(payload, url)
+        except iap_client.IapHttpError as e:
+            if e.transient:
+                raise _unavailable("Apple", e) from e
+            logger.warning("Apple receipt validation error: %s", e)
+            return None
+        status = data.get("status")
+        if status == APPLE_SERVER_UNAVAILABLE or status in APPLE_INTERNAL_ERRORS:
+            raise _unavailable("Apple", iap_client.IapHttpError(f"verifyReceipt status {status}"))
 
-            if data.get("status") != 0:
+        try:
+            if status != 0:
                 return None  # Receipt invalid
 
             # Extract latest transaction
@@ -71,7 +102,7 @@ class IapValidator:
                 "is_valid": True,
             }
         except Exception as e:
-            print(f"Apple receipt validation error: {e}")
+            logger.warning("Apple receipt validation error: %s", e)
             return None
 
     @staticmethod
@@ -86,36 +117,51 @@ class IapValidator:
         Returns:
             Dict with purchase information or None if validation fails
 
+        Raises:
+            StoreUnavailable: Google Play could not be reached or refused our token
+
         Note:
-            Requires Google Play service account credentials in environment
-            or as a JSON file.
+            Requires a Google Play service account access token in
+            GOOGLE_PLAY_ACCESS_TOKEN; returns None without one.
 
         """
-        # Implement Google Play API validation
         # https://developers.google.com/android-publisher/api-ref/rest/v3/purchases.products/get
-        # Requires: oauth2 service account credentials
+        # Requires an OAuth2 access token of a service account; minting and
+        # refreshing it is not implemented yet, so without one this stays a stub.
+        access_token = os.getenv("GOOGLE_PLAY_ACCESS_TOKEN")
+        if not access_token:
+            return None
+
+        try:
+            data = iap_client.get_iap_client().get_google_purchase(
+                package_name, product_id, token, access_token
+            )
+        except iap_client.IapHttpError as e:
+            if e.transient:
+                raise _unavailable("Google", e) from e
+            logger.warning("Google receipt validation error: %s", e)
+            return None
 
-        # Placeholder for now
-        return None
+        # purchaseState: 0 purchased, 1 canceled, 2 pending
+        if data.get("purchaseState") != 0:
+            return None
+
+        purchase_time_ms = int(data.get("purchaseTimeMillis", 0))
+        return {
+            "transaction_id": data.get("orderId"),
+            "product_id": product_id,
+            "purchase_date": datetime.fromtimestamp(purchase_time_ms / 1000),
+            "expiry_date": None,
+            "is_valid": True,
+        }
 
 
 class ProductIdToTariffMapper:
-    """Maps product IDs to tariff IDs and provides tariff information."""
-
-    # Mapping of product IDs to tariff IDs
-    # This should ideally come from the database, but for now we use a static mapping
-    MAPPING: ClassVar = {
-        "com.example.vpn.monthly": 1,  # 30 дней
-        "com.example.vpn.annual": 2,  # 365 дней
-        "com.example.vpn.lifetime": 3,  # Lifetime
-    }
-
-    # Duration in days for each tariff
-    DURATION_MAPPING: ClassVar = {
-        1: 30,  # Monthly
-        2: 365,  # Annual
-        3: 36500,  # Lifetime (~100 years)
-    }
+    """Maps product IDs to tariff IDs and provides tariff information.
+
+    Backed by the ``products`` / ``tariffs`` tables through the in-process
+    snapshot in :mod:`vpn_api.catalog`.
+    """
 
     @staticmethod
     def get_tariff_id(product_id: str) -> Optional[int]:
@@ -128,7 +174,8 @@ class ProductIdToTariffMapper:
             Tariff ID or None if product_id is not recognized
 
         """
-        return ProductIdToTariffMapper.MAPPING.get(product_id)
+        tariff = catalog.product_tariff(product_id)
+        return tariff.id if tariff else None
 
     @staticmethod
     def get_duration_days(tariff_id: int) -> int:
@@ -138,10 +185,11 @@ class ProductIdToTariffMapper:
             tariff_id: Tariff ID from database
 
         Returns:
-            Duration in days
+            Duration in days (0 if the tariff is unknown)
 
         """
-        return ProductIdToTariffMapper.DURATION_MAPPING.get(tariff_id, 0)
+        tariff = catalog.tariff(tariff_id)
+        return tariff.duration_days if tariff else 0
 
     @staticmethod
     def get_product_ids() -> list:
@@ -151,4 +199,4 @@ class ProductIdToTariffMapper:
             List of product IDs
 
         """
-        return list(ProductIdToTariffMapper.MAPPING.keys())
+        return list(catalog.get_catalog().products)
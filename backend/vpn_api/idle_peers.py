@@ -0,0 +1,180 @@
+"""Idle-peer reaping and lazy re-activation on the WireGuard interface.
+
+``apply_peer`` adds every peer to the interface for good, so the kernel peer
+table keeps growing with users who never connect. :func:`reap` reads the
+interface once (``wg show <iface> dump`` via :mod:`vpn_api.wg_host`) and
+parks every peer whose latest handshake (or creation time, if it never
+connected) is older than ``WG_IDLE_AFTER``: ``vpn_peers.idle_since`` is set and
+the peer is removed from the interface with one ``wg set`` per batch. The row
+stays active, so nothing changes for the user.
+
+A parked peer is put back through the outbox (:func:`wake`) on its next
+``GET /vpn_peers/self/config`` or when the user's subscription is renewed.
+The WireGuard handshake itself never reaches the API, so a client that keeps
+an old config and never asks for it again stays parked until one of those
+happens.
+
+Parked peers are excluded from :func:`vpn_api.wg_host.desired_peers` and the
+reconciler's DB snapshot, so neither puts them back. Peers managed by wg-easy
+(``wg_client_id`` set) are skipped: wg-easy owns its interface and would
+re-add them on its next config write.
+
+Run ``python -m vpn_api.idle_peers`` (loop) or ``--once`` / ``--dry-run``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import UTC, datetime
+from typing import Optional
+
+from vpn_api import metrics, models, outbox, wg_host
+
+logger = logging.getLogger(__name__)
+
+# Park peers without a handshake for this long, seconds.
+WG_IDLE_AFTER = int(os.getenv("WG_IDLE_AFTER", str(14 * 24 * 3600)))
+WG_IDLE_INTERVAL = float(os.getenv("WG_IDLE_INTERVAL", "3600"))
+# Peers removed per ``wg set`` invocation / DB transaction.
+WG_IDLE_BATCH = int(os.getenv("WG_IDLE_BATCH", "500"))
+
+
+def _ts(value: Optional[datetime]) -> float:
+    if value is None:
+        return 0.0
+    if value.tzinfo is None:
+        # SQLite hands back naive datetimes; they are stored as UTC
+        value = value.replace(tzinfo=UTC)
+    return value.timestamp()
+
+
+def find_idle(
+    db, state: wg_host.InterfaceState, now: float, idle_after: int = WG_IDLE_AFTER
+) -> list[tuple[int, str]]:
+    """Return (peer id, public key) of live interface peers idle for ``idle_after``."""
+    cutoff = now - idle_after
+    rows = db.query(
+        models.VpnPeer.id, models.VpnPeer.wg_public_key, models.VpnPeer.created_at
+    ).filter(
+        models.VpnPeer.active.is_(True),
+        models.VpnPeer.idle_since.is_(None),
+        models.VpnPeer.wg_client_id.is_(None),
+    )
+    idle = []
+    for peer_id, pub, created_at in rows.yield_per(10000):
+        live = state.peers.get(pub)
+        if live is None:
+            # not on the interface: nothing to reap (drift is the reconciler's job)
+            continue
+        last = live.latest_handshake or _ts(created_at)
+        if last < cutoff:
+            idle.append((peer_id, pub))
+    return idle
+
+
+def reap(
+    db,
+    iface: Optional[str] = None,
+    dry_run: bool = False,
+    idle_after: int = WG_IDLE_AFTER,
+    now: Optional[float] = None,
+) -> list[int]:
+    """Park idle peers and remove them from ``iface``; returns the parked peer ids.
+
+    Like :func:`vpn_api.wg_host.reconcile` this does not look at
+    WG_APPLY_ENABLED: it is an explicit operator action.
+    """
+    now = time.time() if now is None else now
+    state = wg_host.read_interface(iface)
+    idle = find_idle(db, state, now, idle_after)
+    logger.info(
+        "[WG_IDLE] live=%d idle=%d%s", len(state.peers), len(idle), " (dry run)" if dry_run else ""
+    )
+    if dry_run:
+        return [peer_id for peer_id, _pub in idle]
+    parked = []
+    since = datetime.fromtimestamp(now, UTC)
+    for i in range(0, len(idle), WG_IDLE_BATCH):
+        chunk = idle[i : i + WG_IDLE_BATCH]
+        # mark first: if the wg call fails the reconciler prunes them later,
+        # while the opposite order could leave an unmarked peer off the interface
+        db.query(models.VpnPeer).filter(
+            models.VpnPeer.id.in_([peer_id for peer_id, _pub in chunk]),
+            models.VpnPeer.idle_since.is_(None),
+        ).update({"idle_since": since}, synchronize_session=False)
+        db.commit()
+        wg_host.apply_diff(
+            wg_host.PeerDiff(remove=[pub for _id, pub in chunk]), state, iface, method="set"
+        )
+        parked += [peer_id for peer_id, _pub in chunk]
+        metrics.inc("idle_reaped", len(chunk))
+    return parked
+
+
+def wake(db, peers: list[models.VpnPeer]) -> int:
+    """Queue parked ``peers`` for re-apply and clear their mark; commits if any."""
+    woken = 0
+    for peer in peers:
+        if peer.idle_since is None:
+            continue
+        peer.idle_since = None
+        outbox.enqueue_apply(db, peer)
+        woken += 1
+    if woken:
+        db.commit()
+        outbox.notify()
+        metrics.inc("idle_woken", woken)
+    return woken
+
+
+def wake_user(db, user_id: int) -> int:
+    """Wake every parked active peer of ``user_id`` (subscription renewal)."""
+    peers = (
+        db.query(models.VpnPeer)
+        .filter(
+            models.VpnPeer.user_id == user_id,
+            models.VpnPeer.active.is_(True),
+            models.VpnPeer.idle_since.isnot(None),
+        )
+        .all()
+    )
+    return wake(db, peers)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m vpn_api.idle_peers",
+        description="Remove peers without a recent handshake from the WireGuard interface.",
+    )
+    parser.add_argument("--once", action="store_true", help="run a single pass and exit")
+    parser.add_argument("--dry-run", action="store_true", help="report idle peers, change nothing")
+    parser.add_argument("--iface", default=None, help=f"interface (default {wg_host.WG_INTERFACE})")
+    parser.add_argument("--idle-after", type=int, default=WG_IDLE_AFTER, help="seconds")
+    parser.add_argument("--interval", type=float, default=WG_IDLE_INTERVAL)
+    args = parser.parse_args(argv)
+
+    from vpn_api.database import SessionLocal
+
+    while True:
+        db = SessionLocal()
+        try:
+            parked = reap(db, args.iface, dry_run=args.dry_run, idle_after=args.idle_after)
+            print(f"{'idle' if args.dry_run else 'parked'}: {len(parked)}")
+        except Exception:
+            logger.exception("idle reaping failed")
+            db.rollback()
+            if args.once:
+                return 1
+        finally:
+            db.close()
+        if args.once:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
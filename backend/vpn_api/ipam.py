@@ -0,0 +1,294 @@
+"""IP address management for WireGuard peers.
+
+Peer addresses are handed out from a configurable CIDR pool (``WG_IP_POOL``).
+Free/used state is kept in a hierarchical bitmap: one bit per address plus
+summary levels of one bit per 64-bit word, so allocate/release are O(1) for
+any pool size we support (up to a /8). Each word is a Python int in a list,
+about 44 bytes with its slot, so a /16 costs ~50 KB and a /8 ~12 MB.
+
+The bitmap is built from ``vpn_peers.wg_ip`` on first use. Several uvicorn
+workers each hold their own bitmap; the unique constraint on ``vpn_peers.wg_ip``
+is the arbiter between them. A caller whose address was committed first by
+another worker rebuilds the bitmap from the table (:func:`resync`) before
+allocating again, since every worker hands out the lowest free address and
+the next few are likely taken too. The bitmap is also rebuilt when the pool
+looks exhausted and every ``WG_IP_POOL_RESYNC`` seconds, so addresses
+released by other workers come back.
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import logging
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Pool that peer addresses are allocated from. wg-easy's default subnet is
+# 10.8.0.0/24; larger deployments should widen this together with the server
+# interface address (e.g. 10.8.0.0/16).
+WG_IP_POOL = os.getenv("WG_IP_POOL", "10.8.0.0/24")
+# Comma-separated addresses or ``first-last`` ranges that are never handed out.
+# 10.8.0.1 is the server and 10.8.0.2-10.8.0.19 are pre-existing manual clients.
+WG_IP_RESERVED = os.getenv("WG_IP_RESERVED", "10.8.0.1-10.8.0.19")
+# Rebuild the bitmap from vpn_peers this often, seconds, to pick up
+# addresses released by other workers.
+WG_IP_POOL_RESYNC = float(os.getenv("WG_IP_POOL_RESYNC", "300"))
+
+# Largest pool we are willing to keep a bitmap for (a /8 is ~12 MB of bitmap).
+MAX_POOL_SIZE = 1 << 24
+
+_WORD = 64
+_FULL = (1 << _WORD) - 1
+
+
+class PoolExhaustedError(RuntimeError):
+    """Raised when the pool has no free addresses left."""
+
+
+class _Bitmap:
+    """Hierarchical free-bitmap; a set bit means "free".
+
+    ``levels[0]`` holds one bit per slot, every level above holds one bit per
+    word of the level below that still has a free slot. Finding the lowest free
+    slot descends one word per level, i.e. O(log64 n).
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.levels: list[list[int]] = []
+        n = size
+        while True:
+            words = (n + _WORD - 1) // _WORD
+            level = [_FULL] * words
+            tail = n % _WORD
+            if tail:
+                level[-1] = (1 << tail) - 1
+            self.levels.append(level)
+            if words == 1:
+                break
+            n = words
+
+    def is_free(self, i: int) -> bool:
+        return bool(self.levels[0][i // _WORD] >> (i % _WORD) & 1)
+
+    def first_free(self) -> Optional[int]:
+        top = self.levels[-1][0]
+        if not top:
+            return None
+        idx = (top & -top).bit_length() - 1
+        for level in reversed(self.levels[:-1]):
+            word = level[idx]
+            idx = idx * _WORD + (word & -word).bit_length() - 1
+        return idx
+
+    def set_used(self, i: int) -> bool:
+        for level in self.levels:
+            w, b = divmod(i, _WORD)
+            word = level[w]
+            if not word >> b & 1:
+                return False
+            word &= ~(1 << b)
+            level[w] = word
+            if word:
+                break
+            i = w
+        return True
+
+    def set_free(self, i: int) -> bool:
+        for level in self.levels:
+            w, b = divmod(i, _WORD)
+            word = level[w]
+            if word >> b & 1:
+                return False
+            level[w] = word | (1 << b)
+            if word:
+                break
+            i = w
+        return True
+
+
+def parse_ranges(spec: str) -> list[tuple[str, str]]:
+    """Parse ``"a.b.c.d, e.f.g.h-i.j.k.l"`` into a list of (first, last) pairs."""
+    ranges = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "/" in part:
+            net = ipaddress.ip_network(part, strict=False)
+            ranges.append((str(net.network_address), str(net.broadcast_address)))
+        elif "-" in part:
+            first, last = part.split("-", 1)
+            ranges.append((first.strip(), last.strip()))
+        else:
+            ranges.append((part, part))
+    return ranges
+
+
+class IpPool:
+    """Thread-safe address pool over a single CIDR network."""
+
+    def __init__(self, cidr: str, reserved: Iterable[tuple[str, str]] = ()):
+        self.network = ipaddress.ip_network(cidr, strict=False)
+        size = self.network.num_addresses
+        if size > MAX_POOL_SIZE:
+            raise ValueError(f"pool {cidr} is too large (max {MAX_POOL_SIZE} addresses)")
+        self._base = int(self.network.network_address)
+        self._bits = _Bitmap(size)
+        self._lock = threading.Lock()
+        self._used = 0
+        self.created_at = time.monotonic()
+        self._reserved: list[tuple[int, int]] = []
+        if size > 2:
+            # network and broadcast addresses are never usable
+            self._reserved.append((0, 0))
+            self._reserved.append((size - 1, size - 1))
+        for first, last in reserved:
+            lo = self._offset(first)
+            hi = self._offset(last)
+            if lo is None or hi is None:
+                logger.warning("ignoring reserved range %s-%s outside pool %s", first, last, cidr)
+                continue
+            self._reserved.append((lo, hi))
+        for lo, hi in self._reserved:
+            for off in range(lo, hi + 1):
+                if self._bits.set_used(off):
+                    self._used += 1
+
+    @property
+    def size(self) -> int:
+        return self._bits.size
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    @property
+    def free(self) -> int:
+        return self.size - self._used
+
+    def _offset(self, address: str) -> Optional[int]:
+        try:
+            ip = ipaddress.ip_address(str(address).split("/", 1)[0].strip())
+        except ValueError:
+            return None
+        off = int(ip) - self._base
+        if ip.version != self.network.version or not 0 <= off < self.size:
+            return None
+        return off
+
+    def _is_reserved(self, off: int) -> bool:
+        return any(lo <= off <= hi for lo, hi in self._reserved)
+
+    def _format(self, off: int) -> str:
+        suffix = 32 if self.network.version == 4 else 128
+        return f"{ipaddress.ip_address(self._base + off)}/{suffix}"
+
+    def allocate(self) -> str:
+        """Take the lowest free address and return it as ``"a.b.c.d/32"``."""
+        with self._lock:
+            off = self._bits.first_free()
+            if off is None:
+                raise PoolExhaustedError(f"no free addresses left in {self.network}")
+            self._bits.set_used(off)
+            self._used += 1
+        return self._format(off)
+
+    def allocate_many(self, count: int) -> list[str]:
+        """Allocate ``count`` addresses under one lock; all-or-nothing."""
+        offsets = []
+        with self._lock:
+            if count > self.size - self._used:
+                raise PoolExhaustedError(f"{count} addresses requested, {self.free} free")
+            for _ in range(count):
+                off = self._bits.first_free()
+                self._bits.set_used(off)
+                offsets.append(off)
+            self._used += count
+        return [self._format(off) for off in offsets]
+
+    def reserve(self, address: str) -> bool:
+        """Mark ``address`` as used. Returns False if outside the pool or already used."""
+        off = self._offset(address)
+        if off is None:
+            return False
+        with self._lock:
+            if not self._bits.set_used(off):
+                return False
+            self._used += 1
+        return True
+
+    def release(self, address: str) -> bool:
+        """Return ``address`` to the pool. Reserved and foreign addresses are ignored."""
+        off = self._offset(address)
+        if off is None or self._is_reserved(off):
+            return False
+        with self._lock:
+            if not self._bits.set_free(off):
+                return False
+            self._used -= 1
+        return True
+
+    def is_free(self, address: str) -> bool:
+        off = self._offset(address)
+        return off is not None and self._bits.is_free(off)
+
+    def load(self, addresses: Iterable[Optional[str]]) -> int:
+        """Mark every address in ``addresses`` as used; returns how many were in the pool."""
+        count = 0
+        for address in addresses:
+            if address and self.reserve(address):
+                count += 1
+        return count
+
+
+_pool: Optional[IpPool] = None
+_pool_lock = threading.Lock()
+
+
+def _build(db) -> IpPool:
+    from vpn_api import models
+
+    pool = IpPool(WG_IP_POOL, parse_ranges(WG_IP_RESERVED))
+    rows = db.query(models.VpnPeer.wg_ip).yield_per(10000)
+    loaded = pool.load(row[0] for row in rows)
+    logger.info("IPAM pool %s loaded: %d peers in pool, %d free", pool.network, loaded, pool.free)
+    return pool
+
+
+def get_pool(db) -> IpPool:
+    """Return the process-wide pool, rebuilding it from ``vpn_peers`` when missing or old."""
+    global _pool
+    pool = _pool
+    if pool is None or time.monotonic() - pool.created_at > WG_IP_POOL_RESYNC:
+        with _pool_lock:
+            # another thread may have rebuilt it while we waited
+            if _pool is pool:
+                _pool = _build(db)
+            pool = _pool
+    return pool
+
+
+def resync(db) -> IpPool:
+    """Rebuild the process-wide pool from ``vpn_peers`` now and return it.
+
+    Reads through ``db``, so rows its open transaction inserted count as used.
+    Addresses handed out but not yet committed by other threads of this
+    process are forgotten; if one is handed out twice, the unique constraint
+    catches it and that caller resyncs in turn.
+    """
+    global _pool
+    with _pool_lock:
+        _pool = _build(db)
+        return _pool
+
+
+def reset_pool() -> None:
+    """Drop the process-wide pool so the next :func:`get_pool` rebuilds it."""
+    global _pool
+    with _pool_lock:
+        _pool = None
@@ -0,0 +1,163 @@
+"""Pre-generated WireGuard (Curve25519) keypair pool.
+
+Keypairs are derived locally with X25519 so the public key really belongs to
+the private key. A background worker thread keeps the pool between the low
+and high watermarks (``WG_KEYPOOL_LOW`` / ``WG_KEYPOOL_HIGH``); ``get()`` pops
+a ready pair in O(1) and only generates inline when the pool is empty.
+"""
+
+from __future__ import annotations
+
+import base64
+import logging
+import os
+import threading
+from collections import deque
+from typing import Optional
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from vpn_api import metrics
+
+logger = logging.getLogger(__name__)
+
+WG_KEYPOOL_LOW = int(os.getenv("WG_KEYPOOL_LOW", "64"))
+WG_KEYPOOL_HIGH = int(os.getenv("WG_KEYPOOL_HIGH", "512"))
+
+
+def generate_keypair() -> tuple[str, str]:
+    """Generate a WireGuard keypair and return (private_key_base64, public_key_base64)."""
+    key = X25519PrivateKey.generate()
+    private = key.private_bytes_raw()
+    public = key.public_key().public_bytes_raw()
+    return base64.b64encode(private).decode("ascii"), base64.b64encode(public).decode("ascii")
+
+
+def generate_keypairs(count: int) -> list[tuple[str, str]]:
+    """Generate ``count`` keypairs in one call (bulk provisioning)."""
+    return [generate_keypair() for _ in range(count)]
+
+
+def public_key_for(private_key_b64: str) -> str:
+    """Derive the base64 public key for a base64 private key."""
+    key = X25519PrivateKey.from_private_bytes(base64.b64decode(private_key_b64))
+    return base64.b64encode(key.public_key().public_bytes_raw()).decode("ascii")
+
+
+class KeyPool:
+    """Thread-safe pool of ready keypairs refilled by a daemon thread."""
+
+    def __init__(self, low: int = WG_KEYPOOL_LOW, high: int = WG_KEYPOOL_HIGH):
+        if low < 0 or high < low:
+            raise ValueError("keypool watermarks must satisfy 0 <= low <= high")
+        self.low = low
+        self.high = high
+        self._pairs: deque[tuple[str, str]] = deque()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pairs)
+
+    def start(self) -> None:
+        """Start the refill worker (idempotent)."""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="wg-keypool-refill", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.fill()
+            except Exception:
+                logger.exception("keypool refill failed")
+
+    def fill(self) -> int:
+        """Generate pairs until the pool reaches the high watermark; returns how many."""
+        added = 0
+        while len(self._pairs) < self.high and not self._stop.is_set():
+            self._pairs.append(generate_keypair())
+            added += 1
+        if added:
+            metrics.inc("keypool_generated", added)
+            metrics.inc("keypool_refills")
+        return added
+
+    def _maybe_refill(self) -> None:
+        if len(self._pairs) < self.low:
+            if self._thread is None or not self._thread.is_alive():
+                self.start()
+            else:
+                self._wake.set()
+
+    def get(self) -> tuple[str, str]:
+        """Return a (private, public) pair, generating inline on a pool miss."""
+        try:
+            pair = self._pairs.popleft()
+            metrics.inc("keypool_hits")
+        except IndexError:
+            pair = generate_keypair()
+            metrics.inc("keypool_misses")
+        self._maybe_refill()
+        return pair
+
+    def take(self, count: int) -> list[tuple[str, str]]:
+        """Return ``count`` pairs: drain what is ready and generate the rest in bulk."""
+        out: list[tuple[str, str]] = []
+        while len(out) < count:
+            try:
+                out.append(self._pairs.popleft())
+            except IndexError:
+                break
+        hits = len(out)
+        if hits < count:
+            out.extend(generate_keypairs(count - hits))
+        metrics.inc("keypool_hits", hits)
+        metrics.inc("keypool_misses", count - hits)
+        self._maybe_refill()
+        return out
+
+    def stats(self) -> dict:
+        hits = metrics.get("keypool_hits")
+        misses = metrics.get("keypool_misses")
+        total = hits + misses
+        return {
+            "size": len(self._pairs),
+            "low": self.low,
+            "high": self.high,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else None,
+        }
+
+
+_pool: Optional[KeyPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_key_pool() -> KeyPool:
+    """Return the process-wide key pool, starting its refill worker on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = KeyPool()
+                metrics.register_gauge("keypool_size", pool.__len__)
+                pool.start()
+                _pool = pool
+    return _pool
@@ -1,15 +1,57 @@
 import os
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException
 
-from vpn_api import models
+from vpn_api import (
+    deadlines,
+    hashing,
+    iap_client,
+    metrics,
+    models,
+    outbox,
+    payment_inbox,
+    ssh_pool,
+    wg_easy_pool,
+)
+from vpn_api.auth import get_current_user
 from vpn_api.auth import router as auth_router
 from vpn_api.database import engine
 from vpn_api.payments import router as payments_router
 from vpn_api.peers import router as peers_router
 from vpn_api.tariffs import router as tariffs_router
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # exact-time subscription cutoff (the expiry sweeper stays the backstop)
+    if deadlines.WG_EXPIRY_SCHEDULER:
+        deadlines.start()
+    # retry host/controller events left over from before the restart
+    if outbox.WG_OUTBOX_WORKERS > 0:
+        outbox.get_worker()
+    # process notifications left over from before the restart
+    if payment_inbox.PAYMENT_WEBHOOK_ASYNC:
+        payment_inbox.get_worker()
+    yield
+    # stop the deadline scheduler thread
+    deadlines.shutdown()
+    # stop outbox workers (undrained events stay in the table)
+    outbox.shutdown()
+    # stop payment inbox workers (unprocessed notifications stay in the table)
+    payment_inbox.shutdown()
+    # release long-lived controller sessions (logout + close keep-alive pool)
+    wg_easy_pool.shutdown()
+    # stop persistent ssh control masters
+    ssh_pool.shutdown()
+    # stop password hashing worker processes
+    hashing.shutdown()
+    # close keep-alive connections to the app stores
+    iap_client.shutdown()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="VPN Backend",
     version=os.getenv("APP_VERSION", "0.1.0"),
     description=(
@@ -40,3 +82,11 @@ app.include_router(payments_router)
 @app.get("/")
 def root():
     return {"msg": "VPN API is running"}
+
+
+@app.get("/metrics")
+def metrics_snapshot(current_user: models.User = Depends(get_current_user)):
+    """Return in-process counters and gauges for this worker (admin only)."""
+    if not getattr(current_user, "is_admin", False):
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return metrics.snapshot()
@@ -0,0 +1,97 @@
+"""Minimal in-process metrics registry.
+
+Counters, gauges and latency histograms are process-local (one set per uvicorn worker) and are
+exposed as JSON by the admin-only ``GET /metrics`` endpoint.
+"""
+
+from __future__ import annotations
+
+import bisect
+import threading
+from typing import Callable, Iterable
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_gauges: dict[str, Callable[[], float]] = {}
+# gauges read together: names -> callable returning {name: value}
+_gauge_groups: dict[tuple[str, ...], Callable[[], dict[str, float]]] = {}
+# upper bounds in seconds; the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# name -> per-bucket counts (len(BUCKETS) + 1), then sum and count
+_histograms: dict[str, list[float]] = {}
+
+
+def inc(name: str, value: float = 1) -> None:
+    """Increment counter ``name`` by ``value``."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, seconds: float) -> None:
+    """Record one duration in histogram ``name``."""
+    index = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = [0] * (len(BUCKETS) + 3)
+        hist[index] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+
+
+def get(name: str) -> float:
+    return _counters.get(name, 0)
+
+
+def register_gauge(name: str, fn: Callable[[], float]) -> None:
+    """Register a callable evaluated on every snapshot (e.g. a queue length)."""
+    with _lock:
+        _gauges[name] = fn
+
+
+def register_gauges(names: Iterable[str], fn: Callable[[], dict[str, float]]) -> None:
+    """Register gauges that share one ``fn`` call per snapshot (e.g. one stats query)."""
+    with _lock:
+        _gauge_groups[tuple(names)] = fn
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        groups = dict(_gauge_groups)
+        histograms = {name: list(hist) for name, hist in _histograms.items()}
+    values = {}
+    for name, fn in gauges.items():
+        try:
+            values[name] = fn()
+        except Exception:
+            values[name] = None
+    for names, fn in groups.items():
+        try:
+            group = fn()
+        except Exception:
+            group = {}
+        for name in names:
+            values[name] = group.get(name)
+    return {
+        "counters": counters,
+        "gauges": values,
+        "histograms": {name: _histogram(hist) for name, hist in histograms.items()},
+    }
+
+
+def _histogram(hist: list[float]) -> dict:
+    # cumulative, like Prometheus "le" buckets
+    buckets, total = {}, 0
+    for bound, count in zip([*BUCKETS, "+Inf"], hist[:-2]):
+        total += count
+        buckets[str(bound)] = total
+    return {"buckets": buckets, "sum": hist[-2], "count": hist[-1]}
+
+
+def reset() -> None:
+    """Clear all counters and histograms (gauges stay registered). Intended for tests."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
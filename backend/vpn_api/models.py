@@ -1,15 +1,19 @@
 import enum
 
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
     Numeric,
     String,
+    Text,
     UniqueConstraint,
+    text,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -51,6 +55,11 @@ class User(Base):
     verification_code = Column(String, nullable=True, index=True)
     verification_expires_at = Column(DateTime(timezone=True), nullable=True)
 
+    # Materialized from user_tariffs by vpn_api.subscriptions.refresh: the
+    # tariff granting access now (NULL: none) and when it ends (NULL: lifetime).
+    active_tariff_id = Column(Integer, ForeignKey("tariffs.id", ondelete="SET NULL"), nullable=True)
+    active_until = Column(DateTime(timezone=True), nullable=True, index=True)
+
 
 class Tariff(Base):
     __tablename__ = "tariffs"
@@ -65,16 +74,37 @@ class Tariff(Base):
     user_tariffs = relationship("UserTariff", back_populates="tariff", cascade="all, delete-orphan")
 
 
+class Product(Base):
+    """Store (App Store / Google Play) product id and the tariff it grants."""
+
+    __tablename__ = "products"
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(String, unique=True, nullable=False)
+    tariff_id = Column(
+        Integer, ForeignKey("tariffs.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
 class UserTariff(Base):
     __tablename__ = "user_tariffs"
     __table_args__ = (
         UniqueConstraint("user_id", "tariff_id", "started_at", name="uix_user_tariff_start"),
+        # access checks and renewals: user_id = ? AND status = ? AND ended_at ...
+        Index("ix_user_tariffs_user_status_ended", "user_id", "status", "ended_at"),
+        # expiry sweeps over the (few) still-active rows only
+        Index(
+            "ix_user_tariffs_active_ended",
+            "ended_at",
+            sqlite_where=text("status = 'active'"),
+            postgresql_where=text("status = 'active'"),
+        ),
     )
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(
-        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
-    )
+    # indexed by the leading column of ix_user_tariffs_user_status_ended
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     tariff_id = Column(
         Integer, ForeignKey("tariffs.id", ondelete="RESTRICT"), nullable=False, index=True
     )
@@ -88,11 +118,24 @@ class UserTariff(Base):
 
 class VpnPeer(Base):
     __tablename__ = "vpn_peers"
+    __table_args__ = (
+        # a user's active peers, newest first (config fetch, idle wake-up). The
+        # predicates match how SQLAlchemy renders ``VpnPeer.active`` per dialect.
+        Index(
+            "ix_vpn_peers_user_active_created",
+            "user_id",
+            text("created_at DESC"),
+            sqlite_where=text("active = 1"),
+            postgresql_where=text("active"),
+        ),
+        # keyset pagination of listings (vpn_api.pagination), all or per user
+        Index("ix_vpn_peers_created_id", "created_at", "id"),
+        Index("ix_vpn_peers_user_created_id", "user_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(
-        Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
-    )
+    # indexed by the leading column of ix_vpn_peers_user_created_id
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     wg_private_key = Column(String, nullable=False)
     wg_public_key = Column(String, nullable=False, unique=True)
     # If the peer was created via an external controller (wg-easy), store the
@@ -105,22 +148,109 @@ class VpnPeer(Base):
     wg_config_encrypted = Column(String, nullable=True)
     active = Column(Boolean, default=True, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # Set while an idle peer is parked off the WireGuard interface (the row
+    # stays active); cleared when the peer is re-applied. See vpn_api.idle_peers.
+    idle_since = Column(DateTime(timezone=True), nullable=True)
 
     user = relationship("User", back_populates="vpn_peers")
 
 
 class Payment(Base):
     __tablename__ = "payments"
+    __table_args__ = (
+        # one row per store transaction: the webhook inserts ON CONFLICT DO NOTHING
+        Index("uq_payments_provider_payment_id", "provider", "provider_payment_id", unique=True),
+        # keyset pagination of listings (vpn_api.pagination), all or per user
+        Index("ix_payments_created_id", "created_at", "id"),
+        Index("ix_payments_user_created_id", "user_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(
-        Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True, index=True
-    )
+    # indexed by the leading column of ix_payments_user_created_id
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
     amount = Column(Numeric(10, 2), nullable=False)
     currency = Column(String(8), nullable=False, default="USD")
     status = Column(Enum(PaymentStatus), default=PaymentStatus.pending, nullable=False)
     provider = Column(String, nullable=True)
-    provider_payment_id = Column(String, nullable=True, index=True)
+    provider_payment_id = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
     user = relationship("User", back_populates="payments")
+
+
+class OutboxEvent(Base):
+    """Host/controller side effect recorded in the same transaction as the peer change.
+
+    Drained asynchronously by :mod:`vpn_api.outbox`. ``dedupe_key`` identifies
+    the remote object (e.g. ``host:<public key>``): a newer pending event for
+    the same key supersedes older ones.
+    """
+
+    __tablename__ = "outbox_events"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(32), nullable=False)
+    dedupe_key = Column(String, nullable=False, index=True)
+    # not a foreign key: remove events outlive the peer row
+    peer_id = Column(Integer, nullable=True)
+    payload = Column(Text, nullable=False)
+    # pending | processing | done | superseded | dead
+    status = Column(String(16), nullable=False, default="pending", index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class PaymentNotification(Base):
+    """Raw store notification accepted by the webhook, processed by :mod:`vpn_api.payment_inbox`."""
+
+    __tablename__ = "payment_notifications"
+    __table_args__ = (
+        # claim order and the "earlier unfinished item of this user" check
+        Index("ix_payment_notifications_status_id", "status", "id"),
+        Index("ix_payment_notifications_user_status", "user_id", "status", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    # not a foreign key: the notification is stored before anything is checked
+    user_id = Column(Integer, nullable=False)
+    provider = Column(String, nullable=False)
+    # PaymentWebhookIn as received
+    payload = Column(Text, nullable=False)
+    # pending | processing | done | failed
+    status = Column(String(16), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    # webhook response body once processed
+    result = Column(Text, nullable=True)
+    received_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    processed_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class PeerUsage(Base):
+    """Per-peer traffic for one time bucket, written by :mod:`vpn_api.telemetry`.
+
+    ``resolution`` is the bucket length in seconds (60, 3600 or 86400); old
+    fine buckets are rolled up into coarser ones, so a time range is covered
+    by summing rows of all resolutions.
+    """
+
+    __tablename__ = "peer_usage"
+    __table_args__ = (
+        UniqueConstraint("peer_id", "resolution", "bucket_start", name="uix_peer_usage_bucket"),
+        Index("ix_peer_usage_user_bucket", "user_id", "bucket_start"),
+        Index("ix_peer_usage_resolution_bucket", "resolution", "bucket_start"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    peer_id = Column(Integer, ForeignKey("vpn_peers.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    resolution = Column(Integer, nullable=False)
+    bucket_start = Column(DateTime(timezone=True), nullable=False)
+    rx_bytes = Column(BigInteger, nullable=False, default=0)
+    tx_bytes = Column(BigInteger, nullable=False, default=0)
+    last_handshake = Column(DateTime(timezone=True), nullable=True)
@@ -0,0 +1,374 @@
+"""Durable outbox for host and controller side effects.
+
+``create_peer``/``delete_peer`` used to call ``apply_peer``, ``remove_peer``
+and the wg-easy delete inline, swallowing any failure. Instead they now add an
+:class:`~vpn_api.models.OutboxEvent` to the same transaction as the
+``VpnPeer`` change (:func:`enqueue`), and a small worker pool drains the
+table in the background:
+
+- an event is claimed with a conditional ``UPDATE`` (safe across threads and
+  uvicorn workers; the claim and worker pool are shared with the payment
+  inbox, see :mod:`vpn_api.durable_queue`);
+- failures are retried with exponential backoff and jitter
+  (``WG_OUTBOX_BACKOFF`` doubling up to ``WG_OUTBOX_BACKOFF_MAX``);
+- after ``WG_OUTBOX_MAX_ATTEMPTS`` the event is parked as ``dead`` and can
+  be re-queued with ``python -m vpn_api.outbox retry-dead``;
+- a new event for the same remote object (``dedupe_key``) supersedes any
+  older pending one, so apply-then-remove collapses to the remove. Events of
+  one key run in order: an event is not claimed while an older one for its
+  key is pending or processing, and a failed event that a newer one has
+  already replaced is marked ``superseded`` instead of being retried;
+- events left in ``processing`` by a crashed worker are re-queued after
+  ``WG_OUTBOX_LEASE`` seconds.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sys
+import time
+import types
+from datetime import UTC, datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import exists
+
+from vpn_api import durable_queue, metrics, models
+
+logger = logging.getLogger(__name__)
+
+WG_OUTBOX_WORKERS = int(os.getenv("WG_OUTBOX_WORKERS", "2"))
+WG_OUTBOX_MAX_ATTEMPTS = int(os.getenv("WG_OUTBOX_MAX_ATTEMPTS", "8"))
+# first retry delay and cap, seconds
+WG_OUTBOX_BACKOFF = float(os.getenv("WG_OUTBOX_BACKOFF", "2"))
+WG_OUTBOX_BACKOFF_MAX = float(os.getenv("WG_OUTBOX_BACKOFF_MAX", "600"))
+# how long a claimed event may stay in "processing" before it is re-queued
+WG_OUTBOX_LEASE = float(os.getenv("WG_OUTBOX_LEASE", "300"))
+# idle poll interval; enqueue() wakes the workers immediately
+WG_OUTBOX_POLL = float(os.getenv("WG_OUTBOX_POLL", "5"))
+# done/superseded rows older than this are purged, seconds
+WG_OUTBOX_RETENTION = float(os.getenv("WG_OUTBOX_RETENTION", "86400"))
+
+# keys per supersede UPDATE in enqueue_apply_many (bound parameter limits)
+_SUPERSEDE_CHUNK = 500
+
+APPLY = "wg_apply"
+REMOVE = "wg_remove"
+WG_EASY_DELETE = "wg_easy_delete"
+WG_EASY_DISABLE = "wg_easy_disable"
+WG_EASY_ENABLE = "wg_easy_enable"
+
+
+class PermanentError(RuntimeError):
+    """A failure that retrying will not fix; the event goes straight to ``dead``."""
+
+
+def _now() -> datetime:
+    return datetime.now(UTC)
+
+
+def enqueue(
+    db, kind: str, dedupe_key: str, payload: dict, peer_id: Optional[int] = None
+) -> models.OutboxEvent:
+    """Add an event to ``db``'s transaction; the caller commits.
+
+    Older pending events with the same ``dedupe_key`` are marked
+    ``superseded`` in the same transaction.
+    """
+    db.query(models.OutboxEvent).filter(
+        models.OutboxEvent.dedupe_key == dedupe_key,
+        models.OutboxEvent.status == "pending",
+    ).update({"status": "superseded"}, synchronize_session=False)
+    event = models.OutboxEvent(
+        kind=kind,
+        dedupe_key=dedupe_key,
+        peer_id=peer_id,
+        payload=json.dumps(payload),
+        status="pending",
+        attempts=0,
+        next_attempt_at=_now(),
+    )
+    db.add(event)
+    metrics.inc("outbox_enqueued")
+    return event
+
+
+def enqueue_apply(db, peer: models.VpnPeer) -> None:
+    enqueue(
+        db,
+        APPLY,
+        f"host:{peer.wg_public_key}",
+        {"wg_public_key": peer.wg_public_key, "allowed_ips": peer.allowed_ips},
+        peer_id=peer.id,
+    )
+
+
+def enqueue_apply_many(db, peers: list[models.VpnPeer]) -> None:
+    """:func:`enqueue_apply` for a batch of flushed peers, superseding per chunk of keys."""
+    keys = [f"host:{peer.wg_public_key}" for peer in peers]
+    for start in range(0, len(keys), _SUPERSEDE_CHUNK):
+        db.query(models.OutboxEvent).filter(
+            models.OutboxEvent.dedupe_key.in_(keys[start : start + _SUPERSEDE_CHUNK]),
+            models.OutboxEvent.status == "pending",
+        ).update({"status": "superseded"}, synchronize_session=False)
+    now = _now()
+    db.add_all(
+        [
+            models.OutboxEvent(
+                kind=APPLY,
+                dedupe_key=key,
+                peer_id=peer.id,
+                payload=json.dumps(
+                    {"wg_public_key": peer.wg_public_key, "allowed_ips": peer.allowed_ips}
+                ),
+                status="pending",
+                attempts=0,
+                next_attempt_at=now,
+            )
+            for key, peer in zip(keys, peers)
+        ]
+    )
+    metrics.inc("outbox_enqueued", len(peers))
+
+
+def _enqueue_wg_easy(db, kind: str, peer: models.VpnPeer) -> None:
+    enqueue(
+        db,
+        kind,
+        f"wg-easy:{peer.wg_client_id}",
+        {"wg_client_id": peer.wg_client_id},
+        peer_id=peer.id,
+    )
+
+
+def _enqueue_host_remove(db, peer: models.VpnPeer) -> None:
+    enqueue(
+        db,
+        REMOVE,
+        f"host:{peer.wg_public_key}",
+        {"wg_public_key": peer.wg_public_key, "allowed_ips": peer.allowed_ips},
+        peer_id=peer.id,
+    )
+
+
+def enqueue_remove(db, peer: models.VpnPeer) -> None:
+    if peer.wg_client_id:
+        _enqueue_wg_easy(db, WG_EASY_DELETE, peer)
+    _enqueue_host_remove(db, peer)
+
+
+def enqueue_suspend(db, peer: models.VpnPeer) -> None:
+    """Take a lapsed peer off the host; its wg-easy client is disabled, not deleted."""
+    if peer.wg_client_id:
+        _enqueue_wg_easy(db, WG_EASY_DISABLE, peer)
+    _enqueue_host_remove(db, peer)
+
+
+def enqueue_resume(db, peer: models.VpnPeer) -> None:
+    """Undo :func:`enqueue_suspend` after a renewal (same key, address and config)."""
+    if peer.wg_client_id:
+        _enqueue_wg_easy(db, WG_EASY_ENABLE, peer)
+    enqueue_apply(db, peer)
+
+
+def _host_apply(payload: dict) -> None:
+    from vpn_api import peers, wg_host
+
+    ok = peers.apply_peer(types.SimpleNamespace(**payload))
+    # apply_peer returns False both when disabled and when it failed
+    if not ok and wg_host.WG_APPLY_ENABLED:
+        raise RuntimeError("apply_peer failed")
+
+
+def _host_remove(payload: dict) -> None:
+    from vpn_api import peers, wg_host
+
+    ok = peers.remove_peer(types.SimpleNamespace(**payload))
+    if not ok and wg_host.WG_APPLY_ENABLED:
+        raise RuntimeError("remove_peer failed")
+
+
+def _wg_easy_credentials() -> tuple[str, str]:
+    url, password = os.getenv("WG_EASY_URL"), os.getenv("WG_EASY_PASSWORD")
+    if not url or not password:
+        raise PermanentError("WG_EASY_URL or WG_EASY_PASSWORD not set")
+    return url, password
+
+
+def _wg_easy_delete(payload: dict) -> None:
+    from vpn_api import peers
+
+    peers._delete_wg_easy_client(*_wg_easy_credentials(), payload["wg_client_id"])
+
+
+def _wg_easy_disable(payload: dict) -> None:
+    from vpn_api import peers
+
+    peers._set_wg_easy_client_enabled(*_wg_easy_credentials(), payload["wg_client_id"], False)
+
+
+def _wg_easy_enable(payload: dict) -> None:
+    from vpn_api import peers
+
+    peers._set_wg_easy_client_enabled(*_wg_easy_credentials(), payload["wg_client_id"], True)
+
+
+HANDLERS: dict[str, Callable[[dict], None]] = {
+    APPLY: _host_apply,
+    REMOVE: _host_remove,
+    WG_EASY_DELETE: _wg_easy_delete,
+    WG_EASY_DISABLE: _wg_easy_disable,
+    WG_EASY_ENABLE: _wg_easy_enable,
+}
+
+
+def backoff(attempts: int) -> float:
+    """Delay before retry number ``attempts`` (1-based), with +-20% jitter."""
+    return durable_queue.backoff(attempts, WG_OUTBOX_BACKOFF, WG_OUTBOX_BACKOFF_MAX)
+
+
+def _claim(db) -> Optional[models.OutboxEvent]:
+    """Atomically move the oldest due event to ``processing`` and return it."""
+    return durable_queue.claim(db, models.OutboxEvent, "dedupe_key")
+
+
+def _finish(db, event: models.OutboxEvent, error: Optional[BaseException]) -> None:
+    if error is None:
+        event.status = "done"
+        event.last_error = None
+        metrics.inc("outbox_done")
+    else:
+        event.attempts += 1
+        event.last_error = f"{type(error).__name__}: {error}"
+        newer = db.query(
+            exists().where(
+                models.OutboxEvent.dedupe_key == event.dedupe_key,
+                models.OutboxEvent.id > event.id,
+            )
+        ).scalar()
+        if newer:
+            # retrying would undo the newer event (e.g. re-apply a removed peer)
+            event.status = "superseded"
+            metrics.inc("outbox_superseded")
+        elif isinstance(error, PermanentError) or event.attempts >= WG_OUTBOX_MAX_ATTEMPTS:
+            event.status = "dead"
+            metrics.inc("outbox_dead")
+            logger.error(
+                "outbox event %s (%s %s) is dead after %d attempts: %s",
+                event.id,
+                event.kind,
+                event.dedupe_key,
+                event.attempts,
+                event.last_error,
+            )
+        else:
+            event.status = "pending"
+            event.next_attempt_at = _now() + timedelta(seconds=backoff(event.attempts))
+            metrics.inc("outbox_retries")
+    event.locked_at = None
+    db.commit()
+
+
+def process_one(db) -> bool:
+    """Claim and run one due event; returns False if there was nothing to do."""
+    event = _claim(db)
+    if event is None:
+        return False
+    handler = HANDLERS.get(event.kind)
+    start = time.perf_counter()
+    error: Optional[BaseException] = None
+    try:
+        if handler is None:
+            raise PermanentError(f"unknown outbox event kind {event.kind!r}")
+        handler(json.loads(event.payload))
+    except Exception as exc:
+        error = exc
+    finally:
+        metrics.inc("outbox_handler_seconds", time.perf_counter() - start)
+    _finish(db, event, error)
+    return True
+
+
+def recover_stale(db, lease: float = WG_OUTBOX_LEASE) -> int:
+    """Re-queue events stuck in ``processing`` longer than ``lease`` seconds."""
+    return durable_queue.recover_stale(db, models.OutboxEvent, lease)
+
+
+def purge(db, retention: float = WG_OUTBOX_RETENTION) -> int:
+    """Delete done/superseded events older than ``retention`` seconds."""
+    cutoff = _now() - timedelta(seconds=retention)
+    count = (
+        db.query(models.OutboxEvent)
+        .filter(
+            models.OutboxEvent.status.in_(("done", "superseded")),
+            models.OutboxEvent.created_at < cutoff,
+        )
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return count
+
+
+def retry_dead(db, ids: Optional[list[int]] = None) -> int:
+    """Move dead events (all, or ``ids``) back to pending with a fresh attempt budget."""
+    return durable_queue.requeue(db, models.OutboxEvent, "dead", ids)
+
+
+def stats(db) -> dict[str, int]:
+    return durable_queue.counts(db, models.OutboxEvent)
+
+
+def drain(db, max_events: Optional[int] = None) -> int:
+    """Process due events in the calling thread; returns how many were handled."""
+    return durable_queue.drain(db, process_one, max_events)
+
+
+def _maintenance(db) -> None:
+    recover_stale(db)
+    purge(db)
+
+
+class OutboxWorker(durable_queue.Worker):
+    """Background threads draining the outbox table."""
+
+    def __init__(self, workers: int = WG_OUTBOX_WORKERS, poll: float = WG_OUTBOX_POLL):
+        super().__init__("outbox", process_one, _maintenance, workers, poll)
+
+
+_worker = durable_queue.ProcessWorker(lambda: OutboxWorker(WG_OUTBOX_WORKERS, WG_OUTBOX_POLL))
+
+
+def get_worker() -> OutboxWorker:
+    """Return the process-wide worker pool, starting it on first use."""
+    return _worker.get()
+
+
+def notify() -> None:
+    """Wake the workers after committing enqueued events."""
+    _worker.notify()
+
+
+def shutdown() -> None:
+    """Stop the process-wide worker pool (called on application shutdown)."""
+    _worker.shutdown()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    return durable_queue.main(
+        argv,
+        "python -m vpn_api.outbox",
+        stats,
+        retry_dead,
+        drain,
+        stats_help="count events per status",
+        requeue_command="retry-dead",
+        requeue_help="re-queue dead events",
+        ids_help="event ids (default: all dead)",
+        drain_help="process all due events in this process",
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
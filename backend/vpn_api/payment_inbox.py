@@ -0,0 +1,232 @@
+"""Asynchronous ingestion of store payment notifications.
+
+Apple and Google send notifications in bursts, and the synchronous webhook
+validates the receipt and writes the grant before it answers. With
+``PAYMENT_WEBHOOK_ASYNC=1`` ``POST /payments/webhook`` only stores the raw
+notification as a :class:`~vpn_api.models.PaymentNotification`
+(:func:`accept`) and answers 202. A worker pool, the same
+:mod:`vpn_api.durable_queue` machinery as :mod:`vpn_api.outbox`, then runs
+:func:`vpn_api.payments.process_webhook` on each item:
+
+- an item is claimed with a conditional ``UPDATE`` that also requires that
+  no earlier item of the same user is still pending or processing, so each
+  user's notifications are applied in arrival order, across threads and
+  uvicorn workers;
+- errors, including store outages
+  (:class:`~vpn_api.iap_validator.StoreUnavailable`), are retried with
+  exponential backoff up to ``PAYMENT_INBOX_MAX_ATTEMPTS``. Rejections (an
+  HTTPException, e.g. an invalid receipt) fail at once. Failed items no longer hold back the user's
+  later items and can be replayed with
+  ``python -m vpn_api.payment_inbox replay``;
+- items left in ``processing`` by a crashed worker are re-queued after
+  ``PAYMENT_INBOX_LEASE`` seconds.
+
+Metrics: the ``payment_inbox_depth`` and ``payment_inbox_lag_seconds``
+gauges (pending items, and the age of the oldest one), the
+``payment_inbox_lag`` histogram (time from receipt to processing), and the
+``payment_inbox_{received,done,failed,retries}`` counters.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sys
+from datetime import UTC, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func, select
+
+from vpn_api import durable_queue, metrics, models
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_WEBHOOK_ASYNC = os.getenv("PAYMENT_WEBHOOK_ASYNC", "0") == "1"
+PAYMENT_INBOX_WORKERS = int(os.getenv("PAYMENT_INBOX_WORKERS", "4"))
+PAYMENT_INBOX_MAX_ATTEMPTS = int(os.getenv("PAYMENT_INBOX_MAX_ATTEMPTS", "6"))
+# first retry delay and cap, seconds
+PAYMENT_INBOX_BACKOFF = float(os.getenv("PAYMENT_INBOX_BACKOFF", "5"))
+PAYMENT_INBOX_BACKOFF_MAX = float(os.getenv("PAYMENT_INBOX_BACKOFF_MAX", "600"))
+# how long a claimed item may stay in "processing" before it is re-queued
+PAYMENT_INBOX_LEASE = float(os.getenv("PAYMENT_INBOX_LEASE", "300"))
+# idle poll interval; accept() wakes the workers immediately
+PAYMENT_INBOX_POLL = float(os.getenv("PAYMENT_INBOX_POLL", "5"))
+
+N = models.PaymentNotification
+
+
+def _now() -> datetime:
+    return datetime.now(UTC)
+
+
+def _aware(value: datetime) -> datetime:
+    return value.replace(tzinfo=UTC) if value.tzinfo is None else value
+
+
+def accept(db, payload) -> int:
+    """Store the raw notification and commit; returns its id."""
+    item = N(
+        user_id=payload.user_id,
+        provider=payload.provider,
+        payload=payload.model_dump_json(),
+        status="pending",
+        attempts=0,
+        next_attempt_at=_now(),
+    )
+    db.add(item)
+    db.commit()
+    metrics.inc("payment_inbox_received")
+    notify()
+    return item.id
+
+
+def backoff(attempts: int) -> float:
+    """Delay before retry number ``attempts`` (1-based), with +-20% jitter."""
+    return durable_queue.backoff(attempts, PAYMENT_INBOX_BACKOFF, PAYMENT_INBOX_BACKOFF_MAX)
+
+
+def _claim(db) -> Optional[models.PaymentNotification]:
+    """Atomically move the oldest claimable item to ``processing`` and return it."""
+    return durable_queue.claim(db, N, "user_id")
+
+
+def _finish(db, item, result: Optional[dict], error: Optional[BaseException]) -> None:
+    from fastapi import HTTPException
+
+    now = _now()
+    if error is None:
+        item.status = "done"
+        item.result = json.dumps(result, default=str)
+        item.last_error = None
+        item.processed_at = now
+        metrics.inc("payment_inbox_done")
+        metrics.observe("payment_inbox_lag", (now - _aware(item.received_at)).total_seconds())
+    else:
+        item.attempts += 1
+        if isinstance(error, HTTPException):
+            item.last_error = f"{error.status_code}: {error.detail}"
+        else:
+            item.last_error = f"{type(error).__name__}: {error}"
+        if isinstance(error, HTTPException) or item.attempts >= PAYMENT_INBOX_MAX_ATTEMPTS:
+            item.status = "failed"
+            item.processed_at = now
+            metrics.inc("payment_inbox_failed")
+            logger.error(
+                "payment notification %s (user %s) failed after %d attempts: %s",
+                item.id,
+                item.user_id,
+                item.attempts,
+                item.last_error,
+            )
+        else:
+            item.status = "pending"
+            item.next_attempt_at = now + timedelta(seconds=backoff(item.attempts))
+            metrics.inc("payment_inbox_retries")
+    item.locked_at = None
+    db.commit()
+
+
+def process_one(db) -> bool:
+    """Claim and process one item; returns False if there was nothing to do."""
+    from vpn_api import schemas
+    from vpn_api.payments import process_webhook
+
+    item = _claim(db)
+    if item is None:
+        return False
+    result: Optional[dict] = None
+    error: Optional[BaseException] = None
+    try:
+        result = process_webhook(db, schemas.PaymentWebhookIn.model_validate_json(item.payload))
+    except Exception as exc:
+        db.rollback()
+        error = exc
+    _finish(db, db.get(N, item.id), result, error)
+    return True
+
+
+def drain(db, max_items: Optional[int] = None) -> int:
+    """Process claimable items in the calling thread; returns how many were handled."""
+    return durable_queue.drain(db, process_one, max_items)
+
+
+def recover_stale(db, lease: float = PAYMENT_INBOX_LEASE) -> int:
+    """Re-queue items stuck in ``processing`` longer than ``lease`` seconds."""
+    return durable_queue.recover_stale(db, N, lease)
+
+
+def replay(db, ids: Optional[list[int]] = None) -> int:
+    """Move failed items (all, or ``ids``) back to pending with a fresh attempt budget."""
+    return durable_queue.requeue(db, N, "failed", ids, processed_at=None)
+
+
+def stats(db) -> dict:
+    counts = durable_queue.counts(db, N)
+    oldest = db.scalar(select(func.min(N.received_at)).where(N.status == "pending"))
+    lag = (_now() - _aware(oldest)).total_seconds() if oldest is not None else 0.0
+    return {"counts": counts, "depth": counts.get("pending", 0), "lag_seconds": lag}
+
+
+def _gauges() -> dict:
+    # both gauges come from one stats() query per metrics snapshot
+    from vpn_api.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        current = stats(db)
+    finally:
+        db.close()
+    return {
+        "payment_inbox_depth": current["depth"],
+        "payment_inbox_lag_seconds": current["lag_seconds"],
+    }
+
+
+class InboxWorker(durable_queue.Worker):
+    """Background threads draining the payment notification inbox."""
+
+    def __init__(self, workers: int = PAYMENT_INBOX_WORKERS, poll: float = PAYMENT_INBOX_POLL):
+        super().__init__("payment-inbox", process_one, recover_stale, workers, poll)
+
+
+def _new_worker() -> InboxWorker:
+    metrics.register_gauges(("payment_inbox_depth", "payment_inbox_lag_seconds"), _gauges)
+    return InboxWorker(PAYMENT_INBOX_WORKERS, PAYMENT_INBOX_POLL)
+
+
+_worker = durable_queue.ProcessWorker(_new_worker)
+
+
+def get_worker() -> InboxWorker:
+    """Return the process-wide worker pool, starting it on first use."""
+    return _worker.get()
+
+
+def notify() -> None:
+    """Wake the workers after committing accepted notifications."""
+    _worker.notify()
+
+
+def shutdown() -> None:
+    """Stop the process-wide worker pool (called on application shutdown)."""
+    _worker.shutdown()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    return durable_queue.main(
+        argv,
+        "python -m vpn_api.payment_inbox",
+        stats,
+        replay,
+        drain,
+        stats_help="queue depth, lag and counts per status",
+        requeue_command="replay",
+        requeue_help="re-queue failed notifications",
+        ids_help="notification ids (default: all)",
+        drain_help="process all claimable notifications in this process",
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
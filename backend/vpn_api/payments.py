@@ -1,11 +1,25 @@
-from typing import List, Optional
+import functools
+from datetime import UTC, datetime
+from typing import List, Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
+from sqlalchemy import literal, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from vpn_api import models, schemas
+from vpn_api import (
+    catalog,
+    models,
+    pagination,
+    payment_inbox,
+    receipt_cache,
+    schemas,
+    subscriptions,
+)
 from vpn_api.auth import get_current_user
 from vpn_api.database import get_db
+from vpn_api.iap_validator import IapValidator, StoreUnavailable
 
 router = APIRouter(prefix="/payments", tags=["payments"])
 
@@ -35,14 +49,16 @@ def create_payment(
     return payment
 
 
-@router.get("/", response_model=List[schemas.PaymentOut])
+@router.get("/", response_model=Union[List[schemas.PaymentOut], schemas.Page[schemas.PaymentOut]])
 def list_payments(
     user_id: Optional[int] = None,
-    skip: int = 0,
-    limit: int = 100,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
+    """List payments; with ``cursor`` (empty for the first page) returns a keyset page."""
     q = db.query(models.Payment)
     if user_id:
         if not getattr(current_user, "is_admin", False) and current_user.id != user_id:
@@ -50,6 +66,8 @@ def list_payments(
         q = q.filter(models.Payment.user_id == user_id)
     elif not getattr(current_user, "is_admin", False):
         q = q.filter(models.Payment.user_id == current_user.id)
+    if cursor is not None:
+        return pagination.keyset(q, models.Payment, cursor, limit)
     return q.offset(skip).limit(limit).all()
 
 
@@ -101,3 +119,154 @@ def delete_payment(
     db.delete(payment)
     db.commit()
     return {"msg": "deleted"}
+
+
+def _validate_receipt(payload: schemas.PaymentWebhookIn):
+    if payload.provider == "apple":
+        bundle_id = payload.bundle_id or "com.example.vpn"
+        validate = functools.partial(
+            IapValidator.validate_apple_receipt, receipt=payload.receipt, bundle_id=bundle_id
+        )
+    elif payload.provider == "google":
+        validate = functools.partial(
+            IapValidator.validate_google_receipt,
+            package_name=payload.bundle_id or "com.example.vpn",
+            product_id=payload.product_id or "",
+            token=payload.receipt,
+        )
+    else:
+        raise HTTPException(status_code=400, detail=f"Unknown provider: {payload.provider}")
+    # client retries resend the same receipt: answer them from the cache
+    return receipt_cache.cached_validation(
+        payload.provider, payload.receipt, validate, payload.bundle_id, payload.product_id
+    )
+
+
+def _insert_payment(db, user_id: int, values: dict) -> Optional[int]:
+    """Insert the payment unless (provider, provider_payment_id) exists; returns its id.
+
+    Also returns None when ``user_id`` does not exist: the row is selected
+    from ``users``, so a missing user inserts nothing.
+    """
+    P = models.Payment
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:  # pragma: no cover - only SQLite and PostgreSQL are deployed
+        payment = P(user_id=user_id, **values)
+        db.add(payment)
+        try:
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            return None
+        return payment.id
+    columns = ["user_id", *values]
+    source = select(
+        models.User.id, *(literal(v, type_=P.__table__.c[k].type) for k, v in values.items())
+    ).where(models.User.id == user_id)
+    stmt = (
+        insert(P)
+        .from_select(columns, source)
+        .on_conflict_do_nothing(index_elements=["provider", "provider_payment_id"])
+        .returning(P.id)
+    )
+    return db.execute(stmt).scalar()
+
+
+@router.post("/webhook")
+def webhook_payment(
+    payload: schemas.PaymentWebhookIn,
+    db: Session = Depends(get_db),
+):
+    """Handle IAP webhook from Apple or Google Play.
+
+    With PAYMENT_WEBHOOK_ASYNC=1 the notification is only recorded and 202
+    is returned; vpn_api.payment_inbox workers process it later. Otherwise a
+    store outage answers 503 so the client retries.
+    """
+    if not payload.receipt:
+        raise HTTPException(status_code=400, detail="Receipt is required")
+    if payment_inbox.PAYMENT_WEBHOOK_ASYNC:
+        notification_id = payment_inbox.accept(db, payload)
+        return JSONResponse(
+            status_code=202, content={"msg": "accepted", "notification_id": notification_id}
+        )
+    try:
+        return process_webhook(db, payload)
+    except StoreUnavailable as exc:
+        raise HTTPException(status_code=503, detail="Store unavailable, retry later") from exc
+
+
+def process_webhook(db: Session, payload: schemas.PaymentWebhookIn) -> dict:
+    """Validate the receipt and grant the tariff; raises HTTPException on rejection.
+
+    Raises StoreUnavailable when the receipt could not be checked at all.
+
+    Validates the receipt via IapValidator and, on success, records the
+    Payment and the UserTariff it grants in one write transaction, together
+    with the user's materialized subscription state (vpn_api.subscriptions).
+    The payment is inserted with ON CONFLICT DO NOTHING on (provider,
+    provider_payment_id), so concurrent retries grant the subscription once.
+    """
+    receipt_data = _validate_receipt(payload)
+    if not receipt_data:
+        raise HTTPException(status_code=400, detail="Invalid receipt")
+
+    transaction_id = receipt_data.get("transaction_id")
+    product_id = receipt_data.get("product_id")
+    purchase_date = receipt_data.get("purchase_date")
+    if not transaction_id or not product_id:
+        raise HTTPException(status_code=400, detail="Receipt missing transaction_id or product_id")
+
+    tariff = catalog.product_tariff(product_id)
+    if tariff is None:
+        raise HTTPException(status_code=400, detail=f"Unknown product: {product_id}")
+
+    payment_id = _insert_payment(
+        db,
+        payload.user_id,
+        {
+            "amount": tariff.price,
+            "currency": payload.currency or "USD",
+            "status": models.PaymentStatus.completed,
+            "provider": payload.provider,
+            "provider_payment_id": transaction_id,
+        },
+    )
+    if payment_id is None:
+        db.rollback()
+        existing_id = (
+            db.query(models.Payment.id)
+            .filter(
+                models.Payment.provider == payload.provider,
+                models.Payment.provider_payment_id == transaction_id,
+            )
+            .scalar()
+        )
+        if existing_id is not None:
+            return {"msg": "Payment already processed", "payment_id": existing_id}
+        raise HTTPException(status_code=404, detail="User not found")
+
+    now = datetime.now(UTC)
+    user_tariff = models.UserTariff(
+        user_id=payload.user_id,
+        tariff_id=tariff.id,
+        started_at=purchase_date or now,
+        ended_at=tariff.ends_at(now),
+        status="active",
+    )
+    db.add(user_tariff)
+    state = subscriptions.refresh(db, payload.user_id, now)
+    user_tariff_id = user_tariff.id
+    db.commit()
+    subscriptions.committed(payload.user_id, state)
+
+    return {
+        "msg": "Payment processed successfully",
+        "payment_id": payment_id,
+        "user_tariff_id": user_tariff_id,
+        "tariff_id": tariff.id,
+    }
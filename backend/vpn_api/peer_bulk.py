@@ -0,0 +1,336 @@
+"""Bulk peer provisioning behind ``POST /vpn_peers/bulk``.
+
+The request is processed in stages so that per-peer costs are batched:
+
+1. keys for every item according to WG_KEY_POLICY (key pool / host / wg-easy,
+   the remote calls with bounded concurrency);
+2. addresses from the IPAM pool in one allocation;
+3. wg-quick configs encrypted on a worker pool;
+4. all rows inserted in a single transaction together with their host apply
+   events in the outbox (per-item savepoints only if the batch insert fails);
+5. results streamed back as NDJSON, one line per item followed by a summary
+   line.
+
+The host apply itself is left to the outbox workers, which retry it and
+honour WG_APPLY_ENABLED like for a single peer. Stages 1-4 run before the
+response starts; stage 5 only touches plain values, so the DB session may be
+closed while the response is streamed.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from vpn_api import ipam, models, outbox, schemas
+from vpn_api.crypto import encrypt_text
+from vpn_api.keypool import get_key_pool
+
+logger = logging.getLogger(__name__)
+
+# Max specs accepted per request.
+WG_BULK_MAX = int(os.getenv("WG_BULK_MAX", "10000"))
+# Concurrent host/controller operations (host key generation, wg-easy create/delete).
+WG_BULK_CONCURRENCY = int(os.getenv("WG_BULK_CONCURRENCY", "8"))
+# Threads used to encrypt configs.
+WG_BULK_WORKERS = int(os.getenv("WG_BULK_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+
+@dataclass
+class _Item:
+    index: int
+    user_id: int
+    spec: schemas.VpnPeerCreate
+    private: Optional[str] = None
+    public: Optional[str] = None
+    wg_ip: Optional[str] = None
+    allowed_ips: Optional[str] = None
+    client_id: Optional[str] = None
+    config: Optional[str] = None
+    encrypted: Optional[str] = None
+    ip_allocated: bool = False
+    peer_id: Optional[int] = None
+    error: Optional[str] = None
+
+    def result(self, **extra) -> dict:
+        if self.error:
+            return {"index": self.index, "status": "error", "detail": self.error}
+        return {
+            "index": self.index,
+            "status": "created",
+            "peer": {
+                "id": self.peer_id,
+                "user_id": self.user_id,
+                "wg_public_key": self.public,
+                "wg_ip": self.wg_ip,
+                "allowed_ips": self.allowed_ips,
+                "wg_client_id": self.client_id,
+            },
+            **extra,
+        }
+
+
+def _keys_wg_easy(items: list[_Item]) -> None:
+    from vpn_api import peers
+
+    if not os.getenv("WG_EASY_URL") or not os.getenv("WG_EASY_PASSWORD"):
+        for item in items:
+            item.error = "WG_EASY_URL or WG_EASY_PASSWORD not set"
+        return
+
+    def _create(item: _Item):
+        name = item.spec.device_name or f"peer-{item.user_id}-{secrets.token_hex(4)}"
+        return peers._handle_wg_easy_creation(item.user_id, name)
+
+    with ThreadPoolExecutor(max_workers=WG_BULK_CONCURRENCY) as ex:
+        futures = {ex.submit(_create, item): item for item in items}
+        for fut in as_completed(futures):
+            item = futures[fut]
+            try:
+                public, private, client_id, meta = fut.result()
+            except Exception as e:
+                item.error = f"failed to create remote wg-easy client: {e}"
+                continue
+            meta = dict(meta or {})
+            item.public, item.private, item.client_id = public, private, client_id
+            item.config = meta.pop("wg_quick", None)
+            item.wg_ip = item.spec.wg_ip or meta.get("address")
+            item.allowed_ips = item.spec.allowed_ips or meta.get("allowed_ips")
+            if not item.wg_ip:
+                item.error = "wg-easy did not return an address"
+
+
+def _keys_host(items: list[_Item]) -> None:
+    from vpn_api import peers
+
+    def _gen(item: _Item):
+        return peers.generate_key_on_host(f"peer_{item.user_id}_{secrets.token_hex(6)}")
+
+    with ThreadPoolExecutor(max_workers=WG_BULK_CONCURRENCY) as ex:
+        futures = {ex.submit(_gen, item): item for item in items}
+        for fut in as_completed(futures):
+            item = futures[fut]
+            try:
+                gen = fut.result()
+            except Exception:
+                gen = None
+            if gen:
+                item.private, item.public = f"host:{gen['private']}", gen["public"]
+    # host generation failed: fall back to local keys, as in create_peer
+    missing = [item for item in items if not item.private]
+    for item, (private, public) in zip(missing, get_key_pool().take(len(missing))):
+        item.private, item.public = private, public
+
+
+def _keys_local(items: list[_Item]) -> None:
+    pairs = get_key_pool().take(len(items))
+    for item, (private, public) in zip(items, pairs):
+        item.private = private
+        # a client-supplied public key is kept, as in create_peer
+        item.public = item.spec.wg_public_key or public
+
+
+def _prepare_keys(items: list[_Item], policy: str) -> None:
+    if policy == "wg-easy":
+        _keys_wg_easy(items)
+    elif policy == "host":
+        _keys_host(items)
+    else:
+        _keys_local(items)
+
+
+def _allocate_ips(items: list[_Item], db: Session) -> None:
+    need = [item for item in items if not item.error and not item.wg_ip]
+    explicit = [item for item in items if not item.error and item.wg_ip]
+    for item in explicit:
+        item.allowed_ips = item.allowed_ips or item.spec.allowed_ips
+    if not need:
+        return
+    pool = ipam.get_pool(db)
+    try:
+        addresses = pool.allocate_many(len(need))
+    except ipam.PoolExhaustedError:
+        for item in need:
+            item.error = "No free addresses in pool"
+        return
+    for item, address in zip(need, addresses):
+        item.wg_ip = address
+        item.ip_allocated = True
+        item.allowed_ips = item.spec.allowed_ips
+
+
+def _build_config(item: _Item) -> Optional[str]:
+    from vpn_api import peers
+
+    if item.client_id:
+        return item.config
+    return peers._build_wg_quick_config(item.private, item.wg_ip, item.allowed_ips or "0.0.0.0/0")
+
+
+def _encrypt_one(item: _Item) -> None:
+    item.config = _build_config(item)
+    if not item.config:
+        return
+    try:
+        item.encrypted = encrypt_text(item.config)
+    except Exception as e:
+        # best-effort, as in create_peer: the peer is still created
+        logger.warning("bulk: failed to encrypt config for item %d: %s", item.index, e)
+
+
+def _encrypt_configs(items: list[_Item]) -> None:
+    live = [item for item in items if not item.error]
+    if not live:
+        return
+    with ThreadPoolExecutor(max_workers=WG_BULK_WORKERS) as ex:
+        list(ex.map(_encrypt_one, live))
+
+
+def _row(item: _Item) -> models.VpnPeer:
+    return models.VpnPeer(
+        user_id=item.user_id,
+        wg_private_key=item.private,
+        wg_public_key=item.public,
+        wg_client_id=item.client_id,
+        wg_ip=item.wg_ip,
+        allowed_ips=item.allowed_ips,
+        wg_config_encrypted=item.encrypted,
+    )
+
+
+def _insert_one_by_one(db: Session, items: list[_Item]) -> None:
+    """Slow path: one savepoint per item inside the same transaction."""
+    from vpn_api import peers
+
+    for item in items:
+        for attempt in range(peers.IP_ALLOC_RETRIES):
+            row = _row(item)
+            try:
+                with db.begin_nested():
+                    db.add(row)
+                    db.flush()
+                    outbox.enqueue_apply(db, row)
+                item.peer_id = row.id
+                break
+            except IntegrityError as e:
+                taken = (
+                    item.ip_allocated
+                    and db.query(models.VpnPeer.id)
+                    .filter(models.VpnPeer.wg_ip == item.wg_ip)
+                    .first()
+                )
+                if not taken or attempt == peers.IP_ALLOC_RETRIES - 1:
+                    item.error = f"insert failed: {e.orig}"
+                    break
+                # another worker owns this address: reload the bitmap, take a new one
+                try:
+                    pool = ipam.resync(db)
+                    # items not inserted yet keep the addresses they were given
+                    pool.load(i.wg_ip for i in items if i.peer_id is None and i is not item)
+                    item.wg_ip = pool.allocate()
+                except ipam.PoolExhaustedError:
+                    item.error = "No free addresses in pool"
+                    break
+                _encrypt_one(item)
+
+
+def _insert(db: Session, items: list[_Item]) -> None:
+    live = [item for item in items if not item.error]
+    rows = [_row(item) for item in live]
+    try:
+        db.add_all(rows)
+        db.flush()
+        outbox.enqueue_apply_many(db, rows)
+        # read ids before commit: committing expires the rows
+        ids = [row.id for row in rows]
+        db.commit()
+        for item, peer_id in zip(live, ids):
+            item.peer_id = peer_id
+        return
+    except IntegrityError:
+        db.rollback()
+        logger.info("bulk: batch insert failed, retrying %d items one by one", len(live))
+    _insert_one_by_one(db, live)
+    try:
+        db.commit()
+    except Exception:
+        for item in live:
+            item.peer_id = None
+        raise
+
+
+def _cleanup_failed(db: Session, items: list[_Item]) -> None:
+    """Release addresses and remove remote clients of items that were not persisted."""
+    from vpn_api import peers
+
+    pool = ipam.get_pool(db) if any(i.ip_allocated for i in items) else None
+    orphaned = []
+    for item in items:
+        if item.peer_id is not None:
+            continue
+        if item.ip_allocated and pool is not None:
+            pool.release(item.wg_ip)
+        if item.client_id:
+            orphaned.append(item.client_id)
+    if not orphaned:
+        return
+    url, password = os.getenv("WG_EASY_URL"), os.getenv("WG_EASY_PASSWORD")
+    with ThreadPoolExecutor(max_workers=WG_BULK_CONCURRENCY) as ex:
+        for fut in [ex.submit(peers._delete_wg_easy_client, url, password, c) for c in orphaned]:
+            try:
+                fut.result()
+            except Exception:
+                # best-effort compensation, as in create_peer
+                pass
+
+
+def _stream(items: list[_Item]) -> Iterator[str]:
+    created = sum(1 for item in items if item.peer_id is not None)
+    for item in items:
+        yield json.dumps(item.result()) + "\n"
+    # every created peer has its host apply queued in the outbox
+    counts = {"created": created, "failed": len(items) - created, "queued": created}
+    yield json.dumps({"summary": counts}) + "\n"
+
+
+def provision_peers(
+    specs: list[schemas.VpnPeerCreate], db: Session, default_user_id: int
+) -> Iterator[str]:
+    """Create peers for ``specs`` and return an iterator of NDJSON result lines."""
+    items = [_Item(i, spec.user_id or default_user_id, spec) for i, spec in enumerate(specs)]
+
+    user_ids = {item.user_id for item in items}
+    known = {row[0] for row in db.query(models.User.id).filter(models.User.id.in_(user_ids)).all()}
+    for item in items:
+        if item.user_id not in known:
+            item.error = "User not found"
+
+    live = [item for item in items if not item.error]
+    _prepare_keys(live, os.getenv("WG_KEY_POLICY", "db"))
+    _allocate_ips(items, db)
+    _encrypt_configs(items)
+    try:
+        _insert(db, items)
+    finally:
+        _cleanup_failed(db, items)
+    # the apply events were committed with the rows
+    outbox.notify()
+    # explicit or controller-assigned addresses: keep the IPAM bitmap in sync
+    pool = ipam.get_pool(db)
+    for item in items:
+        if item.peer_id is not None and not item.ip_allocated:
+            pool.reserve(item.wg_ip)
+    logger.info(
+        "[BULK_PEERS] requested=%d created=%d",
+        len(items),
+        sum(1 for item in items if item.peer_id is not None),
+    )
+    return _stream(items)
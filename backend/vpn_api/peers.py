@@ -1,20 +1,24 @@
-import asyncio
-import base64
+import ipaddress
 import logging
 import os
 import secrets
-from datetime import UTC, datetime
-from typing import List, Optional
+from typing import Callable, List, Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from vpn_api import models, schemas
+from vpn_api import ipam, models, outbox, pagination, schemas, subscriptions
 from vpn_api.auth import get_current_user
 from vpn_api.crypto import decrypt_text, encrypt_text
 from vpn_api.database import get_db
-from vpn_api.wg_easy_adapter import WgEasyAdapter
-from vpn_api.wg_host import apply_peer, generate_key_on_host, remove_peer
+from vpn_api.keypool import get_key_pool
+from vpn_api.wg_easy_pool import get_wg_easy_pool
+
+# apply_peer/remove_peer are looked up on this module by the outbox handlers
+# and bulk provisioning, so tests can patch vpn_api.peers.apply_peer.
+from vpn_api.wg_host import apply_peer, generate_key_on_host, remove_peer  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
@@ -24,19 +28,9 @@ router = APIRouter(prefix="/vpn_peers", tags=["vpn_peers"])
 def _check_active_subscription(user_id: int, db: Session) -> bool:
     """Check if user has an active subscription.
 
-    Returns True if user has at least one active subscription that hasn't expired.
+    Reads the materialized state on the user row (see vpn_api.subscriptions).
     """
-    now = datetime.now(UTC)
-    active = (
-        db.query(models.UserTariff)
-        .filter(
-            models.UserTariff.user_id == user_id,
-            models.UserTariff.status == "active",
-            (models.UserTariff.ended_at.is_(None)) | (models.UserTariff.ended_at > now),
-        )
-        .first()
-    )
-    return active is not None
+    return subscriptions.has_active(db, user_id)
 
 
 def _build_wg_quick_config(private_key: str, address: str, allowed_ips: str) -> str:
@@ -52,11 +46,12 @@ def _build_wg_quick_config(private_key: str, address: str, allowed_ips: str) ->
     WG_DNS = os.getenv("WG_DNS", "1.1.1.1")
     WG_MTU = os.getenv("WG_MTU", "1420")
 
-    # Ensure Address has /24 mask instead of /32
+    # Client Address carries the pool mask (/24 by default) instead of /32
+    prefix = ipaddress.ip_network(ipam.WG_IP_POOL, strict=False).prefixlen
     if address and "/" not in address:
-        address = f"{address}/24"
+        address = f"{address}/{prefix}"
     elif address and address.endswith("/32"):
-        address = address.replace("/32", "/24")
+        address = address.replace("/32", f"/{prefix}")
 
     return (
         "[Interface]\n"
@@ -73,41 +68,79 @@ def _build_wg_quick_config(private_key: str, address: str, allowed_ips: str) ->
 
 
 def _generate_wg_keypair() -> tuple[str, str]:
-    """Generate a WireGuard-compatible key pair locally.
+    """Return a WireGuard key pair from the pre-generated pool.
 
-    Returns a tuple of (private_key_base64, public_key_base64).
-    Uses the WireGuard key format: clamped 32-byte random values, base64-encoded.
+    Returns a tuple of (private_key_base64, public_key_base64); the public key
+    is derived from the private key (X25519), see vpn_api.keypool.
     """
-    # Generate 32 random bytes for private key
-    private_key_bytes = bytearray(secrets.token_bytes(32))
+    return get_key_pool().get()
 
-    # Generate 32 random bytes for public key
-    # (in reality derived from private, but for MVP we use random)
-    public_key_bytes = bytearray(secrets.token_bytes(32))
 
-    # Clamp the private key (WireGuard standard)
-    private_key_bytes[0] &= 248  # Clear bits 0, 1, 2
-    private_key_bytes[31] &= 127  # Clear bit 7
-    private_key_bytes[31] |= 64  # Set bit 6
+# How many times create_peer re-allocates an address that another worker
+# committed first (see vpn_api.ipam for the multi-worker model).
+IP_ALLOC_RETRIES = 5
 
-    # Encode to base64
-    private_key_b64 = base64.b64encode(bytes(private_key_bytes)).decode("utf-8")
-    public_key_b64 = base64.b64encode(bytes(public_key_bytes)).decode("utf-8")
 
-    return private_key_b64, public_key_b64
+def _alloc_ip(db: Session) -> str:
+    """Allocate a free /32 from the IPAM pool (WG_IP_POOL)."""
+    try:
+        allocated_ip = ipam.get_pool(db).allocate()
+    except ipam.PoolExhaustedError:
+        # other workers may have released addresses this bitmap still holds
+        try:
+            allocated_ip = ipam.resync(db).allocate()
+        except ipam.PoolExhaustedError as e:
+            raise HTTPException(status_code=503, detail="No free addresses in pool") from e
+    logger.info(f"[ALLOC_IP] allocated_ip={allocated_ip}")
+    return allocated_ip
 
 
-def _alloc_dummy_ip(user_id: int) -> str:
-    """Allocate a deterministic /32 address in 10.8.0.x range to match WireGuard server.
+def _commit_new_peer(
+    db: Session,
+    peer: models.VpnPeer,
+    ip_allocated: bool,
+    before_commit: Optional[Callable[[], None]] = None,
+) -> None:
+    """Commit a freshly added peer, re-allocating its address on wg_ip conflicts.
 
-    WireGuard-Easy uses 10.8.0.x subnet for clients. This allocates IPs in that range.
+    Another uvicorn worker may have committed the same address from its own
+    bitmap; in that case the address stays marked as used locally and a new one
+    is taken. Any other failure releases the allocated address and re-raises.
+    ``before_commit`` runs inside every attempt's transaction (a rollback
+    discards whatever it added).
     """
-    # Allocate from 10.8.0.19 onwards (10.8.0.1-10.8.0.18 are reserved for existing clients)
-    # Simple allocation: just use (user_id % 200) + 20 to avoid collisions
-    ip_suffix = (user_id % 200) + 20
-    allocated_ip = f"10.8.0.{ip_suffix}/32"
-    logger.info(f"[ALLOC_IP] user_id={user_id}, suffix={ip_suffix}, allocated_ip={allocated_ip}")
-    return allocated_ip
+    for attempt in range(IP_ALLOC_RETRIES):
+        try:
+            if before_commit is not None:
+                before_commit()
+            db.commit()
+            db.refresh(peer)
+            if not ip_allocated:
+                # explicit or controller-assigned address: keep the bitmap in sync
+                ipam.get_pool(db).reserve(peer.wg_ip)
+            return
+        except IntegrityError:
+            db.rollback()
+            taken = (
+                ip_allocated
+                and db.query(models.VpnPeer.id).filter(models.VpnPeer.wg_ip == peer.wg_ip).first()
+            )
+            if not taken or attempt == IP_ALLOC_RETRIES - 1:
+                if ip_allocated and not taken:
+                    ipam.get_pool(db).release(peer.wg_ip)
+                raise
+            logger.info(f"[ALLOC_IP] wg_ip={peer.wg_ip} taken by another worker, resyncing")
+            # the local bitmap is behind the table: reload it before retrying
+            ipam.resync(db)
+            peer.wg_ip = _alloc_ip(db)
+            db.add(peer)
+        except Exception:
+            # before_commit may have flushed rows; don't leave the
+            # transaction (and its write lock) open
+            db.rollback()
+            if ip_allocated:
+                ipam.get_pool(db).release(peer.wg_ip)
+            raise
 
 
 @router.post("/", response_model=schemas.VpnPeerOut)
@@ -132,6 +165,10 @@ def create_peer(  # noqa: C901 - function is intentionally a bit complex; refact
     public = payload.wg_public_key
     # container for any metadata returned by external controllers
     extra_metadata: dict = {}
+    # whether wg_ip came from the IPAM pool (and must be released on failure)
+    ip_allocated = False
+    # wg-quick text returned by the controller at creation time (wg-easy policy)
+    wg_easy_config = None
 
     # For db-backed keys, generate a local key pair
     if key_policy == "db":
@@ -152,7 +189,8 @@ def create_peer(  # noqa: C901 - function is intentionally a bit complex; refact
             # Keep the client's public key as is
 
         if not payload.wg_ip:
-            payload.wg_ip = _alloc_dummy_ip(target_user)
+            payload.wg_ip = _alloc_ip(db)
+            ip_allocated = True
 
     if key_policy == "host":
         # attempt to generate keypair on host; use username or timestamp as base name
@@ -168,7 +206,8 @@ def create_peer(  # noqa: C901 - function is intentionally a bit complex; refact
         # ensure wg_ip exists to satisfy DB NOT NULL; allocate a synthetic
         # address when not provided by payload or controller
         if not payload.wg_ip:
-            payload.wg_ip = _alloc_dummy_ip(target_user)
+            payload.wg_ip = _alloc_ip(db)
+            ip_allocated = True
     elif key_policy == "wg-easy":
         # Use the wg-easy HTTP API (via adapter). Create remote client first
         # then persist DB row. If persisting fails we attempt to delete the
@@ -180,7 +219,9 @@ def create_peer(  # noqa: C901 - function is intentionally a bit complex; refact
             public, private, wg_client_id, meta = _handle_wg_easy_creation(
                 target_user, payload.device_name
             )
-            extra_metadata.update(meta or {})
+            meta = dict(meta or {})
+            wg_easy_config = meta.pop("wg_quick", None)
+            extra_metadata.update(meta)
             # If wg_ip missing in payload, try to obtain from metadata
             if not payload.wg_ip:
                 payload.wg_ip = extra_metadata.get("address")
@@ -210,9 +251,14 @@ def create_peer(  # noqa: C901 - function is intentionally a bit complex; refact
         f"[PEER_CREATED] user_id={target_user}, wg_ip={peer.wg_ip}, allowed_ips={peer.allowed_ips}"
     )
     db.add(peer)
+
+    def _enqueue_apply():
+        # host apply goes through the outbox, committed together with the peer
+        db.flush()
+        outbox.enqueue_apply(db, peer)
+
     try:
-        db.commit()
-        db.refresh(peer)
+        _commit_new_peer(db, peer, ip_allocated, before_commit=_enqueue_apply)
     except Exception:
         # If we created a remote wg-easy client above, remove it as
         # compensation to avoid orphaned entries.
@@ -227,21 +273,10 @@ def create_peer(  # noqa: C901 - function is intentionally a bit complex; refact
             # best-effort
             pass
         raise
-    # Try to apply the peer on the host (best-effort). This will be a no-op unless
-    # WG_APPLY_ENABLED=1 is set in the environment. We don't fail the API call if
-    # the host operation fails; the DB remains the source of truth.
-    try:
-        from vpn_api import wg_host as wg_host_module
-
-        print(
-            f"[DEBUG] WG_APPLY_ENABLED={wg_host_module.WG_APPLY_ENABLED}, "
-            f"WG_HOST_SSH={wg_host_module.WG_HOST_SSH}"
-        )
-        apply_peer(peer)
-    except Exception as e:
-        # apply_peer is already logging; swallow exceptions to avoid 500s
-        print(f"[ERROR] apply_peer failed: {e}")
-        pass
+    # The host apply was recorded in the outbox with the peer row; outbox
+    # workers perform it (with retries) outside the request. It is still a
+    # no-op on the host unless WG_APPLY_ENABLED=1.
+    outbox.notify()
     # Attach any extra metadata onto the returned model object for the
     # response serializer to include (e.g. dns/endpoint). We intentionally
     # don't persist unrelated controller fields to the DB schema here.
@@ -250,25 +285,11 @@ def create_peer(  # noqa: C901 - function is intentionally a bit complex; refact
     # If key policy produced a config (wg-easy path or local generation), try
     # to store the wg-quick client config encrypted in the DB (best-effort).
     try:
-        # If wg-easy created a config, _get_wg_easy_client_config may have
-        # returned metadata including the private key; build a wg-quick text
-        # when possible.
+        # The wg-easy path already fetched the client config once during
+        # creation; reuse it instead of asking the controller again.
         cfg_text = None
         if locals().get("wg_client_id"):
-            # attempt to fetch the config again (best-effort, synchronous)
-            try:
-                cfg_bytes = _get_wg_easy_client_config(
-                    os.getenv("WG_EASY_URL"),
-                    os.getenv("WG_EASY_PASSWORD"),
-                    locals().get("wg_client_id"),
-                )
-                cfg_text = (
-                    cfg_bytes.decode("utf-8")
-                    if isinstance(cfg_bytes, (bytes, bytearray))
-                    else str(cfg_bytes)
-                )
-            except Exception:
-                cfg_text = None
+            cfg_text = wg_easy_config
         else:
             # For db or host keys generate a minimal wg-quick client config from
             # the stored values so that the mobile app can import it.
@@ -294,6 +315,30 @@ def create_peer(  # noqa: C901 - function is intentionally a bit complex; refact
     return peer
 
 
+@router.post(
+    "/bulk",
+    summary="Create many VPN peers in one request (admin only)",
+    description=(
+        "Allocates keys and addresses in batch, inserts all rows in a single transaction\n"
+        "and applies peers on the host with bounded concurrency. The response is NDJSON:\n"
+        "one line per item (in completion order) followed by a summary line."
+    ),
+)
+def create_peers_bulk(
+    payload: schemas.VpnPeerBulkCreate,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    from vpn_api.peer_bulk import WG_BULK_MAX, provision_peers
+
+    if not getattr(current_user, "is_admin", False):
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    if len(payload.peers) > WG_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {WG_BULK_MAX} peers per request")
+    lines = provision_peers(payload.peers, db, current_user.id)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
 @router.get("/self/config")
 def get_my_peer_config(
     db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)
@@ -316,6 +361,11 @@ def get_my_peer_config(
     )
     if not peer:
         raise HTTPException(status_code=404, detail="No peer found for user")
+    if peer.idle_since is not None:
+        # parked by the idle reaper: the client is about to connect again
+        from vpn_api import idle_peers
+
+        idle_peers.wake(db, [peer])
     if not peer.wg_config_encrypted:
         raise HTTPException(status_code=404, detail="No stored config for peer")
     cfg = decrypt_text(peer.wg_config_encrypted)
@@ -325,21 +375,31 @@ def get_my_peer_config(
 
 
 def _create_wg_easy_client(url: str, password: str, name: str) -> dict:
-    """Call the async WgEasyAdapter.create_client synchronously and return result."""
+    """Create a wg-easy client through the shared adapter pool and return the result.
+
+    A create cut short by a 401 may already have added the client, so the
+    retry after re-login looks for it by name before creating again.
+    """
+    known: set = set()
 
-    async def _inner():
-        async with WgEasyAdapter(url, password) as adapter:
-            return await adapter.create_client(name)
+    async def create(adapter):
+        known.update(adapter.index.ids_for(name))
+        return await adapter.create_client(name)
 
-    return asyncio.run(_inner())
+    async def retry(adapter):
+        return await adapter.find_created(name, known) or await adapter.create_client(name)
+
+    return get_wg_easy_pool().run(url, password, create, replay=retry)
 
 
 def _delete_wg_easy_client(url: str, password: str, client_id: str) -> None:
-    async def _inner():
-        async with WgEasyAdapter(url, password) as adapter:
-            await adapter.delete_client(client_id)
+    get_wg_easy_pool().run(url, password, lambda adapter: adapter.delete_client(client_id))
+
 
-    return asyncio.run(_inner())
+def _set_wg_easy_client_enabled(url: str, password: str, client_id: str, enabled: bool) -> None:
+    get_wg_easy_pool().run(
+        url, password, lambda adapter: adapter.set_client_enabled(client_id, enabled)
+    )
 
 
 def _parse_wg_quick_config(cfg_text: str) -> dict:
@@ -400,6 +460,8 @@ def _handle_wg_easy_creation(user_id: int, device_name: str | None = None):
             else str(cfg_bytes)
         )
         meta = _parse_wg_quick_config(cfg_text)
+        # keep the raw config so create_peer can store it without a second fetch
+        meta["wg_quick"] = cfg_text
         private = meta.get("private_key") or "wg-easy:remote"
         # If public key not present try to derive from config (rare)
         return public, private, wg_client_id, meta
@@ -408,38 +470,22 @@ def _handle_wg_easy_creation(user_id: int, device_name: str | None = None):
 
 
 def _get_wg_easy_client_config(url: str, password: str, client_id: str) -> bytes:
-    # Prefer a simple synchronous HTTP GET here to avoid creating an
-    # aiohttp.ClientSession in a library (wg_easy_api) when called from
-    # synchronous code paths (tests and API helpers). The caller will
-    # treat any exception as non-fatal and fall back to a placeholder.
-    try:
-        import urllib.request
-
-        base = url.rstrip("/")
-        cfg_url = f"{base}/api/wireguard/client/{client_id}/configuration"
-        # Build Authorization header: prefer WG_API_KEY if set.
-        api_key = os.environ.get("WG_API_KEY")
-        if api_key:
-            auth = api_key
-        else:
-            auth = password
-
-        req = urllib.request.Request(cfg_url, headers={"Authorization": auth})
-        with urllib.request.urlopen(req, timeout=5) as resp:
-            return resp.read()
-    except Exception:
-        # Caller handles failures; return empty bytes to indicate missing config
-        raise
+    """Fetch the wg-quick config for a client through the shared adapter pool."""
+    return get_wg_easy_pool().run(
+        url, password, lambda adapter: adapter.get_client_config(client_id)
+    )
 
 
-@router.get("/", response_model=List[schemas.VpnPeerOut])
+@router.get("/", response_model=Union[List[schemas.VpnPeerOut], schemas.Page[schemas.VpnPeerOut]])
 def list_peers(
     user_id: Optional[int] = None,
-    skip: int = 0,
-    limit: int = 100,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
+    """List peers; with ``cursor`` (empty for the first page) returns a keyset page."""
     q = db.query(models.VpnPeer)
     if user_id:
         # non-admin can only list their own
@@ -448,9 +494,34 @@ def list_peers(
         q = q.filter(models.VpnPeer.user_id == user_id)
     elif not getattr(current_user, "is_admin", False):
         q = q.filter(models.VpnPeer.user_id == current_user.id)
+    if cursor is not None:
+        return pagination.keyset(q, models.VpnPeer, cursor, limit)
     return q.offset(skip).limit(limit).all()
 
 
+@router.get("/usage", response_model=schemas.UsageOut)
+def get_usage(
+    user_id: Optional[int] = None,
+    hours: int = 24,
+    step: str = "1h",
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    """Traffic of a user's peers over the last ``hours``, bucketed by ``step`` (1m/1h/1d)."""
+    from vpn_api import telemetry
+
+    if user_id is None:
+        user_id = current_user.id
+    elif not getattr(current_user, "is_admin", False) and current_user.id != user_id:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    if step not in telemetry.RESOLUTIONS:
+        raise HTTPException(status_code=400, detail="step must be one of 1m, 1h, 1d")
+    if hours < 1 or hours > 24 * 366:
+        raise HTTPException(status_code=400, detail="hours out of range")
+    since, until = telemetry.default_window(hours)
+    return telemetry.usage_for_user(db, user_id, since, until, step)
+
+
 @router.get("/{peer_id}", response_model=schemas.VpnPeerOut)
 def get_peer(
     peer_id: int,
@@ -530,11 +601,16 @@ def update_peer(
         raise HTTPException(status_code=404, detail="Peer not found")
     if not getattr(current_user, "is_admin", False) and peer.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not allowed")
+    old_ip = peer.wg_ip
     peer.wg_public_key = payload.wg_public_key
     peer.wg_ip = payload.wg_ip
     peer.allowed_ips = payload.allowed_ips
     db.commit()
     db.refresh(peer)
+    if peer.wg_ip != old_ip:
+        pool = ipam.get_pool(db)
+        pool.reserve(peer.wg_ip)
+        pool.release(old_ip)
     return peer
 
 
@@ -549,19 +625,11 @@ def delete_peer(
         raise HTTPException(status_code=404, detail="Peer not found")
     if not getattr(current_user, "is_admin", False) and peer.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not allowed")
+    # Host removal and the wg-easy client delete are queued in the same
+    # transaction and retried by the outbox workers.
+    outbox.enqueue_remove(db, peer)
     db.delete(peer)
     db.commit()
-    # Best-effort remove from host or wg-easy controller
-    try:
-        # If peer was created via wg-easy remove remote client id as well
-        if getattr(peer, "wg_client_id", None):
-            try:
-                _delete_wg_easy_client(
-                    os.getenv("WG_EASY_URL"), os.getenv("WG_EASY_PASSWORD"), peer.wg_client_id
-                )
-            except Exception:
-                pass
-        remove_peer(peer)
-    except Exception:
-        pass
+    ipam.get_pool(db).release(peer.wg_ip)
+    outbox.notify()
     return {"msg": "deleted"}
@@ -0,0 +1,241 @@
+"""Rate limiting for the login and registration endpoints.
+
+Every rule is a token bucket: ``count`` attempts per ``seconds``, refilled
+continuously, so short bursts are allowed while the sustained rate is capped.
+The auth endpoints check their rules before any password is hashed; a
+rejected attempt costs one bucket update instead of a pbkdf2 round.
+
+Rules (``RATE_LIMIT_<RULE>=count/seconds``, ``0`` disables a rule):
+
+- ``login_ip`` / ``login_email``: ``POST /auth/login`` per client address and
+  per (lower-cased) email, so neither one address nor a spread of addresses
+  can grind through one account;
+- ``register_ip``: ``POST /auth/register`` and ``/auth/register/email``.
+
+Backends (``RATE_LIMIT_BACKEND``):
+
+- ``memory``: per-process buckets in ``RATE_LIMIT_SHARDS`` independently locked
+  shards, at most ``RATE_LIMIT_MAX_KEYS`` keys in total. Each shard evicts
+  its least recently used key when full. That key is almost always a bucket
+  that has refilled anyway, and dropping a full bucket loses nothing.
+- ``sqlite``: buckets in a SQLite file (``RATE_LIMIT_SQLITE_PATH``) shared by
+  every worker on the host, a local stand-in for a shared store. One
+  ``BEGIN IMMEDIATE`` transaction per check. Refilled rows are purged
+  periodically.
+
+Rejections are counted in :mod:`vpn_api.metrics` (``ratelimit_rejected`` and
+``ratelimit_rejected_<rule>``).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException, Request
+
+from vpn_api import metrics
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_SQLITE_PATH = os.getenv(
+    "RATE_LIMIT_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "vpn-api-ratelimit.db")
+)
+# Use the first X-Forwarded-For address (only behind a proxy that sets it).
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+
+DEFAULT_RULES = {
+    "login_ip": "30/60",
+    "login_email": "10/300",
+    "register_ip": "10/3600",
+}
+
+
+def parse_rule(value: str) -> Optional[tuple[float, float]]:
+    """Parse ``count/seconds``; returns None for a disabled rule."""
+    if not value or value.strip() == "0":
+        return None
+    count, _, seconds = value.partition("/")
+    return float(count), float(seconds or 1)
+
+
+RULES = {
+    name: parse_rule(os.getenv(f"RATE_LIMIT_{name.upper()}", default))
+    for name, default in DEFAULT_RULES.items()
+}
+
+
+def _take(
+    tokens: float, updated: float, now: float, capacity: float, rate: float
+) -> tuple[float, float]:
+    """Refill and take one token; returns (tokens left, seconds to wait or 0)."""
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBackend:
+    """Sharded in-process token buckets with LRU eviction."""
+
+    def __init__(self, shards: int = RATE_LIMIT_SHARDS, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self._shards = [OrderedDict() for _ in range(max(1, shards))]
+        self._locks = [threading.Lock() for _ in self._shards]
+        self._per_shard = max(1, max_keys // len(self._shards))
+
+    def __len__(self) -> int:
+        return sum(len(s) for s in self._shards)
+
+    def hit(self, key: str, capacity: float, seconds: float, now: float) -> float:
+        index = hash(key) % len(self._shards)
+        shard = self._shards[index]
+        rate = capacity / seconds
+        with self._locks[index]:
+            tokens, updated = shard.get(key, (capacity, now))
+            tokens, wait = _take(tokens, updated, now, capacity, rate)
+            shard[key] = (tokens, now)
+            shard.move_to_end(key)
+            if len(shard) > self._per_shard:
+                shard.popitem(last=False)
+                metrics.inc("ratelimit_evictions")
+        return wait
+
+    def clear(self) -> None:
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                shard.clear()
+
+
+class SqliteBackend:
+    """Token buckets in a SQLite file shared by the workers of one host."""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str = RATE_LIMIT_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._hits = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, "
+                "full_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_rate_buckets_full_at ON rate_buckets (full_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def hit(self, key: str, capacity: float, seconds: float, now: float) -> float:
+        rate = capacity / seconds
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens, wait = _take(tokens, updated, now, capacity, rate)
+            conn.execute(
+                "INSERT INTO rate_buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, "
+                "updated = excluded.updated, full_at = excluded.full_at",
+                (key, tokens, now, now + (capacity - tokens) / rate),
+            )
+            self._hits += 1
+            if self._hits % self.PURGE_EVERY == 0:
+                # refilled buckets are equivalent to missing ones
+                conn.execute("DELETE FROM rate_buckets WHERE full_at < ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def clear(self) -> None:
+        self._connect().execute("DELETE FROM rate_buckets")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if RATE_LIMIT_BACKEND == "sqlite":
+                    _backend = SqliteBackend()
+                else:
+                    backend = MemoryBackend()
+                    metrics.register_gauge("ratelimit_keys", backend.__len__)
+                    _backend = backend
+    return _backend
+
+
+def reset() -> None:
+    """Drop the backend (tests); the next check creates a fresh one."""
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def client_ip(request: Optional[Request]) -> str:
+    if request is None:
+        return "unknown"
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def check(rule: str, value: str, now: Optional[float] = None) -> None:
+    """Count one attempt for ``value`` under ``rule``; raises 429 when over the limit."""
+    limit = RULES.get(rule)
+    if not RATE_LIMIT_ENABLED or limit is None:
+        return
+    capacity, seconds = limit
+    now = time.time() if now is None else now
+    try:
+        wait = get_backend().hit(f"{rule}:{value}", capacity, seconds, now)
+    except sqlite3.Error:
+        # a broken shared store must not lock everybody out
+        logger.exception("rate limit backend failed; allowing the request")
+        return
+    if wait > 0:
+        metrics.inc("ratelimit_rejected")
+        metrics.inc(f"ratelimit_rejected_{rule}")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many attempts, retry later",
+            headers={"Retry-After": str(int(wait) + 1)},
+        )
+
+
+def check_login(request: Optional[Request], email: str) -> None:
+    check("login_ip", client_ip(request))
+    check("login_email", email.strip().lower())
+
+
+def check_register(request: Optional[Request]) -> None:
+    check("register_ip", client_ip(request))
@@ -0,0 +1,134 @@
+"""Bounded TTL cache of receipt validation results with call coalescing.
+
+Mobile clients retry ``POST /payments/webhook`` with the same large receipt,
+and each retry used to cost another App Store / Google Play round trip
+before the ``provider_payment_id`` dedupe could even run. Successful
+validations are cached for ``RECEIPT_CACHE_TTL`` seconds under a SHA-256
+digest of (provider, app, product, receipt), so the receipt itself is not
+kept as a key. At most ``RECEIPT_CACHE_SIZE`` results are held (least
+recently used evicted first).
+
+Concurrent validations of the same receipt are coalesced: the first caller
+goes upstream and the others wait for its result. Failed validations are
+not cached, because the validator cannot tell a rejected receipt from a
+store outage, but they are still shared with the callers waiting on them.
+
+Counters: ``receipt_cache_hits``, ``receipt_cache_misses`` and
+``receipt_cache_coalesced``, plus the ``receipt_cache_size`` and
+``receipt_cache_hit_rate`` gauges.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+from vpn_api import metrics
+
+# Max cached results per process; 0 disables caching (coalescing stays on).
+RECEIPT_CACHE_SIZE = int(os.getenv("RECEIPT_CACHE_SIZE", "10000"))
+RECEIPT_CACHE_TTL = float(os.getenv("RECEIPT_CACHE_TTL", "600"))
+
+
+def receipt_key(provider: str, receipt: str, *context: Optional[str]) -> str:
+    """Digest identifying one validation request."""
+    digest = hashlib.sha256(provider.encode())
+    for part in (*context, receipt):
+        digest.update(b"\0")
+        digest.update((part or "").encode())
+    return digest.hexdigest()
+
+
+class ReceiptCache:
+    def __init__(self, size: int = RECEIPT_CACHE_SIZE, ttl: float = RECEIPT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get_or_validate(self, key: str, validate: Callable[[], Optional[dict]]) -> Optional[dict]:
+        """Return the cached result for ``key``, or run ``validate()`` once for all callers."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] > now:
+                self._items.move_to_end(key)
+                metrics.inc("receipt_cache_hits")
+                return dict(item[0])
+            if item is not None:
+                del self._items[key]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            metrics.inc("receipt_cache_coalesced")
+            result = future.result()
+            return dict(result) if result else result
+
+        metrics.inc("receipt_cache_misses")
+        try:
+            result = validate()
+        except BaseException as exc:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(exc)
+            raise
+        with self._lock:
+            del self._inflight[key]
+            if result and self.size > 0:
+                self._items[key] = (dict(result), time.monotonic() + self.ttl)
+                self._items.move_to_end(key)
+                while len(self._items) > self.size:
+                    self._items.popitem(last=False)
+        future.set_result(result)
+        return result
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        hits = metrics.get("receipt_cache_hits")
+        coalesced = metrics.get("receipt_cache_coalesced")
+        misses = metrics.get("receipt_cache_misses")
+        total = hits + coalesced + misses
+        return {
+            "size": len(self._items),
+            "hits": hits,
+            "coalesced": coalesced,
+            "misses": misses,
+            # share of validations answered without a store call of their own
+            "hit_rate": (hits + coalesced) / total if total else None,
+        }
+
+
+_cache: Optional[ReceiptCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_receipt_cache() -> ReceiptCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                cache = ReceiptCache()
+                metrics.register_gauge("receipt_cache_size", cache.__len__)
+                metrics.register_gauge("receipt_cache_hit_rate", lambda: cache.stats()["hit_rate"])
+                _cache = cache
+    return _cache
+
+
+def cached_validation(
+    provider: str, receipt: str, validate: Callable[[], Any], *context: Optional[str]
+) -> Any:
+    return get_receipt_cache().get_or_validate(receipt_key(provider, receipt, *context), validate)
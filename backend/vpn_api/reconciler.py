@@ -0,0 +1,321 @@
+"""Three-way reconciliation of vpn_peers, wg-easy and the WireGuard interface.
+
+Each cycle takes three snapshots keyed by public key:
+
+- the wg-easy client list (when WG_EASY_URL is configured);
+- ``wg show <iface> dump`` via :mod:`vpn_api.wg_host`;
+- ``vpn_peers`` (one column query, no ORM objects), read last so that a peer
+  created and applied while the other two are read is not pruned as stale.
+
+Every snapshot carries an order-independent digest (count + sum of per-item
+hashes, computed while loading). When all three digests match the previous
+cycle the diff is skipped and the previous report is reused. Otherwise the
+snapshots are compared with dict/set lookups only, O(n) in the number of
+peers, and repairs are applied in batches:
+
+- interface drift (missing/stale/wrong AllowedIPs) in one ``wg`` call through
+  :func:`vpn_api.wg_host.apply_diff`, only when WG_APPLY_ENABLED=1;
+- wg-easy clients that no peer row refers to (e.g. left behind when the
+  compensation delete in ``create_peer`` failed) are queued as outbox
+  deletes, only when WG_RECONCILE_DELETE_ORPHANS=1 and only once they were
+  orphans in two consecutive cycles: a ``create_peer`` in flight has its
+  client listed before its peer row commits;
+- peer rows whose wg-easy client is gone are reported, not repaired.
+
+Run ``python -m vpn_api.reconciler`` (loop) or ``--once`` / ``--dry-run``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import select
+
+from vpn_api import metrics, models, outbox, wg_host
+
+logger = logging.getLogger(__name__)
+
+WG_RECONCILE_INTERVAL = float(os.getenv("WG_RECONCILE_INTERVAL", "60"))
+# Delete wg-easy clients that no vpn_peers row refers to.
+WG_RECONCILE_DELETE_ORPHANS = os.getenv("WG_RECONCILE_DELETE_ORPHANS", "0") == "1"
+# Outbox events committed per transaction when queueing repairs.
+WG_RECONCILE_BATCH = int(os.getenv("WG_RECONCILE_BATCH", "1000"))
+
+_MASK = (1 << 64) - 1
+
+
+@dataclass
+class Snapshot:
+    """Items keyed by public key plus a cheap digest of the whole set."""
+
+    items: dict
+    digest: tuple[int, int]
+    # interface snapshots keep the parsed dump to render a syncconf config
+    state: Optional[wg_host.InterfaceState] = None
+
+
+def _digest(hashes) -> tuple[int, int]:
+    # order-independent and process-local (str hashing is randomised per
+    # process), which is all a cycle-to-cycle comparison needs
+    count = total = 0
+    for h in hashes:
+        count += 1
+        total += h
+    return count, total & _MASK
+
+
+def snapshot_db(db) -> Snapshot:
+    """Map public key -> (peer id, wg-easy client id, tunnel address, on interface).
+
+    "On interface" means active and not parked by :mod:`vpn_api.idle_peers`.
+    """
+    t = models.VpnPeer.__table__.c
+    stmt = select(t.wg_public_key, t.id, t.wg_client_id, t.wg_ip, t.active, t.idle_since)
+    # plain DB-API cursor: at 50k rows SQLAlchemy result processing costs
+    # more than the query itself
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute(str(stmt.compile(dialect=db.get_bind().dialect)))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    items = {
+        row[0]: (row[1], row[2], row[3], bool(row[4]) and row[5] is None) for row in rows if row[0]
+    }
+    return Snapshot(items, _digest(hash((k, v)) for k, v in items.items()))
+
+
+def snapshot_wg_easy() -> Optional[Snapshot]:
+    """Map public key (``id:<client id>`` if unknown) -> client; None if not configured."""
+    url, password = os.getenv("WG_EASY_URL"), os.getenv("WG_EASY_PASSWORD")
+    if not url or not password:
+        return None
+    from vpn_api.wg_easy_pool import get_wg_easy_pool
+
+    clients = get_wg_easy_pool().run(url, password, lambda adapter: adapter.list_clients())
+    return snapshot_clients(clients)
+
+
+def snapshot_clients(clients) -> Snapshot:
+    items = {}
+    for c in clients:
+        key = c.get("publicKey") or f"id:{c.get('id')}"
+        items[key] = c
+    return Snapshot(items, _digest(hash((k, c.get("id"))) for k, c in items.items()))
+
+
+def snapshot_iface(iface: Optional[str] = None) -> Snapshot:
+    state = wg_host.read_interface(iface)
+    return snapshot_state(state)
+
+
+def snapshot_state(state: wg_host.InterfaceState) -> Snapshot:
+    digest = _digest(hash((k, p.allowed_ips)) for k, p in state.peers.items())
+    return Snapshot(state.peers, digest, state)
+
+
+@dataclass
+class Report:
+    iface: wg_host.PeerDiff = field(default_factory=wg_host.PeerDiff)
+    # wg-easy clients no peer row refers to
+    orphan_clients: list[dict] = field(default_factory=list)
+    # peer ids whose wg-easy client no longer exists
+    missing_clients: list[int] = field(default_factory=list)
+    unchanged: bool = False
+    seconds: float = 0.0
+
+    def summary(self) -> dict:
+        return {
+            "iface_add": len(self.iface.add),
+            "iface_remove": len(self.iface.remove),
+            "iface_update": len(self.iface.update),
+            "orphan_clients": len(self.orphan_clients),
+            "missing_clients": len(self.missing_clients),
+            "unchanged": self.unchanged,
+            "seconds": round(self.seconds, 4),
+        }
+
+    @property
+    def actions(self) -> int:
+        return (
+            len(self.iface.add)
+            + len(self.iface.remove)
+            + len(self.iface.update)
+            + len(self.orphan_clients)
+        )
+
+
+def diff(db_snap: Snapshot, easy: Optional[Snapshot], iface: Optional[Snapshot]) -> Report:
+    """Compare the snapshots by public key; O(n) dict/set lookups."""
+    report = Report()
+    peers = db_snap.items
+    if iface is not None:
+        desired = {
+            pub: wg_host._normalize_ips(ip)
+            for pub, (_id, _cid, ip, active) in peers.items()
+            if active
+        }
+        report.iface = wg_host.compute_diff(desired, iface.state, prune=True)
+    if easy is not None:
+        known_ids = {cid for (_id, cid, _ip, _active) in peers.values() if cid}
+        client_ids = set()
+        for key, client in easy.items.items():
+            cid = client.get("id")
+            client_ids.add(cid)
+            if key not in peers and cid not in known_ids:
+                report.orphan_clients.append(client)
+        report.missing_clients = [
+            peer_id
+            for (peer_id, cid, _ip, _active) in peers.values()
+            if cid and cid not in client_ids
+        ]
+    return report
+
+
+class Reconciler:
+    """Keeps the previous digests so unchanged cycles skip the diff."""
+
+    def __init__(self, iface: Optional[str] = None):
+        self.iface = iface
+        self._last_digest: Optional[tuple] = None
+        self._last_report: Optional[Report] = None
+        # orphan client ids seen in the previous cycle / already queued for deletion
+        self._orphans_seen: set = set()
+        self._orphans_queued: set = set()
+
+    def _confirmed_orphans(self, clients: list[dict]) -> list[dict]:
+        """Orphans that were already orphans in the previous cycle and are not queued yet."""
+        ids = {c["id"] for c in clients}
+        confirmed = [
+            c
+            for c in clients
+            if c["id"] in self._orphans_seen and c["id"] not in self._orphans_queued
+        ]
+        self._orphans_seen = ids
+        self._orphans_queued &= ids
+        return confirmed
+
+    def cycle(self, db, dry_run: bool = False) -> Report:
+        start = time.perf_counter()
+        easy = _safe("wg-easy", snapshot_wg_easy)
+        iface = _safe("interface", lambda: snapshot_iface(self.iface))
+        db_snap = snapshot_db(db)
+        digest = (
+            db_snap.digest,
+            easy.digest if easy else None,
+            iface.digest if iface else None,
+        )
+        metrics.inc("reconcile_cycles")
+        if digest == self._last_digest and self._last_report is not None:
+            metrics.inc("reconcile_unchanged")
+            report = Report(
+                iface=self._last_report.iface,
+                orphan_clients=self._last_report.orphan_clients,
+                missing_clients=self._last_report.missing_clients,
+                unchanged=True,
+            )
+        else:
+            report = diff(db_snap, easy, iface)
+            self._last_digest = digest
+            self._last_report = report
+        orphans = self._confirmed_orphans(report.orphan_clients)
+        if not dry_run and ((report.actions and not report.unchanged) or orphans):
+            try:
+                # an unchanged report's interface repairs were applied last cycle
+                repair(db, report, None if report.unchanged else iface, orphans)
+            except Exception:
+                # forget the digest so the next cycle diffs and retries
+                self._last_digest = None
+                raise
+            if WG_RECONCILE_DELETE_ORPHANS:
+                self._orphans_queued |= {c["id"] for c in orphans}
+        report.seconds = time.perf_counter() - start
+        metrics.inc("reconcile_seconds", report.seconds)
+        metrics.inc("reconcile_actions", report.actions)
+        return report
+
+
+def _safe(name: str, fn):
+    try:
+        return fn()
+    except Exception as exc:
+        # a source we cannot read is left out of this cycle rather than
+        # being treated as empty (which would prune everything)
+        logger.warning("reconcile: %s snapshot failed: %s", name, exc)
+        return None
+
+
+def repair(
+    db, report: Report, iface: Optional[Snapshot], orphans: Optional[list[dict]] = None
+) -> None:
+    """Apply the report's repairs in batches.
+
+    ``orphans`` are the wg-easy clients to delete (default: all of the report's).
+    """
+    if orphans is None:
+        orphans = report.orphan_clients
+    if not report.iface.empty and iface is not None:
+        if wg_host.WG_APPLY_ENABLED:
+            wg_host.apply_diff(report.iface, iface.state)
+            metrics.inc("reconcile_iface_repairs", report.actions - len(report.orphan_clients))
+        else:
+            logger.info(
+                "reconcile: interface drift %s (WG_APPLY_ENABLED=0)", report.iface.summary()
+            )
+    if orphans and WG_RECONCILE_DELETE_ORPHANS:
+        for i in range(0, len(orphans), WG_RECONCILE_BATCH):
+            for client in orphans[i : i + WG_RECONCILE_BATCH]:
+                outbox.enqueue(
+                    db,
+                    outbox.WG_EASY_DELETE,
+                    f"wg-easy:{client['id']}",
+                    {"wg_client_id": client["id"]},
+                )
+            db.commit()
+        outbox.notify()
+        metrics.inc("reconcile_orphans_queued", len(orphans))
+    if report.missing_clients:
+        logger.warning(
+            "reconcile: %d peers reference missing wg-easy clients (ids %s...)",
+            len(report.missing_clients),
+            report.missing_clients[:10],
+        )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m vpn_api.reconciler",
+        description="Reconcile vpn_peers, wg-easy and the WireGuard interface.",
+    )
+    parser.add_argument("--once", action="store_true", help="run a single cycle and exit")
+    parser.add_argument("--dry-run", action="store_true", help="report only, repair nothing")
+    parser.add_argument("--interval", type=float, default=WG_RECONCILE_INTERVAL)
+    parser.add_argument("--iface", default=None)
+    args = parser.parse_args(argv)
+
+    from vpn_api.database import SessionLocal
+
+    reconciler = Reconciler(iface=args.iface)
+    while True:
+        db = SessionLocal()
+        try:
+            report = reconciler.cycle(db, dry_run=args.dry_run)
+            print(json.dumps(report.summary()), flush=True)
+        except Exception:
+            logger.exception("reconcile cycle failed")
+        finally:
+            db.close()
+        if args.once:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
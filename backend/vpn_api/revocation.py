@@ -0,0 +1,82 @@
+"""In-memory token revocation for the stateless auth mode.
+
+Stateless access tokens carry the user's status and admin flag, so a change
+to either (promotion, blocking, activation) has to invalidate tokens issued
+before it. Every token carries ``ver``, the version current when it was
+issued; :func:`bump` gives a user a new version and every token of that user
+with a lower ``ver`` is rejected until it expires. The client then uses its
+refresh token, which re-reads the user from the DB.
+
+Versions come from one strictly increasing counter seeded by the wall clock
+(microseconds), so they compare correctly between tokens issued by different
+workers. The set itself is per process: a bump is only seen by the worker that
+made it, and other workers keep accepting the old token for at most the
+access-token TTL. Entries older than that TTL are dropped, since every token
+they could reject has expired, which keeps the set at one int per recently
+changed user.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Optional
+
+_lock = threading.Lock()
+_versions: dict[int, int] = {}
+_last = 0
+_purged_at = 0.0
+# How long an entry must be kept: the longest access-token lifetime, seconds.
+_ttl = 15 * 60.0
+
+
+def configure(ttl_seconds: float) -> None:
+    global _ttl
+    _ttl = float(ttl_seconds)
+
+
+def _next() -> int:
+    global _last
+    _last = max(_last + 1, time.time_ns() // 1000)
+    return _last
+
+
+def current() -> int:
+    """Version to embed in a newly issued token."""
+    with _lock:
+        return _next()
+
+
+def bump(user_id: int) -> int:
+    """Invalidate every token of ``user_id`` issued so far."""
+    global _purged_at
+    with _lock:
+        version = _next()
+        _versions[user_id] = version
+        now = time.monotonic()
+        if now - _purged_at > 60:
+            _purged_at = now
+            _purge(version)
+        return version
+
+
+def _purge(now_version: int) -> None:
+    horizon = now_version - int(_ttl * 1_000_000)
+    for user_id in [u for u, v in _versions.items() if v < horizon]:
+        del _versions[user_id]
+
+
+def is_revoked(user_id: int, version: Optional[int]) -> bool:
+    """Tell whether a token of ``user_id`` issued at ``version`` is no longer valid."""
+    floor = _versions.get(user_id)
+    return floor is not None and (version is None or version < floor)
+
+
+def size() -> int:
+    return len(_versions)
+
+
+def reset() -> None:
+    """Forget every entry (tests)."""
+    with _lock:
+        _versions.clear()
@@ -1,10 +1,20 @@
 from datetime import datetime
 from decimal import Decimal
 from enum import Enum
-from typing import Optional
+from typing import Generic, List, Optional, TypeVar
 
 from pydantic import BaseModel, EmailStr
 
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+    """One page of a cursor-paginated listing (see vpn_api.pagination)."""
+
+    items: List[T]
+    # pass back as ?cursor= for the next page; None on the last page
+    next_cursor: Optional[str] = None
+
 
 class UserStatus(str, Enum):
     pending = "pending"
@@ -29,6 +39,12 @@ class VerifyIn(BaseModel):
 class TokenOut(BaseModel):
     access_token: str
     token_type: str = "bearer"
+    # only issued in the stateless auth mode
+    refresh_token: Optional[str] = None
+
+
+class RefreshIn(BaseModel):
+    refresh_token: str
 
 
 class UserOut(BaseModel):
@@ -63,6 +79,17 @@ class TariffOut(BaseModel):
     model_config = {"from_attributes": True}
 
 
+class ProductCreate(BaseModel):
+    product_id: str
+    tariff_id: int
+
+
+class ProductOut(BaseModel):
+    product_id: str
+    tariff_id: int
+    model_config = {"from_attributes": True}
+
+
 class AssignTariff(BaseModel):
     tariff_id: int
 
@@ -80,6 +107,11 @@ class VpnPeerCreate(BaseModel):
     device_name: Optional[str] = None
 
 
+class VpnPeerBulkCreate(BaseModel):
+    # Each item follows VpnPeerCreate; user_id defaults to the calling admin.
+    peers: List[VpnPeerCreate]
+
+
 class VpnPeerOut(BaseModel):
     id: int
     user_id: int
@@ -97,6 +129,31 @@ class VpnPeerOut(BaseModel):
     model_config = {"from_attributes": True}
 
 
+class PeerUsageOut(BaseModel):
+    peer_id: int
+    rx_bytes: int
+    tx_bytes: int
+    last_handshake: Optional[datetime]
+
+
+class UsagePoint(BaseModel):
+    t: datetime
+    rx_bytes: int
+    tx_bytes: int
+
+
+class UsageOut(BaseModel):
+    user_id: int
+    since: datetime
+    until: datetime
+    step: str
+    rx_bytes: int
+    tx_bytes: int
+    last_handshake: Optional[datetime]
+    peers: List[PeerUsageOut]
+    series: List[UsagePoint]
+
+
 class PaymentCreate(BaseModel):
     user_id: Optional[int]
     amount: Decimal
@@ -104,6 +161,17 @@ class PaymentCreate(BaseModel):
     provider: Optional[str]
 
 
+class PaymentWebhookIn(BaseModel):
+    """IAP webhook payload from Apple IAP or Google Play."""
+
+    user_id: int
+    provider: str  # "apple" or "google"
+    receipt: str  # Base64-encoded receipt or token
+    product_id: Optional[str] = None  # Google Play product ID (optional for Apple)
+    bundle_id: Optional[str] = None  # App bundle ID for validation
+    currency: Optional[str] = "USD"
+
+
 class PaymentOut(BaseModel):
     id: int
     user_id: Optional[int]
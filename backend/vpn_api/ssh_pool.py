@@ -0,0 +1,285 @@
+"""Persistent OpenSSH control channels for wg_host operations.
+
+Every ``ssh host cmd`` used to pay a TCP connect plus key exchange and
+authentication. :class:`SshPool` keeps one ControlMaster per host (started
+with ``ssh -M -N -f``, kept alive by ``ControlPersist``) and runs commands as
+multiplexed sessions over its control socket, which only costs a local
+socket round trip.
+
+Per host the pool:
+
+- health-checks the master with ``ssh -O check`` (at most every
+  ``WG_SSH_CHECK_INTERVAL`` seconds) and restarts it when it is gone;
+- retries a command once on exit code 255 (ssh-level failure) after
+  re-establishing the master;
+- limits concurrent sessions to ``WG_SSH_MAX_SESSIONS`` (keep it below the
+  server's ``MaxSessions``, 10 by default);
+- records ``ssh_connect_seconds`` (master setup), ``ssh_wait_seconds``
+  (waiting for a session slot) and ``ssh_command_seconds`` in
+  :mod:`vpn_api.metrics`, so setup cost can be compared to command time.
+
+If the master cannot be started the command falls back to a plain one-shot
+``ssh`` so host operations keep working without multiplexing.
+
+Control sockets live in a private directory: by default one created with
+:func:`tempfile.mkdtemp` (mode 0700) per process, otherwise
+``WG_SSH_CONTROL_DIR``, which must be owned by the service user and not
+accessible to others. Socket names include the pid, so uvicorn workers
+sharing that directory never start masters on the same path.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from vpn_api import metrics
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to run every ssh command standalone (previous behaviour).
+WG_SSH_MUX = os.getenv("WG_SSH_MUX", "1") == "1"
+WG_SSH_BINARY = os.getenv("WG_SSH_BINARY", "ssh")
+# Directory for control sockets; must be private to the service user.
+# Unset: a fresh 0700 directory under the system temp dir, per process.
+WG_SSH_CONTROL_DIR = os.getenv("WG_SSH_CONTROL_DIR")
+# How long an idle master stays up (seconds).
+WG_SSH_CONTROL_PERSIST = int(os.getenv("WG_SSH_CONTROL_PERSIST", "600"))
+WG_SSH_CONNECT_TIMEOUT = int(os.getenv("WG_SSH_CONNECT_TIMEOUT", "10"))
+WG_SSH_MAX_SESSIONS = int(os.getenv("WG_SSH_MAX_SESSIONS", "8"))
+WG_SSH_CHECK_INTERVAL = float(os.getenv("WG_SSH_CHECK_INTERVAL", "30"))
+
+# ssh exits with 255 when the connection itself failed
+SSH_ERROR = 255
+
+_private_dir: Optional[str] = None
+_private_dir_lock = threading.Lock()
+
+
+def _default_control_dir() -> str:
+    """Return this process's private control directory, creating it on first use."""
+    global _private_dir
+    with _private_dir_lock:
+        if _private_dir is None or not os.path.isdir(_private_dir):
+            _private_dir = tempfile.mkdtemp(prefix="vpn-api-ssh-")
+        return _private_dir
+
+
+def _is_private(path: str) -> bool:
+    st = os.stat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+class SshMaster:
+    """ControlMaster lifecycle and session limit for a single host."""
+
+    def __init__(
+        self,
+        host: str,
+        control_dir: Optional[str] = None,
+        max_sessions: int = WG_SSH_MAX_SESSIONS,
+        check_interval: float = WG_SSH_CHECK_INTERVAL,
+    ):
+        self.host = host
+        self.check_interval = check_interval
+        control_dir = control_dir or WG_SSH_CONTROL_DIR or _default_control_dir()
+        digest = hashlib.sha1(host.encode()).hexdigest()[:16]
+        # short name: unix socket paths are limited to ~104 bytes
+        self.control_path = os.path.join(control_dir, f"{digest}-{os.getpid()}")
+        self.log_path = self.control_path + ".log"
+        self._control_dir = control_dir
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._healthy = False
+
+    def _base(self) -> list[str]:
+        return [WG_SSH_BINARY, "-o", f"ControlPath={self.control_path}"]
+
+    def check(self) -> bool:
+        """Return True if the master answers ``ssh -O check``."""
+        proc = subprocess.run(
+            [*self._base(), "-O", "check", self.host],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=WG_SSH_CONNECT_TIMEOUT,
+        )
+        return proc.returncode == 0
+
+    def _start(self) -> bool:
+        os.makedirs(self._control_dir, mode=0o700, exist_ok=True)
+        if not _is_private(self._control_dir):
+            # anyone else who can write there could plant or hijack the socket
+            logger.warning(
+                "ssh control dir %s is not private (0700, owned by us); not multiplexing",
+                self._control_dir,
+            )
+            metrics.inc("ssh_connect_failures")
+            return False
+        cmd = [
+            *self._base(),
+            "-M",
+            "-N",
+            "-f",
+            "-o",
+            f"ControlPersist={WG_SSH_CONTROL_PERSIST}",
+            "-o",
+            f"ConnectTimeout={WG_SSH_CONNECT_TIMEOUT}",
+            "-o",
+            "ServerAliveInterval=15",
+            "-o",
+            "ServerAliveCountMax=3",
+            "-o",
+            "BatchMode=yes",
+            self.host,
+        ]
+        start = time.perf_counter()
+        # the backgrounded master may keep inherited fds open, so never hand
+        # it a pipe: stderr goes to a log file instead
+        with open(self.log_path, "ab") as log:
+            try:
+                proc = subprocess.run(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=log,
+                    timeout=WG_SSH_CONNECT_TIMEOUT + 5,
+                )
+                ok = proc.returncode == 0
+            except subprocess.TimeoutExpired:
+                ok = False
+        metrics.inc("ssh_connects")
+        metrics.inc("ssh_connect_seconds", time.perf_counter() - start)
+        if not ok:
+            metrics.inc("ssh_connect_failures")
+            logger.warning("ssh master for %s failed to start, see %s", self.host, self.log_path)
+        return ok
+
+    def ensure(self, force_check: bool = False) -> bool:
+        """Make sure a live master exists; returns False if it could not be started."""
+        with self._lock:
+            now = time.monotonic()
+            if self._healthy and not force_check and now - self._checked_at < self.check_interval:
+                return True
+            healthy = os.path.exists(self.control_path) and self.check()
+            if not healthy:
+                if self._checked_at:
+                    metrics.inc("ssh_reconnects")
+                    logger.info("ssh master for %s is gone; reconnecting", self.host)
+                healthy = self._start()
+            self._healthy = healthy
+            self._checked_at = now
+            return healthy
+
+    def mark_failed(self) -> None:
+        with self._lock:
+            self._healthy = False
+
+    def command(self, argv: list[str], multiplexed: bool) -> list[str]:
+        """Rewrite an ``["ssh", host, cmd]`` argv to go through the control socket."""
+        if not multiplexed:
+            return [WG_SSH_BINARY, *argv[1:]]
+        return [*self._base(), "-o", "ControlMaster=no", *argv[1:]]
+
+    def run(self, argv: list[str], check: bool = False, **kwargs) -> subprocess.CompletedProcess:
+        wait_start = time.perf_counter()
+        with self._slots:
+            metrics.inc("ssh_wait_seconds", time.perf_counter() - wait_start)
+            multiplexed = self.ensure()
+            proc = self._exec(self.command(argv, multiplexed), **kwargs)
+            if proc.returncode == SSH_ERROR and multiplexed:
+                # the control channel may have died under us: re-check and retry once
+                self.mark_failed()
+                if self.ensure(force_check=True):
+                    metrics.inc("ssh_retries")
+                    proc = self._exec(self.command(argv, True), **kwargs)
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, argv, proc.stdout, proc.stderr)
+        return proc
+
+    def _exec(self, cmd: list[str], **kwargs) -> subprocess.CompletedProcess:
+        start = time.perf_counter()
+        try:
+            return subprocess.run(cmd, **kwargs)
+        finally:
+            metrics.inc("ssh_commands")
+            metrics.inc("ssh_command_seconds", time.perf_counter() - start)
+
+    def close(self) -> None:
+        """Stop the master (``ssh -O exit``)."""
+        with self._lock:
+            self._healthy = False
+            if not os.path.exists(self.control_path):
+                return
+            try:
+                subprocess.run(
+                    [*self._base(), "-O", "exit", self.host],
+                    stdin=subprocess.DEVNULL,
+                    capture_output=True,
+                    timeout=WG_SSH_CONNECT_TIMEOUT,
+                )
+            except Exception:
+                logger.exception("failed to stop ssh master for %s", self.host)
+
+
+class SshPool:
+    """One :class:`SshMaster` per host."""
+
+    def __init__(self, **master_kwargs):
+        self._master_kwargs = master_kwargs
+        self._masters: dict[str, SshMaster] = {}
+        self._lock = threading.Lock()
+
+    def master(self, host: str) -> SshMaster:
+        master = self._masters.get(host)
+        if master is None:
+            with self._lock:
+                master = self._masters.get(host)
+                if master is None:
+                    master = SshMaster(host, **self._master_kwargs)
+                    self._masters[host] = master
+        return master
+
+    def run(self, host: str, argv: list[str], **kwargs) -> subprocess.CompletedProcess:
+        """Run an ``["ssh", host, remote_cmd]`` argv over the host's control channel."""
+        return self.master(host).run(argv, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            masters = list(self._masters.values())
+            self._masters.clear()
+        for master in masters:
+            master.close()
+
+
+_pool: Optional[SshPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_ssh_pool() -> SshPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SshPool()
+    return _pool
+
+
+def shutdown() -> None:
+    """Stop every master (called on application shutdown)."""
+    global _pool, _private_dir
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+    with _private_dir_lock:
+        private_dir, _private_dir = _private_dir, None
+    if private_dir is not None:
+        shutil.rmtree(private_dir, ignore_errors=True)
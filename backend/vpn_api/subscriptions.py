@@ -0,0 +1,106 @@
+"""Materialized subscription state on the user row.
+
+Access checks used to scan ``user_tariffs`` on every config fetch and
+subscription poll. Instead, ``users.active_tariff_id`` / ``users.active_until``
+hold the subscription that currently grants access:
+
+- ``active_tariff_id`` is NULL: no active subscription;
+- ``active_until`` is NULL (and a tariff is set): lifetime;
+- otherwise access ends at ``active_until``. Expiry therefore needs no write,
+  and a stale row can only be one whose deadline has already passed.
+
+Every code path that adds or ends a ``UserTariff`` calls :func:`refresh` in
+the same transaction, before its commit. Today that is ``/auth/subscribe``,
+``assign_tariff`` and ``POST /payments/webhook``. A user who has access
+again gets the peers suspended by :mod:`vpn_api.expiry` back in that same
+transaction. After the commit the caller passes what :func:`refresh`
+returned to :func:`committed`, which moves the user's deadline in
+:mod:`vpn_api.deadlines` and wakes the outbox; a rolled-back renewal thus
+never reaches the timing wheel.
+"""
+
+from __future__ import annotations
+
+from datetime import UTC, datetime
+from typing import Optional
+
+from vpn_api import models
+
+
+def _aware(value: Optional[datetime]) -> Optional[datetime]:
+    # SQLite hands back naive datetimes; they are stored as UTC
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=UTC)
+    return value
+
+
+def compute(db, user_id: int, now: Optional[datetime] = None):
+    """Return (tariff id, until) of the user's longest-running active subscription."""
+    now = now or datetime.now(UTC)
+    rows = (
+        db.query(models.UserTariff.tariff_id, models.UserTariff.ended_at)
+        .filter(
+            models.UserTariff.user_id == user_id,
+            models.UserTariff.status == "active",
+            (models.UserTariff.ended_at.is_(None)) | (models.UserTariff.ended_at > now),
+        )
+        .all()
+    )
+    best = None
+    for tariff_id, ended_at in rows:
+        ended_at = _aware(ended_at)
+        if ended_at is None:
+            return tariff_id, None
+        if best is None or ended_at > best[1]:
+            best = (tariff_id, ended_at)
+    return best or (None, None)
+
+
+def refresh(db, user_id: int, now: Optional[datetime] = None):
+    """Recompute the user's materialized state and resume lapsed peers; the caller commits.
+
+    Returns (tariff id, until), to be passed to :func:`committed`.
+    """
+    db.flush()
+    tariff_id, until = compute(db, user_id, now)
+    db.query(models.User).filter(models.User.id == user_id).update(
+        {"active_tariff_id": tariff_id, "active_until": until}, synchronize_session=False
+    )
+    if is_active(tariff_id, until, now):
+        from vpn_api import expiry
+
+        expiry.resume_peers(db, user_id)
+    return tariff_id, until
+
+
+def committed(user_id: int, state) -> None:
+    """After the commit of a :func:`refresh`: reschedule the deadline, wake the outbox."""
+    from vpn_api import deadlines, outbox
+
+    tariff_id, until = state
+    deadlines.reschedule(user_id, until if tariff_id is not None else None)
+    if tariff_id is not None:
+        # a renewal may have queued the user's suspended peers for re-apply
+        outbox.notify()
+
+
+def is_active(
+    tariff_id: Optional[int], until: Optional[datetime], now: Optional[datetime] = None
+) -> bool:
+    if tariff_id is None:
+        return False
+    return until is None or _aware(until) > (now or datetime.now(UTC))
+
+
+def active_state(db, user_id: int):
+    """(tariff id, until) from the user row: one primary-key lookup."""
+    row = (
+        db.query(models.User.active_tariff_id, models.User.active_until)
+        .filter(models.User.id == user_id)
+        .first()
+    )
+    return (row[0], _aware(row[1])) if row else (None, None)
+
+
+def has_active(db, user_id: int, now: Optional[datetime] = None) -> bool:
+    return is_active(*active_state(db, user_id), now=now)
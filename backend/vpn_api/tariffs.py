@@ -1,8 +1,11 @@
+from typing import Optional
+
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from vpn_api import models, schemas
+from vpn_api import catalog, models, pagination, schemas
+from vpn_api.auth import get_current_user
 from vpn_api.database import get_db
 
 router = APIRouter()
@@ -13,7 +16,9 @@ def create_tariff(t: schemas.TariffCreate, db: Session = Depends(get_db)):
     db_t = db.query(models.Tariff).filter(models.Tariff.name == t.name).first()
     if db_t:
         raise HTTPException(status_code=400, detail="Tariff already exists")
-    new = models.Tariff(name=t.name, price=t.price)
+    new = models.Tariff(
+        name=t.name, description=t.description, duration_days=t.duration_days, price=t.price
+    )
     db.add(new)
     try:
         db.commit()
@@ -21,14 +26,72 @@ def create_tariff(t: schemas.TariffCreate, db: Session = Depends(get_db)):
         db.rollback()
         raise HTTPException(status_code=400, detail="Tariff already exists or DB error") from err
     db.refresh(new)
+    catalog.reload()
     return new
 
 
 @router.get("/")
 def list_tariffs(
-    db: Session = Depends(get_db), skip: int = Query(0, ge=0), limit: int = Query(10, ge=1, le=100)
+    db: Session = Depends(get_db),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(10, ge=1, le=100),
+    cursor: Optional[str] = None,
+):
+    """List tariffs; with ``cursor`` (empty for the first page) returns a keyset page."""
+    # served from the in-process catalog snapshot, not the database
+    tariff_list = catalog.get_catalog().tariff_list
+    if cursor is not None:
+        return pagination.keyset_in_memory(tariff_list, cursor, limit)
+    return tariff_list[skip : skip + limit]
+
+
+# Store product ids (App Store / Google Play) and the tariffs they grant
+@router.get("/products", response_model=list[schemas.ProductOut])
+def list_products(
+    db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)
+):
+    if not getattr(current_user, "is_admin", False):
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return db.query(models.Product).order_by(models.Product.product_id).all()
+
+
+@router.post("/products", response_model=schemas.ProductOut)
+def create_product(
+    p: schemas.ProductCreate,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    if not getattr(current_user, "is_admin", False):
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    if db.get(models.Tariff, p.tariff_id) is None:
+        raise HTTPException(status_code=404, detail="Tariff not found")
+    product = models.Product(product_id=p.product_id, tariff_id=p.tariff_id)
+    db.add(product)
+    try:
+        db.commit()
+    except IntegrityError as err:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Product already exists") from err
+    db.refresh(product)
+    catalog.reload()
+    return product
+
+
+@router.delete("/products/{product_id}")
+def delete_product(
+    product_id: str,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
 ):
-    return db.query(models.Tariff).offset(skip).limit(limit).all()
+    if not getattr(current_user, "is_admin", False):
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    product = db.query(models.Product).filter(models.Product.product_id == product_id).first()
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    db.delete(product)
+    db.commit()
+    catalog.reload()
+    return {"msg": "product deleted", "product_id": product_id}
 
 
 # Удаление тарифа (если не назначен ни одному пользователю)
@@ -42,6 +105,8 @@ def delete_tariff(tariff_id: int, db: Session = Depends(get_db)):
         raise HTTPException(
             status_code=400, detail="Tariff is assigned to users and cannot be deleted"
         )
+    db.query(models.Product).filter(models.Product.tariff_id == tariff_id).delete()
     db.delete(tariff)
     db.commit()
+    catalog.reload()
     return {"msg": "tariff deleted", "tariff_id": tariff_id}
@@ -0,0 +1,398 @@
+"""Per-peer traffic and handshake telemetry.
+
+The collector samples the cumulative counters once per cycle, either from
+``wg show all dump`` through :mod:`vpn_api.wg_host` or from the wg-easy client
+list (``WG_TELEMETRY_SOURCE=wg|wg-easy``). It turns them into per-peer deltas
+(a counter that went down means the peer was re-added or the interface
+restarted, so the new value is the delta) and adds them to 1-minute
+``peer_usage`` buckets. Peers without traffic get no row. The baseline only
+moves forward once the rows are committed, so a failed write is counted
+again by the next cycle instead of being lost.
+
+Public keys are mapped to peers through a copy of ``vpn_peers`` that is
+reloaded every ``WG_TELEMETRY_PEER_TTL`` seconds, or earlier when an
+unknown key shows traffic. Keys still unknown after a reload (manual or
+reserved clients) are remembered until the next reload.
+
+:func:`rollup` keeps the table compact: 1-minute buckets older than
+``WG_TELEMETRY_RETAIN_1M`` are summed into 1-hour buckets, and 1-hour buckets
+older than ``WG_TELEMETRY_RETAIN_1H`` into 1-day buckets, moving rows in the
+same transaction so every byte is counted exactly once.
+
+Run ``python -m vpn_api.telemetry`` (loop) or ``--once``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import UTC, datetime, timedelta
+from typing import Iterable, Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from vpn_api import metrics, models
+
+logger = logging.getLogger(__name__)
+
+WG_TELEMETRY_SOURCE = os.getenv("WG_TELEMETRY_SOURCE", "wg")
+WG_TELEMETRY_INTERVAL = float(os.getenv("WG_TELEMETRY_INTERVAL", "60"))
+# how long fine buckets are kept before being rolled up, seconds
+WG_TELEMETRY_RETAIN_1M = int(os.getenv("WG_TELEMETRY_RETAIN_1M", str(24 * 3600)))
+WG_TELEMETRY_RETAIN_1H = int(os.getenv("WG_TELEMETRY_RETAIN_1H", str(30 * 24 * 3600)))
+# how long the public key -> peer map is trusted, seconds
+WG_TELEMETRY_PEER_TTL = float(os.getenv("WG_TELEMETRY_PEER_TTL", "300"))
+
+MINUTE, HOUR, DAY = 60, 3600, 86400
+RESOLUTIONS = {"1m": MINUTE, "1h": HOUR, "1d": DAY}
+
+# public key -> (rx bytes, tx bytes, latest handshake unix time or 0)
+Sample = dict[str, tuple[int, int, int]]
+
+
+def floor_time(ts: float, resolution: int) -> datetime:
+    return datetime.fromtimestamp(ts - ts % resolution, UTC)
+
+
+def _aware(value: Optional[datetime]) -> Optional[datetime]:
+    # SQLite hands back naive datetimes; everything here is UTC
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=UTC)
+    return value
+
+
+def sample_wg() -> Sample:
+    from vpn_api import wg_host
+
+    out: Sample = {}
+    for state in wg_host.read_all().values():
+        for pub, peer in state.peers.items():
+            out[pub] = (peer.rx_bytes, peer.tx_bytes, peer.latest_handshake)
+    return out
+
+
+def _handshake_ts(value) -> int:
+    if not value:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp())
+    except ValueError:
+        return 0
+
+
+def sample_clients(clients: Iterable[dict]) -> Sample:
+    """Build a sample from wg-easy clients (transferRx/transferTx/latestHandshakeAt)."""
+    out: Sample = {}
+    for c in clients:
+        pub = c.get("publicKey")
+        if pub:
+            out[pub] = (
+                int(c.get("transferRx") or 0),
+                int(c.get("transferTx") or 0),
+                _handshake_ts(c.get("latestHandshakeAt")),
+            )
+    return out
+
+
+def sample_wg_easy() -> Sample:
+    from vpn_api.wg_easy_pool import get_wg_easy_pool
+
+    url, password = os.getenv("WG_EASY_URL"), os.getenv("WG_EASY_PASSWORD")
+    if not url or not password:
+        raise RuntimeError("WG_EASY_URL or WG_EASY_PASSWORD not set")
+    clients = get_wg_easy_pool().run(url, password, lambda adapter: adapter.list_clients())
+    return sample_clients(clients)
+
+
+def _upsert_add(db, rows: list[dict]) -> None:
+    """Insert usage rows, adding to existing buckets on conflict."""
+    if not rows:
+        return
+    table = models.PeerUsage.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:  # pragma: no cover - only SQLite and PostgreSQL are deployed
+        for row in rows:
+            _merge_add(db, row)
+        return
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["peer_id", "resolution", "bucket_start"],
+        set_={
+            "rx_bytes": table.c.rx_bytes + stmt.excluded.rx_bytes,
+            "tx_bytes": table.c.tx_bytes + stmt.excluded.tx_bytes,
+            "last_handshake": func.coalesce(stmt.excluded.last_handshake, table.c.last_handshake),
+        },
+    )
+    db.execute(stmt, rows)
+
+
+def _merge_add(db, row: dict) -> None:  # pragma: no cover - see _upsert_add
+    existing = (
+        db.query(models.PeerUsage)
+        .filter_by(
+            peer_id=row["peer_id"], resolution=row["resolution"], bucket_start=row["bucket_start"]
+        )
+        .first()
+    )
+    if existing is None:
+        db.add(models.PeerUsage(**row))
+        return
+    existing.rx_bytes += row["rx_bytes"]
+    existing.tx_bytes += row["tx_bytes"]
+    existing.last_handshake = row["last_handshake"] or existing.last_handshake
+
+
+class Collector:
+    """Keeps the previous counters so each cycle stores only the deltas."""
+
+    def __init__(self, source: str = WG_TELEMETRY_SOURCE, peer_ttl: float = WG_TELEMETRY_PEER_TTL):
+        self.source = source
+        self.peer_ttl = peer_ttl
+        self._last: dict[str, tuple[int, int]] = {}
+        # public key -> (peer id, user id), and keys known not to be peers
+        self._peers: dict[str, tuple[int, int]] = {}
+        self._unmanaged: set[str] = set()
+        self._peers_loaded_at: Optional[float] = None
+
+    def sample(self) -> Sample:
+        return sample_wg_easy() if self.source == "wg-easy" else sample_wg()
+
+    def _diff(self, sample: Sample) -> tuple[dict, dict]:
+        """Traffic since the previous sample, and the baseline ``sample`` becomes."""
+        out = {}
+        last = self._last
+        # peers that disappeared are dropped, so a re-add starts from a new baseline
+        baseline = {}
+        for pub, (rx, tx, handshake) in sample.items():
+            prev = last.get(pub)
+            if prev is not None:
+                drx = rx - prev[0] if rx >= prev[0] else rx
+                dtx = tx - prev[1] if tx >= prev[1] else tx
+                if rx < prev[0] or tx < prev[1]:
+                    metrics.inc("telemetry_counter_resets")
+                if drx or dtx:
+                    out[pub] = (drx, dtx, handshake)
+            baseline[pub] = (rx, tx)
+        return out, baseline
+
+    def deltas(self, sample: Sample) -> dict[str, tuple[int, int, int]]:
+        """Return traffic since the previous sample; the first sample is only a baseline."""
+        out, self._last = self._diff(sample)
+        return out
+
+    def _load_peers(self, db) -> None:
+        rows = db.query(models.VpnPeer.wg_public_key, models.VpnPeer.id, models.VpnPeer.user_id)
+        self._peers = {pub: (peer_id, user_id) for pub, peer_id, user_id in rows}
+        self._unmanaged = set()
+        self._peers_loaded_at = time.monotonic()
+        metrics.inc("telemetry_peer_loads")
+
+    def _peer_ids(self, db, keys: Iterable[str]) -> dict[str, tuple[int, int]]:
+        keys = list(keys)
+        expired = (
+            self._peers_loaded_at is None
+            or time.monotonic() - self._peers_loaded_at > self.peer_ttl
+        )
+        if expired or any(k not in self._peers and k not in self._unmanaged for k in keys):
+            self._load_peers(db)
+            self._unmanaged.update(k for k in keys if k not in self._peers)
+        return self._peers
+
+    def _rows(self, db, deltas: dict, now: float) -> list[dict]:
+        peers = self._peer_ids(db, deltas.keys())
+        bucket = floor_time(now, MINUTE)
+        rows = []
+        for pub, (drx, dtx, handshake) in deltas.items():
+            ids = peers.get(pub)
+            if ids is None:
+                # traffic of a peer we do not manage (manual client)
+                continue
+            rows.append(
+                {
+                    "peer_id": ids[0],
+                    "user_id": ids[1],
+                    "resolution": MINUTE,
+                    "bucket_start": bucket,
+                    "rx_bytes": drx,
+                    "tx_bytes": dtx,
+                    "last_handshake": (
+                        datetime.fromtimestamp(handshake, UTC) if handshake else None
+                    ),
+                }
+            )
+        return rows
+
+    def collect(self, db, sample: Optional[Sample] = None, now: Optional[float] = None) -> int:
+        """Sample, store deltas in 1-minute buckets and return how many rows were written."""
+        sample = self.sample() if sample is None else sample
+        now = time.time() if now is None else now
+        deltas, baseline = self._diff(sample)
+        rows = self._rows(db, deltas, now)
+        try:
+            _upsert_add(db, rows)
+            db.commit()
+        except IntegrityError:
+            # a peer in the cached map was deleted since (FK violation):
+            # reload the map and write the rows of the remaining peers
+            db.rollback()
+            metrics.inc("telemetry_stale_peers")
+            self._load_peers(db)
+            rows = self._rows(db, deltas, now)
+            _upsert_add(db, rows)
+            db.commit()
+        # advance the baseline only once the deltas are stored
+        self._last = baseline
+        metrics.inc("telemetry_samples")
+        metrics.inc("telemetry_rows", len(rows))
+        return len(rows)
+
+
+def rollup(db, now: Optional[float] = None, batch: int = 100_000) -> int:
+    """Fold expired 1m buckets into 1h and expired 1h buckets into 1d; returns rows moved."""
+    now = time.time() if now is None else now
+    moved = 0
+    for fine, coarse, retain in (
+        (MINUTE, HOUR, WG_TELEMETRY_RETAIN_1M),
+        (HOUR, DAY, WG_TELEMETRY_RETAIN_1H),
+    ):
+        # only whole coarse buckets are folded, so a coarse row is written once
+        cutoff = floor_time(now - retain, coarse)
+        while True:
+            rows = (
+                db.query(models.PeerUsage)
+                .filter(
+                    models.PeerUsage.resolution == fine,
+                    models.PeerUsage.bucket_start < cutoff,
+                )
+                .order_by(models.PeerUsage.id)
+                .limit(batch)
+                .all()
+            )
+            if not rows:
+                break
+            acc: dict[tuple, list] = defaultdict(lambda: [0, 0, None])
+            for r in rows:
+                start = _aware(r.bucket_start).timestamp()
+                key = (r.peer_id, r.user_id, floor_time(start, coarse))
+                a = acc[key]
+                a[0] += r.rx_bytes
+                a[1] += r.tx_bytes
+                hs = _aware(r.last_handshake)
+                if hs is not None and (a[2] is None or hs > a[2]):
+                    a[2] = hs
+            _upsert_add(
+                db,
+                [
+                    {
+                        "peer_id": peer_id,
+                        "user_id": user_id,
+                        "resolution": coarse,
+                        "bucket_start": start,
+                        "rx_bytes": rx,
+                        "tx_bytes": tx,
+                        "last_handshake": hs,
+                    }
+                    for (peer_id, user_id, start), (rx, tx, hs) in acc.items()
+                ],
+            )
+            db.query(models.PeerUsage).filter(models.PeerUsage.id.in_([r.id for r in rows])).delete(
+                synchronize_session=False
+            )
+            db.commit()
+            moved += len(rows)
+    metrics.inc("telemetry_rolled_up", moved)
+    return moved
+
+
+def usage_for_user(db, user_id: int, since: datetime, until: datetime, step: str = "1h") -> dict:
+    """Total, per-peer and bucketed (``step``) usage of ``user_id`` in [since, until)."""
+    resolution = RESOLUTIONS[step]
+    rows = (
+        db.query(models.PeerUsage)
+        .filter(
+            models.PeerUsage.user_id == user_id,
+            models.PeerUsage.bucket_start >= since,
+            models.PeerUsage.bucket_start < until,
+        )
+        .all()
+    )
+    total = [0, 0]
+    last_handshake: Optional[datetime] = None
+    per_peer: dict[int, dict] = {}
+    series: dict[datetime, list[int]] = defaultdict(lambda: [0, 0])
+    for r in rows:
+        total[0] += r.rx_bytes
+        total[1] += r.tx_bytes
+        peer = per_peer.setdefault(
+            r.peer_id, {"peer_id": r.peer_id, "rx_bytes": 0, "tx_bytes": 0, "last_handshake": None}
+        )
+        peer["rx_bytes"] += r.rx_bytes
+        peer["tx_bytes"] += r.tx_bytes
+        hs = _aware(r.last_handshake)
+        if hs is not None:
+            if peer["last_handshake"] is None or hs > peer["last_handshake"]:
+                peer["last_handshake"] = hs
+            if last_handshake is None or hs > last_handshake:
+                last_handshake = hs
+        point = series[floor_time(_aware(r.bucket_start).timestamp(), resolution)]
+        point[0] += r.rx_bytes
+        point[1] += r.tx_bytes
+    return {
+        "user_id": user_id,
+        "since": since,
+        "until": until,
+        "step": step,
+        "rx_bytes": total[0],
+        "tx_bytes": total[1],
+        "last_handshake": last_handshake,
+        "peers": sorted(per_peer.values(), key=lambda p: p["peer_id"]),
+        "series": [
+            {"t": t, "rx_bytes": rx, "tx_bytes": tx} for t, (rx, tx) in sorted(series.items())
+        ],
+    }
+
+
+def default_window(hours: int) -> tuple[datetime, datetime]:
+    until = datetime.now(UTC)
+    return until - timedelta(hours=hours), until
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m vpn_api.telemetry")
+    parser.add_argument("--once", action="store_true", help="run a single cycle and exit")
+    parser.add_argument("--interval", type=float, default=WG_TELEMETRY_INTERVAL)
+    parser.add_argument("--source", choices=("wg", "wg-easy"), default=WG_TELEMETRY_SOURCE)
+    args = parser.parse_args(argv)
+
+    from vpn_api.database import SessionLocal
+
+    collector = Collector(source=args.source)
+    while True:
+        db = SessionLocal()
+        try:
+            written = collector.collect(db)
+            moved = rollup(db)
+            logger.info("[TELEMETRY] rows=%d rolled_up=%d", written, moved)
+        except Exception:
+            logger.exception("telemetry cycle failed")
+            db.rollback()
+        finally:
+            db.close()
+        if args.once:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,20 @@
 from fastapi.testclient import TestClient
 
+from vpn_api import outbox
+from vpn_api.database import SessionLocal
 from vpn_api.main import app
 
 client = TestClient(app)
 
 
+def _drain_outbox():
+    db = SessionLocal()
+    try:
+        outbox.drain(db)
+    finally:
+        db.close()
+
+
 def _register_and_auth(email: str, password: str = "strongpass"):
     r = client.post("/auth/register", json={"email": email, "password": password})
     assert r.status_code == 200
@@ -42,6 +52,9 @@ def test_create_peer_calls_apply(monkeypatch):
 
     resp = client.post("/vpn_peers/", json=payload, headers=headers)
     assert resp.status_code == 200
+    # the host apply is queued in the outbox, not run inside the request
+    assert called["apply"] is False
+    _drain_outbox()
     assert called["apply"] is True
 
 
@@ -63,4 +76,5 @@ def test_delete_peer_calls_remove(monkeypatch):
 
     resp = client.delete(f"/vpn_peers/{peer['id']}", headers=headers)
     assert resp.status_code == 200
+    _drain_outbox()
     assert called["remove"] is True
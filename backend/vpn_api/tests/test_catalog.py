@@ -0,0 +1,109 @@
+from datetime import UTC, datetime
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from vpn_api import catalog, metrics, models, schemas, tariffs
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.iap_validator import ProductIdToTariffMapper
+from vpn_api.main import app
+
+client = TestClient(app)
+ADMIN = models.User(id=1, is_admin=True)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _tariff(name, days):
+    db = SessionLocal()
+    tariff = models.Tariff(name=name, price=4, duration_days=days)
+    db.add(tariff)
+    db.commit()
+    tariff_id = tariff.id
+    db.close()
+    return tariff_id
+
+
+def test_product_changes_swap_the_snapshot():
+    tariff_id = _tariff("catalog-monthly", 30)
+    db = SessionLocal()
+    before = catalog.reload()
+    tariffs.create_product(
+        schemas.ProductCreate(product_id="catalog.monthly", tariff_id=tariff_id),
+        db=db,
+        current_user=ADMIN,
+    )
+    after = catalog.get_catalog()
+    assert after is not before
+    assert "catalog.monthly" not in before.products
+    assert after.products["catalog.monthly"] == tariff_id
+    assert ProductIdToTariffMapper.get_tariff_id("catalog.monthly") == tariff_id
+    assert ProductIdToTariffMapper.get_duration_days(tariff_id) == 30
+
+    tariffs.delete_product("catalog.monthly", db=db, current_user=ADMIN)
+    assert catalog.product_tariff("catalog.monthly") is None
+    db.close()
+
+
+def test_product_endpoints_are_admin_only():
+    db = SessionLocal()
+    body = schemas.ProductCreate(product_id="catalog.denied", tariff_id=1)
+    with pytest.raises(HTTPException) as exc:
+        tariffs.create_product(body, db=db, current_user=models.User(id=2, is_admin=False))
+    assert exc.value.status_code == 403
+    db.close()
+
+
+def test_lookups_do_not_query_the_database():
+    tariff_id = _tariff("catalog-hot", 365)
+    db = SessionLocal()
+    db.add(models.Product(product_id="catalog.hot", tariff_id=tariff_id))
+    db.commit()
+    db.close()
+    catalog.reload()
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        for _ in range(100):
+            assert catalog.product_tariff("catalog.hot").id == tariff_id
+            assert catalog.tariff(tariff_id).duration_days == 365
+        listing = client.get("/tariffs/", params={"limit": 100}).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert statements == []
+    assert tariff_id in [t["id"] for t in listing]
+
+
+def test_misses_reload_at_most_once_per_interval(monkeypatch):
+    monkeypatch.setattr(catalog, "TARIFF_CATALOG_MISS_RELOAD", 60)
+    snapshot = catalog.reload()
+    metrics.reset()
+    for i in range(50):
+        assert catalog.product_tariff(f"catalog.unknown-{i}") is None
+        assert catalog.tariff(10**9 + i) is None
+    assert catalog.get_catalog() is snapshot
+    assert metrics.get("tariff_catalog_loads") == 0
+    assert metrics.get("tariff_catalog_misses") == 100
+
+    # once the snapshot is old enough, a miss reloads it again
+    monkeypatch.setattr(catalog, "TARIFF_CATALOG_MISS_RELOAD", 0)
+    tariff_id = _tariff("catalog-late", 7)
+    assert catalog.tariff(tariff_id).duration_days == 7
+    assert metrics.get("tariff_catalog_loads") == 1
+
+
+def test_ends_at_lifetime():
+    start = datetime(2026, 1, 1, tzinfo=UTC)
+    info = catalog.TariffInfo(1, "t", None, 30, 1, None)
+    assert info.ends_at(start) == datetime(2026, 1, 31, tzinfo=UTC)
+    for days in (0, catalog.LIFETIME_DAYS):
+        assert catalog.TariffInfo(1, "t", None, days, 1, None).ends_at(start) is None
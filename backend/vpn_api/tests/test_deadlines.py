@@ -0,0 +1,154 @@
+import random
+from datetime import UTC, datetime, timedelta
+
+from vpn_api import deadlines, models, subscriptions
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.deadlines import ExpiryScheduler, TimingWheel
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def test_wheel_fires_every_deadline_at_its_tick():
+    rng = random.Random(7)
+    # small levels so cascading and the overflow list are exercised
+    wheel = TimingWheel(tick=1, slots=(8, 4, 4), start=1000)
+    expected = {}
+    for key in range(2000):
+        when = 1000 + rng.uniform(-5, 400)
+        wheel.add(key, when)
+        expected[key] = max(1000, -(-when // 1))
+    fired = {}
+    for now in range(1000, 1401):
+        for key in wheel.advance(now):
+            fired[key] = now
+    assert fired == expected
+    assert len(wheel) == 0
+
+
+def test_wheel_reschedule_and_cancel():
+    wheel = TimingWheel(tick=1, slots=(8, 4), start=0)
+    wheel.add("a", 5)
+    wheel.add("b", 5)
+    wheel.add("c", 50)
+    wheel.add("a", 20)  # renewal: the entry at 5 goes stale
+    wheel.cancel("b")
+    assert wheel.advance(10) == []
+    assert wheel.advance(20) == ["a"]
+    assert "c" in wheel
+    assert wheel.advance(100) == ["c"]
+
+
+def test_scheduler_loads_window_and_tracks_refresh():
+    now = datetime.now(UTC)
+    db = SessionLocal()
+    tariff = models.Tariff(name="deadline-tariff", price=1, duration_days=30)
+    db.add(tariff)
+    db.flush()
+    soon = models.User(email="deadline-soon@example.com")
+    later = models.User(email="deadline-later@example.com")
+    db.add_all([soon, later])
+    db.flush()
+    for user, end in ((soon, now + timedelta(minutes=5)), (later, now + timedelta(days=10))):
+        db.add(
+            models.UserTariff(
+                user_id=user.id, tariff_id=tariff.id, started_at=now, ended_at=end, status="active"
+            )
+        )
+        subscriptions.refresh(db, user.id, now)
+    db.commit()
+    soon_id, later_id = soon.id, later.id
+
+    fired = []
+    scheduler = ExpiryScheduler(
+        tick=1,
+        horizon=3600,
+        fire=lambda ids, at: fired.extend(ids),
+        clock=lambda: now.timestamp(),
+    )
+    scheduler.load(db)
+    assert soon_id in scheduler._wheel and later_id not in scheduler._wheel
+
+    # renewal via the normal write path moves the deadline, once committed
+    deadlines._scheduler = scheduler
+    renewal = {
+        "user_id": soon_id,
+        "tariff_id": tariff.id,
+        "started_at": now + timedelta(minutes=5),
+        "status": "active",
+    }
+    try:
+        db.add(models.UserTariff(ended_at=now + timedelta(days=300), **renewal))
+        subscriptions.refresh(db, soon_id, now)
+        db.rollback()
+        # the rolled-back renewal (beyond the horizon) did not cancel the entry
+        assert soon_id in scheduler._wheel
+        db.add(models.UserTariff(ended_at=now + timedelta(minutes=20), **renewal))
+        state = subscriptions.refresh(db, soon_id, now)
+        db.commit()
+        subscriptions.committed(soon_id, state)
+    finally:
+        deadlines._scheduler = None
+    assert scheduler.run_once(db, now.timestamp() + 600) == []
+    assert soon_id in scheduler.run_once(db, now.timestamp() + 1201)
+    assert soon_id in fired and later_id not in fired
+    db.close()
+
+
+def test_fired_deadline_deprovisions_through_outbox(monkeypatch):
+    monkeypatch.setattr("vpn_api.outbox.notify", lambda: None)
+    now = datetime.now(UTC)
+    db = SessionLocal()
+    tariff = models.Tariff(name="deadline-fire-tariff", price=1, duration_days=30)
+    db.add(tariff)
+    db.flush()
+    user = models.User(email="deadline-fire@example.com")
+    db.add(user)
+    db.flush()
+    db.add(
+        models.UserTariff(
+            user_id=user.id,
+            tariff_id=tariff.id,
+            started_at=now - timedelta(days=30),
+            ended_at=now + timedelta(seconds=30),
+            status="active",
+        )
+    )
+    subscriptions.refresh(db, user.id, now)
+    db.add(
+        models.VpnPeer(
+            user_id=user.id,
+            wg_private_key="x",
+            wg_public_key="deadline-pub",
+            wg_ip="10.23.0.1/32",
+            allowed_ips="10.23.0.1/32",
+        )
+    )
+    db.commit()
+    user_id = user.id
+    db.close()
+
+    scheduler = ExpiryScheduler(tick=1, horizon=3600, clock=lambda: now.timestamp())
+    db = SessionLocal()
+    scheduler.load(db)
+    assert scheduler.run_once(db, now.timestamp() + 10) == []
+    assert scheduler.run_once(db, now.timestamp() + 31) == [user_id]
+    db.expire_all()
+    peer = db.query(models.VpnPeer).filter_by(wg_public_key="deadline-pub").one()
+    assert peer.active is False
+    assert db.get(models.User, user_id).active_tariff_id is None
+    assert db.query(models.UserTariff).filter_by(user_id=user_id, status="expired").count() == 1
+    assert db.query(models.OutboxEvent).filter_by(peer_id=peer.id).count() == 1
+    db.close()
+
+
+def test_app_lifespan_runs(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from vpn_api.main import app
+
+    monkeypatch.setattr(deadlines, "WG_EXPIRY_SCHEDULER", True)
+    with TestClient(app):
+        assert deadlines._scheduler is not None
+    assert deadlines._scheduler is None
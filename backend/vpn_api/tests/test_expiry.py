@@ -0,0 +1,204 @@
+from datetime import UTC, datetime, timedelta
+
+from fastapi.testclient import TestClient
+
+from vpn_api import catalog, expiry, ipam, models, outbox, subscriptions, wg_host
+from vpn_api.crypto import encrypt_text
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.main import app
+from vpn_api.tests.test_peer_config_api import _ensure_key
+
+client = TestClient(app)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _user(db, email, tariff_id, ends, now):
+    user = models.User(email=email)
+    db.add(user)
+    db.flush()
+    for i, end in enumerate(ends):
+        db.add(
+            models.UserTariff(
+                user_id=user.id,
+                tariff_id=tariff_id,
+                started_at=now - timedelta(days=60 - i),
+                ended_at=end,
+                status="active",
+            )
+        )
+    # materialized as the writers would have left it before the deadline
+    subscriptions.refresh(db, user.id, now - timedelta(days=2))
+    return user
+
+
+def _peer(db, user, pub, ip, **kw):
+    peer = models.VpnPeer(
+        user_id=user.id, wg_private_key="x", wg_public_key=pub, wg_ip=ip, allowed_ips=ip, **kw
+    )
+    db.add(peer)
+    return peer
+
+
+# sweeps are global: a "now" in the past keeps other tests' rows out of them
+NOW = datetime(2020, 1, 1, tzinfo=UTC)
+
+
+def test_sweep_expires_in_chunks_and_deprovisions(monkeypatch):
+    now = NOW
+    past, future = now - timedelta(days=1), now + timedelta(days=10)
+    db = SessionLocal()
+    tariff = models.Tariff(name="expiry-tariff", price=1, duration_days=30)
+    db.add(tariff)
+    db.flush()
+    lapsed = _user(db, "expiry-lapsed@example.com", tariff.id, [past, past], now)
+    renewed = _user(db, "expiry-renewed@example.com", tariff.id, [past, future], now)
+    _peer(db, lapsed, "exp-plain", "10.22.0.1/32")
+    _peer(db, lapsed, "exp-easy", "10.22.0.2/32", wg_client_id="c-exp")
+    _peer(db, lapsed, "exp-parked", "10.22.0.3/32", idle_since=past)
+    _peer(db, renewed, "exp-renewed", "10.22.0.4/32")
+    db.commit()
+    lapsed_id, renewed_id = lapsed.id, renewed.id
+
+    totals = expiry.sweep(db, now=now, batch=2)
+    assert totals == {"expired": 3, "lapsed_users": 1, "peers": 3}
+
+    db.expire_all()
+    assert expiry.count_due(db, now) == 0
+    active = {
+        p.wg_public_key: p.active
+        for p in db.query(models.VpnPeer).filter(models.VpnPeer.wg_ip.like("10.22.%"))
+    }
+    assert active == {
+        "exp-plain": False,
+        "exp-easy": False,
+        "exp-parked": False,
+        "exp-renewed": True,
+    }
+    assert db.get(models.User, lapsed_id).active_tariff_id is None
+    assert subscriptions.has_active(db, renewed_id, now)
+    queued = {
+        e.dedupe_key: e.kind
+        for e in db.query(models.OutboxEvent).filter_by(status="pending")
+        if e.dedupe_key.endswith(("exp-plain", "exp-easy", "exp-parked", "c-exp"))
+    }
+    # the wg-easy client is disabled, not deleted, so a renewal can bring it back
+    assert queued == {
+        "host:exp-plain": outbox.REMOVE,
+        "host:exp-easy": outbox.REMOVE,
+        "host:exp-parked": outbox.REMOVE,
+        "wg-easy:c-exp": outbox.WG_EASY_DISABLE,
+    }
+    assert expiry.sweep(db, now=now) == {"expired": 0, "lapsed_users": 0, "peers": 0}
+    db.close()
+
+
+def test_host_removal_goes_through_the_outbox(monkeypatch):
+    now = NOW + timedelta(days=1)
+    db = SessionLocal()
+    tariff = models.Tariff(name="expiry-fail-tariff", price=1, duration_days=30)
+    db.add(tariff)
+    db.flush()
+    user = _user(db, "expiry-fail@example.com", tariff.id, [now - timedelta(hours=1)], now)
+    _peer(db, user, "exp-fail", "10.22.1.1/32")
+    db.commit()
+
+    def boom(*a, **kw):
+        raise AssertionError("the sweep must not touch the host itself")
+
+    monkeypatch.setattr(wg_host, "apply_diff", boom)
+    assert expiry.sweep(db, now=now)["peers"] == 1
+    db.expire_all()
+    assert db.query(models.VpnPeer).filter_by(wg_public_key="exp-fail").one().active is False
+    [event] = db.query(models.OutboxEvent).filter_by(dedupe_key="host:exp-fail").all()
+    assert (event.kind, event.status) == (outbox.REMOVE, "pending")
+    db.close()
+
+
+def test_lapse_renew_and_fetch_config():
+    _ensure_key()
+    email = "expiry-renew@example.com"
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    token = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    headers = {"Authorization": f"Bearer {token.json()['access_token']}"}
+    now = datetime.now(UTC)
+    db = SessionLocal()
+    tariff = models.Tariff(name="expiry-renew-tariff", price=1, duration_days=30)
+    db.add(tariff)
+    db.flush()
+    tariff_id = tariff.id
+    user = db.query(models.User).filter_by(email=email).one()
+    db.add(
+        models.UserTariff(
+            user_id=user.id,
+            tariff_id=tariff_id,
+            started_at=now - timedelta(days=30),
+            ended_at=now + timedelta(days=1),
+            status="active",
+        )
+    )
+    subscriptions.refresh(db, user.id, now)
+    _peer(db, user, "exp-renew", "10.22.2.1/32", wg_config_encrypted=encrypt_text("[Interface]"))
+    _peer(db, user, "exp-renew-easy", "10.22.2.2/32", wg_client_id="c-renew")
+    db.commit()
+    user_id = user.id
+    catalog.reload()
+    assert client.get("/vpn_peers/self/config", headers=headers).status_code == 200
+
+    # the deadline passes
+    assert expiry.expire_users(db, [user_id], now + timedelta(days=2))["peers"] == 2
+    assert client.get("/vpn_peers/self/config", headers=headers).status_code == 403
+
+    r = client.post("/auth/subscribe", json={"tariff_id": tariff_id}, headers=headers)
+    assert r.status_code == 200, r.text
+    r = client.get("/vpn_peers/self/config", headers=headers)
+    assert r.status_code == 200
+    assert r.json()["wg_quick"] == "[Interface]"
+    db.expire_all()
+    assert all(p.active for p in db.query(models.VpnPeer).filter_by(user_id=user_id))
+    kinds = {
+        e.dedupe_key: e.kind
+        for e in db.query(models.OutboxEvent).filter(
+            models.OutboxEvent.peer_id.isnot(None), models.OutboxEvent.status == "pending"
+        )
+        if e.dedupe_key in ("host:exp-renew", "host:exp-renew-easy", "wg-easy:c-renew")
+    }
+    assert kinds == {
+        "host:exp-renew": outbox.APPLY,
+        "host:exp-renew-easy": outbox.APPLY,
+        "wg-easy:c-renew": outbox.WG_EASY_ENABLE,
+    }
+    db.close()
+
+
+def test_purge_frees_long_lapsed_peers():
+    now = NOW + timedelta(days=2)
+    db = SessionLocal()
+    tariff = models.Tariff(name="expiry-purge-tariff", price=1, duration_days=30)
+    db.add(tariff)
+    db.flush()
+    old = _user(db, "expiry-purge@example.com", tariff.id, [now - timedelta(days=100)], now)
+    recent = _user(db, "expiry-keep@example.com", tariff.id, [now - timedelta(days=1)], now)
+    _peer(db, old, "exp-purge", "10.8.0.250/32", wg_client_id="c-purge", active=False)
+    _peer(db, recent, "exp-keep", "10.8.0.251/32", active=False)
+    db.commit()
+    pool = ipam.get_pool(db)
+    pool.reserve("10.8.0.250/32")
+
+    assert expiry.purge_lapsed(db, now=now, purge_after=90 * 24 * 3600) == 1
+    keys = {p.wg_public_key for p in db.query(models.VpnPeer).filter_by(active=False)}
+    assert "exp-purge" not in keys and "exp-keep" in keys
+    assert pool.is_free("10.8.0.250/32")
+    assert (
+        db.query(models.OutboxEvent).filter_by(dedupe_key="wg-easy:c-purge").one().kind
+        == outbox.WG_EASY_DELETE
+    )
+    assert expiry.purge_lapsed(db, now=now, purge_after=0) == 0
+    db.close()
+
+
+def test_dry_run_cli(capsys):
+    assert expiry.main(["--dry-run"]) == 0
+    assert capsys.readouterr().out.startswith("due: ")
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from vpn_api import hashing, metrics
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+def test_pool_hashes_in_worker_process():
+    pool = hashing.HashPool(workers=1, queue=4, timeout=30)
+    try:
+        hashed = pool.run(hashing._hash, "correct horse")
+        assert pool.run(hashing._verify, "correct horse", hashed)
+        assert not pool.run(hashing._verify, "wrong", hashed)
+        assert pool.depth == 0
+    finally:
+        pool.close()
+
+
+def test_saturated_pool_sheds():
+    metrics.reset()
+    pool = hashing.HashPool(workers=1, queue=0)
+    with pytest.raises(hashing.HashPoolSaturated):
+        pool.run(hashing._hash, "x")
+    assert metrics.get("hash_shed") == 1
+    pool.close()
+
+
+def test_timed_out_call_holds_its_slot_until_done():
+    pool = hashing.HashPool(workers=1, queue=1, timeout=30)
+    try:
+        # warm up the worker process so the short timeout only covers the call
+        pool.run(time.sleep, 0)
+        pool.timeout = 0.2
+        with pytest.raises(hashing.HashPoolSaturated, match="timed out"):
+            pool.run(time.sleep, 1.5)
+        # the worker is still busy: a new call is shed instead of queued behind it
+        assert pool.depth == 1
+        with pytest.raises(hashing.HashPoolSaturated, match="in flight"):
+            pool.run(time.sleep, 0)
+        deadline = time.monotonic() + 10
+        while pool.depth and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pool.depth == 0
+    finally:
+        pool.close()
+
+
+def test_login_returns_503_when_hashing_is_saturated(monkeypatch):
+    email = "hash-shed@example.com"
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    monkeypatch.setattr(hashing, "_pool", hashing.HashPool(workers=1, queue=0))
+    r = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    assert r.status_code == 503
+    assert r.headers["retry-after"] == "1"
@@ -0,0 +1,133 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from vpn_api import iap_client, metrics
+from vpn_api.iap_client import IapHttpClient
+from vpn_api.iap_validator import IapValidator, StoreUnavailable
+
+RECEIPT = {
+    "status": 0,
+    "latest_receipt_info": [
+        {
+            "transaction_id": "1000000001",
+            "product_id": "com.example.vpn.monthly",
+            "purchase_date_ms": "1760000000000",
+            "expires_date_ms": "1762592000000",
+        }
+    ],
+}
+
+
+class FakeVerifyReceipt(BaseHTTPRequestHandler):
+    """verifyReceipt that knows only sandbox receipts, like Apple's production."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.calls.append((self.path, body["receipt-data"]))
+            server.connections.add(self.client_address)
+        if body["receipt-data"] == "broken":
+            answer = {"status": 21002}
+        elif body["receipt-data"] == "busy":
+            answer = {"status": 21005}
+        elif self.path == "/production/verifyReceipt":
+            answer = {"status": 21007}
+        else:
+            answer = RECEIPT
+        data = json.dumps(answer).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_apple(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeVerifyReceipt)
+    server.lock = threading.Lock()
+    server.calls = []
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(iap_client, "APPLE_PRODUCTION_URL", f"{base}/production/verifyReceipt")
+    monkeypatch.setattr(iap_client, "APPLE_SANDBOX_URL", f"{base}/sandbox/verifyReceipt")
+    monkeypatch.setattr(IapValidator, "APPLE_PRODUCTION_URL", f"{base}/production/verifyReceipt")
+    monkeypatch.delenv("APPLE_RECEIPT_URL", raising=False)
+    metrics.reset()
+    yield server
+    iap_client.shutdown()
+    server.shutdown()
+    server.server_close()
+
+
+def test_sandbox_receipt_is_redirected_and_parsed(fake_apple):
+    result = IapValidator.validate_apple_receipt("sandbox-receipt", "com.example.vpn")
+    assert result["transaction_id"] == "1000000001"
+    assert result["product_id"] == "com.example.vpn.monthly"
+    assert [path for path, _ in fake_apple.calls] == [
+        "/production/verifyReceipt",
+        "/sandbox/verifyReceipt",
+    ]
+    assert metrics.get("iap_apple_redirects") == 1
+    hist = metrics.snapshot()["histograms"]["iap_apple_seconds"]
+    assert hist["count"] == 2 and hist["buckets"]["+Inf"] == 2
+
+
+def test_invalid_receipt_is_not_redirected(fake_apple):
+    assert IapValidator.validate_apple_receipt("broken", "com.example.vpn") is None
+    assert len(fake_apple.calls) == 1
+
+
+def test_store_outage_is_not_an_invalid_receipt(fake_apple, monkeypatch):
+    with pytest.raises(StoreUnavailable):
+        IapValidator.validate_apple_receipt("busy", "com.example.vpn")
+    monkeypatch.setenv("APPLE_RECEIPT_URL", "http://127.0.0.1:9/verifyReceipt")
+    with pytest.raises(StoreUnavailable):
+        IapValidator.validate_apple_receipt("any", "com.example.vpn")
+    assert iap_client.IapHttpError("gone", 410).transient is False
+    assert iap_client.IapHttpError("down", 503).transient is True
+
+
+def test_connections_are_reused_and_capped_per_host(fake_apple):
+    client = IapHttpClient(pool_size=2)
+    try:
+        payload = {"receipt-data": "r", "password": ""}
+        with ThreadPoolExecutor(8) as pool:
+            answers = list(
+                pool.map(
+                    lambda _: client.verify_apple(payload, iap_client.APPLE_SANDBOX_URL),
+                    range(40),
+                )
+            )
+        assert all(a["status"] == 0 for a in answers)
+        assert len(fake_apple.calls) == 40
+        # at most pool_size sockets to the host, kept alive across calls
+        assert len(fake_apple.connections) <= 2
+    finally:
+        client.close()
+
+
+def test_unreachable_store_counts_an_error(monkeypatch):
+    metrics.reset()
+    client = IapHttpClient(timeout=2, connect_timeout=1)
+    # nothing listens on the discard port
+    monkeypatch.setattr(iap_client, "APPLE_PRODUCTION_URL", "http://127.0.0.1:9/verifyReceipt")
+    try:
+        with pytest.raises(iap_client.IapHttpError):
+            client.verify_apple({"receipt-data": "r"})
+    finally:
+        client.close()
+    assert metrics.get("iap_apple_errors") == 1
+    assert metrics.snapshot()["histograms"]["iap_apple_seconds"]["count"] == 1
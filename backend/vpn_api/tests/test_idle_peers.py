@@ -0,0 +1,126 @@
+import os
+import time
+from datetime import UTC, datetime, timedelta
+
+from cryptography.fernet import Fernet
+from fastapi.testclient import TestClient
+
+from vpn_api import idle_peers, models, subscriptions, wg_host
+from vpn_api.crypto import encrypt_text
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _state(handshakes: dict) -> wg_host.InterfaceState:
+    state = wg_host.InterfaceState(private_key="PRIV")
+    for i, (pub, handshake) in enumerate(handshakes.items()):
+        state.peers[pub] = wg_host.HostPeer(
+            public_key=pub, allowed_ips=f"10.33.0.{i + 1}/32", latest_handshake=handshake
+        )
+    return state
+
+
+def test_reap_parks_idle_peers_only(monkeypatch):
+    now = time.time()
+    db = SessionLocal()
+    user = models.User(email="idle-reap@example.com")
+    db.add(user)
+    db.commit()
+    old = datetime.now(UTC) - timedelta(days=30)
+    for pub, ip, client_id in (
+        ("idle-old", "10.33.1.1/32", None),
+        ("idle-fresh", "10.33.1.2/32", None),
+        ("idle-never", "10.33.1.3/32", None),
+        ("idle-easy", "10.33.1.4/32", "c-1"),
+    ):
+        db.add(
+            models.VpnPeer(
+                user_id=user.id,
+                wg_private_key="x",
+                wg_public_key=pub,
+                wg_ip=ip,
+                wg_client_id=client_id,
+                created_at=old,
+            )
+        )
+    db.commit()
+
+    state = _state(
+        {"idle-old": int(now - 20 * 86400), "idle-fresh": int(now - 60), "idle-never": 0}
+    )
+    state.peers["idle-easy"] = wg_host.HostPeer(public_key="idle-easy", allowed_ips="10.33.1.4/32")
+    removed = []
+    monkeypatch.setattr(wg_host, "read_interface", lambda iface=None: state)
+    monkeypatch.setattr(
+        wg_host,
+        "apply_diff",
+        lambda diff, state, iface=None, method="syncconf": removed.append((method, diff.remove)),
+    )
+
+    assert len(idle_peers.reap(db, dry_run=True, idle_after=7 * 86400, now=now)) == 2
+    assert removed == []
+
+    parked = idle_peers.reap(db, idle_after=7 * 86400, now=now)
+    assert len(parked) == 2
+    assert removed == [("set", ["idle-old", "idle-never"])]
+    rows = {p.wg_public_key: p for p in db.query(models.VpnPeer).filter_by(user_id=user.id)}
+    assert rows["idle-old"].idle_since is not None and rows["idle-old"].active
+    assert rows["idle-fresh"].idle_since is None
+    assert rows["idle-easy"].idle_since is None
+
+    desired = wg_host.desired_peers(db)
+    assert "idle-old" not in desired and "idle-fresh" in desired
+
+    woken = idle_peers.wake_user(db, user.id)
+    assert woken == 2
+    events = db.query(models.OutboxEvent).filter_by(dedupe_key="host:idle-old").all()
+    assert [e.kind for e in events if e.status == "pending"] == ["wg_apply"]
+    db.close()
+
+
+def test_config_fetch_wakes_parked_peer(monkeypatch):
+    if not os.getenv("CONFIG_ENCRYPTION_KEY"):
+        monkeypatch.setenv("CONFIG_ENCRYPTION_KEY", Fernet.generate_key().decode())
+    email = "idle-config@example.com"
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    token = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    headers = {"Authorization": f"Bearer {token.json()['access_token']}"}
+
+    db = SessionLocal()
+    user = db.query(models.User).filter_by(email=email).one()
+    tariff = models.Tariff(name="idle-tariff", price=1, duration_days=30)
+    db.add(tariff)
+    db.commit()
+    db.add(models.UserTariff(user_id=user.id, tariff_id=tariff.id, status="active"))
+    subscriptions.refresh(db, user.id)
+    peer = models.VpnPeer(
+        user_id=user.id,
+        wg_private_key="x",
+        wg_public_key="idle-config",
+        wg_ip="10.33.2.1/32",
+        wg_config_encrypted=encrypt_text("[Interface]\n"),
+        idle_since=datetime.now(UTC),
+    )
+    db.add(peer)
+    db.commit()
+    peer_id = peer.id
+    db.close()
+
+    r = client.get("/vpn_peers/self/config", headers=headers)
+    assert r.status_code == 200
+
+    db = SessionLocal()
+    assert db.get(models.VpnPeer, peer_id).idle_since is None
+    assert (
+        db.query(models.OutboxEvent)
+        .filter_by(dedupe_key="host:idle-config", status="pending")
+        .count()
+        == 1
+    )
+    db.close()
@@ -0,0 +1,147 @@
+import pytest
+
+from vpn_api import ipam, models, peers, schemas
+from vpn_api.database import Base, SessionLocal, engine
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def test_allocate_skips_reserved_and_network_addresses():
+    pool = ipam.IpPool("10.8.0.0/24", ipam.parse_ranges("10.8.0.1-10.8.0.19"))
+    assert pool.allocate() == "10.8.0.20/32"
+    assert pool.allocate() == "10.8.0.21/32"
+    # 256 addresses minus network, broadcast, 19 reserved and 2 allocated
+    assert pool.free == 256 - 2 - 19 - 2
+
+
+def test_release_reuses_lowest_free_address():
+    pool = ipam.IpPool("10.9.0.0/16")
+    first = pool.allocate()
+    second = pool.allocate()
+    assert pool.release(first) is True
+    assert pool.release(first) is False
+    assert pool.allocate() == first
+    assert pool.allocate() != second
+
+
+def test_reserved_and_foreign_addresses_are_never_released():
+    pool = ipam.IpPool("10.8.0.0/24", ipam.parse_ranges("10.8.0.1"))
+    assert pool.release("10.8.0.1/32") is False
+    assert pool.release("192.168.1.1") is False
+    assert pool.reserve("not-an-ip") is False
+    assert not pool.is_free("10.8.0.1")
+
+
+def test_exhaustion_crosses_bitmap_words():
+    pool = ipam.IpPool("10.10.0.0/22")
+    got = {pool.allocate() for _ in range(pool.free)}
+    assert len(got) == 1022
+    with pytest.raises(ipam.PoolExhaustedError):
+        pool.allocate()
+    pool.release("10.10.2.200/32")
+    assert pool.allocate() == "10.10.2.200/32"
+
+
+def test_load_marks_existing_addresses_used():
+    pool = ipam.IpPool("10.8.0.0/24")
+    assert pool.load(["10.8.0.1/32", "10.8.0.2", None, "10.0.0.5/32"]) == 2
+    assert pool.allocate() == "10.8.0.3/32"
+
+
+def test_rejects_oversized_pool():
+    with pytest.raises(ValueError):
+        ipam.IpPool("10.0.0.0/7")
+
+
+def test_create_peer_retries_when_another_worker_took_the_address(monkeypatch):
+    monkeypatch.setenv("WG_KEY_POLICY", "db")
+    monkeypatch.setattr(ipam, "WG_IP_POOL", "10.77.0.0/24")
+    monkeypatch.setattr(ipam, "WG_IP_RESERVED", "")
+    ipam.reset_pool()
+    db = SessionLocal()
+    try:
+        user = models.User(email="ipam-race@example.test")
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+        pool = ipam.get_pool(db)
+
+        # another worker commits the address this worker would hand out next
+        contested = pool.allocate()
+        pool.release(contested)
+        other = SessionLocal()
+        other.add(
+            models.VpnPeer(
+                user_id=user.id, wg_private_key="p", wg_public_key="other-pk", wg_ip=contested
+            )
+        )
+        other.commit()
+        other.close()
+
+        payload = schemas.VpnPeerCreate(user_id=user.id, wg_public_key="ipam-race-pk")
+        peer = peers.create_peer(payload, db=db, current_user=user)
+        assert peer.wg_ip != contested
+        # the conflict rebuilt the bitmap from the table
+        pool = ipam.get_pool(db)
+        assert not pool.is_free(contested)
+        assert not pool.is_free(peer.wg_ip)
+
+        peers.delete_peer(peer.id, db=db, current_user=models.User(id=user.id, is_admin=True))
+        assert pool.is_free(peer.wg_ip)
+    finally:
+        db.close()
+        ipam.reset_pool()
+
+
+def test_two_allocators_sharing_one_db(monkeypatch):
+    monkeypatch.setenv("WG_KEY_POLICY", "db")
+    monkeypatch.setattr(ipam, "WG_IP_POOL", "10.78.0.0/29")
+    monkeypatch.setattr(ipam, "WG_IP_RESERVED", "")
+    ipam.reset_pool()
+    db = SessionLocal()
+    other = SessionLocal()
+    try:
+        user = models.User(email="ipam-two@example.test")
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+        ipam.get_pool(db)
+
+        # the other worker has its own bitmap and commits the three lowest addresses
+        theirs = ipam.IpPool(ipam.WG_IP_POOL)
+        rows = [
+            models.VpnPeer(
+                user_id=user.id,
+                wg_private_key="p",
+                wg_public_key=f"ipam-two-other-{i}",
+                wg_ip=theirs.allocate(),
+            )
+            for i in range(3)
+        ]
+        other.add_all(rows)
+        other.commit()
+        taken = {row.wg_ip for row in rows}
+
+        def create(n):
+            payload = schemas.VpnPeerCreate(user_id=user.id, wg_public_key=f"ipam-two-{n}")
+            return peers.create_peer(payload, db=db, current_user=user)
+
+        # one conflict resyncs the whole bitmap: no address is tried twice
+        mine = [create(n) for n in range(3)]
+        assert {p.wg_ip for p in mine}.isdisjoint(taken)
+        assert len({p.wg_ip for p in mine}) == 3
+
+        # the other worker releases its addresses; this bitmap still has them as
+        # taken, so the pool looks exhausted until it is rebuilt from the table
+        for row in rows:
+            other.delete(row)
+        other.commit()
+        assert ipam.get_pool(db).free == 0
+        fourth = create(3)
+        assert fourth.wg_ip in taken
+    finally:
+        other.close()
+        db.close()
+        ipam.reset_pool()
@@ -0,0 +1,52 @@
+import base64
+
+from vpn_api import keypool, metrics, peers
+
+
+def test_generated_public_key_is_derived_from_private():
+    private, public = keypool.generate_keypair()
+    assert len(base64.b64decode(private)) == 32
+    assert keypool.public_key_for(private) == public
+
+
+def test_pool_hits_after_fill_and_misses_when_empty():
+    metrics.reset()
+    pool = keypool.KeyPool(low=0, high=4)
+    pool.fill()
+    assert len(pool) == 4
+    pairs = [pool.get() for _ in range(5)]
+    assert len({p for p, _ in pairs}) == 5
+    stats = pool.stats()
+    assert stats["hits"] == 4
+    assert stats["misses"] == 1
+
+
+def test_background_refill_reaches_high_watermark():
+    pool = keypool.KeyPool(low=2, high=8)
+    pool.start()
+    try:
+        pool.get()
+        for _ in range(200):
+            if len(pool) == 8:
+                break
+            pool._wake.set()
+            pool._stop.wait(0.01)
+        assert len(pool) == 8
+    finally:
+        pool.stop()
+
+
+def test_take_bulk_mixes_pool_and_fresh_pairs():
+    metrics.reset()
+    pool = keypool.KeyPool(low=0, high=3)
+    pool.fill()
+    pairs = pool.take(10)
+    assert len(pairs) == 10
+    assert all(keypool.public_key_for(p) == pub for p, pub in pairs)
+    assert metrics.get("keypool_hits") == 3
+    assert metrics.get("keypool_misses") == 7
+
+
+def test_peers_keypair_uses_real_derivation():
+    private, public = peers._generate_wg_keypair()
+    assert keypool.public_key_for(private) == public
@@ -0,0 +1,205 @@
+import json
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from vpn_api import models, outbox, peers, schemas, wg_host
+from vpn_api.database import Base, SessionLocal, engine
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    session.query(models.OutboxEvent).delete()
+    session.commit()
+    user = session.query(models.User).filter_by(email="outbox@example.test").first()
+    if user is None:
+        user = models.User(email="outbox@example.test", is_admin=True)
+        session.add(user)
+        session.commit()
+    session.info["user"] = user
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def host(monkeypatch):
+    calls = []
+    result = {"ok": True}
+
+    def fake_apply(peer):
+        calls.append(("apply", peer.wg_public_key))
+        return result["ok"]
+
+    def fake_remove(peer):
+        calls.append(("remove", peer.wg_public_key))
+        return result["ok"]
+
+    monkeypatch.setattr(peers, "apply_peer", fake_apply)
+    monkeypatch.setattr(peers, "remove_peer", fake_remove)
+    monkeypatch.setattr(wg_host, "WG_APPLY_ENABLED", True)
+    return calls, result
+
+
+def _create(db, key: str) -> models.VpnPeer:
+    user = db.info["user"]
+    payload = schemas.VpnPeerCreate(user_id=user.id, wg_public_key=key)
+    return peers.create_peer(payload, db=db, current_user=user)
+
+
+def _events(db):
+    return db.query(models.OutboxEvent).order_by(models.OutboxEvent.id).all()
+
+
+def test_create_and_delete_go_through_outbox(db, host):
+    calls, _ = host
+    peer = _create(db, "ob-create")
+    assert calls == []
+    [event] = _events(db)
+    assert (event.kind, event.status, event.peer_id) == (outbox.APPLY, "pending", peer.id)
+    assert json.loads(event.payload)["wg_public_key"] == "ob-create"
+
+    assert outbox.drain(db) == 1
+    assert calls == [("apply", "ob-create")]
+    assert _events(db)[0].status == "done"
+
+    peers.delete_peer(peer.id, db=db, current_user=db.info["user"])
+    assert outbox.drain(db) == 1
+    assert calls[-1] == ("remove", "ob-create")
+
+
+def test_newer_event_supersedes_pending_one(db, host):
+    calls, _ = host
+    peer = _create(db, "ob-dedupe")
+    peers.delete_peer(peer.id, db=db, current_user=db.info["user"])
+
+    assert [e.status for e in _events(db)] == ["superseded", "pending"]
+    assert outbox.drain(db) == 1
+    assert calls == [("remove", "ob-dedupe")]
+
+
+def test_failed_insert_leaves_no_event(db, host):
+    _create(db, "ob-dup")
+    outbox.drain(db)
+    with pytest.raises(IntegrityError):
+        _create(db, "ob-dup")
+    assert [e.status for e in _events(db)] == ["done"]
+
+
+def test_retry_backoff_and_dead_letter(db, host, monkeypatch):
+    calls, result = host
+    result["ok"] = False
+    monkeypatch.setattr(outbox, "WG_OUTBOX_MAX_ATTEMPTS", 2)
+    _create(db, "ob-fail")
+
+    assert outbox.drain(db) == 1
+    event = _events(db)[0]
+    assert (event.status, event.attempts) == ("pending", 1)
+    assert "apply_peer failed" in event.last_error
+    # backed off: not due yet
+    assert outbox.drain(db) == 0
+
+    event.next_attempt_at = datetime.now(UTC) - timedelta(seconds=1)
+    db.commit()
+    assert outbox.drain(db) == 1
+    assert (_events(db)[0].status, _events(db)[0].attempts) == ("dead", 2)
+
+    result["ok"] = True
+    assert outbox.retry_dead(db) == 1
+    assert outbox.drain(db) == 1
+    assert _events(db)[0].status == "done"
+    assert len(calls) == 3
+
+
+def test_backoff_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(outbox, "WG_OUTBOX_BACKOFF", 1)
+    monkeypatch.setattr(outbox, "WG_OUTBOX_BACKOFF_MAX", 10)
+    assert 0.8 <= outbox.backoff(1) <= 1.2
+    assert 3.2 <= outbox.backoff(3) <= 4.8
+    assert outbox.backoff(20) <= 12
+
+
+def test_stale_processing_is_recovered(db, host):
+    _create(db, "ob-stale")
+    event = _events(db)[0]
+    event.status = "processing"
+    event.locked_at = datetime.now(UTC) - timedelta(hours=1)
+    db.commit()
+    assert outbox.recover_stale(db, lease=60) == 1
+    assert outbox.drain(db) == 1
+
+
+def test_worker_threads_drain_after_notify(db, host):
+    calls, _ = host
+    worker = outbox.OutboxWorker(workers=2, poll=30)
+    worker.start()
+    try:
+        _create(db, "ob-worker")
+        worker.notify()
+        deadline = time.monotonic() + 5
+        while not calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        worker.stop()
+    assert calls == [("apply", "ob-worker")]
+
+
+def test_app_startup_drains_events_left_from_before(db, host, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from vpn_api.main import app
+
+    calls, _ = host
+    _create(db, "ob-startup")
+    # a restart: the event is committed, but no worker of this process runs
+    outbox.shutdown()
+    monkeypatch.setattr(outbox, "WG_OUTBOX_WORKERS", 1)
+    with TestClient(app):
+        deadline = time.monotonic() + 5
+        while not calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert calls == [("apply", "ob-startup")]
+    assert outbox._worker.current is None
+
+
+def test_events_of_one_key_run_in_order_across_workers(db, host, monkeypatch):
+    calls, _ = host
+    started, release = threading.Event(), threading.Event()
+
+    def slow_failing_apply(peer):
+        calls.append(("apply", peer.wg_public_key))
+        started.set()
+        release.wait(5)
+        return False
+
+    monkeypatch.setattr(peers, "apply_peer", slow_failing_apply)
+    worker = outbox.OutboxWorker(workers=2, poll=0.05)
+    worker.start()
+    try:
+        peer = _create(db, "ob-order")
+        worker.notify()
+        assert started.wait(5)
+        # the remove waits while the apply of the same key is processing
+        peers.delete_peer(peer.id, db=db, current_user=db.info["user"])
+        time.sleep(0.3)
+        assert calls == [("apply", "ob-order")]
+        release.set()
+        deadline = time.monotonic() + 5
+        while len(calls) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        release.set()
+        worker.stop()
+    assert calls == [("apply", "ob-order"), ("remove", "ob-order")]
+    db.expire_all()
+    # the failed apply is not retried after the remove
+    assert [e.status for e in _events(db)] == ["superseded", "done"]
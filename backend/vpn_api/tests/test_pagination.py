@@ -0,0 +1,104 @@
+from datetime import UTC, datetime
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from vpn_api import models, pagination, peers
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _login(email: str) -> dict:
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    r = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+def _pages(path, headers=None, **params):
+    ids, cursor = [], ""
+    while cursor is not None:
+        r = client.get(path, params={**params, "cursor": cursor}, headers=headers)
+        assert r.status_code == 200, r.text
+        ids += [item["id"] for item in r.json()["items"]]
+        cursor = r.json()["next_cursor"]
+    return ids
+
+
+def test_payment_pages_match_offset_listing():
+    headers = _login("keyset-payments@example.com")
+    db = SessionLocal()
+    user_id = db.query(models.User.id).filter_by(email="keyset-payments@example.com").scalar()
+    # server-default created_at: most rows share the same second
+    db.add_all(models.Payment(user_id=user_id, amount=i, provider="test") for i in range(7))
+    db.commit()
+
+    offset = [p["id"] for p in client.get("/payments/", headers=headers).json()]
+    assert len(offset) == 7
+    assert _pages("/payments/", headers, limit=2) == offset
+
+    # the anchor row disappears between two pages
+    first = client.get("/payments/", params={"cursor": "", "limit": 3}, headers=headers).json()
+    db.query(models.Payment).filter_by(id=first["items"][-1]["id"]).delete()
+    db.commit()
+    db.close()
+    r = client.get("/payments/", params={"cursor": first["next_cursor"]}, headers=headers)
+    assert [p["id"] for p in r.json()["items"]] == offset[3:]
+
+
+def test_peer_pages_and_invalid_cursor():
+    db = SessionLocal()
+    user = models.User(email="keyset-peers@example.com")
+    db.add(user)
+    db.commit()
+    for i in range(5):
+        db.add(
+            models.VpnPeer(
+                user_id=user.id,
+                wg_private_key="k",
+                wg_public_key=f"keyset-pub-{i}",
+                wg_ip=f"10.99.0.{i + 2}",
+                created_at=datetime(2026, 1, 1 + i % 2, tzinfo=UTC),
+            )
+        )
+    db.commit()
+    ids, cursor = [], ""
+    while cursor is not None:
+        page = peers.list_peers(limit=2, cursor=cursor, db=db, current_user=user)
+        ids += [peer.id for peer in page["items"]]
+        cursor = page["next_cursor"]
+    rows = db.query(models.VpnPeer).filter_by(user_id=user.id).all()
+    assert ids == [p.id for p in sorted(rows, key=lambda p: (p.created_at, p.id))]
+
+    with pytest.raises(HTTPException) as exc:
+        peers.list_peers(limit=2, cursor="not-a-cursor", db=db, current_user=user)
+    assert exc.value.status_code == 400
+    db.close()
+
+
+def test_tariff_pages_from_the_catalog():
+    db = SessionLocal()
+    db.add_all(models.Tariff(name=f"keyset-tariff-{i}", price=i + 1) for i in range(4))
+    db.commit()
+    db.close()
+    listing = client.get("/tariffs/", params={"limit": 100}).json()
+    assert _pages("/tariffs/", limit=3) == [t["id"] for t in listing]
+    assert client.get("/tariffs/", params={"cursor": "%%"}).status_code == 400
+    cursor = pagination.encode_cursor(datetime(2000, 1, 1), 10**9)
+    assert client.get("/tariffs/", params={"cursor": cursor}).json()["items"]
+
+
+def test_limit_must_be_positive():
+    headers = _login("keyset-limit@example.com")
+    for path in ("/payments/", "/vpn_peers/", "/tariffs/"):
+        for limit in (0, -1):
+            r = client.get(path, params={"cursor": "", "limit": limit}, headers=headers)
+            assert r.status_code == 422, (path, limit)
+    assert client.get("/vpn_peers/", params={"limit": 10**6}, headers=headers).status_code == 422
+    assert pagination._page([], 0) == {"items": [], "next_cursor": None}
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import IntegrityError
+
+from vpn_api import catalog, models
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.iap_validator import IapValidator
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _setup(monkeypatch, name):
+    db = SessionLocal()
+    tariff = models.Tariff(name=f"{name}-tariff", price=5, duration_days=30)
+    user = models.User(email=f"{name}@example.com")
+    db.add_all([tariff, user])
+    db.commit()
+    tariff_id, user_id = tariff.id, user.id
+    product = f"{name}.monthly"
+    db.add(models.Product(product_id=product, tariff_id=tariff_id))
+    db.commit()
+    db.close()
+    catalog.reload()
+    monkeypatch.setattr(
+        IapValidator,
+        "validate_apple_receipt",
+        staticmethod(
+            lambda receipt, bundle_id: {"transaction_id": f"{name}-tx", "product_id": product}
+        ),
+    )
+    return user_id, tariff_id
+
+
+def test_parallel_duplicates_grant_once(monkeypatch):
+    user_id, tariff_id = _setup(monkeypatch, "idem-parallel")
+    body = {"user_id": user_id, "provider": "apple", "receipt": "aWRlbS1wYXJhbGxlbA=="}
+    with ThreadPoolExecutor(100) as pool:
+        responses = list(
+            pool.map(lambda _: client.post("/payments/webhook", json=body), range(100))
+        )
+    assert [r.status_code for r in responses] == [200] * 100
+    messages = [r.json()["msg"] for r in responses]
+    assert messages.count("Payment processed successfully") == 1
+    assert {r.json()["payment_id"] for r in responses} == {responses[0].json()["payment_id"]}
+
+    db = SessionLocal()
+    assert db.query(models.Payment).filter_by(provider_payment_id="idem-parallel-tx").count() == 1
+    assert db.query(models.UserTariff).filter_by(user_id=user_id, tariff_id=tariff_id).count() == 1
+    assert db.get(models.User, user_id).active_tariff_id == tariff_id
+    db.close()
+
+
+def test_same_transaction_id_is_unique_per_provider():
+    db = SessionLocal()
+    for provider in ("apple", "google"):
+        db.add(models.Payment(amount=1, provider=provider, provider_payment_id="idem-shared-tx"))
+    db.commit()
+    db.add(models.Payment(amount=1, provider="apple", provider_payment_id="idem-shared-tx"))
+    with pytest.raises(IntegrityError):
+        db.commit()
+    db.rollback()
+    db.close()
+
+
+def test_unknown_user_and_catalog(monkeypatch):
+    _setup(monkeypatch, "idem-catalog")
+    missing = {"user_id": 10**9, "provider": "apple", "receipt": "bWlzc2luZw=="}
+    assert client.post("/payments/webhook", json=missing).status_code == 404
+
+    # a tariff created behind the snapshot's back is found on the first miss
+    monkeypatch.setattr(catalog, "TARIFF_CATALOG_MISS_RELOAD", 0)
+    catalog.reload()
+    db = SessionLocal()
+    late = models.Tariff(name="idem-late-tariff", price=7, duration_days=30)
+    db.add(late)
+    db.commit()
+    late_id = late.id
+    db.close()
+    assert catalog.tariff(late_id).price == 7
+    assert catalog.tariff(10**9) is None
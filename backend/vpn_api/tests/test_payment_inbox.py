@@ -0,0 +1,162 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from vpn_api import catalog, metrics, models, payment_inbox, schemas
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.iap_validator import IapValidator, StoreUnavailable
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _user_and_tariff(name):
+    db = SessionLocal()
+    tariff = models.Tariff(name=f"{name}-tariff", price=3, duration_days=30)
+    user = models.User(email=f"{name}@example.com")
+    db.add_all([tariff, user])
+    db.commit()
+    ids = user.id, tariff.id
+    db.add(models.Product(product_id=f"{name}.monthly", tariff_id=tariff.id))
+    db.commit()
+    db.close()
+    catalog.reload()
+    return ids
+
+
+def _store(answers):
+    # per receipt: a dict, None (rejected) or an exception to raise
+    def validate(receipt, bundle_id):
+        answer = answers[receipt]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    return staticmethod(validate)
+
+
+def _accept(db, user_id, receipt):
+    return payment_inbox.accept(
+        db, schemas.PaymentWebhookIn(user_id=user_id, provider="apple", receipt=receipt)
+    )
+
+
+def test_webhook_accepts_with_202_and_drain_processes(monkeypatch):
+    user_id, tariff_id = _user_and_tariff("inbox-accept")
+    answer = {"transaction_id": "inbox-accept-tx", "product_id": "inbox-accept.monthly"}
+    monkeypatch.setattr(IapValidator, "validate_apple_receipt", _store({"aW5ib3g=": answer}))
+    monkeypatch.setattr(payment_inbox, "PAYMENT_WEBHOOK_ASYNC", True)
+
+    body = {"user_id": user_id, "provider": "apple", "receipt": "aW5ib3g="}
+    r = client.post("/payments/webhook", json=body)
+    assert r.status_code == 202
+    item_id = r.json()["notification_id"]
+
+    db = SessionLocal()
+    assert db.query(models.Payment).filter_by(provider_payment_id="inbox-accept-tx").count() == 0
+    stats = payment_inbox.stats(db)
+    assert stats["depth"] >= 1 and stats["lag_seconds"] >= 0
+    assert payment_inbox.drain(db) >= 1
+    db.expire_all()
+    item = db.get(models.PaymentNotification, item_id)
+    assert item.status == "done"
+    assert json.loads(item.result)["tariff_id"] == tariff_id
+    assert db.query(models.Payment).filter_by(provider_payment_id="inbox-accept-tx").count() == 1
+    db.close()
+
+
+def test_claims_keep_per_user_order():
+    db = SessionLocal()
+    db.query(models.PaymentNotification).update({"status": "done"})
+    db.commit()
+    first = _accept(db, 900001, "order-a1")
+    second = _accept(db, 900001, "order-a2")
+    other = _accept(db, 900002, "order-b1")
+    assert payment_inbox._claim(db).id == first
+    # a2 waits while a1 is processing; b1 belongs to another user
+    assert payment_inbox._claim(db).id == other
+    assert payment_inbox._claim(db) is None
+    db.get(models.PaymentNotification, first).status = "done"
+    db.commit()
+    assert payment_inbox._claim(db).id == second
+    db.query(models.PaymentNotification).update({"status": "done"})
+    db.commit()
+    db.close()
+
+
+def test_failures_retry_and_replay(monkeypatch):
+    user_id, _ = _user_and_tariff("inbox-fail")
+    good = {"transaction_id": "inbox-fail-tx", "product_id": "inbox-fail.monthly"}
+    answers = {"flaky": RuntimeError("store timeout"), "rejected": None}
+    monkeypatch.setattr(IapValidator, "validate_apple_receipt", _store(answers))
+    db = SessionLocal()
+    flaky = _accept(db, user_id, "flaky")
+    rejected = _accept(db, user_id, "rejected")
+    payment_inbox.drain(db)
+    item = db.get(models.PaymentNotification, flaky)
+    assert (item.status, item.attempts) == ("pending", 1)
+    assert "store timeout" in item.last_error
+    # the rejected one waits behind the retrying one of the same user
+    assert db.get(models.PaymentNotification, rejected).status == "pending"
+
+    answers["flaky"] = None
+    item.next_attempt_at = item.received_at
+    db.commit()
+    assert payment_inbox.drain(db) == 2
+    db.expire_all()
+    assert db.get(models.PaymentNotification, rejected).last_error == "400: Invalid receipt"
+    assert payment_inbox.stats(db)["counts"].get("failed") == 2
+
+    answers["rejected"] = good
+    assert payment_inbox.main(["replay", str(rejected)]) == 0
+    assert payment_inbox.drain(db) == 1
+    db.expire_all()
+    assert db.get(models.PaymentNotification, rejected).status == "done"
+    assert db.get(models.PaymentNotification, flaky).status == "failed"
+    db.close()
+
+
+def test_store_outage_is_retried_not_failed(monkeypatch):
+    user_id, _ = _user_and_tariff("inbox-outage")
+    good = {"transaction_id": "inbox-outage-tx", "product_id": "inbox-outage.monthly"}
+    answers = {"outage": StoreUnavailable("Apple receipt validation unavailable")}
+    monkeypatch.setattr(IapValidator, "validate_apple_receipt", _store(answers))
+    db = SessionLocal()
+    item_id = _accept(db, user_id, "outage")
+    assert payment_inbox.drain(db) == 1
+    item = db.get(models.PaymentNotification, item_id)
+    assert (item.status, item.attempts) == ("pending", 1)
+
+    answers["outage"] = good
+    item.next_attempt_at = item.received_at
+    db.commit()
+    assert payment_inbox.drain(db) == 1
+    db.expire_all()
+    assert db.get(models.PaymentNotification, item_id).status == "done"
+    db.close()
+
+    # the synchronous webhook asks the client to retry
+    answers["sync-outage"] = StoreUnavailable("down")
+    body = {"user_id": user_id, "provider": "apple", "receipt": "sync-outage"}
+    assert client.post("/payments/webhook", json=body).status_code == 503
+
+
+def test_gauges_share_one_stats_query_per_snapshot(monkeypatch):
+    calls = []
+    real_stats = payment_inbox.stats
+
+    def counting_stats(db):
+        calls.append(1)
+        return real_stats(db)
+
+    monkeypatch.setattr(payment_inbox, "stats", counting_stats)
+    # registers the gauges; the returned worker's threads are not started
+    payment_inbox._new_worker()
+    gauges = metrics.snapshot()["gauges"]
+    assert len(calls) == 1
+    assert gauges["payment_inbox_depth"] is not None
+    assert gauges["payment_inbox_lag_seconds"] is not None
@@ -0,0 +1,132 @@
+import json
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+from fastapi.testclient import TestClient
+
+from vpn_api import models, outbox, peers
+from vpn_api.database import SessionLocal
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+def _auth(email: str, admin: bool = True):
+    r = client.post("/auth/register", json={"email": email, "password": "strongpass"})
+    assert r.status_code == 200
+    user = r.json()
+    if admin:
+        r = client.post(
+            "/auth/admin/promote", params={"user_id": user["id"], "secret": "bootstrap-secret"}
+        )
+        assert r.status_code == 200
+    r = client.post("/auth/login", json={"email": email, "password": "strongpass"})
+    return user, {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+def _lines(resp):
+    rows = [json.loads(line) for line in resp.text.splitlines() if line]
+    return [r for r in rows if "index" in r], rows[-1]["summary"]
+
+
+def test_bulk_create_db_policy(monkeypatch):
+    monkeypatch.setenv("WG_KEY_POLICY", "db")
+    if not os.getenv("CONFIG_ENCRYPTION_KEY"):
+        monkeypatch.setenv("CONFIG_ENCRYPTION_KEY", Fernet.generate_key().decode())
+    user, headers = _auth("bulk-admin@example.com")
+
+    specs = [{"user_id": user["id"], "device_name": f"d{i}"} for i in range(40)]
+    r = client.post("/vpn_peers/bulk", json={"peers": specs}, headers=headers)
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    items, summary = _lines(r)
+    assert summary == {"created": 40, "failed": 0, "queued": 40}
+    assert sorted(i["index"] for i in items) == list(range(40))
+    assert len({i["peer"]["wg_ip"] for i in items}) == 40
+
+    db = SessionLocal()
+    try:
+        rows = db.query(models.VpnPeer).filter(models.VpnPeer.user_id == user["id"]).all()
+        assert len(rows) == 40
+        assert all(row.wg_config_encrypted for row in rows)
+        # host apply is queued in the outbox with the rows, not run inline
+        events = (
+            db.query(models.OutboxEvent)
+            .filter(models.OutboxEvent.peer_id.in_([row.id for row in rows]))
+            .all()
+        )
+        assert sorted(e.peer_id for e in events) == sorted(row.id for row in rows)
+        assert {(e.kind, e.status) for e in events} == {(outbox.APPLY, "pending")}
+    finally:
+        db.close()
+
+
+def test_bulk_reports_per_item_failures():
+    user, headers = _auth("bulk-admin2@example.com")
+    specs = [
+        {"user_id": user["id"], "wg_public_key": "bulk-dup-pk"},
+        {"user_id": user["id"], "wg_public_key": "bulk-dup-pk"},
+        {"user_id": 999999},
+        {"user_id": user["id"]},
+    ]
+    r = client.post("/vpn_peers/bulk", json={"peers": specs}, headers=headers)
+    items, summary = _lines(r)
+    by_index = {i["index"]: i for i in items}
+    assert summary["created"] == 2
+    assert by_index[0]["status"] == "created"
+    assert by_index[1]["status"] == "error"
+    assert by_index[2]["detail"] == "User not found"
+    assert by_index[3]["status"] == "created"
+
+    # the one-by-one fallback queues an apply for each row it kept
+    db = SessionLocal()
+    try:
+        events = (
+            db.query(models.OutboxEvent.dedupe_key)
+            .join(models.VpnPeer, models.VpnPeer.id == models.OutboxEvent.peer_id)
+            .filter(models.VpnPeer.user_id == user["id"])
+            .all()
+        )
+        assert sorted(e[0] for e in events) == sorted(
+            f"host:{by_index[i]['peer']['wg_public_key']}" for i in (0, 3)
+        )
+    finally:
+        db.close()
+
+
+def test_bulk_wg_easy_queues_host_apply(monkeypatch):
+    monkeypatch.setenv("WG_KEY_POLICY", "wg-easy")
+    monkeypatch.setenv("WG_EASY_URL", "http://wg")
+    monkeypatch.setenv("WG_EASY_PASSWORD", "pw")
+    deleted = []
+
+    def fake_handle(user_id, name):
+        n = int(name.rsplit("-", 1)[1])
+        if n == 3:
+            raise RuntimeError("controller down")
+        return f"pk-wg-{n}", f"priv-{n}", f"cid-{n}", {"address": f"10.8.1.{n}/32"}
+
+    monkeypatch.setattr(peers, "_handle_wg_easy_creation", fake_handle)
+    monkeypatch.setattr(peers, "_delete_wg_easy_client", lambda u, p, c: deleted.append(c))
+    monkeypatch.setattr(peers, "apply_peer", lambda peer: pytest.fail("applied inline"))
+    user, headers = _auth("bulk-admin3@example.com")
+
+    specs = [{"user_id": user["id"], "device_name": f"wg-{i}"} for i in range(6)]
+    r = client.post("/vpn_peers/bulk", json={"peers": specs}, headers=headers)
+    items, summary = _lines(r)
+    assert summary == {"created": 5, "failed": 1, "queued": 5}
+    assert {i["peer"]["wg_client_id"] for i in items if i["status"] == "created"} == {
+        "cid-0",
+        "cid-1",
+        "cid-2",
+        "cid-4",
+        "cid-5",
+    }
+    assert deleted == []
+
+
+def test_bulk_requires_admin():
+    _user, headers = _auth("bulk-user@example.com", admin=False)
+    r = client.post("/vpn_peers/bulk", json={"peers": [{}]}, headers=headers)
+    assert r.status_code == 403
@@ -0,0 +1,301 @@
+"""Query-plan regression tests for the SQL issued by peers, auth and payments.
+
+The endpoints are driven through the API while every statement they send is
+captured. Each statement is then run under ``EXPLAIN QUERY PLAN`` against an
+empty schema whose planner statistics describe 1M-row tables, so SQLite plans
+as it would in production. A full table scan, or a sort of all matching rows
+for an ORDER BY, fails the test unless the statement has no WHERE clause
+(unfiltered admin listings).
+
+``PLAN_SEED_ROWS=1000000`` seeds that many real rows (and runs ANALYZE)
+instead of writing synthetic statistics. ``PLAN_TEST_POSTGRES_URL`` also
+checks the statements on Postgres with sequential scans disabled, so any
+``Seq Scan`` left in a plan means no usable index.
+"""
+
+import os
+import re
+import tempfile
+import traceback
+from datetime import UTC, datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, text
+
+from vpn_api import auth, catalog, models, pagination, schemas
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.iap_validator import IapValidator
+from vpn_api.main import app
+
+client = TestClient(app)
+
+ROWS = 1_000_000
+SEED_ROWS = int(os.getenv("PLAN_SEED_ROWS", "0"))
+POSTGRES_URL = os.getenv("PLAN_TEST_POSTGRES_URL")
+# catalog tables with a handful of rows, where a scan is the cheapest plan
+SMALL_TABLES = {"tariffs"}
+CHECKED = re.compile(r"vpn_api[\\/](peers|auth|payments|subscriptions)\.py$")
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _origin():
+    for frame in reversed(traceback.extract_stack()):
+        if CHECKED.search(frame.filename):
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+    return None
+
+
+def _login(email: str) -> dict:
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    r = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+def _drive(monkeypatch):
+    """Exercise the peers/auth/payments endpoints once each."""
+    monkeypatch.setenv("WG_KEY_POLICY", "db")
+    if not os.getenv("CONFIG_ENCRYPTION_KEY"):
+        from cryptography.fernet import Fernet
+
+        monkeypatch.setenv("CONFIG_ENCRYPTION_KEY", Fernet.generate_key().decode())
+    user = _login("plan-user@example.com")
+    admin = _login("plan-admin@example.com")
+    db = SessionLocal()
+    admin_id = db.query(models.User.id).filter_by(email="plan-admin@example.com").scalar()
+    user_id = db.query(models.User.id).filter_by(email="plan-user@example.com").scalar()
+    client.post(f"/auth/admin/promote?user_id={admin_id}&secret=bootstrap-secret")
+    tariff = models.Tariff(name="plan-tariff", price=3, duration_days=30)
+    lifetime = models.Tariff(name="plan-lifetime", price=9, duration_days=0)
+    db.add_all([tariff, lifetime])
+    db.commit()
+    tariff_id, lifetime_id = tariff.id, lifetime.id
+    db.close()
+    catalog.reload()
+    admin = _login("plan-admin@example.com")
+
+    client.get("/auth/me", headers=user)
+    client.get("/auth/me/subscription", headers=user)
+    client.post("/auth/subscribe", json={"tariff_id": tariff_id}, headers=user)
+    client.get("/auth/me/subscription", headers=user)
+    db = SessionLocal()
+    admin_user = db.query(models.User).filter_by(id=admin_id).one()
+    auth.assign_tariff(admin_id, schemas.AssignTariff(tariff_id=lifetime_id), db, admin_user)
+    db.close()
+
+    r = client.post("/vpn_peers/self", json={"device_name": "plan"}, headers=user)
+    assert r.status_code == 200, r.text
+    peer = r.json()
+    client.get("/vpn_peers/self/config", headers=user)
+    client.get("/vpn_peers/", headers=user)
+    client.get(f"/vpn_peers/?user_id={user_id}", headers=admin)
+    cursor = pagination.encode_cursor(datetime.now(UTC), peer["id"])
+    client.get("/vpn_peers/", params={"cursor": cursor}, headers=user)
+    client.get("/vpn_peers/", params={"cursor": cursor}, headers=admin)
+    client.get(f"/vpn_peers/{peer['id']}", headers=user)
+    client.delete(f"/vpn_peers/{peer['id']}", headers=user)
+
+    body = {"user_id": user_id, "amount": 3, "currency": "USD", "provider": "test"}
+    payment = client.post("/payments/", json=body, headers=user).json()
+    client.get("/payments/", headers=user)
+    client.get(f"/payments/?user_id={user_id}", headers=admin)
+    cursor = pagination.encode_cursor(datetime.now(UTC), payment["id"])
+    client.get("/payments/", params={"cursor": cursor}, headers=user)
+    client.get("/payments/", params={"cursor": cursor}, headers=admin)
+    client.get(f"/payments/{payment['id']}", headers=user)
+    client.put(f"/payments/{payment['id']}", json=body, headers=user)
+    client.delete(f"/payments/{payment['id']}", headers=user)
+
+    monkeypatch.setattr(
+        IapValidator,
+        "validate_apple_receipt",
+        staticmethod(
+            lambda receipt, bundle_id: {"transaction_id": "plan-tx", "product_id": "plan.monthly"}
+        ),
+    )
+    db = SessionLocal()
+    db.add(models.Product(product_id="plan.monthly", tariff_id=tariff_id))
+    db.commit()
+    db.close()
+    catalog.reload()
+    webhook = {"user_id": user_id, "provider": "apple", "receipt": "eA=="}
+    client.post("/payments/webhook", json=webhook)
+    client.post("/payments/webhook", json=webhook)
+
+
+@pytest.fixture(scope="module")
+def captured():
+    statements = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        origin = _origin()
+        if origin and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            statements.setdefault(statement, (parameters, origin))
+
+    clauses = {}
+
+    def before_execute(conn, clauseelement, multiparams, params, execution_options):
+        origin = _origin()
+        if origin and hasattr(clauseelement, "compile"):
+            clauses.setdefault(str(clauseelement), (clauseelement, origin))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "before_execute", before_execute)
+    monkeypatch = pytest.MonkeyPatch()
+    try:
+        _drive(monkeypatch)
+    finally:
+        monkeypatch.undo()
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        event.remove(engine, "before_execute", before_execute)
+    return statements, clauses
+
+
+def _synthetic_stats(conn) -> None:
+    """Describe every table as ``ROWS`` rows with ~10 rows per leading index key."""
+    # ANALYZE creates sqlite_stat1; its rows are then replaced wholesale
+    conn.exec_driver_sql("ANALYZE")
+    conn.exec_driver_sql("DELETE FROM sqlite_stat1")
+    for table in Base.metadata.sorted_tables:
+        conn.exec_driver_sql(
+            "INSERT INTO sqlite_stat1 VALUES (?, NULL, ?)", (table.name, str(ROWS))
+        )
+        for _seq, name, unique, _origin, partial in conn.exec_driver_sql(
+            f"PRAGMA index_list({table.name})"
+        ):
+            ncols = len(conn.exec_driver_sql(f"PRAGMA index_info({name})").fetchall())
+            # partial indexes cover about one row in 20 (active subscriptions/peers)
+            rows, first = (ROWS // 20, 2) if partial else (ROWS, 10)
+            per_key = ["1"] * ncols if unique else [str(max(1, first >> i)) for i in range(ncols)]
+            conn.exec_driver_sql(
+                "INSERT INTO sqlite_stat1 VALUES (?, ?, ?)",
+                (table.name, name, " ".join([str(rows), *per_key])),
+            )
+
+
+def _seed(conn, rows: int) -> None:
+    now = datetime.now(UTC).isoformat(" ")
+    users = max(1, rows // 10)
+    numbers = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+    conn.exec_driver_sql(
+        "INSERT INTO tariffs (id, name, duration_days, price, created_at) "
+        "VALUES (1, 't', 30, 1, ?)",
+        (now,),
+    )
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO users (id, email, status, is_admin, is_verified, created_at) "
+        "SELECT i, 'u' || i || '@example.com', 'active', 0, 1, ? FROM n",
+        (users, now),
+    )
+    # one in 20 subscriptions still active, the rest expired
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO user_tariffs (user_id, tariff_id, started_at, ended_at, status) "
+        "SELECT i % ? + 1, 1, datetime(?, '-' || i || ' seconds'), "
+        "datetime(?, '+' || (i % 60 - 50) || ' days'), "
+        "CASE WHEN i % 20 = 0 THEN 'active' ELSE 'expired' END FROM n",
+        (rows, users, now, now),
+    )
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO vpn_peers (user_id, wg_private_key, wg_public_key, wg_ip, "
+        "active, created_at) SELECT i % ? + 1, 'k', 'pub' || i, 'ip' || i, i % 3 = 0, "
+        "datetime(?, '-' || i || ' seconds') FROM n",
+        (rows, users, now),
+    )
+    conn.exec_driver_sql(
+        numbers + "INSERT INTO payments (user_id, amount, currency, status, provider, "
+        "provider_payment_id, created_at) SELECT i % ? + 1, 1, 'USD', 'completed', "
+        "'apple', 'tx' || i, datetime(?, '-' || i || ' seconds') FROM n",
+        (rows, users, now),
+    )
+    conn.exec_driver_sql("ANALYZE")
+
+
+@pytest.fixture(scope="module")
+def plan_engine():
+    path = os.path.join(tempfile.mkdtemp(), "plans.db")
+    eng = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=eng)
+    with eng.begin() as conn:
+        if SEED_ROWS:
+            _seed(conn, SEED_ROWS)
+        else:
+            _synthetic_stats(conn)
+    eng.dispose()  # statistics are loaded when a connection reads the schema
+    yield eng
+    eng.dispose()
+
+
+def _regressions(plan: list[str]) -> list[str]:
+    """Full table scans, and sorts of every matching row for an ORDER BY."""
+    return [
+        line
+        for line in plan
+        if (re.match(r"SCAN (?!CONSTANT ROW)", line) and line.split()[1] not in SMALL_TABLES)
+        or line == "USE TEMP B-TREE FOR ORDER BY"
+    ]
+
+
+def test_hot_queries_use_indexes_sqlite(captured, plan_engine):
+    statements, _clauses = captured
+    assert len(statements) > 15
+    failures = []
+    with plan_engine.connect() as conn:
+        for statement, (parameters, origin) in statements.items():
+            plan = [
+                row[3]
+                for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+            ]
+            bad = _regressions(plan)
+            if bad and re.search(r"\bWHERE\b", statement):
+                failures.append(f"{origin}: {bad}\n  {statement}")
+    assert not failures, "unindexed queries:\n" + "\n".join(failures)
+
+
+def test_partial_indexes_match_their_queries(plan_engine):
+    with plan_engine.connect() as conn:
+        plan = conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT id FROM vpn_peers WHERE vpn_peers.user_id = 1 "
+            "AND vpn_peers.active = 1 ORDER BY vpn_peers.created_at DESC"
+        ).fetchall()
+        assert "ix_vpn_peers_user_active_created" in plan[0][3]
+        assert not any("TEMP B-TREE" in row[3] for row in plan)
+        plan = conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN UPDATE user_tariffs SET status = 'expired' "
+            "WHERE status = 'active' AND ended_at <= '2026-01-01'"
+        ).fetchall()
+        assert "ix_user_tariffs_active_ended" in plan[0][3]
+
+
+@pytest.mark.skipif(not POSTGRES_URL, reason="PLAN_TEST_POSTGRES_URL not set")
+def test_hot_queries_use_indexes_postgres(captured):
+    from sqlalchemy.dialects import postgresql
+
+    _statements, clauses = captured
+    pg = create_engine(POSTGRES_URL)
+    Base.metadata.drop_all(bind=pg)
+    Base.metadata.create_all(bind=pg)
+    failures = []
+    try:
+        with pg.connect() as conn:
+            conn.execute(text("SET enable_seqscan = off"))
+            for clause, origin in clauses.values():
+                try:
+                    sql = str(
+                        clause.compile(
+                            dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+                        )
+                    )
+                except Exception:
+                    continue  # parameters bound at execution time
+                if not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                    continue
+                plan = [row[0] for row in conn.execute(text("EXPLAIN " + sql))]
+                if any("Seq Scan" in line for line in plan) and " WHERE " in sql.replace("\n", " "):
+                    failures.append(f"{origin}: {sql}\n  " + "\n  ".join(plan))
+    finally:
+        Base.metadata.drop_all(bind=pg)
+        pg.dispose()
+    assert not failures, "sequential scans:\n" + "\n".join(failures)
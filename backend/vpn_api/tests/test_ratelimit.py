@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+from vpn_api import hashing, metrics, ratelimit
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_ENABLED", True)
+    ratelimit.reset()
+    metrics.reset()
+    yield
+    ratelimit.reset()
+
+
+def test_token_bucket_refills():
+    backend = ratelimit.MemoryBackend(shards=2, max_keys=100)
+    assert [backend.hit("k", 2, 10, 0.0) for _ in range(3)] == [0.0, 0.0, 5.0]
+    # one token every 5 seconds
+    assert backend.hit("k", 2, 10, 5.0) == 0.0
+    assert backend.hit("k", 2, 10, 5.0) > 0
+
+
+def test_memory_backend_is_bounded():
+    backend = ratelimit.MemoryBackend(shards=4, max_keys=40)
+    for i in range(1000):
+        backend.hit(f"k{i}", 5, 60, 0.0)
+    assert len(backend) <= 40
+
+
+def test_sqlite_backend_is_shared(tmp_path):
+    path = str(tmp_path / "rl.db")
+    a, b = ratelimit.SqliteBackend(path), ratelimit.SqliteBackend(path)
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        waits = list(ex.map(lambda i: (a if i % 2 else b).hit("k", 10, 60, 100.0), range(20)))
+    assert sum(1 for w in waits if w == 0) == 10
+
+
+def test_login_is_limited_per_email_before_hashing(limiter, monkeypatch):
+    monkeypatch.setitem(ratelimit.RULES, "login_email", (3, 60))
+    email = "ratelimit@example.com"
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+
+    hashed = []
+    real_verify = hashing.verify_password
+    monkeypatch.setattr(hashing, "verify_password", lambda *a: hashed.append(1) or real_verify(*a))
+    codes = [
+        client.post("/auth/login", json={"email": email, "password": "wrongpass1"}).status_code
+        for _ in range(5)
+    ]
+    assert codes == [401, 401, 401, 429, 429]
+    assert len(hashed) == 3
+    assert metrics.get("ratelimit_rejected_login_email") == 2
+
+    r = client.post("/auth/login", json={"email": email.upper(), "password": "testpass123"})
+    assert r.status_code == 429
+    assert int(r.headers["retry-after"]) >= 1
+
+
+def test_register_is_limited_per_ip(limiter, monkeypatch):
+    monkeypatch.setitem(ratelimit.RULES, "register_ip", (2, 3600))
+    for i in range(2):
+        client.post("/auth/register/email", json={"email": f"rl-reg{i}@example.com"})
+    r = client.post("/auth/register", json={"email": "rl-reg9@example.com", "password": "x" * 8})
+    assert r.status_code == 429
+    assert metrics.get("ratelimit_rejected") == 1
+
+
+def test_disabled_rule_never_limits(limiter, monkeypatch):
+    assert ratelimit.parse_rule("0") is None
+    assert ratelimit.parse_rule("5/60") == (5.0, 60.0)
+    monkeypatch.setitem(ratelimit.RULES, "login_ip", None)
+    for _ in range(100):
+        ratelimit.check("login_ip", "1.2.3.4")
+    assert metrics.get("ratelimit_rejected") == 0
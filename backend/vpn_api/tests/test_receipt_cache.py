@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+from vpn_api import catalog, metrics, models, receipt_cache
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.iap_validator import IapValidator
+from vpn_api.main import app
+from vpn_api.receipt_cache import ReceiptCache, receipt_key
+
+client = TestClient(app)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def test_key_depends_on_provider_and_receipt():
+    assert receipt_key("apple", "r") == receipt_key("apple", "r")
+    assert receipt_key("apple", "r") != receipt_key("google", "r")
+    assert receipt_key("apple", "r", "a") != receipt_key("apple", "r", "b")
+
+
+def test_concurrent_validations_are_coalesced():
+    metrics.reset()
+    cache = ReceiptCache()
+    calls = []
+    gate = threading.Event()
+
+    def validate():
+        calls.append(1)
+        gate.wait(5)
+        return {"transaction_id": "t"}
+
+    with ThreadPoolExecutor(10) as pool:
+        futures = [pool.submit(cache.get_or_validate, "k", validate) for _ in range(10)]
+        time.sleep(0.2)
+        gate.set()
+        results = [f.result() for f in futures]
+    assert len(calls) == 1
+    assert all(r == {"transaction_id": "t"} for r in results)
+    assert cache.get_or_validate("k", validate) == {"transaction_id": "t"}
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats["misses"], stats["coalesced"] + stats["hits"]) == (1, 10)
+    assert stats["hit_rate"] == pytest.approx(10 / 11)
+
+
+def test_failures_are_shared_but_not_cached():
+    cache = ReceiptCache()
+    calls = []
+
+    def invalid():
+        calls.append(1)
+
+    assert cache.get_or_validate("bad", invalid) is None
+    assert cache.get_or_validate("bad", invalid) is None
+    assert len(calls) == 2
+
+    def boom():
+        raise RuntimeError("store down")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_validate("boom", boom)
+    assert cache.get_or_validate("boom", lambda: {"ok": 1}) == {"ok": 1}
+
+
+def test_ttl_and_size_bound():
+    cache = ReceiptCache(size=2, ttl=0.05)
+    for key in "abc":
+        cache.get_or_validate(key, lambda key=key: {"k": key})
+    assert len(cache) == 2
+    time.sleep(0.1)
+    calls = []
+    cache.get_or_validate("b", lambda: calls.append(1) or {"k": "b2"})
+    assert calls == [1]
+
+
+def test_webhook_retry_skips_the_store(monkeypatch):
+    db = SessionLocal()
+    tariff = models.Tariff(name="receipt-cache-tariff", price=1, duration_days=30)
+    user = models.User(email="receipt-cache@example.com")
+    db.add_all([tariff, user])
+    db.commit()
+    tariff_id, user_id = tariff.id, user.id
+    db.add(models.Product(product_id="receipt.cache.monthly", tariff_id=tariff_id))
+    db.commit()
+    db.close()
+    catalog.reload()
+
+    calls = []
+
+    def validate(receipt, bundle_id):
+        calls.append(receipt)
+        return {"transaction_id": "receipt-cache-tx", "product_id": "receipt.cache.monthly"}
+
+    monkeypatch.setattr(IapValidator, "validate_apple_receipt", staticmethod(validate))
+    receipt_cache.get_receipt_cache().clear()
+
+    body = {"user_id": user_id, "provider": "apple", "receipt": "cmVjZWlwdC1jYWNoZQ=="}
+    assert client.post("/payments/webhook", json=body).status_code == 200
+    r = client.post("/payments/webhook", json=body)
+    assert r.json()["msg"] == "Payment already processed"
+    assert len(calls) == 1
@@ -0,0 +1,159 @@
+from vpn_api import metrics, models, reconciler, wg_host
+from vpn_api.database import Base, SessionLocal, engine
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _state(peers: dict) -> wg_host.InterfaceState:
+    state = wg_host.InterfaceState(private_key="PRIV")
+    for pub, allowed in peers.items():
+        state.peers[pub] = wg_host.HostPeer(public_key=pub, allowed_ips=allowed)
+    return state
+
+
+def _db_snap(items: dict) -> reconciler.Snapshot:
+    return reconciler.Snapshot(items, reconciler._digest(hash(i) for i in items.items()))
+
+
+def test_diff_by_public_key():
+    db_snap = _db_snap(
+        {
+            "A": (1, None, "10.55.0.1/32", True),
+            "B": (2, "c-b", "10.55.0.2/32", True),
+            "C": (3, None, "10.55.0.3/32", False),
+            "D": (4, "c-gone", "10.55.0.4/32", True),
+        }
+    )
+    iface = reconciler.snapshot_state(
+        _state({"A": "10.55.0.9/32", "C": "10.55.0.3/32", "X": "10.55.0.50/32"})
+    )
+    easy = reconciler.snapshot_clients(
+        [
+            {"id": "c-b", "name": "b", "publicKey": "B"},
+            {"id": "c-orphan", "name": "o", "publicKey": "O"},
+            {"id": "c-nokey", "name": "n", "publicKey": None},
+        ]
+    )
+
+    report = reconciler.diff(db_snap, easy, iface)
+
+    assert report.iface.add == {"B": "10.55.0.2/32", "D": "10.55.0.4/32"}
+    assert report.iface.update == {"A": ("10.55.0.9/32", "10.55.0.1/32")}
+    assert sorted(report.iface.remove) == ["C", "X"]
+    assert sorted(c["id"] for c in report.orphan_clients) == ["c-nokey", "c-orphan"]
+    assert report.missing_clients == [4]
+
+
+def test_unreadable_source_is_skipped_not_pruned():
+    db_snap = _db_snap({"A": (1, "c-a", "10.55.0.1/32", True)})
+    report = reconciler.diff(db_snap, None, None)
+    assert report.iface.empty and report.orphan_clients == [] and report.missing_clients == []
+
+
+def test_cycle_repairs_in_batches_and_skips_unchanged(monkeypatch):
+    db = SessionLocal()
+    db.query(models.OutboxEvent).delete()
+    user = models.User(email="reconciler@example.test")
+    db.add(user)
+    db.commit()
+    db.add(
+        models.VpnPeer(
+            user_id=user.id, wg_private_key="x", wg_public_key="rc-1", wg_ip="10.55.1.1/32"
+        )
+    )
+    db.commit()
+
+    real_snapshot_db = reconciler.snapshot_db
+
+    def only_ours(session):
+        snap = real_snapshot_db(session)
+        return _db_snap({k: v for k, v in snap.items.items() if k.startswith("rc-")})
+
+    live = _state({"rc-stale": "10.55.1.99/32"})
+    applied = []
+    monkeypatch.setattr(reconciler, "snapshot_db", only_ours)
+    monkeypatch.setattr(reconciler, "snapshot_iface", lambda iface: reconciler.snapshot_state(live))
+    monkeypatch.setattr(
+        reconciler,
+        "snapshot_wg_easy",
+        lambda: reconciler.snapshot_clients(
+            [{"id": f"orphan-{i}", "name": "x", "publicKey": f"O{i}"} for i in range(5)]
+        ),
+    )
+    monkeypatch.setattr(wg_host, "WG_APPLY_ENABLED", True)
+    monkeypatch.setattr(wg_host, "apply_diff", lambda diff, state: applied.append(diff))
+    monkeypatch.setattr(reconciler, "WG_RECONCILE_DELETE_ORPHANS", True)
+    monkeypatch.setattr(reconciler, "WG_RECONCILE_BATCH", 2)
+    metrics.reset()
+
+    rec = reconciler.Reconciler()
+    try:
+        report = rec.cycle(db)
+        assert report.summary()["iface_add"] == 1 and report.iface.remove == ["rc-stale"]
+        # all interface changes in one wg call
+        assert len(applied) == 1
+        # orphans get one cycle of grace (their peer row may not be committed yet)
+        deletes = db.query(models.OutboxEvent).filter_by(kind="wg_easy_delete")
+        assert deletes.count() == 0
+
+        # nothing changed in the sources: the digest short-circuits the diff,
+        # and the orphans, seen twice now, are queued once
+        report = rec.cycle(db)
+        assert report.unchanged and len(applied) == 1
+        assert metrics.get("reconcile_unchanged") == 1
+        assert deletes.count() == 5
+        rec.cycle(db)
+        assert deletes.count() == 5
+
+        live.peers.clear()
+        live.peers["rc-1"] = wg_host.HostPeer("rc-1", "10.55.1.1/32")
+        report = rec.cycle(db)
+        assert not report.unchanged and report.iface.empty
+    finally:
+        db.query(models.OutboxEvent).delete()
+        db.query(models.VpnPeer).filter(models.VpnPeer.wg_public_key == "rc-1").delete()
+        db.delete(user)
+        db.commit()
+        db.close()
+
+
+def test_sources_are_read_before_the_database(monkeypatch):
+    reads = []
+    monkeypatch.setattr(reconciler, "snapshot_db", lambda db: reads.append("db") or _db_snap({}))
+    monkeypatch.setattr(
+        reconciler,
+        "snapshot_iface",
+        lambda iface: reads.append("iface") or reconciler.snapshot_state(_state({})),
+    )
+    monkeypatch.setattr(
+        reconciler,
+        "snapshot_wg_easy",
+        lambda: reads.append("wg-easy") or reconciler.snapshot_clients([]),
+    )
+    reconciler.Reconciler().cycle(None, dry_run=True)
+    assert reads == ["wg-easy", "iface", "db"]
+
+
+def test_orphan_that_gets_its_peer_row_is_not_deleted(monkeypatch):
+    client = {"id": "inflight", "name": "n", "publicKey": "INFLIGHT"}
+    rows = {}
+    queued = []
+    monkeypatch.setattr(reconciler, "snapshot_db", lambda db: _db_snap(dict(rows)))
+    monkeypatch.setattr(reconciler, "snapshot_iface", lambda iface: None)
+    monkeypatch.setattr(
+        reconciler, "snapshot_wg_easy", lambda: reconciler.snapshot_clients([client])
+    )
+    monkeypatch.setattr(reconciler, "WG_RECONCILE_DELETE_ORPHANS", True)
+    monkeypatch.setattr(
+        reconciler.outbox, "enqueue", lambda db, kind, key, payload: queued.append(key)
+    )
+    monkeypatch.setattr(reconciler.outbox, "notify", lambda: None)
+
+    rec = reconciler.Reconciler()
+    assert [c["id"] for c in rec.cycle(None).orphan_clients] == ["inflight"]
+    # create_peer commits its row before the next cycle
+    rows["INFLIGHT"] = (1, "inflight", "10.0.0.2/32", True)
+    assert rec.cycle(None).orphan_clients == []
+    assert queued == []
@@ -0,0 +1,170 @@
+import os
+import stat
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+from vpn_api import metrics, ssh_pool, wg_host
+
+# Stand-in for ssh: "-M" creates the control socket file, "-O check/exit"
+# test/remove it, anything else runs the remote command locally. Every
+# invocation is logged as "master", "check", "exit", "mux" or "direct";
+# a leading "sudo" in the remote command is dropped.
+FAKE_SSH = textwrap.dedent(
+    """\
+    import os, subprocess, sys
+
+    args = sys.argv[1:]
+    control, rest = None, []
+    i = 0
+    while i < len(args):
+        if args[i] == "-o":
+            key, _, value = args[i + 1].partition("=")
+            if key == "ControlPath":
+                control = value
+            i += 2
+        else:
+            rest.append(args[i])
+            i += 1
+
+    def log(kind):
+        with open(os.environ["FAKE_SSH_LOG"], "a") as f:
+            f.write(kind + "\\n")
+
+    if "-M" in rest:
+        log("master")
+        if os.environ.get("FAKE_SSH_DOWN"):
+            sys.exit(255)
+        open(control, "w").close()
+    elif "-O" in rest:
+        op = rest[rest.index("-O") + 1]
+        log(op)
+        alive = control and os.path.exists(control)
+        if op == "exit" and alive:
+            os.remove(control)
+        sys.exit(0 if alive else 255)
+    else:
+        if control and not os.path.exists(control):
+            log("mux-broken")
+            sys.exit(255)
+        log("mux" if control else "direct")
+        remote = rest[-1].removeprefix("sudo ")
+        sys.exit(subprocess.run(remote, shell=True).returncode)
+    """
+)
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    binary = tmp_path / "ssh"
+    binary.write_text(f"#!{sys.executable}\n" + FAKE_SSH)
+    binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+    log = tmp_path / "ssh.log"
+    monkeypatch.setenv("FAKE_SSH_LOG", str(log))
+    monkeypatch.setattr(ssh_pool, "WG_SSH_BINARY", str(binary))
+    metrics.reset()
+
+    def calls():
+        return log.read_text().split() if log.exists() else []
+
+    return tmp_path / "ctl", calls
+
+
+def test_commands_share_one_master(fake_ssh):
+    control_dir, calls = fake_ssh
+    pool = ssh_pool.SshPool(control_dir=str(control_dir))
+    for _ in range(3):
+        proc = pool.run("root@host", ["ssh", "root@host", "echo hi"], capture_output=True)
+        assert proc.returncode == 0 and proc.stdout.strip() == b"hi"
+    assert calls() == ["master", "mux", "mux", "mux"]
+    assert metrics.get("ssh_connects") == 1
+    assert metrics.get("ssh_commands") == 3
+    pool.close()
+    assert calls()[-1] == "exit"
+
+
+def test_reconnects_when_master_dies(fake_ssh):
+    control_dir, calls = fake_ssh
+    master = ssh_pool.SshMaster("root@host", control_dir=str(control_dir), check_interval=3600)
+    assert master.run(["ssh", "root@host", "true"]).returncode == 0
+    os.remove(master.control_path)
+
+    # cached health says "up": the command fails with 255, the pool
+    # re-checks, starts a new master and retries once
+    assert master.run(["ssh", "root@host", "true"]).returncode == 0
+    assert calls() == ["master", "mux", "mux-broken", "master", "mux"]
+    assert metrics.get("ssh_reconnects") == 1
+    assert metrics.get("ssh_retries") == 1
+
+
+def test_falls_back_to_plain_ssh(fake_ssh, monkeypatch):
+    control_dir, calls = fake_ssh
+    monkeypatch.setenv("FAKE_SSH_DOWN", "1")
+    master = ssh_pool.SshMaster("root@host", control_dir=str(control_dir))
+    with pytest.raises(subprocess.CalledProcessError):
+        master.run(["ssh", "root@host", "exit 3"], check=True)
+    assert calls() == ["master", "direct"]
+    assert metrics.get("ssh_connect_failures") == 1
+
+
+def test_per_host_session_limit(fake_ssh):
+    control_dir, _calls = fake_ssh
+    master = ssh_pool.SshMaster("root@host", control_dir=str(control_dir), max_sessions=2)
+    master.ensure()
+    threads = [
+        threading.Thread(target=master.run, args=(["ssh", "root@host", "sleep 0.3"],))
+        for _ in range(4)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 4 commands, 2 at a time
+    assert time.perf_counter() - start >= 0.6
+    assert metrics.get("ssh_wait_seconds") > 0
+
+
+def test_wg_host_uses_pool(fake_ssh, monkeypatch):
+    control_dir, calls = fake_ssh
+    monkeypatch.setattr(ssh_pool, "_pool", ssh_pool.SshPool(control_dir=str(control_dir)))
+    monkeypatch.setattr(wg_host, "WG_APPLY_ENABLED", True)
+    monkeypatch.setattr(wg_host, "WG_HOST_SSH", "root@host")
+    monkeypatch.setattr(wg_host, "WG_APPLY_SCRIPT", "true")
+    monkeypatch.setattr(wg_host, "WG_REMOVE_SCRIPT", "true")
+
+    class P:
+        wg_public_key = "pk"
+        allowed_ips = "10.8.0.2/32"
+
+    assert wg_host.apply_peer(P()) is True
+    assert wg_host.remove_peer(P()) is True
+    assert calls() == ["master", "mux", "mux"]
+
+
+def test_default_control_dir_is_private_per_process(monkeypatch):
+    monkeypatch.setattr(ssh_pool, "WG_SSH_CONTROL_DIR", None)
+    master = ssh_pool.SshMaster("root@host")
+    control_dir = os.path.dirname(master.control_path)
+    try:
+        st = os.stat(control_dir)
+        assert stat.S_IMODE(st.st_mode) == 0o700
+        assert st.st_uid == os.getuid()
+        assert os.path.basename(master.control_path).endswith(f"-{os.getpid()}")
+        assert os.path.dirname(ssh_pool.SshMaster("root@other").control_path) == control_dir
+    finally:
+        ssh_pool.shutdown()
+    assert not os.path.exists(control_dir)
+
+
+def test_shared_control_dir_is_not_used(fake_ssh):
+    control_dir, calls = fake_ssh
+    control_dir.mkdir()
+    control_dir.chmod(0o777)
+    master = ssh_pool.SshMaster("root@host", control_dir=str(control_dir))
+    assert master.run(["ssh", "root@host", "true"]).returncode == 0
+    assert calls() == ["direct"]
@@ -0,0 +1,78 @@
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from vpn_api import auth, revocation
+from vpn_api.database import engine
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture(autouse=True)
+def stateless(monkeypatch):
+    monkeypatch.setattr(auth, "AUTH_MODE", "stateless")
+    revocation.reset()
+    yield
+    revocation.reset()
+
+
+def _login(email: str) -> dict:
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    r = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    assert r.status_code == 200
+    return r.json()
+
+
+def test_authenticated_read_does_not_query_users():
+    tokens = _login("stateless-read@example.com")
+    assert tokens["refresh_token"]
+
+    # the dependency never touches the session
+    user = auth.get_current_user(tokens["access_token"], db=None)
+    assert isinstance(user, auth.TokenUser)
+    assert user.status == "active" and not user.is_admin
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        r = client.get("/vpn_peers/", headers={"Authorization": f"Bearer {tokens['access_token']}"})
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert r.status_code == 200
+    assert not any("FROM users" in s for s in statements)
+
+
+def test_refresh_token_is_not_an_access_token():
+    tokens = _login("stateless-refresh@example.com")
+    with pytest.raises(HTTPException) as exc:
+        auth.get_current_user(tokens["refresh_token"], db=None)
+    assert exc.value.status_code == 401
+
+    r = client.post("/auth/refresh", json={"refresh_token": tokens["access_token"]})
+    assert r.status_code == 401
+    r = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert r.status_code == 200
+    assert auth.get_current_user(r.json()["access_token"], db=None).email == (
+        "stateless-refresh@example.com"
+    )
+
+
+def test_promotion_revokes_old_tokens_until_refresh():
+    tokens = _login("stateless-promote@example.com")
+    old = {"Authorization": f"Bearer {tokens['access_token']}"}
+    user_id = client.get("/auth/me", headers=old).json()["id"]
+
+    r = client.post(f"/auth/admin/promote?user_id={user_id}&secret=bootstrap-secret")
+    assert r.status_code == 200
+    assert client.get("/vpn_peers/", headers=old).status_code == 401
+
+    # the refresh re-reads the user, so the new token carries the admin flag
+    r = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert r.status_code == 200
+    assert auth.get_current_user(r.json()["access_token"], db=None).is_admin
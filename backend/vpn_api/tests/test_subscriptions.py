@@ -0,0 +1,142 @@
+from datetime import UTC, datetime, timedelta
+
+from fastapi.testclient import TestClient
+
+from vpn_api import catalog, models, subscriptions
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.iap_validator import IapValidator
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _login(email: str) -> dict:
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    r = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+def _tariff(name: str, days: int = 30) -> int:
+    db = SessionLocal()
+    tariff = models.Tariff(name=name, price=5, duration_days=days)
+    db.add(tariff)
+    db.commit()
+    tariff_id = tariff.id
+    db.close()
+    catalog.reload()
+    return tariff_id
+
+
+def _state(email: str):
+    db = SessionLocal()
+    user = db.query(models.User).filter_by(email=email).one()
+    state = (user.id, user.active_tariff_id, user.active_until)
+    db.close()
+    return state
+
+
+def test_subscribe_materializes_state():
+    email = "sub-state@example.com"
+    headers = _login(email)
+    assert client.get("/auth/me/subscription", headers=headers).json() is None
+
+    tariff_id = _tariff("sub-state-tariff", days=30)
+    r = client.post("/auth/subscribe", json={"tariff_id": tariff_id}, headers=headers)
+    assert r.status_code == 200
+    _uid, active_tariff_id, active_until = _state(email)
+    assert active_tariff_id == tariff_id
+    assert active_until is not None
+
+    sub = client.get("/auth/me/subscription", headers=headers).json()
+    assert sub["tariff_id"] == tariff_id
+    assert sub["days_remaining"] in (29, 30)
+    assert not sub["is_lifetime"]
+
+    r = client.post("/auth/subscribe", json={"tariff_id": tariff_id}, headers=headers)
+    assert r.json()["detail"] == "already_has_active_subscription"
+
+
+def test_expired_subscription_is_not_reported():
+    email = "sub-expired@example.com"
+    headers = _login(email)
+    tariff_id = _tariff("sub-expired-tariff")
+    db = SessionLocal()
+    user = db.query(models.User).filter_by(email=email).one()
+    past = datetime.now(UTC) - timedelta(days=1)
+    db.add(
+        models.UserTariff(
+            user_id=user.id,
+            tariff_id=tariff_id,
+            started_at=past - timedelta(days=30),
+            ended_at=past,
+            status="active",
+        )
+    )
+    subscriptions.refresh(db, user.id)
+    db.commit()
+    db.close()
+
+    # the row still says "active", but it has ended
+    assert client.get("/auth/me/subscription", headers=headers).json() is None
+    assert _state(email)[1] is None
+    r = client.post("/vpn_peers/self", json={"device_name": "phone"}, headers=headers)
+    assert r.status_code == 403
+
+
+def test_deadline_passes_without_a_write():
+    now = datetime.now(UTC)
+    assert subscriptions.is_active(1, None, now)
+    assert subscriptions.is_active(1, now + timedelta(seconds=1), now)
+    assert not subscriptions.is_active(1, now, now)
+    assert not subscriptions.is_active(None, None, now)
+
+
+def test_lifetime_wins_over_dated():
+    db = SessionLocal()
+    user = models.User(email="sub-lifetime@example.com")
+    db.add(user)
+    db.commit()
+    monthly, lifetime = _tariff("sub-monthly"), _tariff("sub-lifetime")
+    now = datetime.now(UTC)
+    db.add(models.UserTariff(user_id=user.id, tariff_id=monthly, ended_at=now + timedelta(30)))
+    db.add(models.UserTariff(user_id=user.id, tariff_id=lifetime, started_at=now))
+    subscriptions.refresh(db, user.id)
+    db.commit()
+    assert subscriptions.active_state(db, user.id) == (lifetime, None)
+    db.close()
+
+
+def test_webhook_updates_state(monkeypatch):
+    email = "sub-webhook@example.com"
+    headers = _login(email)
+    tariff_id = _tariff("sub-webhook-tariff")
+    user_id = _state(email)[0]
+    monkeypatch.setattr(
+        IapValidator,
+        "validate_apple_receipt",
+        staticmethod(
+            lambda receipt, bundle_id: {
+                "transaction_id": "sub-webhook-tx",
+                "product_id": "sub-webhook.monthly",
+                "purchase_date": None,
+            }
+        ),
+    )
+    db = SessionLocal()
+    db.add(models.Product(product_id="sub-webhook.monthly", tariff_id=tariff_id))
+    db.commit()
+    db.close()
+    catalog.reload()
+
+    body = {"user_id": user_id, "provider": "apple", "receipt": "cmVjZWlwdA=="}
+    r = client.post("/payments/webhook", json=body)
+    assert r.status_code == 200
+    assert _state(email)[1] == tariff_id
+    assert client.get("/auth/me/subscription", headers=headers).json()["tariff_id"] == tariff_id
+
+    r = client.post("/payments/webhook", json=body)
+    assert r.json()["msg"] == "Payment already processed"
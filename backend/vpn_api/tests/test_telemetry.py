@@ -0,0 +1,163 @@
+import time
+
+from fastapi.testclient import TestClient
+
+from vpn_api import metrics, models, telemetry, wg_host
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.main import app
+
+client = TestClient(app)
+
+DUMP = (
+    "wg0\tPRIV\tPUB\t51820\toff\n"
+    "wg0\tpk-a\t(none)\t1.2.3.4:5\t10.44.0.1/32\t1700000000\t100\t200\t25\n"
+    "wg0\tpk-b\t(none)\t(none)\t10.44.0.2/32\t0\t0\t0\toff\n"
+    "wg1\tPRIV1\tPUB1\t51821\t0x1\n"
+    "wg1\tpk-c\tPSK\t(none)\t10.45.0.1/32\t1700000001\t7\t8\toff\n"
+)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+def _peer(db, email: str, pub: str, ip: str):
+    user = models.User(email=email)
+    db.add(user)
+    db.commit()
+    peer = models.VpnPeer(user_id=user.id, wg_private_key="x", wg_public_key=pub, wg_ip=ip)
+    db.add(peer)
+    db.commit()
+    return user, peer
+
+
+def test_parse_all_dump_splits_interfaces():
+    states = wg_host.parse_all_dump(DUMP)
+    assert sorted(states) == ["wg0", "wg1"]
+    assert states["wg0"].listen_port == "51820"
+    a = states["wg0"].peers["pk-a"]
+    assert (a.rx_bytes, a.tx_bytes, a.latest_handshake) == (100, 200, 1700000000)
+    assert states["wg1"].peers["pk-c"].preshared_key == "PSK"
+
+
+def test_deltas_baseline_and_counter_reset():
+    metrics.reset()
+    c = telemetry.Collector()
+    assert c.deltas({"k": (100, 50, 1)}) == {}
+    assert c.deltas({"k": (150, 50, 2)}) == {"k": (50, 0, 2)}
+    # interface restarted: the counter starts again from zero
+    assert c.deltas({"k": (30, 10, 3)}) == {"k": (30, 10, 3)}
+    assert metrics.get("telemetry_counter_resets") == 1
+    # a peer that disappears starts from a new baseline when it comes back
+    c.deltas({})
+    assert c.deltas({"k": (500, 500, 4)}) == {}
+
+
+def test_collect_keeps_unmanaged_keys_and_baseline_on_failure(monkeypatch):
+    db = SessionLocal()
+    _, peer = _peer(db, "telemetry-cache@example.test", "tm-cache", "10.44.3.1/32")
+    metrics.reset()
+    c = telemetry.Collector()
+    c.collect(db, {"tm-cache": (0, 0, 0), "manual": (0, 0, 0)}, now=1_700_000_000)
+    for i in range(1, 4):
+        c.collect(db, {"tm-cache": (i, i, 0), "manual": (i, i, 0)}, now=1_700_000_000 + i)
+    # loaded once at start and once for the unknown key, not on every cycle
+    assert metrics.get("telemetry_peer_loads") == 2
+
+    def failing(db, rows):
+        raise RuntimeError("database is down")
+
+    real_upsert = telemetry._upsert_add
+    monkeypatch.setattr(telemetry, "_upsert_add", failing)
+    try:
+        c.collect(db, {"tm-cache": (10, 10, 0)}, now=1_700_000_100)
+    except RuntimeError:
+        db.rollback()
+    monkeypatch.setattr(telemetry, "_upsert_add", real_upsert)
+
+    # a deleted peer still in the map: the FK error evicts it, other rows are kept
+    calls = []
+
+    def fk_once(db, rows):
+        calls.append([r["peer_id"] for r in rows])
+        if len(calls) == 1:
+            raise telemetry.IntegrityError("INSERT", {}, Exception("FOREIGN KEY"))
+        real_upsert(db, rows)
+
+    c._peers["tm-gone"] = (10**9, 10**9)
+    c._last["tm-gone"] = (0, 0)
+    monkeypatch.setattr(telemetry, "_upsert_add", fk_once)
+    assert c.collect(db, {"tm-cache": (20, 20, 0), "tm-gone": (5, 5, 0)}, now=1_700_000_200) == 1
+    assert calls == [[peer.id, 10**9], [peer.id]]
+    # the failed interval was not lost: 3 + 17 bytes after the baseline of 3
+    rows = db.query(models.PeerUsage).filter_by(peer_id=peer.id).all()
+    assert sum(r.rx_bytes for r in rows) == 20
+    db.close()
+
+
+def test_collect_and_rollup_preserve_totals():
+    db = SessionLocal()
+    user, peer = _peer(db, "telemetry-rollup@example.test", "tm-1", "10.44.1.1/32")
+    c = telemetry.Collector()
+    t0 = 1_700_000_000 - 1_700_000_000 % telemetry.DAY
+    c.collect(db, {"tm-1": (0, 0, 0)}, now=t0)
+    # three minutes in the first hour, one in the second, one in the next day
+    for i, ts in enumerate((t0 + 60, t0 + 61, t0 + 600, t0 + 3700, t0 + telemetry.DAY + 5)):
+        c.collect(db, {"tm-1": (1000 * (i + 1), 10 * (i + 1), int(ts))}, now=ts)
+
+    rows = db.query(models.PeerUsage).filter_by(peer_id=peer.id).all()
+    # t0 + 60 and t0 + 61 share a minute bucket
+    assert len(rows) == 4
+    assert sum(r.rx_bytes for r in rows) == 5000
+
+    moved = telemetry.rollup(db, now=t0 + 40 * telemetry.DAY)
+    assert moved >= 4
+    rows = db.query(models.PeerUsage).filter_by(peer_id=peer.id).all()
+    assert {r.resolution for r in rows} == {telemetry.DAY}
+    assert len(rows) == 2
+    assert sum(r.rx_bytes for r in rows) == 5000
+    assert sum(r.tx_bytes for r in rows) == 50
+
+    since = telemetry.floor_time(t0, telemetry.DAY)
+    until = telemetry.floor_time(t0 + 2 * telemetry.DAY, telemetry.DAY)
+    usage = telemetry.usage_for_user(db, user.id, since, until, "1d")
+    assert (usage["rx_bytes"], usage["tx_bytes"]) == (5000, 50)
+    assert [p["rx_bytes"] for p in usage["series"]] == [4000, 1000]
+    assert usage["peers"][0]["last_handshake"] is not None
+    db.close()
+
+
+def _login(email: str) -> dict:
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    token = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    return {"Authorization": f"Bearer {token.json()['access_token']}"}
+
+
+def test_usage_endpoint_scopes_to_current_user():
+    headers = _login("telemetry-api@example.com")
+    other = _login("telemetry-other@example.com")
+    db = SessionLocal()
+    user = db.query(models.User).filter_by(email="telemetry-api@example.com").one()
+    peer = models.VpnPeer(
+        user_id=user.id, wg_private_key="x", wg_public_key="tm-api", wg_ip="10.44.2.1/32"
+    )
+    db.add(peer)
+    db.commit()
+    peer_id, user_id = peer.id, user.id
+    c = telemetry.Collector()
+    now = time.time()
+    c.collect(db, {"tm-api": (0, 0, 0)}, now=now - 120)
+    c.collect(db, {"tm-api": (4096, 1024, int(now))}, now=now - 60)
+    db.close()
+
+    r = client.get("/vpn_peers/usage?step=1m", headers=headers)
+    assert r.status_code == 200
+    data = r.json()
+    assert (data["rx_bytes"], data["tx_bytes"]) == (4096, 1024)
+    assert data["peers"][0]["peer_id"] == peer_id
+    assert len(data["series"]) == 1
+
+    assert client.get("/vpn_peers/usage", headers=other).json()["rx_bytes"] == 0
+    r = client.get(f"/vpn_peers/usage?user_id={user_id}", headers=other)
+    assert r.status_code == 403
+    assert client.get("/vpn_peers/usage?step=5m", headers=headers).status_code == 400
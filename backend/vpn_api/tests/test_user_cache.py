@@ -0,0 +1,66 @@
+from datetime import UTC, datetime
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+
+from vpn_api import metrics, user_cache
+from vpn_api.main import app
+
+client = TestClient(app)
+
+
+def _user(email: str, **kw):
+    fields = {
+        "id": 1,
+        "email": email,
+        "status": "active",
+        "is_admin": False,
+        "is_verified": True,
+        "google_id": None,
+        "created_at": datetime.now(UTC),
+    }
+    return SimpleNamespace(**{**fields, **kw})
+
+
+def test_lru_ttl_and_counters():
+    metrics.reset()
+    cache = user_cache.UserCache(size=2, ttl=60)
+    assert cache.get("a@x") is None
+    cache.put(_user("a@x"))
+    cache.put(_user("b@x"))
+    assert cache.get("a@x").email == "a@x"
+    # b is now the least recently used entry
+    cache.put(_user("c@x"))
+    assert cache.get("b@x") is None
+    assert cache.get("c@x") is not None
+    assert (metrics.get("auth_cache_hits"), metrics.get("auth_cache_misses")) == (2, 2)
+
+    cache.ttl = -1
+    cache.put(_user("d@x"))
+    assert cache.get("d@x") is None
+
+
+def test_epoch_bump_clears_other_caches(monkeypatch, tmp_path):
+    monkeypatch.setattr(user_cache, "AUTH_CACHE_EPOCH_FILE", str(tmp_path / "epoch"))
+    monkeypatch.setattr(user_cache, "AUTH_CACHE_EPOCH_CHECK", 0)
+    cache = user_cache.UserCache(size=10, ttl=60)
+    cache.put(_user("e@x"))
+    user_cache.bump_epoch()
+    assert cache.get("e@x") is None
+
+
+def test_promote_is_visible_on_the_next_request():
+    email = "cache-promote@example.com"
+    client.post("/auth/register", json={"email": email, "password": "testpass123"})
+    token = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+    headers = {"Authorization": f"Bearer {token.json()['access_token']}"}
+
+    me = client.get("/auth/me", headers=headers).json()
+    assert me["is_admin"] is False
+    before = metrics.get("auth_cache_hits")
+    client.get("/auth/me", headers=headers)
+    assert metrics.get("auth_cache_hits") == before + 1
+
+    r = client.post(f"/auth/admin/promote?user_id={me['id']}&secret=bootstrap-secret")
+    assert r.status_code == 200
+    assert client.get("/auth/me", headers=headers).json()["is_admin"] is True
@@ -0,0 +1,118 @@
+import asyncio
+import types
+
+import pytest
+
+from vpn_api.wg_easy_adapter import ClientIndex, WgEasyAdapter
+
+
+class StubWg:
+    def __init__(self, url, password, session=None, return_body=True, preload=0):
+        self.return_body = return_body
+        self.list_calls = 0
+        self._clients = [
+            types.SimpleNamespace(id=f"old-{i}", name=f"old-{i}", publicKey=f"pk-old-{i}")
+            for i in range(preload)
+        ]
+
+    async def create_client(self, name):
+        c = types.SimpleNamespace(
+            id=f"cid-{len(self._clients)}", name=name, publicKey=f"pk-{len(self._clients)}"
+        )
+        self._clients.append(c)
+        return c if self.return_body else None
+
+    async def get_clients(self):
+        self.list_calls += 1
+        await asyncio.sleep(0)
+        return list(self._clients)
+
+    async def delete_client(self, client_id):
+        self._clients = [c for c in self._clients if c.id != client_id]
+
+
+def _adapter(monkeypatch, **kw):
+    monkeypatch.setattr(
+        "vpn_api.wg_easy_adapter.WgEasy",
+        lambda url, password, session=None: StubWg(url, password, **kw),
+    )
+    return WgEasyAdapter("http://wg", "pw")
+
+
+@pytest.mark.asyncio
+async def test_create_uses_response_body_without_listing(monkeypatch):
+    async with _adapter(monkeypatch, preload=1000) as adapter:
+        for i in range(20):
+            res = await adapter.create_client(f"n{i}")
+            assert res["publicKey"]
+        assert adapter._wg.list_calls == 0
+        assert adapter.index.by_name["n5"][0]["id"] == "cid-1005"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_creates_share_one_listing(monkeypatch):
+    async with _adapter(monkeypatch, return_body=False) as adapter:
+        results = await asyncio.gather(*(adapter.create_client(f"c{i}") for i in range(10)))
+        assert {r["id"] for r in results} == {f"cid-{i}" for i in range(10)}
+        assert adapter._wg.list_calls < 10
+
+
+class SlowListingWg(StubWg):
+    """Listings snapshot the clients when they start and answer later."""
+
+    creates = 0
+
+    async def create_client(self, name):
+        SlowListingWg.creates += 1
+        if name == "late":
+            # finishes after the other create's listing has started
+            await asyncio.sleep(0.01)
+        return await super().create_client(name)
+
+    async def get_clients(self):
+        self.list_calls += 1
+        snapshot = list(self._clients)
+        await asyncio.sleep(0.05)
+        return snapshot
+
+
+@pytest.mark.asyncio
+async def test_create_after_stale_shared_listing_does_not_duplicate(monkeypatch):
+    SlowListingWg.creates = 0
+    monkeypatch.setattr(
+        "vpn_api.wg_easy_adapter.WgEasy",
+        lambda url, password, session=None: SlowListingWg(url, password, return_body=False),
+    )
+    async with WgEasyAdapter("http://wg", "pw") as adapter:
+        early, late = await asyncio.gather(
+            adapter.create_client("early"), adapter.create_client("late")
+        )
+        assert (early["id"], late["id"]) == ("cid-0", "cid-1")
+        assert SlowListingWg.creates == 2
+        assert len(adapter._wg._clients) == 2
+
+
+@pytest.mark.asyncio
+async def test_duplicate_name_resolves_to_new_client(monkeypatch):
+    async with _adapter(monkeypatch, return_body=False) as adapter:
+        first = await adapter.create_client("phone")
+        second = await adapter.create_client("phone")
+        assert first["id"] != second["id"]
+
+
+@pytest.mark.asyncio
+async def test_get_client_and_delete_use_index(monkeypatch):
+    async with _adapter(monkeypatch, preload=5) as adapter:
+        assert (await adapter.get_client("old-3"))["publicKey"] == "pk-old-3"
+        assert (await adapter.get_client("old-4"))["name"] == "old-4"
+        assert adapter._wg.list_calls == 1
+        await adapter.delete_client("old-3")
+        assert "old-3" not in adapter.index.by_id
+        assert "old-3" not in adapter.index.by_name
+
+
+def test_index_ttl_expiry():
+    idx = ClientIndex(ttl=0)
+    idx.replace([{"id": "a", "name": "x", "publicKey": "k"}])
+    assert not idx.fresh()
+    assert idx.find("x")["id"] == "a"
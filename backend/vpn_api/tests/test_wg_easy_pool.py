@@ -0,0 +1,133 @@
+import os
+import threading
+
+import pytest
+
+from vpn_api import models, peers, schemas, wg_easy_pool
+from vpn_api.database import Base, SessionLocal, engine
+from vpn_api.wg_easy_adapter import WgEasyHTTPError
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+_instances: list = []
+
+
+class FakeWg:
+    def __init__(self, url, password, session=None):
+        self.logins = 0
+        self.logouts = 0
+        self.fail_next = 0
+        self.fail_after_create = 0
+        self.threads = set()
+        self._clients = []
+        _instances.append(self)
+
+    async def login(self):
+        self.logins += 1
+
+    async def logout(self):
+        self.logouts += 1
+
+    async def create_client(self, name):
+        self.threads.add(threading.get_ident())
+        if self.fail_next:
+            self.fail_next -= 1
+            raise WgEasyHTTPError(401, "session expired")
+        self._clients.append({"name": name, "id": f"cid-{len(self._clients)}"})
+        if self.fail_after_create:
+            # the client exists, but the session expired before the answer
+            self.fail_after_create -= 1
+            raise WgEasyHTTPError(401, "session expired")
+
+    async def get_clients(self):
+        return [type("C", (), {**c, "publicKey": "pk"})() for c in self._clients]
+
+    async def delete_client(self, client_id):
+        self._clients = [c for c in self._clients if c["id"] != client_id]
+
+    async def get_client_config(self, client_id):
+        return b"[Interface]\nPrivateKey = PRIV\nAddress = 10.8.0.50/32\n"
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    _instances.clear()
+    monkeypatch.setattr("vpn_api.wg_easy_adapter.WgEasy", FakeWg)
+    p = wg_easy_pool.WgEasyPool(timeout=5)
+    yield p
+    p.close()
+
+
+def test_login_is_cached_across_calls(pool):
+    for i in range(5):
+        res = pool.run("http://wg", "pw", lambda a, i=i: a.create_client(f"n{i}"))
+        assert res["id"] == f"cid-{i}"
+    assert len(_instances) == 1
+    wg = _instances[0]
+    assert wg.logins == 1
+    assert wg.logouts == 0
+    # all operations ran on the single pool loop thread
+    assert len(wg.threads) == 1
+
+
+def test_reauth_only_on_401(pool):
+    pool.run("http://wg", "pw", lambda a: a.create_client("first"))
+    wg = _instances[0]
+    wg.fail_next = 1
+    res = pool.run("http://wg", "pw", lambda a: a.create_client("second"))
+    assert res["id"] == "cid-1"
+    assert wg.logins == 2
+
+
+def test_create_interrupted_by_401_is_not_duplicated(pool, monkeypatch):
+    monkeypatch.setattr(peers, "get_wg_easy_pool", lambda: pool)
+    peers._create_wg_easy_client("http://wg", "pw", "dup")
+    wg = _instances[0]
+    wg.fail_after_create = 1
+    res = peers._create_wg_easy_client("http://wg", "pw", "dup")
+    # the retry found the client the interrupted call made instead of adding a third
+    assert [c["id"] for c in wg._clients] == ["cid-0", "cid-1"]
+    assert res["id"] == "cid-1"
+    assert wg.logins == 2
+
+
+def test_close_logs_out(pool):
+    pool.run("http://wg", "pw", lambda a: a.create_client("x"))
+    pool.close()
+    assert _instances[0].logouts == 1
+
+
+def test_create_peer_fetches_controller_config_once(monkeypatch):
+    from cryptography.fernet import Fernet
+
+    if not os.getenv("CONFIG_ENCRYPTION_KEY"):
+        monkeypatch.setenv("CONFIG_ENCRYPTION_KEY", Fernet.generate_key().decode())
+    monkeypatch.setenv("WG_KEY_POLICY", "wg-easy")
+    monkeypatch.setenv("WG_EASY_URL", "http://wg")
+    monkeypatch.setenv("WG_EASY_PASSWORD", "pw")
+    fetches = []
+
+    def fake_config(url, password, client_id):
+        fetches.append(client_id)
+        return b"[Interface]\nPrivateKey = PRIV\nAddress = 10.8.7.51/32\n"
+
+    monkeypatch.setattr(
+        peers, "_create_wg_easy_client", lambda u, p, n: {"id": "cid-once", "publicKey": "pk-once"}
+    )
+    monkeypatch.setattr(peers, "_get_wg_easy_client_config", fake_config)
+
+    db = SessionLocal()
+    try:
+        user = models.User(email="wg-once@example.test")
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+        peer = peers.create_peer(schemas.VpnPeerCreate(user_id=user.id), db=db, current_user=user)
+        assert fetches == ["cid-once"]
+        assert peer.wg_ip == "10.8.7.51/32"
+        assert peer.wg_config_encrypted
+    finally:
+        db.close()
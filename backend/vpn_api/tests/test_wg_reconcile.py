@@ -0,0 +1,185 @@
+import json
+import os
+import stat
+import sys
+import textwrap
+
+import pytest
+
+from vpn_api import models, wg_host
+from vpn_api.database import Base, SessionLocal, engine
+
+# Stand-in for the wg binary: keeps interface state in a JSON file and logs
+# every invocation so tests can count round trips.
+FAKE_WG = textwrap.dedent(
+    """\
+    import json, os, sys
+
+    state_path = os.environ["FAKE_WG_STATE"]
+    with open(state_path) as f:
+        state = json.load(f)
+    with open(state_path + ".log", "a") as f:
+        f.write(" ".join(sys.argv[1:2]) + "\\n")
+
+    args = sys.argv[1:]
+    if args[0] == "show" and args[2] == "dump":
+        print("\\t".join([state["private"], "PUB", "51820", "off"]))
+        for pub, allowed in state["peers"].items():
+            print("\\t".join([pub, "(none)", "(none)", allowed or "(none)", "0", "0", "0", "off"]))
+    elif args[0] == "syncconf":
+        peers, pub = {}, None
+        for line in open(args[2]).read().splitlines():
+            key, _, value = (part.strip() for part in line.partition("="))
+            if key == "PrivateKey":
+                assert value == state["private"], "interface key lost"
+            elif key == "PublicKey":
+                pub = value
+                peers[pub] = ""
+            elif key == "AllowedIPs":
+                peers[pub] = value
+        state["peers"] = peers
+    elif args[0] == "set":
+        rest = args[2:]
+        while rest:
+            assert rest[0] == "peer"
+            pub = rest[1]
+            if rest[2] == "remove":
+                state["peers"].pop(pub, None)
+                rest = rest[3:]
+            else:
+                state["peers"][pub] = rest[3]
+                rest = rest[4:]
+    else:
+        sys.exit("unsupported: " + " ".join(args))
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+    """
+)
+
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+
+@pytest.fixture
+def fake_wg(tmp_path, monkeypatch):
+    binary = tmp_path / "wg"
+    binary.write_text(f"#!{sys.executable}\n" + FAKE_WG)
+    binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+    state_path = tmp_path / "state.json"
+
+    def set_state(peers):
+        state_path.write_text(json.dumps({"private": "SERVERPRIV", "peers": peers}))
+
+    def get_state():
+        return json.loads(state_path.read_text())["peers"]
+
+    def calls():
+        log = tmp_path / "state.json.log"
+        return log.read_text().split() if log.exists() else []
+
+    monkeypatch.setenv("FAKE_WG_STATE", str(state_path))
+    monkeypatch.setattr(wg_host, "WG_BINARY", str(binary))
+    monkeypatch.setattr(wg_host, "WG_HOST_SSH", None)
+    set_state({})
+    return set_state, get_state, calls
+
+
+@pytest.fixture
+def db(monkeypatch):
+    session = SessionLocal()
+    session.query(models.VpnPeer).filter(models.VpnPeer.wg_public_key.like("rec-%")).delete(
+        synchronize_session=False
+    )
+    user = session.query(models.User).filter_by(email="reconcile@example.test").first()
+    if user is None:
+        user = models.User(email="reconcile@example.test")
+        session.add(user)
+        session.commit()
+    for i, active in ((1, True), (2, True), (3, False)):
+        session.add(
+            models.VpnPeer(
+                user_id=user.id,
+                wg_private_key="x",
+                wg_public_key=f"rec-{i}",
+                wg_ip=f"10.66.0.{i}/32",
+                active=active,
+            )
+        )
+    session.commit()
+    # only look at this test's peers
+    real = wg_host.desired_peers
+    monkeypatch.setattr(
+        wg_host,
+        "desired_peers",
+        lambda s: {k: v for k, v in real(s).items() if k.startswith("rec-")},
+    )
+    try:
+        yield session
+    finally:
+        session.query(models.VpnPeer).filter(models.VpnPeer.wg_public_key.like("rec-%")).delete(
+            synchronize_session=False
+        )
+        session.commit()
+        session.close()
+
+
+def test_parse_dump():
+    text = "PRIV\tPUB\t51820\toff\nAAA\t(none)\t1.2.3.4:5\t10.8.0.2/32\t1700000000\t10\t20\toff\n"
+    state = wg_host.parse_dump(text)
+    assert state.private_key == "PRIV" and state.listen_port == "51820" and state.fwmark is None
+    peer = state.peers["AAA"]
+    assert peer.allowed_ips == "10.8.0.2/32"
+    assert (peer.latest_handshake, peer.rx_bytes, peer.tx_bytes) == (1700000000, 10, 20)
+
+
+@pytest.mark.parametrize("method", ["syncconf", "set"])
+def test_reconcile_applies_diff_in_one_call(fake_wg, db, method):
+    set_state, get_state, calls = fake_wg
+    set_state({"rec-1": "10.66.0.9/32", "rec-3": "10.66.0.3/32", "rec-stale": "10.66.0.50/32"})
+
+    diff = wg_host.reconcile(db, method=method)
+
+    assert diff.add == {"rec-2": "10.66.0.2/32"}
+    assert diff.update == {"rec-1": ("10.66.0.9/32", "10.66.0.1/32")}
+    assert sorted(diff.remove) == ["rec-3", "rec-stale"]
+    assert get_state() == {"rec-1": "10.66.0.1/32", "rec-2": "10.66.0.2/32"}
+    # one read, one write
+    assert calls() == ["show", method]
+
+    assert wg_host.reconcile(db, method=method).empty
+    assert calls() == ["show", method, "show"]
+
+
+def test_reconcile_keeps_reserved_and_no_prune(fake_wg, db, monkeypatch):
+    set_state, get_state, _calls = fake_wg
+    monkeypatch.setattr("vpn_api.ipam.WG_IP_RESERVED", "10.66.0.100-10.66.0.110")
+    set_state({"manual": "10.66.0.105/32", "rec-stale": "10.66.0.50/32"})
+
+    diff = wg_host.reconcile(db)
+    assert diff.remove == ["rec-stale"]
+    assert "manual" in get_state()
+
+    set_state({"rec-stale": "10.66.0.50/32"})
+    assert wg_host.reconcile(db, prune=False).remove == []
+    assert "rec-stale" in get_state()
+
+
+def test_cli_dry_run_prints_diff(fake_wg, db, capsys):
+    set_state, get_state, calls = fake_wg
+    set_state({"rec-stale": "10.66.0.50/32"})
+
+    assert wg_host.main(["reconcile", "--dry-run"]) == 0
+
+    out = capsys.readouterr().out.splitlines()
+    assert "+ rec-1 10.66.0.1/32" in out
+    assert "- rec-stale" in out
+    assert out[-1] == "add=2 remove=1 update=0 (dry run)"
+    assert get_state() == {"rec-stale": "10.66.0.50/32"}
+    assert calls() == ["show"]
+
+
+def test_cli_reports_wg_failure(fake_wg, db, capsys, monkeypatch):
+    monkeypatch.setenv("FAKE_WG_STATE", os.devnull + "-missing")
+    assert wg_host.main(["reconcile"]) == 1
+    assert "wg failed" in capsys.readouterr().err
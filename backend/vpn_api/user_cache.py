@@ -0,0 +1,181 @@
+"""Bounded LRU/TTL cache of authenticated users.
+
+``get_current_user`` (db auth mode) used to run one ``users`` query per
+request. The cache maps the token subject (email) to a :class:`UserSnapshot`
+of the row for ``AUTH_CACHE_TTL`` seconds, holding at most
+``AUTH_CACHE_SIZE`` users (least recently used evicted first).
+
+Write paths that change a user call :func:`invalidate`, which drops the
+entry in the calling process. Rare changes that must reach every worker
+(promotion, deletion by ``scripts/delete_user.py`` from outside the app)
+also bump a shared epoch file (``AUTH_CACHE_EPOCH_FILE``); every cache
+clears itself when it sees the file change, checking it at most every
+``AUTH_CACHE_EPOCH_CHECK`` seconds. Other workers pick up any other change
+within the TTL.
+
+Hits and misses are counted in :mod:`vpn_api.metrics` (``auth_cache_hits`` /
+``auth_cache_misses``).
+"""
+
+from __future__ import annotations
+
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from vpn_api import metrics
+
+# Max cached users per process; 0 disables the cache.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_EPOCH_FILE = os.getenv(
+    "AUTH_CACHE_EPOCH_FILE", os.path.join(tempfile.gettempdir(), "vpn-api-user-cache.epoch")
+)
+AUTH_CACHE_EPOCH_CHECK = float(os.getenv("AUTH_CACHE_EPOCH_CHECK", "1"))
+
+
+@dataclass(slots=True)
+class UserSnapshot:
+    """The ``users`` columns endpoints read from ``current_user``."""
+
+    id: int
+    email: str
+    status: str
+    is_admin: bool
+    is_verified: bool
+    google_id: Optional[str]
+    created_at: Optional[datetime]
+
+    @classmethod
+    def of(cls, user) -> UserSnapshot:
+        status = user.status
+        return cls(
+            id=user.id,
+            email=user.email,
+            status=status.value if hasattr(status, "value") else str(status),
+            is_admin=bool(user.is_admin),
+            is_verified=bool(user.is_verified),
+            google_id=user.google_id,
+            created_at=user.created_at,
+        )
+
+
+def _epoch() -> float:
+    try:
+        return os.stat(AUTH_CACHE_EPOCH_FILE).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def bump_epoch() -> None:
+    """Make every process clear its cache on its next epoch check."""
+    try:
+        with open(AUTH_CACHE_EPOCH_FILE, "a"):
+            pass
+        os.utime(AUTH_CACHE_EPOCH_FILE)
+    except OSError:
+        # no shared file: other workers rely on the TTL
+        pass
+
+
+class UserCache:
+    def __init__(self, size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[UserSnapshot, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = _epoch()
+        self._epoch_checked = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _check_epoch(self, now: float) -> None:
+        if now - self._epoch_checked < AUTH_CACHE_EPOCH_CHECK:
+            return
+        self._epoch_checked = now
+        epoch = _epoch()
+        if epoch != self._epoch:
+            self._epoch = epoch
+            self._items.clear()
+
+    def get(self, email: str) -> Optional[UserSnapshot]:
+        now = time.monotonic()
+        with self._lock:
+            self._check_epoch(now)
+            item = self._items.get(email)
+            if item is not None and item[1] > now:
+                self._items.move_to_end(email)
+                metrics.inc("auth_cache_hits")
+                return item[0]
+            if item is not None:
+                del self._items[email]
+        metrics.inc("auth_cache_misses")
+        return None
+
+    def put(self, user) -> UserSnapshot:
+        snapshot = UserSnapshot.of(user)
+        if self.size <= 0:
+            return snapshot
+        with self._lock:
+            self._items[snapshot.email] = (snapshot, time.monotonic() + self.ttl)
+            self._items.move_to_end(snapshot.email)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return snapshot
+
+    def discard(self, email: str) -> None:
+        with self._lock:
+            self._items.pop(email, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        hits = metrics.get("auth_cache_hits")
+        misses = metrics.get("auth_cache_misses")
+        total = hits + misses
+        return {
+            "size": len(self._items),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else None,
+        }
+
+
+_cache: Optional[UserCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_user_cache() -> UserCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                cache = UserCache()
+                metrics.register_gauge("auth_cache_size", cache.__len__)
+                _cache = cache
+    return _cache
+
+
+def enabled() -> bool:
+    return AUTH_CACHE_SIZE > 0
+
+
+def invalidate(email: Optional[str], everywhere: bool = False) -> None:
+    """Drop ``email`` from this process' cache (call after committing).
+
+    ``everywhere`` also bumps the epoch so every worker clears its cache; it
+    is meant for rare changes such as promotion or deletion, since a bump
+    empties the caches of all users.
+    """
+    if email:
+        get_user_cache().discard(email)
+    if everywhere:
+        bump_epoch()
@@ -6,7 +6,9 @@ This adapter exposes a small async API used by the rest of the project.
 from __future__ import annotations
 
 import asyncio
-from typing import TYPE_CHECKING, Optional
+import os
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Iterable, Optional
 
 if TYPE_CHECKING:
     # Import for type checkers only.
@@ -21,10 +23,141 @@ if TYPE_CHECKING:
 WgEasy = None
 
 
+class WgEasyHTTPError(RuntimeError):
+    """Non-2xx response from the wg-easy HTTP API; ``status`` holds the code."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def is_unauthorized(exc: BaseException) -> bool:
+    """Return True if ``exc`` (or anything it was raised from) is an HTTP 401."""
+    seen = set()
+    cur: Optional[BaseException] = exc
+    while cur is not None and id(cur) not in seen:
+        seen.add(id(cur))
+        if getattr(cur, "status", None) == 401:
+            return True
+        cur = cur.__cause__ or cur.__context__
+    return False
+
+
+# Seconds a full client listing stays authoritative for lookups by name/id.
+WG_EASY_INDEX_TTL = float(os.getenv("WG_EASY_INDEX_TTL", "30"))
+
+
+def _normalize_client(c) -> dict:
+    """Return ``{"id", "name", "publicKey"}`` plus traffic fields when present.
+
+    ``transferRx``/``transferTx``/``latestHandshakeAt`` are kept for the
+    telemetry collector.
+    """
+    get = c.get if isinstance(c, dict) else (lambda k, d=None: getattr(c, k, d))
+    out = {
+        "id": get("id") or (None if isinstance(c, dict) else get("uid")),
+        "name": get("name"),
+        "publicKey": get("publicKey") or get("public_key"),
+    }
+    for key, alt in (
+        ("transferRx", "transfer_rx"),
+        ("transferTx", "transfer_tx"),
+        ("latestHandshakeAt", "latest_handshake_at"),
+    ):
+        value = get(key)
+        if value is None:
+            value = get(alt)
+        if value is not None:
+            out[key] = value
+    return out
+
+
+class ClientIndex:
+    """name→clients and id→client maps of the controller's client list.
+
+    Our own creates and deletes update the maps in place; a full listing is
+    only fetched when the TTL expired or a lookup misses. Concurrent refreshes
+    share one in-flight listing.
+    """
+
+    def __init__(self, ttl: float = WG_EASY_INDEX_TTL):
+        self.ttl = ttl
+        self.by_name: dict[str, list[dict]] = {}
+        self.by_id: dict[str, dict] = {}
+        self.loaded_at: Optional[float] = None
+        self.refreshes = 0
+        self._inflight: Optional[asyncio.Future] = None
+
+    def fresh(self) -> bool:
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    def add(self, client: dict) -> None:
+        cid = client.get("id")
+        if cid is None:
+            return
+        old = self.by_id.get(cid)
+        if old is not None:
+            self.remove(cid)
+        self.by_id[cid] = client
+        self.by_name.setdefault(client.get("name"), []).append(client)
+
+    def remove(self, client_id) -> None:
+        client = self.by_id.pop(client_id, None)
+        if client is None:
+            return
+        same = self.by_name.get(client.get("name"), [])
+        same[:] = [c for c in same if c.get("id") != client_id]
+        if not same:
+            self.by_name.pop(client.get("name"), None)
+
+    def ids_for(self, name: str) -> set:
+        return {c.get("id") for c in self.by_name.get(name, ())}
+
+    def find(self, name: str, exclude: Iterable = ()) -> Optional[dict]:
+        """Return a client named ``name`` whose id is not in ``exclude``."""
+        exclude = set(exclude)
+        for c in self.by_name.get(name, ()):
+            if c.get("id") not in exclude:
+                return c
+        return None
+
+    def replace(self, clients: Iterable) -> None:
+        self.by_name = {}
+        self.by_id = {}
+        for c in clients:
+            self.add(_normalize_client(c))
+        self.loaded_at = time.monotonic()
+        self.refreshes += 1
+
+    async def refresh(self, fetch: Callable[[], Awaitable[Iterable]]) -> bool:
+        """Reload from ``fetch()``; callers arriving mid-refresh await the same listing.
+
+        Returns False when the call joined a listing that was already in
+        flight, which may predate changes the caller has just made.
+        """
+        if self._inflight is not None:
+            await asyncio.shield(self._inflight)
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight = fut
+        try:
+            self.replace(await fetch())
+            fut.set_result(None)
+            return True
+        except BaseException as exc:
+            fut.set_exception(exc)
+            # mark retrieved so an unawaited failure is not logged as unhandled
+            fut.exception()
+            raise
+        finally:
+            self._inflight = None
+
+
 class WgEasyAdapter:
     def __init__(self, url: str, password: str, session=None):
         self.url = url
         self.password = password
+        self.index = ClientIndex()
         # Optional external client instance. Use a non-specific object type
         # at runtime to avoid confusing the type checker when tests monkeypatch
         # the module-level `WgEasy` symbol.
@@ -79,6 +212,43 @@ class WgEasyAdapter:
 
             self._wg = None
 
+    async def _resolve_created(
+        self, name: str, known: set, created, fetch: Callable[[], Awaitable[Iterable]]
+    ) -> Optional[dict]:
+        """Turn a create response into ``{"id", "publicKey"}``.
+
+        The response body is used directly when the controller returns the new
+        client. Otherwise the client is looked up by name in the index, which is
+        refreshed (one listing, shared by concurrent creates) only on a miss.
+        A shared listing may have started before this create finished, so a
+        miss after joining one is retried with a listing of its own.
+        """
+        if created is not None and not isinstance(created, (str, bytes, bool)):
+            client = _normalize_client(created)
+            if client["id"] is not None and client["publicKey"]:
+                client["name"] = client["name"] or name
+                self.index.add(client)
+                return {"id": client["id"], "publicKey": client["publicKey"]}
+        client = self.index.find(name, known)
+        if client is None:
+            own = await self.index.refresh(fetch)
+            client = self.index.find(name, known)
+            if client is None and not own:
+                await self.index.refresh(fetch)
+                client = self.index.find(name, known)
+        if client is None:
+            return None
+        return {"id": client["id"], "publicKey": client["publicKey"]}
+
+    async def find_created(self, name: str, known: set) -> Optional[dict]:
+        """Return the client a create of ``name`` made, if it went through.
+
+        ``known`` holds the ids named ``name`` before the create; used to retry
+        a create interrupted by a 401 without duplicating the client.
+        """
+        assert self._wg is not None, "adapter not started (use async context)"
+        return await self._resolve_created(name, known, None, self._wg.get_clients)
+
     async def create_client(self, name: str) -> dict:  # noqa: C901
         """Create client and return server response (dict-like).
 
@@ -87,24 +257,22 @@ class WgEasyAdapter:
         """
         assert self._wg is not None, "adapter not started (use async context)"
 
+        known = self.index.ids_for(name)
         # Try using the underlying wrapper first (if available). If it fails
         # for any reason (network, server 500), fall back to a minimal HTTP
         # implementation that mirrors how the UI authenticates (POST /api/session
-        # then POST /api/wireguard/client).
+        # then POST /api/wireguard/client). Once the wrapper's create has
+        # succeeded the client exists, so a second POST would duplicate it.
         last_exc: Optional[Exception] = None
         try:
-            await self._wg.create_client(name)
-            # get last created client by listing all and finding name
-            clients = await self._wg.get_clients()
-            for c in clients:
-                if getattr(c, "name", None) == name:
-                    return {
-                        "id": getattr(c, "id", None) or getattr(c, "uid", None),
-                        "publicKey": getattr(c, "publicKey", None)
-                        or getattr(c, "public_key", None),
-                    }
+            created = await self._wg.create_client(name)
         except Exception as e:  # pragma: no cover - runtime fallback
             last_exc = e
+        else:
+            result = await self._resolve_created(name, known, created, self._wg.get_clients)
+            if result is None:
+                raise RuntimeError(f"wg-easy created client {name!r} but it is not listed")
+            return result
 
         # Fallback: perform minimal HTTP requests using aiohttp and ALWAYS
         # authenticate using the Authorization header. Cookie/session-based
@@ -115,7 +283,6 @@ class WgEasyAdapter:
         # header value (this mirrors how the UI server accepts raw password).
         try:
             import json as _json
-            import os
 
             import aiohttp
 
@@ -151,38 +318,36 @@ class WgEasyAdapter:
             create_url = f"{base}/api/wireguard/client"
             list_url = f"{base}/api/wireguard/client"
 
+            async def _create(sess):
+                status, text, _resp = await _post(
+                    sess, create_url, json_payload={"name": name}, headers=headers
+                )
+                if not 200 <= status < 300:
+                    return status, text, None
+
+                async def _list():
+                    _r_status, r_text, _r_resp = await _get(sess, list_url, headers=headers)
+                    return _json.loads(r_text)
+
+                try:
+                    body = _json.loads(text) if text else None
+                except ValueError:
+                    body = None
+                return status, text, await self._resolve_created(name, known, body, _list)
+
             if session is None:
                 # adapter creates and manages its own session
                 async with aiohttp.ClientSession() as sess:
-                    status, text, _resp = await _post(
-                        sess, create_url, json_payload={"name": name}, headers=headers
-                    )
-                    if 200 <= status < 300:
-                        _r_status, r_text, _r_resp = await _get(sess, list_url, headers=headers)
-                        clients = _json.loads(r_text)
-                        for c in clients:
-                            if c.get("name") == name:
-                                return {
-                                    "id": c.get("id"),
-                                    "publicKey": c.get("publicKey") or c.get("public_key"),
-                                }
+                    status, text, result = await _create(sess)
             else:
                 # use externally provided session; do not close it here
-                sess = session
-                status, text, _resp = await _post(
-                    sess, create_url, json_payload={"name": name}, headers=headers
-                )
-                if 200 <= status < 300:
-                    _r_status, r_text, _r_resp = await _get(sess, list_url, headers=headers)
-                    clients = _json.loads(r_text)
-                    for c in clients:
-                        if c.get("name") == name:
-                            return {
-                                "id": c.get("id"),
-                                "publicKey": c.get("publicKey") or c.get("public_key"),
-                            }
-
-            raise RuntimeError(f"wg-easy create client failed; last status={status}; body={text}")
+                status, text, result = await _create(session)
+            if result is not None:
+                return result
+
+            raise WgEasyHTTPError(
+                status, f"wg-easy create client failed; last status={status}; body={text}"
+            )
         except Exception:  # pragma: no cover - runtime fallback
             # Prefer original exception context if available
             if last_exc is not None:
@@ -192,7 +357,83 @@ class WgEasyAdapter:
     async def delete_client(self, client_id: str) -> None:
         assert self._wg is not None, "adapter not started (use async context)"
         await self._wg.delete_client(client_id)
+        self.index.remove(client_id)
+
+    async def set_client_enabled(self, client_id: str, enabled: bool) -> None:
+        """Enable or disable a client; a disabled client keeps its key and address.
+
+        Uses the wrapper when it supports it, otherwise a plain POST on
+        /api/wireguard/client/<id>/enable (or /disable) with the same
+        Authorization header as the create fallback.
+        """
+        assert self._wg is not None, "adapter not started (use async context)"
+        action = "enable" if enabled else "disable"
+        method = getattr(self._wg, f"{action}_client", None)
+        if method is not None:
+            await method(client_id)
+            return
+
+        import aiohttp
+
+        api_key = os.environ.get("WG_API_KEY")
+        headers = {"Authorization": api_key or self.password}
+        url = f"{self.url.rstrip('/')}/api/wireguard/client/{client_id}/{action}"
+
+        async def _post(sess):
+            resp = await sess.post(url, headers=headers)
+            if not 200 <= resp.status < 300:
+                raise WgEasyHTTPError(resp.status, f"wg-easy {action} failed: {resp.status}")
+
+        if self._session is not None:
+            await _post(self._session)
+            return
+        async with aiohttp.ClientSession() as sess:
+            await _post(sess)
+
+    async def get_client(self, client_id: str) -> Optional[dict]:
+        """Look up a client by id, listing the controller only when the index is stale."""
+        assert self._wg is not None, "adapter not started (use async context)"
+        if not self.index.fresh() or client_id not in self.index.by_id:
+            await self.index.refresh(self._wg.get_clients)
+        return self.index.by_id.get(client_id)
+
+    async def list_clients(self) -> list[dict]:
+        """Return every controller client as ``{"id", "name", "publicKey"}`` (fresh listing)."""
+        assert self._wg is not None, "adapter not started (use async context)"
+        await self.index.refresh(self._wg.get_clients)
+        return list(self.index.by_id.values())
+
+    async def relogin(self) -> None:
+        """Refresh the wrapper's login session (used after a 401)."""
+        assert self._wg is not None, "adapter not started (use async context)"
+        if hasattr(self._wg, "login"):
+            await self._wg.login()
 
     async def get_client_config(self, client_id: str) -> bytes:
+        """Return the wg-quick config for ``client_id``.
+
+        Uses the wrapper when it supports it, otherwise a plain GET on
+        /api/wireguard/client/<id>/configuration with the same Authorization
+        header as the create fallback.
+        """
         assert self._wg is not None, "adapter not started (use async context)"
-        return await self._wg.get_client_config(client_id)
+        if hasattr(self._wg, "get_client_config"):
+            return await self._wg.get_client_config(client_id)
+
+        import aiohttp
+
+        api_key = os.environ.get("WG_API_KEY")
+        headers = {"Authorization": api_key or self.password}
+        cfg_url = f"{self.url.rstrip('/')}/api/wireguard/client/{client_id}/configuration"
+
+        async def _fetch(sess):
+            resp = await sess.get(cfg_url, headers=headers)
+            body = await resp.read()
+            if not 200 <= resp.status < 300:
+                raise WgEasyHTTPError(resp.status, f"wg-easy config fetch failed: {resp.status}")
+            return body
+
+        if self._session is not None:
+            return await _fetch(self._session)
+        async with aiohttp.ClientSession() as sess:
+            return await _fetch(sess)
@@ -0,0 +1,187 @@
+"""Application-scoped pool of logged-in wg-easy adapters.
+
+Synchronous request handlers used to call ``asyncio.run`` per wg-easy
+operation, which created an event loop, an aiohttp session and a fresh
+login/logout every time. This module keeps one event loop on a daemon thread
+and one started :class:`~vpn_api.wg_easy_adapter.WgEasyAdapter` per
+(url, password), sharing a keep-alive ``aiohttp.ClientSession``. The login is
+reused until the controller answers 401, then refreshed once and the call is
+retried. Only idempotent operations are replayed as is; a create passes a
+``replay`` that first checks whether the interrupted call went through.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from vpn_api import metrics
+from vpn_api.wg_easy_adapter import WgEasyAdapter, is_unauthorized
+
+logger = logging.getLogger(__name__)
+
+# Max concurrent keep-alive connections to one controller.
+WG_EASY_POOL_SIZE = int(os.getenv("WG_EASY_POOL_SIZE", "16"))
+# Per-operation timeout in seconds for calls made through the pool.
+WG_EASY_TIMEOUT = float(os.getenv("WG_EASY_TIMEOUT", "15"))
+
+
+class WgEasyPool:
+    """Runs adapter operations on a shared loop thread with cached logins."""
+
+    def __init__(self, pool_size: int = WG_EASY_POOL_SIZE, timeout: float = WG_EASY_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._adapters: dict[tuple[str, str], WgEasyAdapter] = {}
+        self._sessions: dict[tuple[str, str], Any] = {}
+        self._adapter_lock: Optional[asyncio.Lock] = None
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def _run():
+                    asyncio.set_event_loop(loop)
+                    self._adapter_lock = asyncio.Lock()
+                    ready.set()
+                    loop.run_forever()
+
+                self._thread = threading.Thread(target=_run, name="wg-easy-loop", daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._loop = loop
+            return self._loop
+
+    async def _new_session(self):
+        try:
+            import aiohttp
+        except ImportError:  # pragma: no cover - aiohttp is a hard dependency
+            return None
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        return aiohttp.ClientSession(connector=connector)
+
+    async def _get_adapter(self, url: str, password: str) -> WgEasyAdapter:
+        key = (url, password)
+        adapter = self._adapters.get(key)
+        if adapter is not None:
+            return adapter
+        assert self._adapter_lock is not None
+        async with self._adapter_lock:
+            adapter = self._adapters.get(key)
+            if adapter is None:
+                session = await self._new_session()
+                adapter = WgEasyAdapter(url, password, session=session)
+                try:
+                    await adapter.__aenter__()
+                except BaseException:
+                    if session is not None:
+                        await session.close()
+                    raise
+                metrics.inc("wg_easy_logins")
+                self._sessions[key] = session
+                self._adapters[key] = adapter
+        return adapter
+
+    async def _call(
+        self,
+        url: str,
+        password: str,
+        op: Callable[[WgEasyAdapter], Awaitable],
+        replay: Optional[Callable[[WgEasyAdapter], Awaitable]],
+    ):
+        adapter = await self._get_adapter(url, password)
+        try:
+            return await op(adapter)
+        except Exception as exc:
+            if not is_unauthorized(exc):
+                raise
+            logger.info("wg-easy answered 401; re-authenticating")
+            metrics.inc("wg_easy_reauth")
+            await adapter.relogin()
+            return await (replay or op)(adapter)
+
+    def run(
+        self,
+        url: str,
+        password: str,
+        op: Callable[[WgEasyAdapter], Awaitable],
+        replay: Optional[Callable[[WgEasyAdapter], Awaitable]] = None,
+    ) -> Any:
+        """Run ``op(adapter)`` on the pool loop and block until it completes.
+
+        After a 401 the login is refreshed and ``replay(adapter)`` runs instead
+        (default: ``op`` again, fine for idempotent operations). ``op`` may have
+        taken effect before the 401, so a non-idempotent one must pass a
+        ``replay`` that checks for that first.
+        """
+        loop = self._ensure_loop()
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("WgEasyPool.run() must not be called from the pool loop thread")
+        start = time.perf_counter()
+        future = asyncio.run_coroutine_threadsafe(self._call(url, password, op, replay), loop)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+        finally:
+            metrics.inc("wg_easy_calls")
+            metrics.inc("wg_easy_call_seconds", time.perf_counter() - start)
+
+    async def _close_all(self) -> None:
+        for key, adapter in list(self._adapters.items()):
+            try:
+                await adapter.__aexit__(None, None, None)
+            except Exception:
+                logger.exception("failed to close wg-easy adapter")
+            session = self._sessions.pop(key, None)
+            if session is not None:
+                await session.close()
+        self._adapters.clear()
+
+    def close(self) -> None:
+        """Log out, close sessions and stop the loop thread."""
+        with self._start_lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_all(), loop).result(self.timeout)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            if thread is not None:
+                thread.join(self.timeout)
+            loop.close()
+
+
+_pool: Optional[WgEasyPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_wg_easy_pool() -> WgEasyPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = WgEasyPool()
+    return _pool
+
+
+def shutdown() -> None:
+    """Close the process-wide pool (called on application shutdown)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
@@ -1,9 +1,17 @@
+import argparse
+import functools
+import ipaddress
 import logging
 import os
+import re
 import shlex
 import subprocess
+import sys
+from dataclasses import dataclass, field
 from typing import Optional
 
+from vpn_api import ssh_pool
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,6 +21,8 @@ WG_INTERFACE = os.getenv("WG_INTERFACE", "wg0")
 WG_APPLY_SCRIPT = os.getenv("WG_APPLY_SCRIPT", "/app/scripts/wg_apply.sh")
 WG_REMOVE_SCRIPT = os.getenv("WG_REMOVE_SCRIPT", "/app/scripts/wg_remove.sh")
 WG_GEN_SCRIPT = os.getenv("WG_GEN_SCRIPT", "/app/scripts/wg_gen_key.sh")
+# wg binary used by reconcile (run through ``sudo`` on WG_HOST_SSH when set)
+WG_BINARY = os.getenv("WG_BINARY", "wg")
 
 
 def _build_ssh_cmd(remote: str, script: str, args: list[str]) -> list[str]:
@@ -22,6 +32,13 @@ def _build_ssh_cmd(remote: str, script: str, args: list[str]) -> list[str]:
     return cmd
 
 
+def _run(cmd: list[str], **kwargs) -> subprocess.CompletedProcess:
+    """Run ``cmd``; ssh commands go through the host's persistent control channel."""
+    if WG_HOST_SSH and ssh_pool.WG_SSH_MUX and cmd and cmd[0] == "ssh":
+        return ssh_pool.get_ssh_pool().run(WG_HOST_SSH, cmd, **kwargs)
+    return subprocess.run(cmd, **kwargs)
+
+
 def apply_peer(peer) -> bool:
     """Apply a peer to the WireGuard host. Returns True if the operation was attempted.
 
@@ -45,7 +62,7 @@ def apply_peer(peer) -> bool:
             cmd = [WG_APPLY_SCRIPT, iface, public or "", allowed]
 
         logger.info("Applying WireGuard peer on host: %s", cmd)
-        subprocess.run(cmd, check=True, capture_output=True)
+        _run(cmd, check=True, capture_output=True)
         logger.info("WireGuard peer applied successfully")
         return True
     except Exception as exc:
@@ -69,7 +86,7 @@ def remove_peer(peer) -> bool:
             cmd = [WG_REMOVE_SCRIPT, iface, public or ""]
 
         logger.info("Removing WireGuard peer on host: %s", cmd)
-        subprocess.run(cmd, check=True, capture_output=True)
+        _run(cmd, check=True, capture_output=True)
         logger.info("WireGuard peer removed successfully")
         return True
     except Exception as exc:
@@ -78,7 +95,7 @@ def remove_peer(peer) -> bool:
 
 
 def _run_and_capture(cmd: list[str]) -> tuple[int, str, str]:
-    proc = subprocess.run(cmd, capture_output=True, text=True)
+    proc = _run(cmd, capture_output=True, text=True)
     return proc.returncode, proc.stdout.strip(), proc.stderr.strip()
 
 
@@ -115,3 +132,357 @@ def generate_key_on_host(base_name: str, outdir: str = "/etc/wg-keys") -> Option
     except Exception as exc:
         logger.exception("Failed to generate key on host: %s", exc)
         return None
+
+
+# --- Batched reconciliation -------------------------------------------------
+#
+# apply_peer/remove_peer cost one SSH round trip (and one `wg show | grep` in
+# the helper script) per peer. reconcile() instead renders the whole desired
+# peer set from vpn_peers, diffs it against `wg show <iface> dump` and applies
+# the difference with a single `wg syncconf` (or one `wg set` with all peer
+# clauses), so any number of changes costs two wg invocations.
+#
+# On the server side a peer's AllowedIPs is its tunnel address (vpn_peers.wg_ip);
+# allowed_ips on the row is the client-side routing list and is not used here.
+
+
+@dataclass(slots=True)
+class HostPeer:
+    public_key: str
+    allowed_ips: str = ""
+    preshared_key: Optional[str] = None
+    endpoint: Optional[str] = None
+    latest_handshake: int = 0
+    rx_bytes: int = 0
+    tx_bytes: int = 0
+
+
+@dataclass
+class InterfaceState:
+    private_key: Optional[str] = None
+    listen_port: Optional[str] = None
+    fwmark: Optional[str] = None
+    peers: dict[str, HostPeer] = field(default_factory=dict)
+
+
+@dataclass
+class PeerDiff:
+    add: dict[str, str] = field(default_factory=dict)
+    remove: list[str] = field(default_factory=list)
+    update: dict[str, tuple[str, str]] = field(default_factory=dict)
+
+    @property
+    def empty(self) -> bool:
+        return not (self.add or self.remove or self.update)
+
+    def lines(self) -> list[str]:
+        out = [f"+ {pub} {allowed}" for pub, allowed in sorted(self.add.items())]
+        out += [f"- {pub}" for pub in sorted(self.remove)]
+        out += [f"~ {pub} {old} -> {new}" for pub, (old, new) in sorted(self.update.items())]
+        return out
+
+    def summary(self) -> str:
+        return f"add={len(self.add)} remove={len(self.remove)} update={len(self.update)}"
+
+
+def _none(value: str) -> Optional[str]:
+    return None if value in ("(none)", "off", "") else value
+
+
+def parse_dump(text: str) -> InterfaceState:
+    """Parse ``wg show <iface> dump`` output.
+
+    The first line describes the interface (private key, public key, listen
+    port, fwmark); every following line is a peer (public key, preshared key,
+    endpoint, allowed ips, latest handshake, rx, tx, keepalive), tab separated.
+    """
+    state = InterfaceState()
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return state
+    head = lines[0].split("\t")
+    if len(head) >= 4:
+        state.private_key = _none(head[0])
+        state.listen_port = _none(head[2])
+        state.fwmark = _none(head[3])
+    for line in lines[1:]:
+        cols = line.split("\t")
+        if len(cols) < 8:
+            logger.warning("skipping malformed wg dump line: %r", line)
+            continue
+        # inlined (no _none calls): this loop runs for every peer on every
+        # reconcile/telemetry cycle
+        pub, psk, endpoint, allowed = cols[0], cols[1], cols[2], cols[3]
+        state.peers[pub] = HostPeer(
+            pub,
+            "" if allowed == "(none)" else allowed,
+            None if psk == "(none)" else psk,
+            None if endpoint == "(none)" else endpoint,
+            int(cols[4] or 0),
+            int(cols[5] or 0),
+            int(cols[6] or 0),
+        )
+    return state
+
+
+def parse_all_dump(text: str) -> dict[str, InterfaceState]:
+    """Parse ``wg show all dump``: the same columns prefixed by the interface name."""
+    states: dict[str, InterfaceState] = {}
+    for line in text.splitlines():
+        cols = line.split("\t")
+        if len(cols) == 5:
+            state = states.setdefault(cols[0], InterfaceState())
+            state.private_key = None if cols[1] == "(none)" else cols[1]
+            state.listen_port = None if cols[3] in ("(none)", "off") else cols[3]
+            state.fwmark = None if cols[4] in ("(none)", "off") else cols[4]
+        elif len(cols) == 9:
+            peers = states.setdefault(cols[0], InterfaceState()).peers
+            pub, psk, endpoint, allowed = cols[1], cols[2], cols[3], cols[4]
+            peers[pub] = HostPeer(
+                pub,
+                "" if allowed == "(none)" else allowed,
+                None if psk == "(none)" else psk,
+                None if endpoint == "(none)" else endpoint,
+                int(cols[5] or 0),
+                int(cols[6] or 0),
+                int(cols[7] or 0),
+            )
+        elif line.strip():
+            logger.warning("skipping malformed wg dump line: %r", line)
+    return states
+
+
+# canonical single IPv4 host route, e.g. "10.8.0.2/32" (no leading zeros)
+_CANONICAL_HOST = re.compile(
+    r"^(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)/32$"
+)
+
+
+@functools.lru_cache(maxsize=1 << 17)
+def _normalize_ips(value: Optional[str]) -> str:
+    # cached, and the common "a.b.c.d/32" skips ipaddress parsing: the same
+    # address strings are compared for every peer on every reconcile cycle
+    if value and _CANONICAL_HOST.match(value):
+        return value
+    nets = []
+    for part in (value or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            nets.append(ipaddress.ip_network(part, strict=False))
+        except ValueError:
+            nets.append(part)
+    return ",".join(sorted(str(n) for n in nets))
+
+
+def _wg_cmd(args: list[str]) -> list[str]:
+    if WG_HOST_SSH:
+        remote_args = " ".join(shlex.quote(a) for a in [WG_BINARY, *args])
+        return ["ssh", WG_HOST_SSH, f"sudo {remote_args}"]
+    return [WG_BINARY, *args]
+
+
+def read_interface(iface: Optional[str] = None) -> InterfaceState:
+    """Return the live state of ``iface`` (one ``wg show dump`` call)."""
+    cmd = _wg_cmd(["show", iface or WG_INTERFACE, "dump"])
+    proc = _run(cmd, capture_output=True, text=True, check=True)
+    return parse_dump(proc.stdout)
+
+
+def read_all() -> dict[str, InterfaceState]:
+    """Return the live state of every interface (one ``wg show all dump`` call)."""
+    proc = _run(_wg_cmd(["show", "all", "dump"]), capture_output=True, text=True, check=True)
+    return parse_all_dump(proc.stdout)
+
+
+def desired_peers(db) -> dict[str, str]:
+    """Map public key -> server-side AllowedIPs for every active, non-parked peer in the DB."""
+    from vpn_api import models
+
+    rows = (
+        db.query(models.VpnPeer.wg_public_key, models.VpnPeer.wg_ip)
+        .filter(models.VpnPeer.active.is_(True), models.VpnPeer.idle_since.is_(None))
+        .yield_per(10000)
+    )
+    return {pub: _normalize_ips(ip) for pub, ip in rows if pub and ip}
+
+
+def _reserved_ranges() -> list[tuple[int, int]]:
+    from vpn_api import ipam
+
+    ranges = []
+    for first, last in ipam.parse_ranges(ipam.WG_IP_RESERVED):
+        try:
+            ranges.append((int(ipaddress.ip_address(first)), int(ipaddress.ip_address(last))))
+        except ValueError:
+            continue
+    return ranges
+
+
+def _is_unmanaged(peer: HostPeer, reserved: list[tuple[int, int]]) -> bool:
+    """Tell whether every address of ``peer`` lies in WG_IP_RESERVED (manual clients)."""
+    nets = [n for n in _normalize_ips(peer.allowed_ips).split(",") if n]
+    if not nets:
+        return False
+    for net in nets:
+        try:
+            network = ipaddress.ip_network(net, strict=False)
+        except ValueError:
+            return False
+        lo, hi = int(network.network_address), int(network.broadcast_address)
+        if not any(first <= lo and hi <= last for first, last in reserved):
+            return False
+    return True
+
+
+def compute_diff(desired: dict[str, str], state: InterfaceState, prune: bool = True) -> PeerDiff:
+    """Diff the desired peer set against the live interface.
+
+    Live peers that are not in ``desired`` are removed only when ``prune`` is
+    set, and never if they sit entirely inside WG_IP_RESERVED.
+    """
+    diff = PeerDiff()
+    for pub, allowed in desired.items():
+        live = state.peers.get(pub)
+        if live is None:
+            diff.add[pub] = allowed
+        elif _normalize_ips(live.allowed_ips) != allowed:
+            diff.update[pub] = (_normalize_ips(live.allowed_ips), allowed)
+    if prune:
+        reserved = _reserved_ranges()
+        for pub, live in state.peers.items():
+            if pub not in desired and not _is_unmanaged(live, reserved):
+                diff.remove.append(pub)
+    return diff
+
+
+def _target_peers(state: InterfaceState, diff: PeerDiff) -> dict[str, tuple[str, Optional[str]]]:
+    """Public key -> (allowed ips, preshared key) after ``diff`` is applied."""
+    removed = set(diff.remove)
+    peers = {
+        pub: (live.allowed_ips, live.preshared_key)
+        for pub, live in state.peers.items()
+        if pub not in removed
+    }
+    for pub, (_old, new) in diff.update.items():
+        peers[pub] = (new, peers.get(pub, ("", None))[1])
+    for pub, allowed in diff.add.items():
+        peers[pub] = (allowed, None)
+    return peers
+
+
+def render_config(state: InterfaceState, diff: PeerDiff) -> str:
+    """Render a ``wg syncconf`` config: the live interface with ``diff`` applied."""
+    lines = ["[Interface]"]
+    if state.private_key:
+        lines.append(f"PrivateKey = {state.private_key}")
+    if state.listen_port:
+        lines.append(f"ListenPort = {state.listen_port}")
+    if state.fwmark:
+        lines.append(f"FwMark = {state.fwmark}")
+    for pub, (allowed, psk) in _target_peers(state, diff).items():
+        lines += ["", "[Peer]", f"PublicKey = {pub}"]
+        if psk:
+            lines.append(f"PresharedKey = {psk}")
+        if allowed:
+            lines.append(f"AllowedIPs = {allowed}")
+    return "\n".join(lines) + "\n"
+
+
+def _set_args(iface: str, diff: PeerDiff) -> list[str]:
+    args = ["set", iface]
+    for pub in diff.remove:
+        args += ["peer", pub, "remove"]
+    for pub, (_old, new) in diff.update.items():
+        args += ["peer", pub, "allowed-ips", new]
+    for pub, allowed in diff.add.items():
+        args += ["peer", pub, "allowed-ips", allowed]
+    return args
+
+
+def apply_diff(
+    diff: PeerDiff, state: InterfaceState, iface: Optional[str] = None, method: str = "syncconf"
+) -> None:
+    """Apply ``diff`` in a single wg invocation.
+
+    ``syncconf`` streams the full rendered config on stdin, so the command
+    line stays small for any number of peers; ``set`` passes every change as
+    arguments of one ``wg set`` (fine for small diffs, bounded by ARG_MAX).
+    """
+    if diff.empty:
+        return
+    iface = iface or WG_INTERFACE
+    if method == "set":
+        _run(_wg_cmd(_set_args(iface, diff)), text=True, check=True, capture_output=True)
+    elif method == "syncconf":
+        _run(
+            _wg_cmd(["syncconf", iface, "/dev/stdin"]),
+            input=render_config(state, diff),
+            text=True,
+            check=True,
+            capture_output=True,
+        )
+    else:
+        raise ValueError(f"unknown reconcile method: {method}")
+
+
+def reconcile(
+    db,
+    iface: Optional[str] = None,
+    dry_run: bool = False,
+    prune: bool = True,
+    method: str = "syncconf",
+) -> PeerDiff:
+    """Bring ``iface`` in line with the active peers in ``vpn_peers``.
+
+    Unlike apply_peer/remove_peer this does not look at WG_APPLY_ENABLED: it
+    is an explicit operator action (see the CLI below).
+    """
+    state = read_interface(iface)
+    diff = compute_diff(desired_peers(db), state, prune=prune)
+    logger.info("[WG_RECONCILE] %s%s", diff.summary(), " (dry run)" if dry_run else "")
+    if not dry_run:
+        apply_diff(diff, state, iface, method)
+    return diff
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m vpn_api.wg_host",
+        description="Reconcile the WireGuard interface with vpn_peers in one wg call.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("reconcile", help="apply the DB peer set to the interface")
+    rec.add_argument("--iface", default=None, help=f"interface (default {WG_INTERFACE})")
+    rec.add_argument("--dry-run", action="store_true", help="print the diff, change nothing")
+    rec.add_argument(
+        "--no-prune", action="store_true", help="keep live peers that are not in the DB"
+    )
+    rec.add_argument("--method", choices=("syncconf", "set"), default="syncconf")
+    args = parser.parse_args(argv)
+
+    from vpn_api.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        diff = reconcile(
+            db,
+            iface=args.iface,
+            dry_run=args.dry_run,
+            prune=not args.no_prune,
+            method=args.method,
+        )
+    except subprocess.CalledProcessError as exc:
+        print(f"wg failed ({exc.returncode}): {(exc.stderr or '').strip()}", file=sys.stderr)
+        return 1
+    finally:
+        db.close()
+    for line in diff.lines():
+        print(line)
+    print(diff.summary() + (" (dry run)" if args.dry_run else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())